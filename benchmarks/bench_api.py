@@ -0,0 +1,82 @@
+"""
+Time and peak memory to dump the whole catalog from the json api, as one json document
+and as ndjson, against building the same document as a list first.
+
+    python benchmarks/bench_api.py [--songs 20000] [--verses 5]
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from bench_delta import lyrics  # noqa: E402
+
+
+def make_catalog(db, songs: int, verses: int) -> None:
+    from prayer_of_hannah.models import Author, Song, Song_Book, Song_Book_Item, Verse, VerseType
+    with db.write_session() as session:
+        book = Song_Book(code="StF", name="Singing the Faith")
+        for n in range(songs):
+            item = Song_Book_Item(song_book=book, nbr=n % 9999 + 1, verse_order="",
+                                  song=Song(title=f"Hymn {n}", authors=[Author(surname=f"Author{n}", first_names="A")]))
+            session.add_all([Verse(type=VerseType.VERSE, number=v, lyrics=lyrics(n * 10 + v), song_book_item=item)
+                             for v in range(1, verses + 1)])
+            if n % 2000 == 1999:
+                session.commit()
+        session.commit()
+
+
+def measure(chunks) -> tuple[float, int, int]:
+    """seconds, bytes and peak bytes allocated to produce chunks (traced in a second run, tracing is slow)"""
+    start: float = time.perf_counter()
+    sent: int = sum(len(chunk) for chunk in chunks())
+    took: float = time.perf_counter() - start
+    tracemalloc.start()
+    sum(len(chunk) for chunk in chunks())
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return took, sent, peak
+
+
+def main() -> None:
+    from prayer_of_hannah.api import catalog
+    from prayer_of_hannah.dbms import Dbms
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--songs', type=int, default=20000)
+    parser.add_argument('--verses', type=int, default=5)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        db_file: str = os.path.join(directory, 'api.sqlite')
+        db = Dbms(False, 'sqlite:///' + db_file, db_file)
+        db.create_database_structure()
+        make_catalog(db, args.songs, args.verses)
+        resources: list[str] = list(catalog.RESOURCES)
+
+        def listed():
+            with db.engine.connect() as connection:
+                document: dict = {'version': catalog.version(connection)}
+                for name in resources:
+                    document[name] = {'rows': list(catalog.rows(connection, catalog.RESOURCES[name]))}
+            yield json.dumps(document).encode()
+
+        print(f"{args.songs} songs, {args.songs * args.verses} verses, "
+              f"serialiser: {'orjson' if 'orjson' in sys.modules else 'json'}")
+        print(f"{'':<10}{'seconds':>9}{'MB sent':>9}{'peak MB':>9}")
+        for name, chunks in (('list', listed),
+                             ('json', lambda: catalog.buffered(catalog.stream_json(db.engine, resources))),
+                             ('ndjson', lambda: catalog.buffered(catalog.stream_ndjson(db.engine, resources)))):
+            took, sent, peak = measure(chunks)
+            print(f"{name:<10}{took:>9.2f}{sent / 1e6:>9.1f}{peak / 1e6:>9.1f}")
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+"""
+Throughput of the same routes under the Flask (werkzeug) dev server and under the
+ASGI app with uvicorn workers.
+
+    python benchmarks/bench_asgi.py [--songs 500] [--seconds 5] [--clients 32] [--workers <cpus>]
+"""
+import argparse
+import http.client
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+ROUTES = ['/', '/songs/', '/songs/htmx/songs', '/songs/htmx/search?q=grace']
+
+
+def make_database(db_file: str, songs: int) -> None:
+    from prayer_of_hannah.dbms import Dbms
+    from prayer_of_hannah.models import Author, Song, Song_Book, Song_Book_Item
+    db = Dbms(False, 'sqlite:///' + db_file, db_file)
+    db.create_database_structure()
+    with db.write_session() as session:
+        book = Song_Book(code="StF", name="Singing the Faith")
+        for n in range(songs):
+            song = Song(title=f"Amazing grace number {n}", authors=[Author(surname=f"Author{n}", first_names="A")])
+            session.add(Song_Book_Item(song_book=book, song=song, nbr=n + 1, verse_order="v1"))
+        session.commit()
+    db.close()
+
+
+def wait_for(port: int, timeout: float = 20) -> None:
+    end: float = time.monotonic() + timeout
+    while time.monotonic() < end:
+        try:
+            con = http.client.HTTPConnection('127.0.0.1', port, timeout=1)
+            con.request('GET', '/songs/')
+            con.getresponse().read()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError(f"Server on port {port} did not start")
+
+
+def load(port: int, path: str, seconds: float, clients: int) -> float:
+    """Requests per second from clients keep-alive connections hammering path, failures don't count"""
+    counts: list[int] = [0] * clients
+    end: float = time.monotonic() + seconds
+
+    def client(i: int) -> None:
+        con = http.client.HTTPConnection('127.0.0.1', port, timeout=seconds)
+        while time.monotonic() < end:
+            try:
+                con.request('GET', path)
+                response = con.getresponse()
+                response.read()
+            except OSError:
+                con.close()
+                continue
+            if response.status == 200:
+                counts[i] += 1
+        con.close()
+
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(clients)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return sum(counts) / seconds
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--songs', type=int, default=500)
+    parser.add_argument('--seconds', type=float, default=5)
+    parser.add_argument('--clients', type=int, default=32)
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db_file: str = os.path.join(tmp, 'bench.sqlite')
+        make_database(db_file, args.songs)
+        env: dict = dict(os.environ, DATABASE_FILE=db_file, PYTHONPATH=ROOT)
+        servers: dict[str, list[str]] = {
+            'wsgi dev server': [sys.executable, '-c',
+                                'from prayer_of_hannah import create_app; '
+                                'create_app().run(port=8701, threaded=True)'],
+            f'asgi uvicorn x{args.workers}': [sys.executable, '-m', 'uvicorn', 'prayer_of_hannah.asgi:app',
+                                              '--port', '8702', '--workers', str(args.workers),
+                                              '--log-level', 'warning', '--no-access-log'],
+        }
+        results: dict[str, dict[str, float]] = {}
+        for port, (name, command) in enumerate(servers.items(), start=8701):
+            server = subprocess.Popen(command, cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            try:
+                wait_for(port)
+                results[name] = {path: load(port, path, args.seconds, args.clients) for path in ROUTES}
+            finally:
+                server.terminate()
+                server.wait()
+
+    names: list[str] = list(results)
+    print(f"{'route':32}" + "".join(f"{n:>22}" for n in names) + " (requests/second)")
+    for path in ROUTES:
+        print(f"{path:32}" + "".join(f"{results[n][path]:22.0f}" for n in names))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+"""
+Bytes a client downloads to catch up with typical last minute edits to a service,
+the whole bundle (plain and gzipped) against the delta from the version it holds.
+
+    python benchmarks/bench_delta.py [--hymns 6] [--verses 5]
+"""
+import argparse
+import gzip
+import os
+import random
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+WORDS = ("love divine all loves excelling joy of heaven to earth come down fix in us thy humble dwelling "
+         "faithful mercies crown jesu thou art compassion pure unbounded visit with salvation enter every "
+         "trembling heart breathe loving spirit into troubled breast let find promised rest").split()
+
+
+def lyrics(seed: int) -> str:
+    """Eight lines of hymn-like text, different for every verse as real lyrics are"""
+    rng = random.Random(seed)
+    return "<br>".join(" ".join(rng.choice(WORDS) for _ in range(6)) for _ in range(8))
+
+
+def make_service(db, hymns: int, verses: int) -> None:
+    from prayer_of_hannah.models import Service, Service_Item, Song, Song_Book, Song_Book_Item, Verse, VerseType
+    with db.write_session() as session:
+        book = Song_Book(code="StF", name="Singing the Faith")
+        service = Service(name="Sunday Morning")
+        session.add(service)
+        for n in range(1, hymns + 2):
+            item = Song_Book_Item(song_book=book, song=Song(title=f"Hymn {n}", authors=[]), nbr=n,
+                                  verse_order=" ".join(f"v{v} c1" for v in range(1, verses + 1)))
+            session.add(Verse(type=VerseType.CHORUS, number=1, lyrics=lyrics(n * 100), song_book_item=item))
+            session.add_all([Verse(type=VerseType.VERSE, number=v, lyrics=lyrics(n * 100 + v), song_book_item=item)
+                             for v in range(1, verses + 1)])
+            # the last hymn is the replacement for the swap edit
+            if n <= hymns:
+                session.add(Service_Item(service=service, position=n, song_book_item=item))
+        session.commit()
+
+
+def main() -> None:
+    from prayer_of_hannah.dbms import Dbms
+    from prayer_of_hannah.models import Service_Item
+    from prayer_of_hannah.services import decks, delta
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--hymns', type=int, default=6)
+    parser.add_argument('--verses', type=int, default=5)
+    args = parser.parse_args()
+
+    db = Dbms(True)
+    db.create_database_structure()
+    make_service(db, args.hymns, args.verses)
+
+    def edit(position: int, **changes):
+        with db.write_session() as session:
+            item = session.get(Service_Item, position)
+            if changes.pop('drop', False):
+                session.delete(item)
+            for name, value in changes.items():
+                setattr(item, name, value)
+            session.commit()
+            return decks.finalise_service(session, 1)
+
+    with db.write_session() as session:
+        current = decks.finalise_service(session, 1)
+    edits = [
+        ("drop a verse", dict(position=2, verse_order=" ".join(f"v{v} c1" for v in range(1, args.verses)))),
+        ("reorder verses", dict(position=3, verse_order="v2 c1 v1 c1")),
+        ("swap a hymn", dict(position=4, song_book_item_id=args.hymns + 1)),
+        ("drop the first hymn", dict(position=1, drop=True)),
+    ]
+    print(f"{'edit':<22}{'slides':>8}{'bundle':>10}{'gzipped':>10}{'delta':>8}")
+    for name, changes in edits:
+        new = edit(**changes)
+        delta_gz: bytes = delta.encode_delta(current, new)
+        assert delta.rebuild_deck(current.bundle, delta_gz) == new.bundle
+        slides: int = new.bundle.count(b'"verse"')
+        print(f"{name:<22}{slides:>8}{len(new.bundle):>10}{len(gzip.compress(new.bundle)):>10}{len(delta_gz):>8}")
+        current = new
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+"""
+Concurrent media streaming throughput: many tablets streaming the same recording with
+range requests, from the Flask route under the werkzeug dev server and from the native
+ASGI media app under uvicorn.
+
+    python benchmarks/bench_media.py [--mb 32] [--seconds 3] [--clients 1 8 32] [--range-kb 1024]
+"""
+import argparse
+import http.client
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from bench_asgi import wait_for  # noqa: E402
+
+
+def make_database(db_file: str, media_dir: str, mb: int) -> str:
+    from config import Config
+    from prayer_of_hannah.dbms import Dbms
+    from prayer_of_hannah.media import store
+    from prayer_of_hannah.models import MediaType, Song, Song_Book, Song_Book_Item
+    Config.MEDIA_DIR = media_dir
+    db = Dbms(False, 'sqlite:///' + db_file, db_file)
+    db.create_database_structure()
+    recording: str = os.path.join(os.path.dirname(db_file), 'recording.mp3')
+    with open(recording, 'wb') as f:
+        f.write(os.urandom(mb * 1024 * 1024))
+    with db.write_session() as session:
+        session.add(Song_Book_Item(song_book=Song_Book(code="StF", name="Singing the Faith"),
+                                   song=Song(title="And Can It Be", authors=[]), nbr=345, verse_order=""))
+        session.commit()
+        content_hash: str = store.add_media(session, 1, MediaType.AUDIO_WITH_SINGING, recording).content_hash
+    db.close()
+    return content_hash
+
+
+def stream(port: int, path: str, size: int, seconds: float, clients: int, range_bytes: int) -> float:
+    """MB per second received by clients each reading the file range by range, round and round"""
+    received: list[int] = [0] * clients
+    end: float = time.monotonic() + seconds
+
+    def client(i: int) -> None:
+        con = http.client.HTTPConnection('127.0.0.1', port, timeout=seconds + 5)
+        offset: int = (i * range_bytes) % size
+        while time.monotonic() < end:
+            last: int = min(offset + range_bytes, size) - 1
+            try:
+                con.request('GET', path, headers={'Range': f'bytes={offset}-{last}'})
+                response = con.getresponse()
+                received[i] += len(response.read())
+            except OSError:
+                con.close()
+                continue
+            offset = (last + 1) % size
+        con.close()
+
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(clients)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return sum(received) / seconds / (1024 * 1024)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--mb', type=int, default=32)
+    parser.add_argument('--seconds', type=float, default=3)
+    parser.add_argument('--clients', type=int, nargs='+', default=[1, 8, 32])
+    parser.add_argument('--range-kb', type=int, default=1024)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db_file: str = os.path.join(tmp, 'bench.sqlite')
+        media_dir: str = os.path.join(tmp, 'media')
+        content_hash: str = make_database(db_file, media_dir, args.mb)
+        env: dict = dict(os.environ, DATABASE_FILE=db_file, MEDIA_DIR=media_dir, PYTHONPATH=ROOT)
+        servers: dict[str, list[str]] = {
+            'flask send_file (werkzeug)': [sys.executable, '-c',
+                                           'from prayer_of_hannah import create_app; '
+                                           'create_app().run(port=8721, threaded=True)'],
+            'asgi media_app (uvicorn)': [sys.executable, '-m', 'uvicorn', 'prayer_of_hannah.asgi:app',
+                                         '--port', '8722', '--log-level', 'warning', '--no-access-log'],
+        }
+        results: dict[str, dict[int, float]] = {}
+        for port, (name, command) in enumerate(servers.items(), start=8721):
+            server = subprocess.Popen(command, cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            try:
+                wait_for(port)
+                results[name] = {clients: stream(port, f'/media/{content_hash}', args.mb * 1024 * 1024,
+                                                 args.seconds, clients, args.range_kb * 1024)
+                                 for clients in args.clients}
+            finally:
+                server.terminate()
+                server.wait()
+
+    names: list[str] = list(results)
+    print(f"{'clients':>8}" + "".join(f"{n:>30}" for n in names) + " (MB/s)")
+    for clients in args.clients:
+        print(f"{clients:>8}" + "".join(f"{results[n][clients]:30.0f}" for n in names))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,130 @@
+"""
+Keypress to display latency of the presenter protocol on the local machine: the
+operator posts the new slide index, the server confirms it and broadcasts it over
+server-sent events and every display swaps in the slide from its buffer. Measures the
+operator's confirmation round trip and the time until each display has the event.
+
+    python benchmarks/bench_presenter.py [--displays 20] [--presses 200] [--budget-ms 50] [--workers 2]
+"""
+import argparse
+import http.client
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from bench_asgi import wait_for  # noqa: E402
+from bench_delta import make_service  # noqa: E402
+
+PORT = 8711
+
+
+def make_database(db_file: str) -> None:
+    from prayer_of_hannah.dbms import Dbms
+    db = Dbms(False, 'sqlite:///' + db_file, db_file)
+    db.create_database_structure()
+    make_service(db, 6, 5)
+    db.close()
+
+
+def request(con: http.client.HTTPConnection, method: str, path: str, body: dict | None = None) -> dict:
+    con.request(method, path, body=json.dumps(body) if body is not None else None,
+                headers={'Content-Type': 'application/json'})
+    return json.loads(con.getresponse().read())
+
+
+class Display(threading.Thread):
+    """An SSE client recording when each slide event arrived"""
+    def __init__(self, service_id: int) -> None:
+        super().__init__(daemon=True)
+        self.service_id = service_id
+        self.received: dict[int, float] = {}
+        self.connected = threading.Event()
+
+    def run(self) -> None:
+        con = http.client.HTTPConnection('127.0.0.1', PORT)
+        con.request('GET', f'/live/{self.service_id}/events')
+        response = con.getresponse()
+        self.connected.set()
+        event_id: int = 0
+        while True:
+            line: bytes = response.fp.readline()
+            if not line:
+                return
+            if line.startswith(b'id: '):
+                event_id = int(line[4:])
+            elif line.startswith(b'data: ') and event_id:
+                self.received[event_id] = time.perf_counter()
+
+
+def percentile(values: list[float], p: float) -> float:
+    return sorted(values)[min(int(len(values) * p), len(values) - 1)]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--displays', type=int, default=20)
+    parser.add_argument('--presses', type=int, default=200)
+    parser.add_argument('--budget-ms', type=float, default=50)
+    parser.add_argument('--workers', type=int, default=2)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db_file: str = os.path.join(tmp, 'bench.sqlite')
+        make_database(db_file)
+        env: dict = dict(os.environ, DATABASE_FILE=db_file, PYTHONPATH=ROOT)
+        # the operator's moves reach displays held by the other worker through the database
+        server = subprocess.Popen([sys.executable, '-m', 'uvicorn', 'prayer_of_hannah.asgi:app', '--port', str(PORT),
+                                   '--workers', str(args.workers), '--log-level', 'warning', '--no-access-log'],
+                                  cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            wait_for(PORT)
+            operator = http.client.HTTPConnection('127.0.0.1', PORT)
+            request(operator, 'POST', '/services/1/finalise')
+            deck_hash: str = request(operator, 'POST', '/services/1/prewarm')['hash']
+            displays: list[Display] = [Display(1) for _ in range(args.displays)]
+            for display in displays:
+                display.start()
+                display.connected.wait(5)
+            time.sleep(0.5)
+
+            confirm: list[float] = []
+            shown: list[float] = []
+            count: int = request(operator, 'GET', '/live/1/position')['count']
+            for press in range(args.presses):
+                pressed: float = time.perf_counter()
+                position: dict = request(operator, 'POST', '/live/1/slide', {'index': press % count, 'hash': deck_hash})
+                confirm.append(time.perf_counter() - pressed)
+                deadline: float = time.perf_counter() + 5
+                while (any(position['id'] not in d.received for d in displays)
+                       and time.perf_counter() < deadline):
+                    time.sleep(0.0002)
+                shown.extend(d.received[position['id']] - pressed for d in displays if position['id'] in d.received)
+        finally:
+            server.terminate()
+            try:
+                server.wait(5)
+            except subprocess.TimeoutExpired:
+                # still waiting for the displays' event streams to close
+                server.kill()
+                server.wait()
+
+    for name, values in [("operator confirmed", confirm), ("display has slide", shown)]:
+        ms: list[float] = [v * 1000 for v in values]
+        print(f"{name:20} median {statistics.median(ms):6.2f} ms  p95 {percentile(ms, 0.95):6.2f} ms  "
+              f"max {max(ms):6.2f} ms  ({len(ms)} samples)")
+    median_ms: float = statistics.median(shown) * 1000
+    print(f"median keypress to display {'within' if median_ms < args.budget_ms else 'OVER'} "
+          f"the {args.budget_ms:.0f} ms budget")
+    sys.exit(0 if median_ms < args.budget_ms else 1)
+
+
+if __name__ == '__main__':
+    main()
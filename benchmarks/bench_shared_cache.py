@@ -0,0 +1,93 @@
+"""
+Hit latency of the shared cache (one SQLite file for every worker, see
+prayer_of_hannah/shared_cache.py) against a worker's own dict and LruCache, for a
+rendered slide and a catalog page sized value, and the hits per second of several
+worker processes reading it at once.
+
+    python benchmarks/bench_shared_cache.py [--entries 2000] [--gets 20000] [--workers 4]
+"""
+import argparse
+import multiprocessing
+import os
+import random
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+SIZES = {'slide': 2 * 1024, 'catalog page': 200 * 1024}
+
+
+def per_get(get, keys: list[str]) -> float:
+    """Microseconds per get"""
+    started: float = time.perf_counter()
+    for key in keys:
+        get(key)
+    return (time.perf_counter() - started) / len(keys) * 1e6
+
+
+def _worker(path: str, keys: list[str], seconds: float, results) -> None:
+    from prayer_of_hannah.shared_cache import SharedCache
+    cache = SharedCache(path, 1 << 30)
+    gets: int = 0
+    end: float = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        for key in keys:
+            assert cache.get('bench', key) is not None
+        gets += 100
+    results.put(gets)
+
+
+def main() -> None:
+    from prayer_of_hannah.lru import LruCache
+    from prayer_of_hannah.shared_cache import SharedCache
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--entries', type=int, default=2000)
+    parser.add_argument('--gets', type=int, default=20000)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--seconds', type=float, default=2.0)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        print(f"{'us per get':<24}{'dict':>10}{'LruCache':>10}{'shared':>10}{'miss':>10}{'put':>10}")
+        for name, size in SIZES.items():
+            path: str = os.path.join(directory, name.replace(' ', '_') + '.cache')
+            # at most 64MB of each
+            entries: int = min(args.entries, (64 << 20) // size)
+            shared = SharedCache(path, 1 << 30)
+            own: dict[str, bytes] = {}
+            lru: LruCache[str, bytes] = LruCache(entries)
+            value: bytes = os.urandom(size)
+            keys: list[str] = [f'deck{n}/0/projector' for n in range(entries)]
+            started: float = time.perf_counter()
+            for key in keys:
+                shared.put('bench', key, value)
+            put: float = (time.perf_counter() - started) / entries * 1e6
+            for key in keys:
+                own[key] = value
+                lru.put(key, value)
+            gets: list[str] = random.Random(1).choices(keys, k=args.gets)
+            print(f"{name:<24}{per_get(own.get, gets):>10.2f}{per_get(lru.get, gets):>10.2f}"
+                  f"{per_get(lambda k: shared.get('bench', k), gets):>10.2f}"
+                  f"{per_get(lambda k: shared.get('bench', k + 'x'), gets):>10.2f}{put:>10.2f}")
+
+        path = os.path.join(directory, 'slide.cache')
+        keys = [f'deck{n}/0/projector' for n in range(100)]
+        context = multiprocessing.get_context('spawn')
+        for workers in sorted({1, args.workers}):
+            results = context.Queue()
+            processes = [context.Process(target=_worker, args=(path, keys, args.seconds, results))
+                         for _ in range(workers)]
+            for process in processes:
+                process.start()
+            total: int = sum(results.get() for _ in processes)
+            for process in processes:
+                process.join()
+            print(f"{workers} worker processes: {total / args.seconds:,.0f} slide hits/s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+"""
+Time to clone a library with a snapshot, against copying the database file with the
+backup api and against inserting the same rows into a database that already has its
+indexes and change_log triggers.
+
+    python benchmarks/bench_snapshot.py [--songs 20000] [--verses 5]
+"""
+import argparse
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from bench_api import make_catalog  # noqa: E402
+
+
+def timed(action) -> float:
+    started: float = time.perf_counter()
+    action()
+    return time.perf_counter() - started
+
+
+def main() -> None:
+    from prayer_of_hannah.backup import backup_database
+    from prayer_of_hannah.dbms import Dbms
+    from prayer_of_hannah import snapshot
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--songs', type=int, default=20000)
+    parser.add_argument('--verses', type=int, default=5)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        def new_db(name: str) -> Dbms:
+            file: str = os.path.join(directory, name)
+            return Dbms(False, 'sqlite:///' + file, file)
+
+        db = new_db('library.sqlite')
+        db.create_database_structure()
+        make_catalog(db, args.songs, args.verses)
+        db.maintenance.run_idle_tasks(force=True)
+        snapshot_file: str = os.path.join(directory, 'library.snapshot')
+
+        results: list[tuple[str, float, int]] = [
+            ('write snapshot', timed(lambda: snapshot.write_snapshot(db, snapshot_file)), os.path.getsize(snapshot_file)),
+            ('load snapshot into a file', timed(lambda: snapshot.load_snapshot(new_db('copy.sqlite'), snapshot_file)), 0),
+            ('load snapshot into memory', timed(lambda: snapshot.load_snapshot(Dbms(True), snapshot_file)), 0),
+            ('backup api file copy', timed(lambda: backup_database(db.database_file,
+                                                                   os.path.join(directory, 'backup.sqlite'), -1, 0)),
+             os.path.getsize(db.database_file)),
+        ]
+
+        def insert_indexed() -> None:
+            target = new_db('indexed.sqlite')
+            target.create_database_structure()
+            source = sqlite3.connect(db.database_file)
+            con = sqlite3.connect(target.database_file)
+            con.execute("PRAGMA foreign_keys=OFF")
+            for table in snapshot.snapshot_tables():
+                if table.name != 'change_log':
+                    rows = source.execute(f'SELECT * FROM "{table.name}"').fetchall()
+                    if rows:
+                        con.executemany(f'INSERT INTO "{table.name}" VALUES ({", ".join("?" * len(rows[0]))})', rows)
+            con.commit()
+            con.close()
+            source.close()
+        results.append(('insert with indexes and triggers', timed(insert_indexed), 0))
+
+        print(f"{args.songs} songs, {args.songs * args.verses} verses")
+        print(f"{'':<34}{'seconds':>9}{'MB':>9}")
+        for name, took, size in results:
+            print(f"{name:<34}{took:>9.2f}" + (f"{size / 1e6:>9.1f}" if size else ''))
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+"""
+First request latency of each route in a freshly started worker, compiling templates
+on first use against loading them from a precompiled bytecode cache.
+
+    python benchmarks/bench_startup.py [--songs 200] [--runs 5]
+"""
+import argparse
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from bench_asgi import make_database  # noqa: E402
+
+ROUTES = ['/', '/songs/', '/songs/htmx/songs', '/songs/export', '/services/']
+
+
+def first_requests() -> None:
+    """In the worker: the ms each route's first request takes"""
+    from prayer_of_hannah import create_app
+    client = create_app().test_client()
+    timings: dict[str, float] = {}
+    for route in ROUTES:
+        start: float = time.perf_counter()
+        client.get(route).get_data()
+        timings[route] = (time.perf_counter() - start) * 1000
+    print(json.dumps(timings))
+
+
+def worker(env: dict) -> dict[str, float]:
+    output: str = subprocess.run([sys.executable, __file__, '--worker'], env=env, check=True,
+                                 capture_output=True, text=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--songs', type=int, default=200)
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--worker', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.worker:
+        first_requests()
+        return
+
+    with tempfile.TemporaryDirectory() as directory:
+        db_file: str = os.path.join(directory, 'startup.sqlite')
+        cache: str = os.path.join(directory, 'template_cache')
+        make_database(db_file, args.songs)
+        env: dict = dict(os.environ, DATABASE_FILE=db_file, TEMPLATE_CACHE_DIR=cache, PYTHONPATH=ROOT)
+
+        cold: list[dict[str, float]] = []
+        for _ in range(args.runs):
+            shutil.rmtree(cache, ignore_errors=True)
+            cold.append(worker(env))
+        subprocess.run([sys.executable, '-m', 'prayer_of_hannah.precompile'], env=env, check=True,
+                       capture_output=True, cwd=ROOT)
+        warm: list[dict[str, float]] = [worker(env) for _ in range(args.runs)]
+
+    print(f"median first request ms over {args.runs} workers")
+    print(f"{'route':<22}{'compiled':>10}{'precompiled':>13}")
+    for route in ROUTES:
+        print(f"{route:<22}{statistics.median(r[route] for r in cold):>10.1f}"
+              f"{statistics.median(r[route] for r in warm):>13.1f}")
+    print(f"{'all':<22}{statistics.median(sum(r.values()) for r in cold):>10.1f}"
+          f"{statistics.median(sum(r.values()) for r in warm):>13.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+"""
+Time to first byte, total time and peak memory of the song catalog page, rendered
+whole from a list of every song against streamed from a yield_per cursor.
+
+    python benchmarks/bench_streaming.py [--songs 1000 5000 20000]
+"""
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+def make_catalog(db, songs: int) -> None:
+    from prayer_of_hannah.models import Author, Song, Song_Book, Song_Book_Item
+    with db.write_session() as session:
+        book = Song_Book(code="StF", name="Singing the Faith")
+        for n in range(songs):
+            song = Song(title=f"Hymn {n:06}", authors=[Author(surname=f"Author{n}", first_names="A")])
+            session.add(Song_Book_Item(song_book=book, song=song, nbr=n + 1, verse_order="v1"))
+        session.commit()
+
+
+def measure(body) -> tuple[float, float, int]:
+    """ms to the first chunk, ms to the last and peak bytes allocated while producing them"""
+    tracemalloc.start()
+    start: float = time.perf_counter()
+    first: float | None = None
+    for _ in body():
+        if first is None:
+            first = time.perf_counter()
+    end: float = time.perf_counter()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return ((first or end) - start) * 1000, (end - start) * 1000, peak
+
+
+def main() -> None:
+    import prayer_of_hannah
+    from flask import render_template
+    from sqlmodel import Session
+    from prayer_of_hannah import create_app, queries
+    from prayer_of_hannah.dbms import Dbms
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--songs', type=int, nargs='+', default=[1000, 5000, 20000])
+    args = parser.parse_args()
+
+    app = create_app()
+    print(f"{'songs':>7}{'':>3}{'first ms':>10}{'total ms':>10}{'peak MB':>9}")
+    for songs in args.songs:
+        db = Dbms(True)
+        db.create_database_structure()
+        make_catalog(db, songs)
+        setattr(prayer_of_hannah, "__DB", db)
+        setattr(prayer_of_hannah, "__DBE", db.engine)
+
+        def whole():
+            with app.test_request_context('/songs/htmx/songs'):
+                with Session(db.engine) as session:
+                    catalog = queries.song_catalog(session)
+                yield render_template('songs/songs.html', songs=catalog)
+
+        def streamed():
+            client = app.test_client()
+            response = client.get('/songs/htmx/songs', buffered=False)
+            yield from response.response
+            response.close()
+
+        for name, body in (('whole', whole), ('stream', streamed)):
+            first, total, peak = measure(body)
+            print(f"{songs:>7} {name:<7}{first:>8.1f}{total:>10.1f}{peak / 1e6:>9.1f}")
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
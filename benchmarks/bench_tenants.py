@@ -0,0 +1,79 @@
+"""
+Many small congregations served by one worker: requests spread over the tenants with a
+few busy ones (zipf), against the LRU of open tenants. Reports requests per second,
+how often a tenant had to be opened, the open file descriptors (each open tenant holds
+its pooled connections and WAL files) and the memory used.
+
+    python benchmarks/bench_tenants.py [--tenants 300] [--songs 50] [--requests 3000] [--open 32]
+"""
+import argparse
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from bench_asgi import make_database  # noqa: E402
+
+ROUTES = ['/', '/songs/', '/songs/htmx/songs']
+
+
+def open_files() -> int:
+    return len(os.listdir('/proc/self/fd')) if os.path.isdir('/proc/self/fd') else -1
+
+
+def main() -> None:
+    from config import Config
+    from prayer_of_hannah import create_app
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--tenants', type=int, default=300)
+    parser.add_argument('--songs', type=int, default=50)
+    parser.add_argument('--requests', type=int, default=3000)
+    parser.add_argument('--open', type=int, default=32, help="TENANT_ENGINES")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        template: str = os.path.join(directory, 'template.sqlite')
+        make_database(template, args.songs)
+        names: list[str] = [f'church{n}' for n in range(args.tenants)]
+        for name in names:
+            shutil.copyfile(template, os.path.join(directory, name + '.sqlite'))
+
+        settings = type('BenchConfig', (Config,), {'TENANT_ROUTING': 'path', 'TENANT_DIR': directory,
+                                                   'TENANT_ENGINES': args.open})
+        app = create_app(settings)
+        tenants = app.extensions['tenants']
+        client = app.test_client()
+        weights: list[float] = [1 / (rank + 1) for rank in range(args.tenants)]
+        chosen: list[str] = random.Random(1).choices(names, weights, k=args.requests)
+
+        opens: int = 0
+        files: int = 0
+        tracemalloc.start()
+        started: float = time.perf_counter()
+        for n, name in enumerate(chosen):
+            if name not in tenants:
+                opens += 1
+            with client.get(f'/t/{name}{ROUTES[n % len(ROUTES)]}') as response:
+                response.get_data()
+                assert response.status_code == 200, response.status
+            files = max(files, open_files())
+        took: float = time.perf_counter() - started
+        peak: int = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+        print(f"{args.tenants} tenants of {args.songs} songs, {args.requests} requests, at most {args.open} open")
+        print(f"{args.requests / took:.0f} requests/s, {opens} opens ({opens / args.requests:.0%}), "
+              f"{len(tenants)} open at the end")
+        print(f"peak open files {files}, peak traced memory {peak / 1e6:.1f} MB")
+        tenants.close()
+
+
+if __name__ == "__main__":
+    main()
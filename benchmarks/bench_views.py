@@ -0,0 +1,60 @@
+"""
+Cost of showing every slide of a service on a growing number of screens, each following
+one of the views. Rendering per client per slide against picking the view out of the
+slide cache (all views rendered in one pass per slide).
+
+    python benchmarks/bench_views.py [--hymns 6] [--verses 5]
+"""
+import argparse
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from bench_delta import make_service  # noqa: E402
+
+
+def main() -> None:
+    from prayer_of_hannah import create_app
+    from prayer_of_hannah.dbms import Dbms
+    from prayer_of_hannah.live_worship import slides
+    from prayer_of_hannah.services import decks
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--hymns', type=int, default=6)
+    parser.add_argument('--verses', type=int, default=5)
+    args = parser.parse_args()
+
+    db = Dbms(True)
+    db.create_database_structure()
+    make_service(db, args.hymns, args.verses)
+    with db.write_session() as session:
+        deck_hash: str = decks.finalise_service(session, 1).content_hash
+    deck: dict = decks.deck_document(db.engine, deck_hash) or {}
+    count: int = len(deck['slides'])
+
+    print(f"{count} slides, views: {', '.join(slides.VIEWS)}")
+    print(f"{'clients':>8}{'per client ms':>15}{'cached ms':>11}{'renders':>9}")
+    with create_app().app_context():
+        for clients in (1, 10, 100, 1000):
+            views: list[str] = [slides.VIEWS[c % len(slides.VIEWS)] for c in range(clients)]
+
+            start: float = time.perf_counter()
+            for index in range(count):
+                for view in views:
+                    slides.render_slide(deck, index, view)
+            per_client: float = time.perf_counter() - start
+
+            slides._slide_cache = slides.SlideCache()
+            start = time.perf_counter()
+            for index in range(count):
+                for view in views:
+                    slides.cached_slide(deck_hash, deck, index, view)
+            cached: float = time.perf_counter() - start
+            print(f"{clients:>8}{per_client * 1000:>15.1f}{cached * 1000:>11.1f}{slides.slide_cache().misses:>9}")
+
+
+if __name__ == '__main__':
+    main()
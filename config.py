@@ -12,4 +12,41 @@ class Config:
     SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URI')\
         or 'sqlite:///' + SQLALCHEMY_DATABASE_FILE
 
-    SQLALCHEMY_TRACK_MODIFICATIONS = False
\ No newline at end of file
+    SQLALCHEMY_TRACK_MODIFICATIONS = False
+
+    # serve all reads from an in memory copy of the database file (writes still go to the file)
+    SERVE_FROM_MEMORY = os.environ.get('SERVE_FROM_MEMORY', '').lower() in ('1', 'true', 'yes')
+
+    # also serve the FastHTML prototype at /prototype from the ASGI app (needs python-fasthtml)
+    MOUNT_PROTOTYPE = os.environ.get('MOUNT_PROTOTYPE', '').lower() in ('1', 'true', 'yes')
+
+    # threads per ASGI worker running the Flask views, unset for the ThreadPoolExecutor default
+    WSGI_THREADS = int(os.environ['WSGI_THREADS']) if os.environ.get('WSGI_THREADS') else None
+
+    # render the slides of services starting soon ahead of time (see prayer_of_hannah/services/prewarm.py)
+    PREWARM_SERVICES = os.environ.get('PREWARM_SERVICES', 'true').lower() in ('1', 'true', 'yes')
+
+    # media files (audio, video and images), stored by content hash
+    MEDIA_DIR = os.environ.get('MEDIA_DIR') or os.path.join(basedir, 'media')
+
+    # let a front end web server (nginx X-Accel / apache mod_xsendfile) send media files with sendfile
+    USE_X_SENDFILE = os.environ.get('USE_X_SENDFILE', '').lower() in ('1', 'true', 'yes')
+
+    # compiled templates shared by the workers (see prayer_of_hannah/precompile.py), empty to compile in memory
+    TEMPLATE_CACHE_DIR = os.environ.get('TEMPLATE_CACHE_DIR', os.path.join(basedir, 'template_cache'))
+
+    # host many congregations, each with its own database file TENANT_DIR/<name>.sqlite (see prayer_of_hannah/tenants.py)
+    # '' for the one database above, 'subdomain' (<name>.TENANT_DOMAIN) or 'path' (TENANT_PATH_PREFIX/<name>/...)
+    TENANT_ROUTING = os.environ.get('TENANT_ROUTING', '').lower()
+    TENANT_DOMAIN = os.environ.get('TENANT_DOMAIN', '')
+    TENANT_PATH_PREFIX = os.environ.get('TENANT_PATH_PREFIX', '/t')
+    TENANT_DIR = os.environ.get('TENANT_DIR') or os.path.join(basedir, 'tenants')
+    # tenants a worker keeps open (connection pools, maintenance thread and caches) while they are idle
+    TENANT_ENGINES = int(os.environ.get('TENANT_ENGINES', 32))
+    # memory for the caches of each open tenant
+    TENANT_CACHE_MB = int(os.environ.get('TENANT_CACHE_MB', 16))
+
+    # rendered slides and catalog pages shared by the workers on this box (see prayer_of_hannah/shared_cache.py),
+    # empty to keep them in each worker's memory only
+    SHARED_CACHE_FILE = os.environ.get('SHARED_CACHE_FILE', '')
+    SHARED_CACHE_MB = int(os.environ.get('SHARED_CACHE_MB', 256))
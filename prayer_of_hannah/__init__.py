@@ -1,17 +1,26 @@
-from flask import Flask
+from typing import TYPE_CHECKING
 from config import Config
-from sqlalchemy.engine import Engine
 
 from prayer_of_hannah import models
-__all__ = ["models"]
+# keeps Song_Book_Item.verse_order_ids compiled as items and verses are written
+from prayer_of_hannah import verse_order
+__all__ = ["models", "verse_order"]
 
 from prayer_of_hannah.dbms import Dbms
+from prayer_of_hannah.tenants import Tenant, current_tenant
+
+# flask (and the blueprints) are only imported by create_app, so the importer and
+# maintenance commands don't load the web stack (see tests/test_startup.py)
+if TYPE_CHECKING:
+    from flask import Flask
+    from sqlalchemy.engine import Engine
 
 __DB: Dbms | None = None
-__DBE: Engine | None = None
+__DBE: 'Engine | None' = None
 
 
-def create_app(config_class=Config):
+def create_app(config_class=Config) -> 'Flask':
+    from flask import Flask
     app = Flask(__name__)
     app.config.from_object(config_class)
 
@@ -28,6 +37,28 @@ def create_app(config_class=Config):
     from prayer_of_hannah.songs import bp as songs_bp
     app.register_blueprint(songs_bp, url_prefix='/songs')
 
+    from prayer_of_hannah.media import bp as media_bp
+    app.register_blueprint(media_bp, url_prefix='/media')
+
+    from prayer_of_hannah.api import bp as api_bp
+    app.register_blueprint(api_bp, url_prefix='/api')
+
+    # fingerprinted, precompressed static files if they have been built
+    from prayer_of_hannah import assets
+    assets.init_app(app)
+
+    # templates compiled by another worker or at deploy
+    from prayer_of_hannah import precompile
+    precompile.init_app(app)
+
+    # each request to its congregation's database, if TENANT_ROUTING is set
+    from prayer_of_hannah import tenants
+    tenants.init_app(app)
+
+    # upcoming services rendered ahead, if PREWARM_SERVICES is set
+    from prayer_of_hannah.services import prewarm
+    prewarm.init_app(app)
+
     #@app.route('/test/')
     #def test_page():
     #    return '<h1>Testing the Flask Application Factory Pattern</h1>'
@@ -35,14 +66,22 @@ def create_app(config_class=Config):
     return app
 
 def get_db() -> Dbms:
+    """The current tenant's database (see tenants.py), or the app's one database"""
+    tenant: Tenant | None = current_tenant()
+    if tenant is not None:
+        return tenant.db
     global __DB
     if __DB is None:
-        __DB = Dbms(False, Config.SQLALCHEMY_DATABASE_URI)
+        __DB = Dbms(False, Config.SQLALCHEMY_DATABASE_URI, serve_from_memory=Config.SERVE_FROM_MEMORY)
         __DB.create_database_structure()
+        __DB.maintenance.start()
 
     return __DB
 
-def get_dbe() -> Engine:
+def get_dbe() -> 'Engine':
+    tenant: Tenant | None = current_tenant()
+    if tenant is not None:
+        return tenant.db.engine
     global __DBE
     if __DBE is None:
         __DBE = get_db().engine
@@ -0,0 +1,6 @@
+from flask import Blueprint
+
+bp = Blueprint('api', __name__)
+
+
+from prayer_of_hannah.api import routes
@@ -0,0 +1,175 @@
+import json
+from collections.abc import Callable, Iterator
+from sqlalchemy import Table, and_, func, select
+from sqlalchemy.engine import Connection, Engine
+
+from prayer_of_hannah.dbms import CHANGE_LOG_RESTORED
+from prayer_of_hannah.models import Author, Author_Song, Change_Log, Song, Song_Book, Song_Book_Item, Verse
+
+'''
+The catalog as data: the rows of each resource's table streamed straight from the
+database cursor (STREAM_ROWS at a time) into json, so a dump of the whole catalog never
+holds more than one batch in memory.
+
+Every response starts with the database write version (the highest change_log id). A
+consumer passes it back as since=<version> to get only the rows written after it, and
+the keys of rows deleted after it. The version is read before the rows, so a row written
+during a dump may be sent again next time but is never missed. If the database has been
+restored from a backup since then, or the change_log has been pruned past it, every row
+is sent and the response's since is null: the consumer replaces what it has.
+
+Rows are serialised with orjson if it is installed (pip install prayer_of_hannah[api]),
+otherwise with the json module.
+'''
+
+# resource name: the table it is read from, in the order a consumer can insert them
+RESOURCES: dict[str, Table] = {
+    'authors': Author.__table__,  # type: ignore[attr-defined]
+    'song_books': Song_Book.__table__,  # type: ignore[attr-defined]
+    'songs': Song.__table__,  # type: ignore[attr-defined]
+    'author_songs': Author_Song.__table__,  # type: ignore[attr-defined]
+    'song_book_items': Song_Book_Item.__table__,  # type: ignore[attr-defined]
+    'verses': Verse.__table__,  # type: ignore[attr-defined]
+}
+# rows fetched from the cursor at a time
+STREAM_ROWS = 1000
+# rows serialised in one call, for json: one call per row costs more than the encoding
+ENCODE_ROWS = 100
+# bytes of json sent at a time
+STREAM_BUFFER = 64 * 1024
+
+
+def _json_default(value):
+    if hasattr(value, 'isoformat'):
+        return value.isoformat()
+    raise TypeError(f"Can't serialise {type(value).__name__}")
+
+
+def json_dumps() -> Callable[[object], bytes]:
+    try:
+        import orjson
+        return lambda value: orjson.dumps(value, default=_json_default)
+    except ImportError:
+        encoder = json.JSONEncoder(separators=(',', ':'), default=_json_default, ensure_ascii=False)
+        return lambda value: encoder.encode(value).encode('utf-8')
+
+
+dumps: Callable[[object], bytes] = json_dumps()
+
+
+def version(connection: Connection) -> int:
+    return connection.execute(select(func.max(Change_Log.id))).scalar() or 0  # type: ignore[arg-type]
+
+
+def restored_since(connection: Connection, since: int | None) -> int | None:
+    """
+    since, or None if the database was restored after it or the change_log has been pruned
+    past it (see dbms.CHANGE_LOG_KEEP): the change_log no longer says what changed
+    """
+    if since is None:
+        return None
+    restored = (select(Change_Log.id)
+                .where(Change_Log.table_name == CHANGE_LOG_RESTORED, Change_Log.id > since)  # type: ignore[arg-type,operator]
+                .limit(1))
+    oldest: int | None = connection.execute(select(func.min(Change_Log.id))).scalar()  # type: ignore[arg-type]
+    if oldest is not None and oldest > since + 1:
+        return None
+    return None if connection.execute(restored).first() is not None else since
+
+
+def _changed_keys(table: Table, since: int):
+    """The keys of the table's rows written after since, and how to join them to the table"""
+    changed = (select(Change_Log.row_key)
+               .where(Change_Log.table_name == table.name, Change_Log.id > since)  # type: ignore[arg-type,operator]
+               .distinct().subquery())
+    key_columns = list(table.primary_key.columns)
+    on = and_(*(column == func.json_extract(changed.c.row_key, f'$[{i}]') for i, column in enumerate(key_columns)))
+    return changed, key_columns, on
+
+
+def _rows(connection: Connection, table: Table, since: int | None):
+    statement = select(table)
+    if since is not None:
+        changed, _, on = _changed_keys(table, since)
+        statement = statement.join(changed, on)
+    statement = statement.order_by(*table.primary_key.columns)
+    return connection.execution_options(yield_per=STREAM_ROWS).execute(statement)
+
+
+def rows(connection: Connection, table: Table, since: int | None = None) -> Iterator[dict]:
+    """The table's rows (written after since) in primary key order"""
+    columns: list[str] = [c.name for c in table.columns]
+    for row in _rows(connection, table, since):
+        yield dict(zip(columns, row))
+
+
+def row_batches(connection: Connection, table: Table, since: int | None = None,
+                size: int = ENCODE_ROWS) -> Iterator[list[dict]]:
+    """rows() in lists of size, to serialise each list in one call"""
+    columns: list[str] = [c.name for c in table.columns]
+    for batch in _rows(connection, table, since).partitions(size):
+        yield [dict(zip(columns, row)) for row in batch]
+
+
+def deleted_keys(connection: Connection, table: Table, since: int) -> Iterator[list]:
+    """The primary keys of the table's rows deleted after since"""
+    changed, key_columns, on = _changed_keys(table, since)
+    statement = (select(changed.c.row_key).select_from(changed.outerjoin(table, on))
+                 .where(key_columns[0].is_(None)).order_by(changed.c.row_key))
+    for (row_key,) in connection.execution_options(yield_per=STREAM_ROWS).execute(statement):
+        yield json.loads(row_key)
+
+
+def buffered(chunks: Iterator[bytes], size: int = STREAM_BUFFER) -> Iterator[bytes]:
+    parts: list[bytes] = []
+    length: int = 0
+    for chunk in chunks:
+        parts.append(chunk)
+        length += len(chunk)
+        if length >= size:
+            yield b''.join(parts)
+            parts, length = [], 0
+    if parts:
+        yield b''.join(parts)
+
+
+def stream_ndjson(engine: Engine, resources: list[str], since: int | None = None) -> Iterator[bytes]:
+    """
+    A {"version", "since"} line, then a {"resource", "row"} line per row and, with since,
+    a {"resource", "deleted"} line per deleted key
+    """
+    with engine.connect() as connection:
+        since = restored_since(connection, since)
+        yield dumps({'version': version(connection), 'since': since}) + b'\n'
+        for name in resources:
+            for row in rows(connection, RESOURCES[name], since):
+                yield dumps({'resource': name, 'row': row}) + b'\n'
+            if since is not None:
+                for key in deleted_keys(connection, RESOURCES[name], since):
+                    yield dumps({'resource': name, 'deleted': key}) + b'\n'
+
+
+def _array(batches: Iterator[list]) -> Iterator[bytes]:
+    """A json array of the items in batches, each batch serialised in one call"""
+    yield b'['
+    first: bool = True
+    for batch in batches:
+        if batch:
+            # the batch's own array without its brackets
+            yield (b'' if first else b',') + dumps(batch)[1:-1]
+            first = False
+    yield b']'
+
+
+def stream_json(engine: Engine, resources: list[str], since: int | None = None) -> Iterator[bytes]:
+    """{"version", "since", <resource>: {"rows": [...], "deleted": [...]}, ...} written as it is read"""
+    with engine.connect() as connection:
+        since = restored_since(connection, since)
+        yield b'{"version":' + dumps(version(connection)) + b',"since":' + dumps(since)
+        for name in resources:
+            yield b',' + dumps(name) + b':{"rows":'
+            yield from _array(row_batches(connection, RESOURCES[name], since))
+            yield b',"deleted":'
+            yield from _array(iter([list(deleted_keys(connection, RESOURCES[name], since))] if since is not None else []))
+            yield b'}'
+        yield b'}'
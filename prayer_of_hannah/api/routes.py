@@ -0,0 +1,28 @@
+from flask import Response, abort, request
+from prayer_of_hannah.api import bp
+from prayer_of_hannah.api.catalog import RESOURCES, buffered, stream_json, stream_ndjson
+from prayer_of_hannah import get_dbe
+
+NDJSON = 'application/x-ndjson'
+
+def catalog_response(resources: list[str]) -> Response:
+    # ?since=<version> for the changes after it, ?format=ndjson (or Accept: application/x-ndjson) for a row per line
+    since = request.args.get('since', type = int)
+    if 'since' in request.args and (since is None or since < 0):
+        abort(400, description = "since must be a version number")
+    ndjson = request.args.get('format') == 'ndjson' or \
+        (request.args.get('format') is None and request.accept_mimetypes.best_match(['application/json', NDJSON]) == NDJSON)
+    stream = stream_ndjson if ndjson else stream_json
+    response = Response(buffered(stream(get_dbe(), resources, since)), mimetype = NDJSON if ndjson else 'application/json')
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+@bp.get('/catalog')
+def catalog():
+    return catalog_response(list(RESOURCES))
+
+@bp.get('/<resource>')
+def resource(resource: str):
+    if resource not in RESOURCES:
+        abort(404)
+    return catalog_response([resource])
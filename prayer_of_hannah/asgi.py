@@ -0,0 +1,186 @@
+import asyncio
+import contextvars
+import re
+from concurrent.futures import ThreadPoolExecutor
+from asgiref.wsgi import WsgiToAsgi, WsgiToAsgiInstance
+from flask import Flask
+from config import Config
+
+from prayer_of_hannah import create_app, get_db
+from prayer_of_hannah.live_worship.broadcast import sse_app
+from prayer_of_hannah.media.pipeline import shutdown_worker_executor
+from prayer_of_hannah.media.serve import media_app
+from prayer_of_hannah.services.prewarm import start_prewarmer, stop_prewarmer
+from prayer_of_hannah.tenants import NOT_FOUND, Tenant, Tenants, UnknownTenant
+
+'''
+The single ASGI entry point, run it with any ASGI server eg
+
+    uvicorn prayer_of_hannah.asgi:app --workers 4
+
+Every worker process has one app and so one Dbms engine (get_db) and one set of caches
+shared by all its requests, or one of each per open tenant with TENANT_ROUTING (see
+tenants.py). What the workers must agree on, the live worship positions and events, goes
+through the database (see live_worship/broadcast.py), so an operator and the screens of
+a service can be served by different workers. The Flask blueprints run in the app's
+thread pool (WSGI_THREADS threads), their streamed responses are sent to the client
+chunk by chunk. Native ASGI apps (the FastHTML prototype, and later handlers that need
+to hold many idle connections cheaply) are mounted under a path prefix and run on the
+event loop.
+'''
+
+
+class _WsgiInstance(WsgiToAsgiInstance):
+    """
+    asgiref runs every WSGI request on one shared thread, this runs them in parallel on
+    the app's thread pool instead. Only asgiref's public methods (build_environ,
+    start_response) are used, the response is sent as asgiref sends it
+    """
+    def __init__(self, wsgi_application, duplicate_header_limit: int, executor: ThreadPoolExecutor) -> None:
+        super().__init__(wsgi_application, duplicate_header_limit)
+        self.executor = executor
+
+    async def run_wsgi_app(self, body) -> None:
+        loop = asyncio.get_running_loop()
+        # the view sees the request's context variables, as it would under sync_to_async
+        await loop.run_in_executor(self.executor, contextvars.copy_context().run, self._run_wsgi_app, body)
+
+    def _run_wsgi_app(self, body) -> None:
+        try:
+            environ: dict = self.build_environ(self.scope, body)
+        except ValueError:
+            # too many duplicate headers
+            self.sync_send({'type': 'http.response.start', 'status': 400, 'headers': [(b'content-type', b'text/plain')]})
+            self.sync_send({'type': 'http.response.body', 'body': b'Bad Request: Too many duplicate headers'})
+            return
+        sent: int = 0
+        output = self.wsgi_application(environ, self.start_response)
+        try:
+            for chunk in output:
+                if not self.response_started:
+                    self.response_started = True
+                    self.sync_send(self.response_start)
+                if self.response_content_length is not None:
+                    chunk = chunk[:self.response_content_length - sent]
+                self.sync_send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+                sent += len(chunk)
+                if sent == self.response_content_length:
+                    break
+        finally:
+            if hasattr(output, 'close'):
+                output.close()
+        if not self.response_started:
+            self.response_started = True
+            self.sync_send(self.response_start)
+        self.sync_send({'type': 'http.response.body'})
+
+
+class FlaskAsgi(WsgiToAsgi):
+    def __init__(self, wsgi_application, threads: int | None = None) -> None:
+        super().__init__(wsgi_application)
+        self.executor: ThreadPoolExecutor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='wsgi')
+
+    async def __call__(self, scope, receive, send):
+        await _WsgiInstance(self.wsgi_application, self.duplicate_header_limit, self.executor)(scope, receive, send)
+
+    def shutdown(self) -> None:
+        self.executor.shutdown(wait=True)
+
+
+class AsgiApp:
+    """
+    Dispatches to the ASGI routes (by regex, named groups become scope['path_params'])
+    and the mounted ASGI apps (by path prefix), everything else goes to Flask.
+    Handles the ASGI lifespan so the database is opened (and upcoming services are
+    pre-warmed) at startup and closed cleanly (running PRAGMA optimize) at shutdown, when
+    the media process pool is stopped too.
+    With tenants the ASGI routes and mounts run with the request's tenant current, the
+    Flask app finds it itself.
+    """
+    def __init__(self, flask_app: Flask) -> None:
+        self.flask_app = flask_app
+        self.wsgi = FlaskAsgi(flask_app, flask_app.config.get('WSGI_THREADS'))
+        self.tenants: Tenants | None = flask_app.extensions.get('tenants')
+        self.mounts: list[tuple[str, object]] = []
+        self.routes: list[tuple[str, re.Pattern, object]] = []
+
+    def route(self, method: str, pattern: str, app) -> None:
+        self.routes.append((method, re.compile(pattern), app))
+
+    def mount(self, prefix: str, app) -> None:
+        self.mounts.append((prefix.rstrip('/'), app))
+
+    async def __call__(self, scope, receive, send) -> None:
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+            return
+
+        path: str = scope.get('path', '')
+        tenant: str | None = None
+        root_path: str = scope.get('root_path', '')
+        if self.tenants is not None:
+            host: str = dict(scope.get('headers', [])).get(b'host', b'').decode('latin-1')
+            tenant, tenant_prefix, path = self.tenants.route(host, path)
+            root_path += tenant_prefix
+        for method, pattern, app in self.routes:
+            match = pattern.fullmatch(path)
+            if match and scope.get('method') == method:
+                await self.call(app, dict(scope, path=path, root_path=root_path, path_params=match.groupdict()),
+                                receive, send, tenant)
+                return
+        for prefix, app in self.mounts:
+            if path == prefix or path.startswith(prefix + '/'):
+                await self.call(app, dict(scope, path=path, root_path=root_path + prefix), receive, send, tenant)
+                return
+        await self.wsgi(scope, receive, send)
+
+    async def call(self, app, scope, receive, send, tenant: str | None) -> None:
+        if self.tenants is None:
+            await app(scope, receive, send)
+            return
+        try:
+            if tenant is None:
+                raise UnknownTenant("The request names no tenant")
+            found: Tenant = self.tenants.acquire(tenant)
+        except UnknownTenant:
+            await send({'type': 'http.response.start', 'status': 404, 'headers': [(b'content-type', b'text/plain')]})
+            await send({'type': 'http.response.body', 'body': NOT_FOUND})
+            return
+        try:
+            with found.current():
+                await app(scope, receive, send)
+        finally:
+            self.tenants.release(found)
+
+    async def lifespan(self, receive, send) -> None:
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                # tenants pre-warm their own services when their first request opens them
+                if self.tenants is None and self.flask_app.config.get('PREWARM_SERVICES'):
+                    start_prewarmer(self.flask_app)
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                stop_prewarmer(self.flask_app)
+                if self.tenants is not None:
+                    self.tenants.close()
+                else:
+                    get_db().close()
+                shutdown_worker_executor()
+                self.wsgi.shutdown()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+
+def create_asgi_app(config_class=Config) -> AsgiApp:
+    asgi_app = AsgiApp(create_app(config_class))
+    asgi_app.route('GET', r'/live/(?P<service_id>\d+)/events', sse_app)
+    asgi_app.route('GET', r'/media/(?P<content_hash>[0-9a-f]{64})', media_app)
+    asgi_app.route('HEAD', r'/media/(?P<content_hash>[0-9a-f]{64})', media_app)
+    if config_class.MOUNT_PROTOTYPE:
+        from prayer_of_hannah.prayer_of_hannah import app as prototype
+        asgi_app.mount('/prototype', prototype)
+    return asgi_app
+
+
+app = create_asgi_app()
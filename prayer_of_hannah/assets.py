@@ -0,0 +1,250 @@
+import hashlib
+import json
+import mimetypes
+import os
+import re
+from collections.abc import Callable
+from flask import Flask, request, send_file
+from werkzeug.exceptions import NotFound
+from werkzeug.security import safe_join
+
+from prayer_of_hannah.services.decks import IMMUTABLE
+
+'''
+The static asset build. Run it after changing anything in static/ or templates/:
+
+    python -m prayer_of_hannah.assets
+
+Every static file a template loads with url_for('static', filename=...) is copied to
+static/dist/ under a name with its content hash (so it can be cached forever), with a
+gzip copy beside it, and a brotli copy if brotli is installed (pip install
+prayer_of_hannah[assets]). CSS rules whose class selectors are not used by any template,
+script or view are left out first, which takes most of bulma.css away.
+
+static/dist/manifest.json maps each file to its built name. When the app starts it makes
+url_for('static', ...) give the built names, and serves them precompressed to match the
+request's Accept-Encoding. Without a build static files are served as they are.
+'''
+
+DIST_DIR = 'dist'
+MANIFEST = 'manifest.json'
+# classes only added at run time, by htmx or bulma's own javascript
+SAFELIST: set[str] = {'is-active', 'is-loading', 'is-hidden', 'htmx-request', 'htmx-indicator', 'htmx-settling',
+                      'htmx-swapping', 'htmx-added'}
+# (suffix, Content-Encoding) best first
+ENCODINGS: tuple[tuple[str, str], ...] = (('.br', 'br'), ('.gz', 'gzip'))
+
+STATIC_REFERENCE = re.compile(r"""url_for\(\s*['"]static['"]\s*,\s*filename\s*=\s*['"]([^'"]+)['"]""")
+CLASS_ATTRIBUTE = re.compile(r"""class\s*=\s*(?:"([^"]*)"|'([^']*)')""")
+CLASS_LIST = re.compile(r"""classList\.(?:add|remove|toggle|contains)\(([^)]*)\)""")
+TOKEN = re.compile(r'-?[_a-zA-Z][\w-]*')
+CLASS_SELECTOR = re.compile(r'\.(-?[_a-zA-Z][\w-]*)')
+NOT_SELECTOR = re.compile(r':not\([^()]*\)')
+COMMENT = re.compile(r'/\*.*?\*/', re.DOTALL)
+# at-rules holding rules, which are purged too (others such as @keyframes are kept whole)
+GROUPING_RULES = ('@media', '@supports', '@layer', '@container')
+
+
+def source_files(root: str, extensions: tuple[str, ...]) -> list[str]:
+    return sorted(os.path.join(directory, file) for directory, _, files in os.walk(root)
+                  for file in files if file.endswith(extensions) and DIST_DIR not in directory.split(os.sep))
+
+
+def used_classes(package_dir: str) -> set[str]:
+    """Every class named in a template, our own scripts or the python that writes html"""
+    used: set[str] = set(SAFELIST)
+    for path in source_files(package_dir, ('.html', '.py', '.js')):
+        if path.endswith('.min.js') or path.endswith('.js.js'):
+            continue
+        with open(path, encoding='utf-8') as source:
+            text: str = source.read()
+        for match in CLASS_ATTRIBUTE.finditer(text):
+            # jinja expressions in the attribute add some words that aren't classes, they do no harm
+            used.update(TOKEN.findall(match.group(1) or match.group(2)))
+        for match in CLASS_LIST.finditer(text):
+            used.update(TOKEN.findall(match.group(1)))
+    return used
+
+
+def static_references(templates_dir: str) -> list[str]:
+    """The static files the templates load"""
+    found: set[str] = set()
+    for path in source_files(templates_dir, ('.html',)):
+        with open(path, encoding='utf-8') as template:
+            found.update(STATIC_REFERENCE.findall(template.read()))
+    return sorted(found)
+
+
+def split_selectors(selectors: str) -> list[str]:
+    """A selector list split on its top level commas"""
+    parts: list[str] = []
+    depth: int = 0
+    start: int = 0
+    for i, c in enumerate(selectors):
+        if c in '([':
+            depth += 1
+        elif c in ')]':
+            depth -= 1
+        elif c == ',' and depth == 0:
+            parts.append(selectors[start:i].strip())
+            start = i + 1
+    parts.append(selectors[start:].strip())
+    return [p for p in parts if p]
+
+
+def selector_used(selector: str, used: set[str]) -> bool:
+    # a class in :not() doesn't have to be used for the selector to match
+    return all(c in used for c in CLASS_SELECTOR.findall(NOT_SELECTOR.sub('', selector)))
+
+
+def block_end(css: str, start: int) -> int:
+    """The index of the } closing the { at start"""
+    depth: int = 0
+    quote: str | None = None
+    for i in range(start, len(css)):
+        c = css[i]
+        if quote:
+            if c == quote and css[i - 1] != '\\':
+                quote = None
+        elif c in '"\'':
+            quote = c
+        elif c == '{':
+            depth += 1
+        elif c == '}':
+            depth -= 1
+            if depth == 0:
+                return i
+    return len(css)
+
+
+def purge_css(css: str, used: set[str]) -> str:
+    """css without the rules none of whose selectors can match"""
+    css = COMMENT.sub('', css)
+    kept: list[str] = []
+    i: int = 0
+    while i < len(css):
+        brace: int = css.find('{', i)
+        semicolon: int = css.find(';', i)
+        if brace < 0:
+            break
+        if 0 <= semicolon < brace and css[i:semicolon].strip().startswith('@'):
+            # @charset, @import
+            kept.append(css[i:semicolon + 1].strip())
+            i = semicolon + 1
+            continue
+        end: int = block_end(css, brace)
+        prelude: str = css[i:brace].strip()
+        body: str = css[brace + 1:end]
+        i = end + 1
+        if prelude.startswith(GROUPING_RULES):
+            inner: str = purge_css(body, used)
+            if inner:
+                kept.append(f'{prelude}{{{inner}}}')
+        elif prelude.startswith('@'):
+            kept.append(f'{prelude}{{{body}}}')
+        else:
+            selectors: list[str] = [s for s in split_selectors(prelude) if selector_used(s, used)]
+            if selectors:
+                kept.append(f'{",".join(selectors)}{{{body.strip()}}}')
+    return '\n'.join(kept)
+
+
+def fingerprinted(file_name: str, content: bytes) -> str:
+    """bulma.css -> bulma.<first 12 hex digits of its sha256>.css"""
+    root, extension = os.path.splitext(file_name)
+    return f'{root}.{hashlib.sha256(content).hexdigest()[:12]}{extension}'
+
+
+def compressors() -> dict[str, Callable[[bytes], bytes]]:
+    import gzip
+    found: dict[str, Callable[[bytes], bytes]] = {'.gz': lambda data: gzip.compress(data, compresslevel=9, mtime=0)}
+    try:
+        import brotli
+        found['.br'] = lambda data: brotli.compress(data, quality=11)
+    except ImportError:
+        pass
+    return found
+
+
+def build_assets(static_dir: str, templates_dir: str, package_dir: str | None = None) -> dict[str, str]:
+    """Build every static file the templates load into static_dir/dist, returns the manifest"""
+    used: set[str] = used_classes(package_dir or os.path.dirname(templates_dir))
+    dist: str = os.path.join(static_dir, DIST_DIR)
+    os.makedirs(dist, exist_ok=True)
+    manifest: dict[str, str] = {}
+    for file_name in static_references(templates_dir):
+        path: str = os.path.join(static_dir, file_name)
+        if not os.path.isfile(path):
+            print(f"Missing static file: {file_name}")
+            continue
+        with open(path, 'rb') as source:
+            content: bytes = source.read()
+        if file_name.endswith('.css'):
+            content = purge_css(content.decode('utf-8'), used).encode('utf-8')
+        built: str = fingerprinted(file_name, content)
+        for suffix, compress in [('', lambda data: data), *compressors().items()]:
+            with open(os.path.join(dist, built + suffix), 'wb') as output:
+                output.write(compress(content))
+        manifest[file_name] = f'{DIST_DIR}/{built}'
+        print(f"{file_name}: {os.path.getsize(path)} -> {len(content)} bytes, "
+              f"{os.path.getsize(os.path.join(dist, built + '.gz'))} gzipped as {manifest[file_name]}")
+    with open(os.path.join(dist, MANIFEST), 'w') as output:
+        json.dump(manifest, output, indent=2, sort_keys=True)
+    return manifest
+
+
+def load_manifest(static_dir: str) -> dict[str, str]:
+    path: str = os.path.join(static_dir, DIST_DIR, MANIFEST)
+    if not os.path.isfile(path):
+        return {}
+    with open(path) as manifest:
+        return json.load(manifest)
+
+
+def init_app(app: Flask) -> None:
+    """Point url_for('static') at the built assets and serve them precompressed"""
+    assert app.static_folder is not None
+    static_dir: str = app.static_folder
+    manifest: dict[str, str] = load_manifest(static_dir)
+    if not manifest:
+        return
+
+    def built_name(endpoint: str, values: dict) -> None:
+        if endpoint == 'static' and values.get('filename') in manifest:
+            values['filename'] = manifest[values['filename']]
+
+    def send_static(filename: str):
+        if not filename.startswith(DIST_DIR + '/'):
+            return app.send_static_file(filename)
+        path: str | None = safe_join(static_dir, filename)
+        if path is None or not os.path.isfile(path):
+            raise NotFound()
+        mime_type: str | None = mimetypes.guess_type(filename)[0]
+        for suffix, encoding in ENCODINGS:
+            if request.accept_encodings[encoding] and os.path.isfile(path + suffix):
+                response = send_file(path + suffix, mimetype=mime_type, conditional=True)
+                response.headers['Content-Encoding'] = encoding
+                break
+        else:
+            response = send_file(path, mimetype=mime_type, conditional=True)
+        response.headers['Vary'] = 'Accept-Encoding'
+        response.headers['Cache-Control'] = IMMUTABLE
+        return response
+
+    app.url_defaults(built_name)
+    app.view_functions['static'] = send_static
+
+
+def main() -> None:
+    import argparse
+    package_dir: str = os.path.dirname(os.path.abspath(__file__))
+    parser = argparse.ArgumentParser(description="Build the fingerprinted, precompressed static assets")
+    parser.add_argument('--static', default=os.path.join(package_dir, 'static'), help="static directory")
+    parser.add_argument('--templates', default=os.path.join(package_dir, 'templates'), help="templates directory")
+    args = parser.parse_args()
+    manifest: dict[str, str] = build_assets(args.static, args.templates, package_dir)
+    print(f"{len(manifest)} assets built into {os.path.join(args.static, DIST_DIR)}")
+
+
+if __name__ == "__main__":
+    main()
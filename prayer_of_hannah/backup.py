@@ -0,0 +1,206 @@
+import argparse
+import os
+import sqlite3
+import threading
+import time
+import pathlib as pl
+from datetime import datetime
+
+from prayer_of_hannah.dbms import CHANGE_LOG_RESTORED, CHANGE_LOG_TABLE, Dbms
+
+# pages copied per backup step, the source is unlocked between steps
+BACKUP_PAGES_PER_STEP = 64
+# seconds to wait between steps so readers and writers can get in
+BACKUP_STEP_PAUSE = 0.005
+# number of scheduled backups kept in the backup directory
+BACKUP_KEEP = 7
+
+BACKUP_DIR = os.environ.get('BACKUP_DIR')\
+    or os.path.join(os.path.dirname(os.path.abspath(Dbms.SQLALCHEMY_DATABASE_FILE)), 'backups')
+
+BACKUP_SUFFIX = '.sqlite'
+BACKUP_TIME_FORMAT = '%Y%m%d-%H%M%S-%f'
+
+
+class BackupError(Exception):
+    pass
+
+
+def backup_database(source_file: str, backup_file: str,
+                    pages: int = BACKUP_PAGES_PER_STEP, pause: float = BACKUP_STEP_PAUSE) -> None:
+    """
+    Copy a live database with the sqlite online backup API, pages at a time.
+    The source is only locked while a step runs so the app keeps working.
+    """
+    def progress(status: int, remaining: int, total: int) -> None:
+        time.sleep(pause)
+
+    print(f"Backing up {source_file} to {backup_file}")
+    source: sqlite3.Connection = sqlite3.connect(source_file)
+    try:
+        target: sqlite3.Connection = sqlite3.connect(backup_file)
+        try:
+            source.backup(target, pages=pages, progress=progress)
+        finally:
+            target.close()
+    finally:
+        source.close()
+
+
+def verify_backup(backup_file: str) -> None:
+    """Raise BackupError unless the file is a readable, uncorrupted sqlite database"""
+    if not pl.Path(backup_file).is_file():
+        raise BackupError(f"Backup not found: {backup_file}")
+    con: sqlite3.Connection = sqlite3.connect(f"file:{backup_file}?mode=ro", uri=True)
+    try:
+        result: list = con.execute("PRAGMA integrity_check").fetchall()
+        tables: int = con.execute("SELECT count(*) FROM sqlite_master WHERE type = 'table'").fetchone()[0]
+    except sqlite3.DatabaseError as e:
+        raise BackupError(f"Backup is not a database: {backup_file}: {e}") from e
+    finally:
+        con.close()
+    if result != [('ok',)]:
+        raise BackupError(f"Backup failed integrity check: {backup_file}: {result}")
+    if tables == 0:
+        raise BackupError(f"Backup has no tables: {backup_file}")
+
+
+def write_version(db_file: str) -> int:
+    """The database write version, the highest change_log id (0 if there isn't a change_log)"""
+    con: sqlite3.Connection = sqlite3.connect(db_file)
+    try:
+        return con.execute(f"SELECT max(id) FROM {CHANGE_LOG_TABLE}").fetchone()[0] or 0
+    except sqlite3.OperationalError:
+        return 0
+    finally:
+        con.close()
+
+
+def restore_database(backup_file: str, db_file: str,
+                     pages: int = BACKUP_PAGES_PER_STEP, pause: float = BACKUP_STEP_PAUSE,
+                     db: Dbms | None = None) -> None:
+    """
+    Verify a backup then copy it over the database with the backup API. Connections
+    that are already open see the restored data, there is no need to restart.
+
+    The backup's write version is older than the one readers have seen, so a
+    CHANGE_LOG_RESTORED entry is added after the highest version the database had:
+    versions keep going up, caches keyed on them (see shared_cache.py) drop what they
+    hold and every serve_from_memory copy reloads on its next refresh. db, if given,
+    is the app's Dbms for the file and its memory copy is reloaded now.
+    """
+    verify_backup(backup_file)
+    print(f"Restoring {backup_file} to {db_file}")
+    seen: int = write_version(db_file) if pl.Path(db_file).is_file() else 0
+    backup_database(backup_file, db_file, pages, pause)
+    # a backup from before there was a change_log gets one
+    restored_db: Dbms = Dbms(False, 'sqlite:///' + db_file, db_file)
+    restored_db.create_database_structure()
+    restored_db.close()
+    con: sqlite3.Connection = sqlite3.connect(db_file)
+    try:
+        restored: int = con.execute(f"SELECT max(id) FROM {CHANGE_LOG_TABLE}").fetchone()[0] or 0
+        con.execute(f"INSERT INTO {CHANGE_LOG_TABLE} (id, table_name, row_key, deleted) VALUES (?, ?, '[]', 0)",
+                    (max(seen, restored) + 1, CHANGE_LOG_RESTORED))
+        con.commit()
+    finally:
+        con.close()
+    if db is not None:
+        db.refresh_memory()
+
+
+def backup_file_name(backup_dir: str, db_file: str, when: datetime) -> str:
+    return os.path.join(backup_dir, f"{pl.Path(db_file).stem}-{when.strftime(BACKUP_TIME_FORMAT)}{BACKUP_SUFFIX}")
+
+
+def list_backups(backup_dir: str, db_file: str) -> list[str]:
+    """The backups of db_file in backup_dir, oldest first"""
+    path: pl.Path = pl.Path(backup_dir)
+    if not path.is_dir():
+        return []
+    return sorted(str(p) for p in path.glob(f"{pl.Path(db_file).stem}-*{BACKUP_SUFFIX}"))
+
+
+def prune_backups(backup_dir: str, db_file: str, keep: int = BACKUP_KEEP) -> list[str]:
+    """Delete all but the newest keep backups, returns the deleted files"""
+    backups: list[str] = list_backups(backup_dir, db_file)
+    deleted: list[str] = backups[:-keep] if keep > 0 else backups
+    for file in deleted:
+        print(f"Deleting old backup: {file}")
+        os.remove(file)
+    return deleted
+
+
+def take_backup(db_file: str, backup_dir: str = BACKUP_DIR, keep: int = BACKUP_KEEP) -> str:
+    """Back up, verify and apply retention. Returns the new backup file"""
+    os.makedirs(backup_dir, exist_ok=True)
+    backup_file: str = backup_file_name(backup_dir, db_file, datetime.now())
+    partial_file: str = backup_file + '.partial'
+    backup_database(db_file, partial_file)
+    verify_backup(partial_file)
+    # only complete, verified backups get the real name (and count for retention)
+    os.replace(partial_file, backup_file)
+    prune_backups(backup_dir, db_file, keep)
+    return backup_file
+
+
+class BackupScheduler(threading.Thread):
+    """
+    Take a backup every interval seconds until stopped
+    """
+    def __init__(self, db_file: str, interval: float, backup_dir: str = BACKUP_DIR, keep: int = BACKUP_KEEP) -> None:
+        super().__init__(name="BackupScheduler", daemon=True)
+        self.db_file = db_file
+        self.interval = interval
+        self.backup_dir = backup_dir
+        self.keep = keep
+        self._stop_event = threading.Event()
+
+    def run(self) -> None:
+        while not self._stop_event.wait(self.interval):
+            try:
+                take_backup(self.db_file, self.backup_dir, self.keep)
+            except (BackupError, sqlite3.Error, OSError) as e:
+                print(f"Scheduled backup failed: {e}")
+
+    def stop(self) -> None:
+        self._stop_event.set()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Online backup and restore of the Prayer of Hannah database")
+    parser.add_argument('--db', default=Dbms.SQLALCHEMY_DATABASE_FILE, help="database file")
+    parser.add_argument('--dir', default=BACKUP_DIR, help="backup directory")
+    parser.add_argument('--keep', type=int, default=BACKUP_KEEP, help="number of backups to keep")
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('backup', help="take a backup now")
+    schedule = commands.add_parser('schedule', help="take a backup every --every seconds")
+    schedule.add_argument('--every', type=float, default=3600)
+    verify = commands.add_parser('verify', help="check a backup")
+    verify.add_argument('backup_file')
+    restore = commands.add_parser('restore', help="restore a backup over the database")
+    restore.add_argument('backup_file')
+    commands.add_parser('list', help="list the backups")
+    args = parser.parse_args()
+
+    if args.command == 'backup':
+        print(take_backup(args.db, args.dir, args.keep))
+    elif args.command == 'schedule':
+        scheduler = BackupScheduler(args.db, args.every, args.dir, args.keep)
+        scheduler.start()
+        try:
+            scheduler.join()
+        except KeyboardInterrupt:
+            scheduler.stop()
+    elif args.command == 'verify':
+        verify_backup(args.backup_file)
+        print(f"Backup ok: {args.backup_file}")
+    elif args.command == 'restore':
+        restore_database(args.backup_file, args.db)
+    elif args.command == 'list':
+        for file in list_backups(args.dir, args.db):
+            print(file)
+
+
+if __name__ == "__main__":
+    main()
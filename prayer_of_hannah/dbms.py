@@ -1,12 +1,37 @@
 import os
-from sqlmodel import SQLModel, create_engine
-from sqlalchemy import engine
+import json
+import sqlite3
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import TYPE_CHECKING
+from sqlmodel import SQLModel, Session, create_engine
+from sqlalchemy import engine, text
 from sqlalchemy.event import listen
-from sqlalchemy.pool import Pool
+from sqlalchemy.pool import Pool, QueuePool, NullPool
 import pathlib as pl
 
+# the async engine is only needed by the async views, it is imported when first used
+if TYPE_CHECKING:
+    from sqlalchemy.ext.asyncio import AsyncEngine
+    from sqlmodel.ext.asyncio.session import AsyncSession
+
 basedir = os.path.abspath(os.path.dirname(__file__))
 
+CHANGE_LOG_TABLE = 'change_log'
+CHANGE_LOG_TRIGGER_PREFIX = 'change_log_'
+# the change_log table_name of the entry a restore adds (see backup.restore_database):
+# every row may have changed, so copies of the database have to be reloaded
+CHANGE_LOG_RESTORED = '*restored*'
+# live worship events (see live_worship/broadcast.py) are not data, their writes aren't logged
+LIVE_EVENT_TABLE = 'live_event'
+# change_log entries kept by the idle maintenance: a memory copy or an api consumer further
+# behind than this can't be told what changed, it is reloaded or sent everything as after a restore
+CHANGE_LOG_KEEP = 100_000
+# seconds a refresh of a memory copy waits for its readers, and they for it
+MEMORY_BUSY_SECONDS = 5.0
+# indexes replaced by ones on more columns, dropped from existing databases
+DROPPED_INDEXES = ('compound_index_verse',)
 
 
 class Dbms:
@@ -18,13 +43,15 @@ class Dbms:
     # controls if the sql is logged
     ECHO_SQL = False
 
-    def __init__(self, in_memory: bool = False, db_uri: str = '', db_file: str='') -> None:
+    def __init__(self, in_memory: bool = False, db_uri: str = '', db_file: str='', serve_from_memory: bool = False) -> None:
         if db_uri:
             self.SQLALCHEMY_DATABASE_URI = db_uri
         if db_file:
             self.SQLALCHEMY_DATABASE_FILE = db_file
 
         self.in_memory = in_memory
+        # serve_from_memory: reads use a shared in memory copy of the file, writes go to the file
+        self.serve_from_memory = serve_from_memory and not in_memory
         if self.in_memory:
             print("Creating memory DB Engine")
             self.engine: engine.Engine = create_engine("sqlite://", echo=self.ECHO_SQL)
@@ -34,9 +61,264 @@ class Dbms:
             self.engine = create_engine(self.SQLALCHEMY_DATABASE_URI, echo=self.ECHO_SQL)
             print(f"Database Engine Connected: {self.SQLALCHEMY_DATABASE_URI}")
 
+        # all writes go through write_engine, it is the same as engine unless serving from memory
+        self.write_engine: engine.Engine = self.engine
+
+        if self.serve_from_memory:
+            self._memory_lock = threading.Lock()
+            self.memory_version: int = 0
+            # the memdb vfs locks like a file, so a reader waits for a refresh and never sees half of it
+            memory_uri: str = f"file:/poh_memory_{id(self)}?vfs=memdb"
+            # keeps the memory database alive and is used to copy changes into it
+            self._memory_keeper: sqlite3.Connection = sqlite3.connect(memory_uri, uri=True, check_same_thread=False,
+                                                                      isolation_level=None, timeout=MEMORY_BUSY_SECONDS)
+            # reads the file's write version before each read, it sees every process's writes
+            self._file_watch: sqlite3.Connection = sqlite3.connect(self.database_file, check_same_thread=False,
+                                                                   isolation_level=None)
+            self._file_watch_lock = threading.Lock()
+            self.engine = create_engine(f"sqlite:///{memory_uri}&uri=true", echo=self.ECHO_SQL,
+                                        poolclass=QueuePool,
+                                        connect_args={"check_same_thread": False, "timeout": MEMORY_BUSY_SECONDS})
+            self.load_into_memory()
+            listen(self.engine, "checkout", self._before_read)
+
+        self.maintenance: Maintenance = Maintenance(self.write_engine, '' if self.in_memory else self.database_file)
+        if self.engine is not self.write_engine:
+            # reads from the memory copy are activity too
+            self.maintenance.watch(self.engine)
+        self._async_engine: 'AsyncEngine | None' = None
+
+    @property
+    def database_file(self) -> str:
+        """The file behind the write engine (the disk file even when serving from memory)"""
+        return self.write_engine.url.database or ''
+
     def create_database_structure(self) -> None:
         print("Creating Database Structure")
-        SQLModel.metadata.create_all(self.engine)
+        if not self.in_memory:
+            with self.write_engine.connect() as conn:
+                # auto_vacuum only takes effect before the first table is created
+                conn.exec_driver_sql("PRAGMA auto_vacuum=INCREMENTAL")
+                conn.exec_driver_sql("PRAGMA journal_mode=WAL")
+        SQLModel.metadata.create_all(self.write_engine)
+        self.add_missing_columns()
+        self.replace_indexes()
+        self.create_change_log_triggers()
+        if self.serve_from_memory:
+            self.load_into_memory()
+
+    def add_missing_columns(self) -> None:
+        """create_all doesn't change existing tables, add any new (nullable) columns to them"""
+        with self.write_engine.begin() as conn:
+            for table in SQLModel.metadata.sorted_tables:
+                existing: set[str] = {row[1] for row in conn.exec_driver_sql(f'PRAGMA table_info("{table.name}")')}
+                for column in table.columns:
+                    if existing and column.name not in existing and column.nullable:
+                        print(f"Adding column {table.name}.{column.name}")
+                        column_type: str = column.type.compile(dialect=self.write_engine.dialect)
+                        # the existing rows get the server default
+                        default: str = f" DEFAULT '{column.server_default.arg}'" if column.server_default is not None else ''
+                        conn.exec_driver_sql(f'ALTER TABLE "{table.name}" ADD COLUMN "{column.name}" {column_type}{default}')
+
+    def replace_indexes(self) -> None:
+        """Drop the DROPPED_INDEXES and create the indexes create_all doesn't add to existing tables"""
+        with self.write_engine.begin() as conn:
+            for name in DROPPED_INDEXES:
+                conn.exec_driver_sql(f'DROP INDEX IF EXISTS "{name}"')
+            for table in SQLModel.metadata.sorted_tables:
+                for index in table.indexes:
+                    index.create(conn, checkfirst=True)
+
+    def create_change_log_triggers(self) -> None:
+        """
+        Add insert/update/delete triggers to every table (but the live events) so each write
+        is recorded in change_log. The change_log id is then the database write version.
+        """
+        with self.write_engine.begin() as conn:
+            for table in SQLModel.metadata.sorted_tables:
+                if table.name in (CHANGE_LOG_TABLE, LIVE_EVENT_TABLE):
+                    continue
+                for sql in change_log_trigger_sql(table.name, [c.name for c in table.primary_key.columns]):
+                    conn.execute(text(sql))
+
+    def write_session(self) -> Session:
+        """
+        A Session for writing. When serving from memory it writes to the file and,
+        on commit, copies the changed rows into the memory copy.
+        """
+        session: Session = Session(self.write_engine)
+        if self.serve_from_memory:
+            listen(session, "after_commit", lambda s: self._refresh_quietly())
+        return session
+
+    @property
+    def async_engine(self) -> 'AsyncEngine':
+        """
+        An aiosqlite engine for reads from async code, created on first use. It reads the
+        same data as engine (the memory copy when serving from memory).
+        """
+        if self._async_engine is None:
+            from sqlalchemy.ext.asyncio import create_async_engine
+            if self.in_memory:
+                raise ValueError("An async engine needs a database file or serve_from_memory")
+            # NullPool: sqlite connections are cheap and a pooled aiosqlite connection
+            # can't be shared by the event loops Flask creates per async request
+            self._async_engine = create_async_engine(self.engine.url.set(drivername="sqlite+aiosqlite"),
+                                                     echo=self.ECHO_SQL, poolclass=NullPool,
+                                                     connect_args={"timeout": MEMORY_BUSY_SECONDS})
+            if self.serve_from_memory:
+                listen(self._async_engine.sync_engine, "checkout", self._before_read)
+            self.maintenance.watch(self._async_engine.sync_engine)
+        return self._async_engine
+
+    def async_session(self) -> 'AsyncSession':
+        from sqlmodel.ext.asyncio.session import AsyncSession
+        return AsyncSession(self.async_engine)
+
+    def load_into_memory(self) -> None:
+        """Copy the whole database file into the shared memory database with the sqlite backup API"""
+        print(f"Loading database into memory: {self.database_file}")
+        with self._memory_lock:
+            # a backup would copy the file's WAL mode, which memdb can't open: it is copied through
+            # a VACUUM INTO a staging memdb first, which has a rollback journal
+            staging_uri: str = f"file:/poh_loading_{id(self)}?vfs=memdb"
+            staging: sqlite3.Connection = sqlite3.connect(staging_uri, uri=True)
+            try:
+                source: sqlite3.Connection = sqlite3.connect(pl.Path(self.database_file).resolve().as_uri(), uri=True)
+                try:
+                    source.execute("VACUUM INTO ?", (staging_uri,))
+                finally:
+                    source.close()
+                staging.backup(self._memory_keeper)
+            finally:
+                staging.close()
+            # the memory copy is only written by refresh_memory, which copies the change_log rows itself
+            triggers = self._memory_keeper.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'trigger' AND name LIKE ?",
+                (CHANGE_LOG_TRIGGER_PREFIX + '%',)).fetchall()
+            for (name,) in triggers:
+                self._memory_keeper.execute(f'DROP TRIGGER "{name}"')
+            self.memory_version = self._memory_change_log_version()
+            self._memory_keeper.commit()
+
+    def file_version(self) -> int:
+        """The file's write version, the highest change_log id (0 before there is a change_log)"""
+        with self._file_watch_lock:
+            try:
+                return self._file_watch.execute(f"SELECT max(id) FROM {CHANGE_LOG_TABLE}").fetchone()[0] or 0
+            except sqlite3.OperationalError:
+                return 0
+
+    def refresh_if_changed(self) -> int:
+        """
+        Refresh the memory copy if the file has been written since, by any connection or
+        process (another worker, the command line tools, a restore). One indexed max() on
+        the file when it hasn't.
+        """
+        if not self.serve_from_memory or self.file_version() == self.memory_version:
+            return 0
+        return self.refresh_memory()
+
+    def _before_read(self, dbapi_con, connection_record, connection_proxy) -> None:
+        self._refresh_quietly()
+
+    def _refresh_quietly(self) -> None:
+        try:
+            self.refresh_if_changed()
+        except sqlite3.OperationalError as e:
+            # eg a long read held the memory copy, the next read tries again
+            print(f"Refreshing the memory copy failed: {e}")
+
+    def refresh_memory(self) -> int:
+        """
+        Copy the rows written since the memory copy was loaded/refreshed, in one transaction
+        that readers wait for. Returns the number of changed rows copied, or -1 when the file
+        has been restored, or pruned past the copy's version, and is loaded again whole.
+        """
+        if not self.serve_from_memory:
+            return 0
+        with self._memory_lock:
+            # read from the file in one snapshot, before the memory copy is locked
+            with self._file_watch_lock:
+                disk: sqlite3.Connection = self._file_watch
+                disk.execute("BEGIN")
+                try:
+                    changes = disk.execute(
+                        f"SELECT id, table_name, row_key FROM {CHANGE_LOG_TABLE} WHERE id > ? ORDER BY id",
+                        (self.memory_version,)).fetchall()
+                    latest, oldest = disk.execute(f"SELECT max(id), min(id) FROM {CHANGE_LOG_TABLE}").fetchone()
+                    # the file was restored: by restore_database, or by a copy that went behind it, or the
+                    # changes after the copy's version have been pruned
+                    reload: bool = any(table_name == CHANGE_LOG_RESTORED for _, table_name, _ in changes)\
+                        or (latest or 0) < self.memory_version or (oldest or 0) > self.memory_version + 1
+                    if reload:
+                        changes = []
+                    changed: dict[str, set[str]] = {}
+                    for _, table_name, row_key in changes:
+                        changed.setdefault(table_name, set()).add(row_key)
+
+                    # table name: its columns, where clause on its key and each changed key's row (None if deleted)
+                    rows: dict[str, tuple[list[str], str, list[tuple[list, tuple | None]]]] = {}
+                    for table_name, row_keys in changed.items():
+                        table = SQLModel.metadata.tables.get(table_name)
+                        if table is None:
+                            continue
+                        columns: list[str] = [f'"{c.name}"' for c in table.columns]
+                        where: str = " AND ".join(f'"{c.name}" = ?' for c in table.primary_key.columns)
+                        rows[table_name] = (columns, where, [
+                            (key, disk.execute(f'SELECT {", ".join(columns)} FROM "{table_name}" WHERE {where}',
+                                               key).fetchone())
+                            for key in map(json.loads, row_keys)])
+                    log: list[tuple] = disk.execute(
+                        f"SELECT id, table_name, row_key, deleted FROM {CHANGE_LOG_TABLE} WHERE id > ?",
+                        (self.memory_version,)).fetchall() if changes else []
+                finally:
+                    disk.execute("COMMIT")
+
+            con: sqlite3.Connection = self._memory_keeper
+            con.execute("PRAGMA foreign_keys=OFF")
+            try:
+                # readers wait for the commit, they never see a row deleted but not yet inserted again
+                con.execute("BEGIN IMMEDIATE")
+                for table_name, (columns, where, found) in rows.items():
+                    insert: str = f'INSERT INTO "{table_name}" ({", ".join(columns)}) VALUES ({", ".join("?" * len(columns))})'
+                    for key, row in found:
+                        con.execute(f'DELETE FROM "{table_name}" WHERE {where}', key)
+                        if row is not None:
+                            con.execute(insert, row)
+                if changes:
+                    con.executemany(f"INSERT INTO {CHANGE_LOG_TABLE} (id, table_name, row_key, deleted) "
+                                    f"VALUES (?, ?, ?, ?)", log)
+                    # pruned like the file's
+                    con.execute(f"DELETE FROM {CHANGE_LOG_TABLE} WHERE id < ?", (oldest,))
+                    self.memory_version = changes[-1][0]
+                con.execute("COMMIT")
+            except Exception:
+                con.execute("ROLLBACK")
+                raise
+            finally:
+                con.execute("PRAGMA foreign_keys=ON")
+        if reload:
+            self.load_into_memory()
+            return -1
+        return len(changes)
+
+    def _memory_change_log_version(self) -> int:
+        try:
+            row = self._memory_keeper.execute(f"SELECT max(id) FROM {CHANGE_LOG_TABLE}").fetchone()
+        except sqlite3.OperationalError:
+            return 0
+        return row[0] or 0
+
+    def close(self) -> None:
+        """Stop maintenance and close all connections (which runs PRAGMA optimize on each)"""
+        self.maintenance.stop()
+        if self.serve_from_memory:
+            self._file_watch.close()
+        if self._async_engine is not None:
+            self._async_engine.sync_engine.dispose()
+        self.engine.dispose()
+        self.write_engine.dispose()
 
     def delete_database_file(self) -> None:
         if self.in_memory:
@@ -50,6 +332,177 @@ class Dbms:
                 print("No database to delete")
 
 
+class Maintenance:
+    """
+    Keeps a database file healthy. Runs PRAGMA optimize as connections close, ANALYZE after
+    bulk imports and, once the app has been idle for IDLE_SECONDS, prunes the change_log to
+    its latest CHANGE_LOG_KEEP entries, an incremental vacuum and a wal_checkpoint(TRUNCATE).
+    Idle tasks never run while a live service is in progress, in this worker or any other:
+    one whose last live event (see live_worship/broadcast.py) is not its end and is less
+    than LIVE_SECONDS old. Reads count as activity as well as writes, on every engine the
+    Dbms reads with.
+    """
+    # seconds without any sql before idle tasks run
+    IDLE_SECONDS = 300
+    # seconds between checks for an idle window
+    CHECK_INTERVAL = 60
+    # free pages returned to the file system per idle window
+    VACUUM_PAGES = 1000
+    # seconds after its last live event a service that no one ended is over
+    LIVE_SECONDS = 90 * 60
+
+    def __init__(self, dbe: engine.Engine, db_file: str = '') -> None:
+        self.engine = dbe
+        self.db_file = db_file
+        self.last_activity: float = time.monotonic()
+        self.last_run: dict[str, datetime] = {}
+        self._lock = threading.Lock()
+        # held while the idle tasks run, a second caller doesn't wait to run them again
+        self._idle_lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread: threading.Thread | None = None
+        self.watch(self.engine)
+        listen(self.engine, "close", optimize_on_close)
+
+    def watch(self, dbe: engine.Engine) -> None:
+        """Count sql run on dbe as activity, eg the engine reads go to when serving from memory"""
+        listen(dbe, "before_cursor_execute", self._on_execute)
+
+    def _on_execute(self, conn, cursor, statement, parameters, context, executemany) -> None:
+        # the tasks run on the driver's connection, so aren't seen here
+        self.last_activity = time.monotonic()
+
+    def _run(self, name: str, *statements: str) -> list:
+        results: list = []
+        with self._lock:
+            raw = self.engine.raw_connection()
+            try:
+                con: sqlite3.Connection = raw.driver_connection
+                for sql in statements:
+                    if sql.startswith("PRAGMA incremental_vacuum"):
+                        # a plain execute only frees the first page, a script steps it to completion
+                        con.executescript(sql)
+                        results.append([])
+                    else:
+                        results.append(con.execute(sql).fetchall())
+                con.commit()
+            finally:
+                raw.close()
+        self.last_run[name] = datetime.now()
+        return results
+
+    @property
+    def in_live_service(self) -> bool:
+        """If a service is live, from the live events every worker writes to the database"""
+        since: str = (datetime.now() - timedelta(seconds=self.LIVE_SECONDS)).isoformat(sep=' ', timespec='microseconds')
+        raw = self.engine.raw_connection()
+        try:
+            # on the driver's connection, checking isn't activity
+            live = raw.driver_connection.execute(
+                f"SELECT 1 FROM {LIVE_EVENT_TABLE} WHERE id IN (SELECT max(id) FROM {LIVE_EVENT_TABLE} GROUP BY service_id)"
+                f" AND name != 'end' AND published > ? LIMIT 1", (since,)).fetchone()
+        except sqlite3.OperationalError:
+            # no live_event table yet
+            return False
+        finally:
+            raw.close()
+        return live is not None
+
+    def is_idle(self) -> bool:
+        return not self.in_live_service and time.monotonic() - self.last_activity >= self.IDLE_SECONDS
+
+    def optimize(self) -> None:
+        self._run('optimize', "PRAGMA optimize")
+
+    def after_bulk_import(self) -> None:
+        """Give the query planner statistics for the imported data"""
+        print("Analyzing database after import")
+        self._run('analyze', "ANALYZE", "PRAGMA optimize")
+
+    def run_idle_tasks(self, force: bool = False) -> bool:
+        """Vacuum and checkpoint if idle (or forced). Never during a live service or while already running"""
+        if not self._idle_lock.acquire(blocking=False):
+            return False
+        try:
+            if self.in_live_service or not (force or self.is_idle()):
+                return False
+            # the pruned entries' pages are vacuumed with the rest
+            self._run('vacuum', f"DELETE FROM {CHANGE_LOG_TABLE} WHERE id <= (SELECT max(id) FROM {CHANGE_LOG_TABLE}) - "
+                                f"{CHANGE_LOG_KEEP}", f"PRAGMA incremental_vacuum({self.VACUUM_PAGES})")
+            if self.db_file:
+                self._run('checkpoint', "PRAGMA wal_checkpoint(TRUNCATE)")
+            return True
+        finally:
+            self._idle_lock.release()
+
+    def start(self) -> None:
+        """Check for idle windows in a background thread"""
+        if self._thread is None and self.db_file:
+            self._stop_event.clear()
+            self._thread = threading.Thread(target=self._idle_loop, name="DbmsMaintenance", daemon=True)
+            self._thread.start()
+
+    def stop(self) -> None:
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _idle_loop(self) -> None:
+        while not self._stop_event.wait(self.CHECK_INTERVAL):
+            try:
+                self.run_idle_tasks()
+            except Exception as e:
+                print(f"Database maintenance failed: {e}")
+
+    def status(self) -> dict:
+        """File size, free pages and how far the WAL is behind the database file"""
+        with self.engine.connect() as conn:
+            page_size: int = conn.exec_driver_sql("PRAGMA page_size").scalar() or 0
+            page_count: int = conn.exec_driver_sql("PRAGMA page_count").scalar() or 0
+            freelist_count: int = conn.exec_driver_sql("PRAGMA freelist_count").scalar() or 0
+            auto_vacuum: int = conn.exec_driver_sql("PRAGMA auto_vacuum").scalar() or 0
+        file_size: int = os.path.getsize(self.db_file) if self.db_file and os.path.isfile(self.db_file) else 0
+        wal_file: str = self.db_file + '-wal'
+        wal_size: int = os.path.getsize(wal_file) if self.db_file and os.path.isfile(wal_file) else 0
+        return {
+            'file_size': file_size,
+            'page_size': page_size,
+            'page_count': page_count,
+            'freelist_count': freelist_count,
+            'incremental_vacuum': auto_vacuum == 2,
+            'wal_size': wal_size,
+            # frames written to the WAL not yet truncated away by a checkpoint (32 byte header, 24 per frame)
+            'checkpoint_lag': max(wal_size - 32, 0) // (page_size + 24) if page_size else 0,
+            'last_run': {name: when.isoformat(timespec='seconds') for name, when in self.last_run.items()},
+        }
+
+
+def optimize_on_close(dbapi_con, connection_record):
+    try:
+        dbapi_con.execute("PRAGMA optimize")
+    except sqlite3.Error:
+        pass
+
+
+def change_log_trigger_sql(table_name: str, key_columns: list[str]) -> list[str]:
+    new_key: str = "json_array(" + ", ".join(f'NEW."{c}"' for c in key_columns) + ")"
+    old_key: str = "json_array(" + ", ".join(f'OLD."{c}"' for c in key_columns) + ")"
+    log: str = f"INSERT INTO {CHANGE_LOG_TABLE} (table_name, row_key, deleted)"
+    name: str = CHANGE_LOG_TRIGGER_PREFIX + table_name
+    return [
+        f'CREATE TRIGGER IF NOT EXISTS "{name}_insert" AFTER INSERT ON "{table_name}" '
+        f"BEGIN {log} VALUES ('{table_name}', {new_key}, 0); END",
+
+        f'CREATE TRIGGER IF NOT EXISTS "{name}_update" AFTER UPDATE ON "{table_name}" '
+        f"BEGIN {log} VALUES ('{table_name}', {new_key}, 0); "
+        f"{log} SELECT '{table_name}', {old_key}, 1 WHERE {old_key} != {new_key}; END",
+
+        f'CREATE TRIGGER IF NOT EXISTS "{name}_delete" AFTER DELETE ON "{table_name}" '
+        f"BEGIN {log} VALUES ('{table_name}', {old_key}, 1); END",
+    ]
+
+
 def my_on_connect(dbapi_con, connection_record):
     cursor = dbapi_con.cursor()
     cursor.execute("PRAGMA foreign_keys=ON")
@@ -0,0 +1,278 @@
+import os
+import re
+import sys
+import struct
+import time
+import zlib
+from collections import deque
+from collections.abc import Iterator
+from concurrent.futures import Executor, Future
+from typing import NamedTuple
+from xml.sax.saxutils import escape, quoteattr
+from sqlalchemy import select
+from sqlalchemy.engine import Engine
+
+from prayer_of_hannah.dbms import Dbms
+from prayer_of_hannah.models import Author, Author_Song, Song, Song_Book, Song_Book_Item, Verse
+from prayer_of_hannah.verse_order import verse_name
+
+'''
+Exports the library as OpenLyrics XML, one file per Song_Book_Item (a song in two books
+is two files, each with its own verses and verse order), in the form load_song_xml.py
+imports, so a library is moved to another site by exporting it and importing the zip:
+
+    python -m prayer_of_hannah.export_song_xml songs.zip
+    python -m prayer_of_hannah.load_song_xml songs.zip
+
+Songs are read EXPORT_BATCH at a time and each batch is rendered to XML and compressed
+in a process pool, with at most IN_FLIGHT batches per worker queued, while this process
+reads the next batches and writes the finished files into the zip in order. The command
+line starts a pool for its export, the web app uses the worker's media pool (see
+media/pipeline.py) rather than a pool per request. The zip is written front to back,
+never seeking, so it goes straight to the file or HTTP response without a temp file. Memory use doesn't grow with the library beyond the zip's central
+directory, a name and a few numbers per song.
+
+zipfile can't add a file compressed elsewhere, so ZipStream writes the zip itself.
+'''
+
+# songs read and rendered at a time
+EXPORT_BATCH = 200
+# batches queued per pool worker
+IN_FLIGHT = 2
+UNSAFE_NAME = re.compile(r'[^\w+]+')
+COMPRESS_LEVEL = 6
+# zip format versions, 2.0 for deflate and 4.5 for zip64
+ZIP_VERSION = 20
+ZIP64_VERSION = 45
+ZIP64_LIMIT = 0xFFFFFFFF
+UTF8_NAMES = 0x800
+UNIX = 3
+
+
+class ZipEntry(NamedTuple):
+    name: str
+    # deflated
+    data: bytes
+    crc: int
+    size: int
+
+
+def file_stem(text: str, length: int = 60) -> str:
+    return UNSAFE_NAME.sub('-', text).strip('-')[:length] or 'song'
+
+
+def render_song(song: dict) -> bytes:
+    """The song as OpenLyrics XML"""
+    lines: list[str] = ["<?xml version='1.0' encoding='UTF-8'?>",
+                        '<song xmlns="http://openlyrics.info/namespace/2009/song" version="0.9">',
+                        '<properties>',
+                        '<titles>',
+                        f'<title>{escape(song["title"])}</title>',
+                        '</titles>']
+    if song['verse_order']:
+        lines.append(f'<verseOrder>{escape(song["verse_order"])}</verseOrder>')
+    if song['authors']:
+        lines += ['<authors>', *(f'<author>{escape(a)}</author>' for a in song['authors']), '</authors>']
+    if song['song_books']:
+        lines.append('<songbooks>')
+        for code, nbr in song['song_books']:
+            entry: str = f' entry="{nbr}"' if nbr is not None else ''
+            lines.append(f'<songbook name={quoteattr(code)}{entry}/>')
+        lines.append('</songbooks>')
+    lines.append('</properties>')
+    if song['verses']:
+        lines.append('<lyrics>')
+        for name, lyrics in song['verses']:
+            lines.append(f'<verse name="{name}">\n{escape((lyrics or "").replace("<br>", chr(10)))}\n</verse>')
+        lines.append('</lyrics>')
+    lines.append('</song>\n')
+    return '\n'.join(lines).encode('utf-8')
+
+
+def deflate(data: bytes) -> bytes:
+    # raw deflate, without the zlib header and checksum, as zip stores it
+    compressor = zlib.compressobj(COMPRESS_LEVEL, zlib.DEFLATED, -15)
+    return compressor.compress(data) + compressor.flush()
+
+
+def render_batch(songs: list[dict]) -> list[ZipEntry]:
+    """Runs in a pool process. Each song's OpenLyrics file, compressed"""
+    entries: list[ZipEntry] = []
+    for song in songs:
+        xml: bytes = render_song(song)
+        entries.append(ZipEntry(song['file_name'], deflate(xml), zlib.crc32(xml), len(xml)))
+    return entries
+
+
+def _authors(connection, song_ids: list[int]) -> dict[int, list[str]]:
+    # the links first and then the authors by id: joined, sqlite probes the links
+    # (keyed author first) once per author
+    links: list = connection.execute(select(Author_Song.song_id, Author_Song.author_id)
+                                     .where(Author_Song.song_id.in_(song_ids))).all()  # type: ignore[attr-defined]
+    names: dict[int, tuple[str, str]] = {
+        author_id: (surname, first_names) for author_id, surname, first_names in connection.execute(
+            select(Author.id, Author.surname, Author.first_names)
+            .where(Author.id.in_({a for _, a in links})))}  # type: ignore[union-attr]
+    found: dict[int, list[str]] = {}
+    for song_id, author_id in sorted(links, key=lambda link: names[link[1]]):
+        surname, first_names = names[author_id]
+        found.setdefault(song_id, []).append(f'{first_names} {surname}'.strip())
+    return found
+
+
+def song_batches(engine: Engine, size: int = EXPORT_BATCH) -> Iterator[list[dict]]:
+    """
+    Every Song_Book_Item, then every song in no book, as the dicts render_song takes,
+    size at a time. Paged by id so no cursor is held open between batches
+    """
+    last: int = 0
+    while True:
+        with engine.connect() as connection:
+            items = connection.execute(
+                select(Song_Book_Item.id, Song_Book_Item.nbr, Song_Book_Item.verse_order,
+                       Song.id, Song.title, Song_Book.code)
+                .join(Song, Song.id == Song_Book_Item.song_id)  # type: ignore[arg-type]
+                .join(Song_Book, Song_Book.id == Song_Book_Item.song_book_id)  # type: ignore[arg-type]
+                .where(Song_Book_Item.id > last)  # type: ignore[operator]
+                .order_by(Song_Book_Item.id).limit(size)).all()
+            if not items:
+                break
+            verses: dict[int, list[tuple[str, str]]] = {}
+            for item_id, verse_type, number, part, lyrics in connection.execute(
+                    select(Verse.song_book_item_id, Verse.type, Verse.number, Verse.part, Verse.lyrics)
+                    .where(Verse.song_book_item_id.in_([i[0] for i in items]))  # type: ignore[attr-defined]
+                    .order_by(Verse.id)):
+                verses.setdefault(item_id, []).append((verse_name(verse_type, number, part), lyrics))
+            authors: dict[int, list[str]] = _authors(connection, list({i[3] for i in items}))
+        yield [{'file_name': f'{file_stem(code)}-{nbr if nbr is not None else f"x{item_id}"}-{file_stem(title)}.xml',
+                'title': title, 'authors': authors.get(song_id, []), 'song_books': [(code, nbr)],
+                'verse_order': verse_order, 'verses': verses.get(item_id, [])}
+               for item_id, nbr, verse_order, song_id, title, code in items]
+        last = items[-1][0]
+
+    last = 0
+    while True:
+        with engine.connect() as connection:
+            songs = connection.execute(
+                select(Song.id, Song.title)
+                .where(Song.id > last)  # type: ignore[operator]
+                # not in, made once, rather than a not exists per song: song_id doesn't lead an index
+                .where(Song.id.not_in(select(Song_Book_Item.song_id)))  # type: ignore[union-attr]
+                .order_by(Song.id).limit(size)).all()
+            if not songs:
+                break
+            authors = _authors(connection, [s[0] for s in songs])
+        yield [{'file_name': f'song-{song_id}-{file_stem(title)}.xml', 'title': title,
+                'authors': authors.get(song_id, []), 'song_books': [], 'verse_order': '', 'verses': []}
+               for song_id, title in songs]
+        last = songs[-1][0]
+
+
+def rendered(batches: Iterator[list[dict]], workers: int | None = None,
+             executor: Executor | None = None) -> Iterator[list[ZipEntry]]:
+    """
+    render_batch of each batch, in order, in a pool of workers processes (one per cpu by
+    default), or on executor (of about workers processes) which is left running
+    """
+    workers = (os.cpu_count() or 1) if workers is None else workers
+    if executor is None and workers <= 1:
+        # a single worker would only add the pickling
+        for batch in batches:
+            yield render_batch(batch)
+        return
+    pool: Executor | None = executor
+    if pool is None:
+        # the pool (and multiprocessing) is only imported by an export
+        from concurrent.futures import ProcessPoolExecutor
+        pool = ProcessPoolExecutor(max_workers=workers)
+    pending: deque[Future] = deque()
+    try:
+        for batch in batches:
+            pending.append(pool.submit(render_batch, batch))
+            if len(pending) >= max(workers, 1) * IN_FLIGHT:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        # also when the reader stops early, eg a client disconnecting
+        if executor is None:
+            pool.shutdown(wait=True, cancel_futures=True)
+        else:
+            for future in pending:
+                future.cancel()
+
+
+class ZipStream:
+    """
+    Writes a zip of entries already compressed, as bytes to send on. Their sizes are
+    known before they are written so each header is written once, in order
+    """
+    def __init__(self, date_time: tuple | None = None) -> None:
+        year, month, day, hour, minute, second = date_time or time.localtime()[:6]
+        self._dos_date: int = (year - 1980) << 9 | month << 5 | day
+        self._dos_time: int = hour << 11 | minute << 5 | second // 2
+        self._offset: int = 0
+        # (name, crc, size, compressed size, local header offset) for the central directory
+        self._written: list[tuple[bytes, int, int, int, int]] = []
+
+    def entry(self, entry: ZipEntry) -> bytes:
+        name: bytes = entry.name.encode('utf-8')
+        header: bytes = struct.pack('<IHHHHHIIIHH', 0x04034b50, ZIP_VERSION, UTF8_NAMES, zlib.DEFLATED,
+                                    self._dos_time, self._dos_date, entry.crc, len(entry.data), entry.size,
+                                    len(name), 0) + name
+        self._written.append((name, entry.crc, entry.size, len(entry.data), self._offset))
+        self._offset += len(header) + len(entry.data)
+        return header + entry.data
+
+    def close(self) -> bytes:
+        """The central directory and end records"""
+        parts: list[bytes] = []
+        for name, crc, size, compressed, offset in self._written:
+            # zip64 only for what needs it, an archive of lyrics won't
+            extra: bytes = struct.pack('<HHQ', 0x0001, 8, offset) if offset >= ZIP64_LIMIT else b''
+            version: int = ZIP64_VERSION if extra else ZIP_VERSION
+            parts.append(struct.pack('<IHHHHHHIIIHHHHHII', 0x02014b50, UNIX << 8 | version, version, UTF8_NAMES,
+                                     zlib.DEFLATED, self._dos_time, self._dos_date, crc, compressed, size,
+                                     len(name), len(extra), 0, 0, 0, 0o100644 << 16, min(offset, ZIP64_LIMIT))
+                         + name + extra)
+        directory: bytes = b''.join(parts)
+        count: int = len(self._written)
+        end: bytes = b''
+        if count >= 0xFFFF or self._offset >= ZIP64_LIMIT:
+            end = (struct.pack('<IQHHIIQQQQ', 0x06064b50, 44, ZIP64_VERSION, ZIP64_VERSION, 0, 0,
+                               count, count, len(directory), self._offset)
+                   + struct.pack('<IIQI', 0x07064b50, 0, self._offset + len(directory), 1))
+        end += struct.pack('<IHHHHIIH', 0x06054b50, 0, 0, min(count, 0xFFFF), min(count, 0xFFFF),
+                           len(directory), min(self._offset, ZIP64_LIMIT), 0)
+        return directory + end
+
+
+def zip_chunks(engine: Engine, workers: int | None = None, batch: int = EXPORT_BATCH,
+               executor: Executor | None = None) -> Iterator[bytes]:
+    """The library as a zip of OpenLyrics files, a batch of songs at a time, see rendered()"""
+    archive: ZipStream = ZipStream()
+    for entries in rendered(song_batches(engine, batch), workers, executor):
+        yield b''.join(archive.entry(entry) for entry in entries)
+    yield archive.close()
+
+
+def export_zip(engine: Engine, path: str, workers: int | None = None) -> int:
+    """Write the library to the zip at path, returns its size"""
+    size: int = 0
+    with open(path, 'wb') as output:
+        for chunk in zip_chunks(engine, workers):
+            output.write(chunk)
+            size += len(chunk)
+    return size
+
+
+def main(path: str = 'songs.zip') -> None:
+    db = Dbms()
+    started: float = time.perf_counter()
+    size: int = export_zip(db.engine, path)
+    print(f"Exported {path}: {size / 1024:.0f} KB in {time.perf_counter() - started:.1f}s")
+
+
+if __name__ == "__main__":
+    # python -m prayer_of_hannah.export_song_xml [zip]
+    main(*sys.argv[1:2])
@@ -0,0 +1,383 @@
+import asyncio
+import json
+import threading
+from collections import deque
+from dataclasses import dataclass, field
+from datetime import datetime
+from sqlalchemy import text
+
+from prayer_of_hannah.dbms import LIVE_EVENT_TABLE, Dbms
+from prayer_of_hannah.tenants import Tenant, tenant_cache
+
+'''
+Fan-out of live worship events (slide changes) to every screen following a service.
+
+The operator publishes an event once: it is written to the live_event table, which
+numbers it, and every worker process polls the table (one query per POLL_INTERVAL for
+all its services, only while it has subscribers) so the operator and the screens of a
+service can be served by different workers. In each worker the event is encoded once
+and kept in the service's ring buffer, each subscriber is then woken (O(subscribers))
+and writes the same pre-encoded bytes, there is no database query per client.
+
+A client that reconnects, to any worker, sends the Last-Event-ID it saw and is sent the
+events it missed from the ring buffer. Every event says where the service is, so a
+client that missed more than the ring buffer holds, or whose id the channel hasn't
+seen (eg from another database), is sent the latest event to start again from.
+
+Each tenant has its own channels and polls its own database (see tenants.py).
+'''
+
+# events kept per service for reconnecting clients
+RING_SIZE = 256
+# seconds between keepalive comments on an idle event stream
+KEEPALIVE_SECONDS = 15.0
+# seconds between each worker's reads of the events published by the others
+POLL_INTERVAL = 0.1
+
+
+@dataclass(frozen=True)
+class Event:
+    id: int
+    name: str
+    data: str
+    sse: bytes = field(repr=False)
+
+
+def encode_event(event_id: int, name: str, data: str) -> Event:
+    lines: str = "".join(f"data: {line}\n" for line in data.split("\n"))
+    return Event(event_id, name, data, f"id: {event_id}\nevent: {name}\n{lines}\n".encode())
+
+
+class Channel:
+    """
+    The events of one service. Can be published to from any thread and waited on
+    from threads (wait) or from event loops (wait_async).
+    """
+    def __init__(self, service_id: int, size: int = RING_SIZE) -> None:
+        self.service_id = service_id
+        self.events: deque[Event] = deque(maxlen=size)
+        self.last_id: int = 0
+        # a client that saw this id or a later one missed nothing that has left the ring buffer
+        self.complete_from: int = 0
+        self._condition = threading.Condition()
+        self._async_waiters: set[tuple[asyncio.AbstractEventLoop, asyncio.Event]] = set()
+        self._sync_waiters: int = 0
+
+    @property
+    def subscribers(self) -> int:
+        return len(self._async_waiters) + self._sync_waiters
+
+    def publish(self, name: str, payload: dict) -> Event:
+        """Publish to this process only, numbering the event after the last one"""
+        with self._condition:
+            event: Event = encode_event(self.last_id + 1, name, json.dumps(payload, separators=(',', ':')))
+            self.deliver(event)
+        return event
+
+    def deliver(self, event: Event) -> bool:
+        """Add an event numbered elsewhere (see Broadcaster) and wake the subscribers, False if already had"""
+        with self._condition:
+            if event.id <= self.last_id:
+                return False
+            if len(self.events) == self.events.maxlen:
+                self.complete_from = self.events[0].id
+            self.events.append(event)
+            self.last_id = event.id
+            self._condition.notify_all()
+            waiters = list(self._async_waiters)
+        for loop, ready in waiters:
+            loop.call_soon_threadsafe(ready.set)
+        return True
+
+    def mark_gap(self) -> None:
+        """Events after the last one may have been missed, a client can't resume from before them"""
+        with self._condition:
+            self.complete_from = self.last_id + 1
+
+    def latest(self) -> Event | None:
+        with self._condition:
+            return self.events[-1] if self.events else None
+
+    def since(self, last_id: int) -> list[Event]:
+        """
+        The events after last_id. Just the latest if some of them have gone from the ring
+        buffer or last_id is ahead of the channel, so wasn't sent by it
+        """
+        with self._condition:
+            if last_id == self.last_id or not self.events:
+                return []
+            if last_id > self.last_id or last_id < self.complete_from:
+                return [self.events[-1]]
+            return [e for e in self.events if e.id > last_id]
+
+    def _news(self, last_id: int) -> bool:
+        """If since(last_id) has anything to send"""
+        return last_id != self.last_id and bool(self.events)
+
+    def wait(self, last_id: int, timeout: float = KEEPALIVE_SECONDS) -> list[Event]:
+        with self._condition:
+            self._sync_waiters += 1
+            try:
+                self._condition.wait_for(lambda: self._news(last_id), timeout)
+            finally:
+                self._sync_waiters -= 1
+        return self.since(last_id)
+
+    async def wait_async(self, last_id: int, timeout: float = KEEPALIVE_SECONDS) -> list[Event]:
+        ready: asyncio.Event = asyncio.Event()
+        waiter = (asyncio.get_running_loop(), ready)
+        with self._condition:
+            self._async_waiters.add(waiter)
+            waiting: bool = not self._news(last_id)
+        try:
+            if waiting:
+                try:
+                    await asyncio.wait_for(ready.wait(), timeout)
+                except TimeoutError:
+                    pass
+        finally:
+            with self._condition:
+                self._async_waiters.discard(waiter)
+        return self.since(last_id)
+
+
+class EventStore:
+    """The live_event table, where the worker processes publish events to each other"""
+    def __init__(self, db: Dbms | None = None, keep: int = RING_SIZE) -> None:
+        self._db = db
+        self.keep = keep
+
+    @property
+    def db(self) -> Dbms:
+        # the app's database unless one was given
+        if self._db is None:
+            from prayer_of_hannah import get_db
+            return get_db()
+        return self._db
+
+    def append(self, service_id: int, name: str, data: str) -> int:
+        """Store an event, returns its id. Only the service's latest keep events are kept"""
+        # the file even when serving from memory, the other workers read it from there
+        with self.db.write_engine.begin() as conn:
+            event_id: int = conn.execute(
+                text(f"INSERT INTO {LIVE_EVENT_TABLE} (service_id, name, data, published) "
+                     f"VALUES (:service_id, :name, :data, :published)"),
+                {'service_id': service_id, 'name': name, 'data': data,
+                 'published': datetime.now().isoformat(sep=' ', timespec='microseconds')}).lastrowid
+            conn.execute(text(f"DELETE FROM {LIVE_EVENT_TABLE} WHERE service_id = :service_id AND id < "
+                              f"(SELECT min(id) FROM (SELECT id FROM {LIVE_EVENT_TABLE} WHERE service_id = :service_id "
+                              f"ORDER BY id DESC LIMIT :keep))"),
+                         {'service_id': service_id, 'keep': self.keep})
+        return event_id
+
+    def recent(self, service_id: int, limit: int) -> list[Event]:
+        """The service's latest events, oldest first"""
+        with self.db.write_engine.connect() as conn:
+            rows = conn.execute(text(f"SELECT id, name, data FROM {LIVE_EVENT_TABLE} WHERE service_id = :service_id "
+                                     f"ORDER BY id DESC LIMIT :limit"), {'service_id': service_id, 'limit': limit}).all()
+        return [encode_event(event_id, name, data) for event_id, name, data in reversed(rows)]
+
+    def after(self, last_id: int) -> list[tuple[int, Event]]:
+        """(service id, event) of every event after last_id, in order"""
+        with self.db.write_engine.connect() as conn:
+            rows = conn.execute(text(f"SELECT service_id, id, name, data FROM {LIVE_EVENT_TABLE} WHERE id > :id "
+                                     f"ORDER BY id"), {'id': last_id}).all()
+        return [(service_id, encode_event(event_id, name, data)) for service_id, event_id, name, data in rows]
+
+    def last_id(self) -> int:
+        with self.db.write_engine.connect() as conn:
+            return conn.execute(text(f"SELECT max(id) FROM {LIVE_EVENT_TABLE}")).scalar() or 0
+
+
+class Broadcaster:
+    """
+    The channels of a worker process. With a store events are published through it and
+    a thread polls it for the events the other workers publish, without one they only
+    reach the channels of this process.
+    """
+    def __init__(self, size: int = RING_SIZE, store: EventStore | None = None,
+                 poll_interval: float = POLL_INTERVAL) -> None:
+        self.size = size
+        self.store = store
+        self.poll_interval = poll_interval
+        self._channels: dict[int, Channel] = {}
+        self._lock = threading.Lock()
+        # held while reading the store, so a new channel can't miss the events being polled
+        self._polling = threading.Lock()
+        self._seen: int = 0
+        # polls were skipped, the store may have dropped events the channels haven't seen
+        self._behind: bool = False
+        self._poller: threading.Thread | None = None
+        self._stop_event = threading.Event()
+
+    def opened(self, service_id: int) -> Channel | None:
+        """The service's channel if this worker has it, without reading the store"""
+        with self._lock:
+            return self._channels.get(service_id)
+
+    def channel(self, service_id: int) -> Channel:
+        """The service's channel, the first for a service reads its recent events from the store"""
+        with self._lock:
+            channel: Channel | None = self._channels.get(service_id)
+            if channel is not None:
+                return channel
+            if self.store is None:
+                channel = self._channels[service_id] = Channel(service_id, self.size)
+                return channel
+        with self._polling:
+            with self._lock:
+                channel = self._channels.get(service_id)
+            if channel is not None:
+                return channel
+            if self._poller is None:
+                self._seen = self.store.last_id()
+                self._poller = threading.Thread(target=self._poll_loop, name="Broadcaster", daemon=True)
+                self._poller.start()
+            channel = Channel(service_id, self.size)
+            for event in self.store.recent(service_id, self.size):
+                channel.deliver(event)
+            if len(channel.events) == self.size:
+                # events older than these may have been deleted
+                channel.complete_from = channel.events[0].id
+            with self._lock:
+                self._channels[service_id] = channel
+            return channel
+
+    def publish(self, service_id: int, name: str, payload: dict) -> Event:
+        """Send an event to every client of the service, whichever worker is serving it"""
+        channel: Channel = self.channel(service_id)
+        if self.store is None:
+            return channel.publish(name, payload)
+        data: str = json.dumps(payload, separators=(',', ':'))
+        event: Event = encode_event(self.store.append(service_id, name, data), name, data)
+        # this worker's clients don't wait for the poll
+        channel.deliver(event)
+        return event
+
+    def latest(self, service_id: int) -> Event | None:
+        """The service's last event, whichever worker published it"""
+        if self.store is not None:
+            found: list[Event] = self.store.recent(service_id, 1)
+            return found[0] if found else None
+        return self.channel(service_id).latest()
+
+    def poll(self) -> int:
+        """Deliver the events published since the last poll to this worker's channels, returns how many"""
+        if self.store is None:
+            return 0
+        with self._polling:
+            with self._lock:
+                listening: bool = any(channel.subscribers for channel in self._channels.values())
+            if not listening:
+                # no queries while no one is watching, so the database can be maintained
+                self._behind = True
+                return 0
+            events: list[tuple[int, Event]] = self.store.after(self._seen)
+            if self._behind:
+                with self._lock:
+                    channels: list[Channel] = list(self._channels.values())
+                for channel in channels:
+                    channel.mark_gap()
+                self._behind = False
+            delivered: int = 0
+            for service_id, event in events:
+                self._seen = event.id
+                with self._lock:
+                    channel: Channel | None = self._channels.get(service_id)
+                if channel is not None and channel.deliver(event):
+                    delivered += 1
+            return delivered
+
+    def _poll_loop(self) -> None:
+        while not self._stop_event.wait(self.poll_interval):
+            try:
+                self.poll()
+            except Exception as e:
+                print(f"Reading live events failed: {e}")
+
+    def close(self, service_id: int) -> None:
+        with self._lock:
+            self._channels.pop(service_id, None)
+
+    def shutdown(self) -> None:
+        """Stop polling, eg when the tenant is closed"""
+        self._stop_event.set()
+        if self._poller is not None:
+            self._poller.join()
+
+
+broadcaster: Broadcaster = Broadcaster(store=EventStore())
+
+
+def _tenant_broadcaster(tenant: Tenant) -> Broadcaster:
+    return Broadcaster(store=EventStore(tenant.db))
+
+
+def service_broadcaster() -> Broadcaster:
+    """The current tenant's broadcaster, or the worker's"""
+    found: Broadcaster | None = tenant_cache('broadcaster', _tenant_broadcaster)
+    return broadcaster if found is None else found
+
+
+def last_event_id(value: str | None) -> int:
+    try:
+        return max(int(value or 0), 0)
+    except ValueError:
+        return 0
+
+
+def event_stream(channel: Channel, last_id: int):
+    """Generator of sse bytes for a (WSGI) streamed response"""
+    while True:
+        events: list[Event] = channel.wait(last_id)
+        if not events:
+            yield b": keepalive\n\n"
+            continue
+        for event in events:
+            yield event.sse
+        last_id = events[-1].id
+
+
+SSE_HEADERS: list[tuple[bytes, bytes]] = [
+    (b'content-type', b'text/event-stream'),
+    (b'cache-control', b'no-cache'),
+    (b'x-accel-buffering', b'no'),
+]
+
+
+async def sse_app(scope, receive, send) -> None:
+    """
+    Native ASGI event stream for /live/<service_id>/events, each idle client is just a
+    waiting coroutine so one worker can hold thousands of them.
+    """
+    service_id: int = int(scope['path_params']['service_id'])
+    service_events: Broadcaster = service_broadcaster()
+    # a service's first subscriber queries the store, on a thread so the other streams carry on
+    channel: Channel = service_events.opened(service_id) or await asyncio.to_thread(service_events.channel, service_id)
+    headers: dict[bytes, bytes] = dict(scope.get('headers', []))
+    query: dict = dict(part.split('=', 1) for part in scope.get('query_string', b'').decode().split('&') if '=' in part)
+    last_id: int = last_event_id(headers.get(b'last-event-id', b'').decode() or query.get('last_event_id'))
+
+    async def stream() -> None:
+        nonlocal last_id
+        await send({'type': 'http.response.start', 'status': 200, 'headers': SSE_HEADERS})
+        while True:
+            events: list[Event] = await channel.wait_async(last_id)
+            body: bytes = b"".join(e.sse for e in events) if events else b": keepalive\n\n"
+            await send({'type': 'http.response.body', 'body': body, 'more_body': True})
+            if events:
+                last_id = events[-1].id
+
+    async def disconnected() -> None:
+        while (await receive())['type'] != 'http.disconnect':
+            pass
+
+    tasks: list[asyncio.Task] = [asyncio.create_task(stream()), asyncio.create_task(disconnected())]
+    done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+    for task in pending:
+        task.cancel()
+    for task in done:
+        if not task.cancelled() and isinstance(task.exception(), OSError):
+            # the client went away while we were sending
+            continue
+        task.result()
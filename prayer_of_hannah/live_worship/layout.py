@@ -0,0 +1,222 @@
+import hashlib
+import textwrap
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from sqlalchemy.event import listen
+from sqlmodel import Session
+
+from prayer_of_hannah.models import Verse
+from prayer_of_hannah.tenants import Tenant, tenant_cache
+
+'''
+Server side text fitting: the font size and line and slide breaks of a verse on a screen,
+so every screen shows a verse the same way and cheap tablets don't have to measure text.
+
+Text is measured with the average glyph width and line height of the profile's font (in
+ems), which is close enough for lyrics in a proportional sans serif font. The largest
+font size that fits the whole verse on one slide is used. A verse that would need a font
+below the profile's min_font is split across slides at min_font, breaking between its
+lines where possible. A deck splits its verses with split_slides, so that each of its
+slides fits on one screen of every view, and a long verse is stepped through a slide at
+a time.
+
+Layouts are memoised by (verse id, lyrics hash, profile). Editing a verse's lyrics
+changes the hash, and a flush hook drops the verse's old layouts as it is written.
+'''
+
+# layouts kept per worker process
+LAYOUT_CACHE_SIZE = 8192
+# about what a cached layout and its key take, to size a tenant's cache from its memory budget
+LAYOUT_BYTES = 1024
+# fewer verses than this are laid out in process, starting a pool would cost more
+POOL_THRESHOLD = 200
+
+
+@dataclass(frozen=True)
+class Profile:
+    """A screen resolution and the metrics of the font used on it"""
+    name: str
+    width: int
+    height: int
+    # space left around the text, in pixels
+    margin: int = 40
+    # average glyph width and line height, in ems
+    char_width: float = 0.5
+    line_height: float = 1.25
+    min_font: int = 32
+    max_font: int = 96
+    font_step: int = 2
+
+
+PROFILES: dict[str, Profile] = {p.name: p for p in [
+    Profile('projector', 1920, 1080),
+    Profile('projector_4_3', 1024, 768, margin=24, min_font=24, max_font=72),
+    Profile('tablet', 1280, 800, margin=24, min_font=40, max_font=120),
+    Profile('phone', 412, 915, margin=12, min_font=24, max_font=48),
+]}
+
+
+@dataclass(frozen=True)
+class Layout:
+    font_size: int
+    # the lines of each slide, after wrapping
+    pages: tuple[tuple[str, ...], ...]
+
+
+def lyrics_hash(lines: tuple[str, ...]) -> str:
+    return hashlib.sha1('\n'.join(lines).encode()).hexdigest()
+
+
+def wrap_lines(lines: tuple[str, ...], columns: int) -> list[list[str]]:
+    """Each lyric line wrapped to columns characters"""
+    return [textwrap.wrap(line, columns, break_on_hyphens=False) or [''] for line in lines]
+
+
+def fit(lines: tuple[str, ...], profile: Profile, font_size: int) -> tuple[list[list[str]], int]:
+    """Wrapped lines and the number of lines a slide holds at font_size"""
+    columns: int = max(int((profile.width - 2 * profile.margin) / (font_size * profile.char_width)), 1)
+    rows: int = max(int((profile.height - 2 * profile.margin) / (font_size * profile.line_height)), 1)
+    return wrap_lines(lines, columns), rows
+
+
+def paginate(wrapped: list[list[str]], rows: int) -> tuple[tuple[str, ...], ...]:
+    """Fill slides with whole lyric lines, only splitting a line too long for a slide of its own"""
+    pages: list[list[str]] = [[]]
+    for parts in wrapped:
+        if pages[-1] and len(pages[-1]) + len(parts) > rows:
+            pages.append([])
+        for part in parts:
+            if len(pages[-1]) == rows:
+                pages.append([])
+            pages[-1].append(part)
+    return tuple(tuple(page) for page in pages)
+
+
+def layout_lines(lines: tuple[str, ...], profile: Profile) -> Layout:
+    if not lines:
+        return Layout(profile.max_font, ((),))
+    for font_size in range(profile.max_font, profile.min_font - 1, -profile.font_step):
+        wrapped, rows = fit(lines, profile, font_size)
+        if sum(len(parts) for parts in wrapped) <= rows:
+            return Layout(font_size, (tuple(part for parts in wrapped for part in parts),))
+    wrapped, rows = fit(lines, profile, profile.min_font)
+    return Layout(profile.min_font, paginate(wrapped, rows))
+
+
+def fits(lines: tuple[str, ...], profile: Profile) -> bool:
+    """If the lines fit on one slide at the profile's min_font"""
+    wrapped, rows = fit(lines, profile, profile.min_font)
+    return sum(len(parts) for parts in wrapped) <= rows
+
+
+def split_slides(lines: tuple[str, ...], profiles: list[Profile]) -> tuple[tuple[str, ...], ...]:
+    """
+    The lines split into slides that each fit on one screen of every profile, breaking
+    between lyric lines where possible. A line too long for a slide of its own is split
+    into the rows it wraps to on the narrowest screen.
+    """
+    if all(fits(lines, profile) for profile in profiles):
+        return (lines,)
+    slides: list[list[str]] = [[]]
+    for line in lines:
+        parts: list[str] = [line]
+        if not all(fits((line,), profile) for profile in profiles):
+            parts = max((fit((line,), profile, profile.min_font)[0][0] for profile in profiles), key=len)
+        for part in parts:
+            if slides[-1] and not all(fits((*slides[-1], part), profile) for profile in profiles):
+                slides.append([])
+            slides[-1].append(part)
+    return tuple(tuple(slide) for slide in slides)
+
+
+def _layout_job(job: tuple[int, tuple[str, ...], Profile]) -> tuple[int, tuple[str, ...], Profile, Layout]:
+    verse_id, lines, profile = job
+    return verse_id, lines, profile, layout_lines(lines, profile)
+
+
+LayoutKey = tuple[int, str, str]
+
+
+class LayoutCache:
+    def __init__(self, max_entries: int = LAYOUT_CACHE_SIZE) -> None:
+        self.max_entries = max_entries
+        self._layouts: OrderedDict[LayoutKey, Layout] = OrderedDict()
+        self._verse_keys: dict[int, set[LayoutKey]] = {}
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._layouts)
+
+    def get(self, key: LayoutKey) -> Layout | None:
+        with self._lock:
+            layout: Layout | None = self._layouts.get(key)
+            if layout is not None:
+                self._layouts.move_to_end(key)
+            return layout
+
+    def put(self, key: LayoutKey, layout: Layout) -> None:
+        with self._lock:
+            self._layouts[key] = layout
+            self._layouts.move_to_end(key)
+            self._verse_keys.setdefault(key[0], set()).add(key)
+            while len(self._layouts) > self.max_entries:
+                old, _ = self._layouts.popitem(last=False)
+                self._verse_keys.get(old[0], set()).discard(old)
+
+    def invalidate(self, verse_id: int) -> None:
+        with self._lock:
+            for key in self._verse_keys.pop(verse_id, set()):
+                self._layouts.pop(key, None)
+
+
+_layout_cache: LayoutCache = LayoutCache()
+
+
+def _tenant_layout_cache(tenant: Tenant) -> LayoutCache:
+    return LayoutCache(max(tenant.cache_budget('layouts') // LAYOUT_BYTES, 1))
+
+
+def layout_cache() -> LayoutCache:
+    """The current tenant's layouts (see tenants.py), or the worker's"""
+    cache: LayoutCache | None = tenant_cache('layouts', _tenant_layout_cache)
+    return _layout_cache if cache is None else cache
+
+
+def verse_layout(verse_id: int, lines: tuple[str, ...], profile: Profile) -> Layout:
+    cache: LayoutCache = layout_cache()
+    key: LayoutKey = (verse_id, lyrics_hash(lines), profile.name)
+    layout: Layout | None = cache.get(key)
+    if layout is None:
+        layout = layout_lines(lines, profile)
+        cache.put(key, layout)
+    return layout
+
+
+def precompute_layouts(verses: list[tuple[int, tuple[str, ...]]], profiles: list[Profile],
+                       max_workers: int | None = None, pool_threshold: int = POOL_THRESHOLD) -> int:
+    """Lay out (verse id, lines) for every profile in a process pool, returns the number laid out"""
+    cache: LayoutCache = layout_cache()
+    jobs: list[tuple[int, tuple[str, ...], Profile]] = [
+        (verse_id, lines, profile) for verse_id, lines in dict(verses).items() for profile in profiles
+        if cache.get((verse_id, lyrics_hash(lines), profile.name)) is None]
+    if len(jobs) < pool_threshold:
+        results = map(_layout_job, jobs)
+    else:
+        # imports multiprocessing, which most workers never need
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers=max_workers) as pool:
+            results = iter(list(pool.map(_layout_job, jobs, chunksize=max(len(jobs) // 32, 1))))
+    for verse_id, lines, profile, layout in results:
+        cache.put((verse_id, lyrics_hash(lines), profile.name), layout)
+    return len(jobs)
+
+
+def invalidate_changed_verses(session: Session, flush_context) -> None:
+    """after_flush: drop the layouts of verses whose lyrics were changed or that were deleted"""
+    for obj in session.dirty | session.deleted:
+        if isinstance(obj, Verse) and obj.id is not None:
+            layout_cache().invalidate(obj.id)
+
+
+listen(Session, "after_flush", invalidate_changed_verses)
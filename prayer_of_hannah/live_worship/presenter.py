@@ -0,0 +1,96 @@
+import json
+from dataclasses import dataclass
+from sqlalchemy.engine import Engine
+from sqlmodel import Session
+
+from prayer_of_hannah.models import Service
+from prayer_of_hannah.live_worship.broadcast import Event, service_broadcaster
+from prayer_of_hannah.live_worship.slides import cached_slide, slide_cache
+from prayer_of_hannah.services.decks import deck_document
+
+'''
+The presenter protocol. Every client of a service (the operator's and each display)
+holds the rendered slides within BUFFER_SLIDES of the current position, fetched from
+the deck's slide window. The operator moves to a slide from its buffer at once and
+posts the new index, the server only checks and records the position and broadcasts
+it as a slide event with the deck hash, so every display swaps in the slide from its
+own buffer without another request. Clients top their buffer up in the background as
+the position moves.
+
+The position is the service's last slide event, which is kept in the database (see
+broadcast.py), so any worker process can take the operator's next move or tell a new
+display where the service is.
+'''
+
+# slides either side of the current one every client keeps
+BUFFER_SLIDES = 3
+MAX_BUFFER_SLIDES = 20
+
+
+@dataclass(frozen=True)
+class Position:
+    service_id: int
+    index: int
+    deck_hash: str
+    count: int
+    event_id: int
+
+
+class DeckChanged(Exception):
+    """The client's deck is not the service's current deck"""
+    def __init__(self, deck_hash: str | None) -> None:
+        super().__init__(f"The service's deck is now {deck_hash}")
+        self.deck_hash = deck_hash
+
+
+def current_deck(engine: Engine, service_id: int) -> tuple[str, dict] | None:
+    """The hash and document of the deck a service shows"""
+    # a pre-warmed service knows its deck without a query
+    deck_hash: str | None = slide_cache().service_deck(service_id)
+    if deck_hash is None:
+        with Session(engine) as session:
+            service: Service | None = session.get(Service, service_id)
+            deck_hash = service.deck_hash if service is not None else None
+    deck: dict | None = deck_document(engine, deck_hash) if deck_hash else None
+    if deck_hash is None or deck is None:
+        return None
+    return deck_hash, deck
+
+
+def slide_window(deck_hash: str, deck: dict, index: int, view: str, k: int = BUFFER_SLIDES) -> dict[int, str]:
+    """The rendered slides within k of index, needs an app context"""
+    k = min(max(k, 0), MAX_BUFFER_SLIDES)
+    first: int = max(index - k, 0)
+    last: int = min(index + k, len(deck['slides']) - 1)
+    return {i: cached_slide(deck_hash, deck, i, view) for i in range(first, last + 1)}
+
+
+def move(engine: Engine, service_id: int, index: int, deck_hash: str | None = None) -> Position:
+    """
+    Record and broadcast the new position, clamped to the deck. Raises DeckChanged if the
+    client moved within a deck the service no longer shows, LookupError if it has no deck.
+    """
+    found: tuple[str, dict] | None = current_deck(engine, service_id)
+    if found is None:
+        raise LookupError(f"Service {service_id} has no deck")
+    current_hash, deck = found
+    if deck_hash is not None and deck_hash != current_hash:
+        raise DeckChanged(current_hash)
+    count: int = len(deck['slides'])
+    index = min(max(index, 0), count - 1)
+    event: Event = service_broadcaster().publish(service_id, 'slide', {'index': index, 'hash': current_hash, 'count': count})
+    return Position(service_id, index, current_hash, count, event.id)
+
+
+def position(service_id: int) -> Position | None:
+    """Where the service is, None if it hasn't started or has ended"""
+    event: Event | None = service_broadcaster().latest(service_id)
+    if event is None or event.name != 'slide':
+        return None
+    slide: dict = json.loads(event.data)
+    return Position(service_id, slide['index'], slide['hash'], slide['count'], event.id)
+
+
+def end(service_id: int) -> Event:
+    """Tell every display the service has ended"""
+    return service_broadcaster().publish(service_id, 'end', {})
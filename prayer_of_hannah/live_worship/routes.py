@@ -1,6 +1,118 @@
-from flask import render_template
+from flask import Response, abort, jsonify, render_template, request
 from prayer_of_hannah.live_worship import bp
+from sqlmodel import Session
+from prayer_of_hannah.live_worship.broadcast import event_stream, last_event_id, SSE_HEADERS, service_broadcaster
+from prayer_of_hannah.live_worship.slides import VIEWS, DEFAULT_VIEW, cached_slide
+from prayer_of_hannah.live_worship import presenter
+from prayer_of_hannah.models import Verse
+from prayer_of_hannah.live_worship.layout import PROFILES, verse_layout
+from prayer_of_hannah.services import decks, prewarm
+from prayer_of_hannah.services.decks import verse_lines
+from prayer_of_hannah.services.decks import IMMUTABLE
+from prayer_of_hannah import get_db, get_dbe
+from prayer_of_hannah import queries
 
 @bp.route('/')
 def index():
     return render_template('live_worship/index.html')
+
+@bp.get('/htmx/item/<int:song_book_item_id>')
+async def song_book_item(song_book_item_id: int):
+    async with get_db().async_session() as session:
+        item = await queries.async_song_book_item(session, song_book_item_id)
+    if item is None:
+        abort(404)
+    verses = sorted(item.verses, key=lambda v: (v.type, v.number, v.part or ''))
+    return render_template('live_worship/item.html', item = item, verses = verses)
+
+@bp.get('/layout/<int:verse_id>')
+def layout(verse_id: int):
+    profile = PROFILES.get(request.args.get('profile', 'projector'))
+    if profile is None:
+        abort(404)
+    with Session(get_dbe()) as session:
+        verse = session.get(Verse, verse_id)
+        if verse is None:
+            abort(404)
+        lines = tuple(verse_lines(verse.lyrics))
+    fitted = verse_layout(verse_id, lines, profile)
+    return jsonify(verse_id = verse_id, profile = profile.name, font_size = fitted.font_size,
+                   pages = [list(page) for page in fitted.pages])
+
+@bp.get('/<int:service_id>/')
+def display(service_id: int):
+    view: str = request.args.get('view', DEFAULT_VIEW)
+    if view not in VIEWS:
+        abort(404)
+    return render_template('live_worship/display.html', service_id = service_id, view = view, k = presenter.BUFFER_SLIDES)
+
+@bp.get('/<int:service_id>/slides/<int:index>')
+def rendered_slide(service_id: int, index: int):
+    view: str = request.args.get('view', DEFAULT_VIEW)
+    if view not in VIEWS:
+        abort(404)
+    found = presenter.current_deck(get_dbe(), service_id)
+    if found is None or not 0 <= index < len(found[1]['slides']):
+        abort(404)
+    return cached_slide(found[0], found[1], index, view)
+
+@bp.get('/decks/<deck_hash>/window')
+def slide_window(deck_hash: str):
+    view: str = request.args.get('view', DEFAULT_VIEW)
+    index = request.args.get('index', 0, type = int)
+    k = request.args.get('k', presenter.BUFFER_SLIDES, type = int)
+    deck = decks.deck_document(get_dbe(), deck_hash)
+    if view not in VIEWS or deck is None:
+        abort(404)
+    slides = presenter.slide_window(deck_hash, deck, index, view, k)
+    response = jsonify(hash = deck_hash, count = len(deck['slides']), slides = slides)
+    # named by the deck hash so never changes
+    response.headers['Cache-Control'] = IMMUTABLE
+    return response
+
+def position_json(position):
+    return jsonify(index = position.index, hash = position.deck_hash, count = position.count, id = position.event_id)
+
+@bp.get('/<int:service_id>/position')
+def position(service_id: int):
+    current = presenter.position(service_id)
+    if current is None:
+        found = presenter.current_deck(get_dbe(), service_id)
+        if found is None:
+            abort(404)
+        return jsonify(index = None, hash = found[0], count = len(found[1]['slides']), id = 0)
+    return position_json(current)
+
+@bp.get('/<int:service_id>/present')
+def present(service_id: int):
+    return render_template('live_worship/presenter.html', service_id = service_id, k = presenter.BUFFER_SLIDES)
+
+@bp.post('/<int:service_id>/slide')
+def slide(service_id: int):
+    data: dict = request.get_json(silent=True) or request.form
+    try:
+        index: int = int(data['index'])
+    except (KeyError, TypeError, ValueError):
+        abort(400)
+    # the slide event also keeps database maintenance off while the service is live
+    try:
+        moved = presenter.move(get_dbe(), service_id, index, data.get('hash'))
+    except presenter.DeckChanged as e:
+        # the client reloads its buffer from the new deck
+        return jsonify(hash = e.deck_hash), 409
+    except LookupError:
+        abort(404)
+    return position_json(moved)
+
+@bp.post('/<int:service_id>/end')
+def end(service_id: int):
+    event = presenter.end(service_id)
+    prewarm.end_service(service_id)
+    return jsonify(id = event.id)
+
+@bp.get('/<int:service_id>/events')
+def events(service_id: int):
+    # used by the WSGI dev server, under ASGI prayer_of_hannah.asgi serves this with broadcast.sse_app
+    last_id: int = last_event_id(request.headers.get('Last-Event-ID') or request.args.get('last_event_id'))
+    return Response(event_stream(service_broadcaster().channel(service_id), last_id),
+                    headers = [(k.decode(), v.decode()) for k, v in SSE_HEADERS])
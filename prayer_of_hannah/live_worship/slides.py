@@ -0,0 +1,316 @@
+import threading
+import time
+from collections import Counter, OrderedDict
+from itertools import islice
+from flask import current_app
+
+from prayer_of_hannah.live_worship.layout import PROFILES, Layout, Profile, layout_lines, verse_layout
+from prayer_of_hannah.shared_cache import SharedCache, shared_cache
+from prayer_of_hannah.tenants import Tenant, tenant_cache
+
+'''
+Rendered slides, cached by (deck hash, slide index, view).
+
+Every view of a slide is rendered in one pass (render_views): the slide's context, eg
+the next slide for the confidence monitor, is worked out once and each view's template
+renders it. A client only ever picks its view out of the cache, so the rendering cost
+depends on the number of slides not the number of clients.
+
+A deck is immutable so a rendered slide never goes stale, it is only dropped when the
+cache is full. With a shared cache (SHARED_CACHE_FILE) a slide one worker has rendered
+is read from it by the others instead of being rendered again. Entries for a service
+that is about to start or is live are pinned (see services/prewarm.py) so the least
+recently used eviction can't drop them mid service.
+'''
+
+# the output views a slide is rendered for, each has a template live_worship/slides/<view>.html
+#   projector      the main screen
+#   confidence     stage monitor for the band and preacher, with a preview of the next slide
+#   large_print    tablets for people following close up
+#   high_contrast  large print in yellow on black
+VIEWS = ('projector', 'confidence', 'large_print', 'high_contrast')
+# the layout profile (see layout.py) each view fits its text to, None for views that don't
+VIEW_PROFILES: dict[str, str | None] = {
+    'projector': 'projector',
+    'confidence': None,
+    'large_print': 'tablet',
+    'high_contrast': 'tablet',
+}
+# views without a layout profile show backgrounds at this profile's size
+THUMBNAIL_PROFILE = 'phone'
+# media files are served by the media blueprint
+MEDIA_URL = '/media/'
+DEFAULT_VIEW = 'projector'
+# rendered slides kept per worker process
+SLIDE_CACHE_SIZE = 4096
+# slides in the cache shared by the workers (see shared_cache.py), by '<deck hash>/<index>/<view>'
+SHARED_NAMESPACE = 'slides'
+
+SlideKey = tuple[str, int, str]
+
+
+def view_profiles(views: tuple[str, ...] = VIEWS) -> list[Profile]:
+    """The layout profiles the views fit their text to"""
+    return [PROFILES[name] for name in sorted({p for p in (VIEW_PROFILES.get(view) for view in views) if p is not None})]
+
+
+class SlideCache:
+    """
+    Least recently used cache of rendered slides. Pinned entries are never evicted and
+    don't count towards max_entries. max_bytes, if given, bounds the length of all the
+    html kept, as far as dropping unpinned entries can.
+    """
+    def __init__(self, max_entries: int = SLIDE_CACHE_SIZE, max_bytes: int | None = None) -> None:
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._slides: OrderedDict[SlideKey, str] = OrderedDict()
+        self.bytes: int = 0
+        self._pins: dict[int, set[SlideKey]] = {}
+        self._pinned: Counter[SlideKey] = Counter()
+        self._service_decks: dict[int, str] = {}
+        self._lock = threading.Lock()
+        self.hits: int = 0
+        self.misses: int = 0
+
+    def __len__(self) -> int:
+        return len(self._slides)
+
+    def get(self, key: SlideKey) -> str | None:
+        with self._lock:
+            html: str | None = self._slides.get(key)
+            if html is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._slides.move_to_end(key)
+            return html
+
+    def put(self, key: SlideKey, html: str) -> None:
+        self.put_many({key: html})
+
+    def put_many(self, slides: dict[SlideKey, str]) -> None:
+        with self._lock:
+            for key, html in slides.items():
+                self.bytes += len(html) - len(self._slides.get(key, ''))
+                self._slides[key] = html
+                self._slides.move_to_end(key)
+            self._evict()
+
+    def _evict(self) -> None:
+        excess: int = len(self._slides) - self.max_entries
+        if excess > 0 and self._pinned:
+            excess -= sum(1 for key in self._pinned if key in self._slides)
+        if self.max_bytes is not None and self.bytes > self.max_bytes:
+            self._evict_bytes(max(excess, 0))
+            return
+        if excess <= 0:
+            return
+        for key in list(islice((k for k in self._slides if k not in self._pinned), excess)):
+            self.bytes -= len(self._slides.pop(key))
+
+    def _evict_bytes(self, excess: int) -> None:
+        """Drop the excess oldest unpinned entries, and more until the html fits max_bytes"""
+        assert self.max_bytes is not None
+        over: int = self.bytes - self.max_bytes
+        dropped: list[SlideKey] = []
+        for key, html in self._slides.items():
+            if len(dropped) >= excess and over <= 0:
+                break
+            if key not in self._pinned:
+                dropped.append(key)
+                over -= len(html)
+        for key in dropped:
+            self.bytes -= len(self._slides.pop(key))
+
+    def pin(self, service_id: int, deck_hash: str, keys: list[SlideKey]) -> None:
+        """Keep keys cached until unpin(service_id), and remember the deck the service shows"""
+        with self._lock:
+            self._unpin(service_id)
+            self._pins[service_id] = set(keys)
+            self._pinned.update(self._pins[service_id])
+            self._service_decks[service_id] = deck_hash
+
+    def unpin(self, service_id: int) -> None:
+        with self._lock:
+            self._unpin(service_id)
+            self._evict()
+
+    def _unpin(self, service_id: int) -> None:
+        self._pinned.subtract(self._pins.pop(service_id, set()))
+        self._pinned = +self._pinned
+        self._service_decks.pop(service_id, None)
+
+    def pinned_services(self) -> list[int]:
+        return list(self._pins)
+
+    def is_pinned(self, key: SlideKey) -> bool:
+        return key in self._pinned
+
+    def service_deck(self, service_id: int) -> str | None:
+        """The hash of the deck pinned for a service"""
+        return self._service_decks.get(service_id)
+
+
+_slide_cache: SlideCache = SlideCache()
+
+
+def _tenant_slide_cache(tenant: Tenant) -> SlideCache:
+    return SlideCache(max_bytes=tenant.cache_budget('slides'))
+
+
+def slide_cache() -> SlideCache:
+    """The current tenant's slides (see tenants.py), or the worker's"""
+    cache: SlideCache | None = tenant_cache('slides', _tenant_slide_cache)
+    return _slide_cache if cache is None else cache
+
+
+def slide_context(deck: dict, index: int) -> dict:
+    """What every view of a slide needs"""
+    slides: list[dict] = deck['slides']
+    slide: dict = slides[index]
+    next_slide: dict | None = slides[index + 1] if index + 1 < len(slides) else None
+    return {
+        'deck': deck,
+        'index': index,
+        'count': len(slides),
+        'slide': slide,
+        'item': deck['items'][slide['item']],
+        'next_slide': next_slide,
+        'next_item': deck['items'][next_slide['item']] if next_slide is not None else None,
+    }
+
+
+def slide_layout(slide: dict, profile_name: str | None) -> Layout | None:
+    """The layout of a slide, always one page: the deck has split its verses into slides that fit"""
+    if profile_name is None:
+        return None
+    lines: tuple[str, ...] = tuple(slide['lines'])
+    if slide.get('id') is None:
+        fitted: Layout = layout_lines(lines, PROFILES[profile_name])
+    else:
+        fitted = verse_layout(slide['id'], lines, PROFILES[profile_name])
+    if len(fitted.pages) > 1:
+        # a deck from before verses were split (format 3), its slides are shown whole as they were
+        return Layout(fitted.font_size, (tuple(line for page in fitted.pages for line in page),))
+    return fitted
+
+
+# seconds between checks that another worker hasn't made or removed media variants
+BACKGROUND_CHECK_SECONDS = 1.0
+
+
+class BackgroundCache:
+    """
+    The pre-generated media variant each view's background uses, by (media hash, view).
+    Variants are made by whichever worker processed the media, so the entries are
+    dropped when the media_variant table has changed since they were looked up
+    """
+    def __init__(self) -> None:
+        self.entries: dict[tuple[str, str], dict | None] = {}
+        self.version: tuple | None = None
+        self.checked_at: float = 0.0
+        self.lock = threading.Lock()
+
+    def check(self) -> None:
+        """Drop the entries if the variants changed, at most every BACKGROUND_CHECK_SECONDS"""
+        now: float = time.monotonic()
+        if now - self.checked_at < BACKGROUND_CHECK_SECONDS:
+            return
+        from prayer_of_hannah import get_dbe
+        from prayer_of_hannah.models import Media_Variant
+        from sqlmodel import Session, func, select
+        with Session(get_dbe()) as session:
+            version: tuple = tuple(session.exec(select(func.max(Media_Variant.id), func.count())
+                                                .select_from(Media_Variant)).one())
+        with self.lock:
+            if version != self.version:
+                self.entries.clear()
+                self.version = version
+            self.checked_at = now
+
+    def clear(self) -> None:
+        with self.lock:
+            self.entries.clear()
+            self.checked_at = 0.0
+
+
+_backgrounds: BackgroundCache = BackgroundCache()
+
+
+def _background_cache() -> BackgroundCache:
+    cache: BackgroundCache | None = tenant_cache('backgrounds', lambda tenant: BackgroundCache())
+    return _backgrounds if cache is None else cache
+
+
+def item_background(item: dict, view: str) -> dict | None:
+    """The url of the best variant of the item's background for the view's screen"""
+    content_hash: str | None = item.get('background')
+    if not content_hash:
+        return None
+    key: tuple[str, str] = (content_hash, view)
+    backgrounds: BackgroundCache = _background_cache()
+    backgrounds.check()
+    with backgrounds.lock:
+        if key in backgrounds.entries:
+            return backgrounds.entries[key]
+
+    from prayer_of_hannah import get_dbe
+    from prayer_of_hannah.media.pipeline import best_variant
+    from prayer_of_hannah.models import Media
+    from sqlmodel import Session, select
+    profile = PROFILES[VIEW_PROFILES.get(view) or THUMBNAIL_PROFILE]
+    with Session(get_dbe()) as session:
+        media: Media | None = session.exec(select(Media).where(Media.content_hash == content_hash)).first()
+        variant = best_variant(list(media.variants), profile.width, profile.height) if media is not None else None
+        background: dict | None = None if media is None else {
+            'url': MEDIA_URL + (variant.content_hash if variant is not None else content_hash),
+            'video': bool(item.get('background_video')) and (variant is None or variant.mime_type.startswith('video/')),
+        }
+    with backgrounds.lock:
+        backgrounds.entries[key] = background
+    return background
+
+
+def forget_backgrounds() -> None:
+    """New variants have been made, slides rendered from now on use them"""
+    _background_cache().clear()
+
+
+def render_views(deck: dict, index: int, views: tuple[str, ...] = VIEWS) -> dict[str, str]:
+    """Render one slide of a deck for every view, needs an app context"""
+    context: dict = slide_context(deck, index)
+    env = current_app.jinja_env
+    return {view: env.get_template(f'live_worship/slides/{view}.html')
+            .render(context, layout=slide_layout(context['slide'], VIEW_PROFILES.get(view)),
+                    background=item_background(context['item'], view))
+            for view in views}
+
+
+def render_slide(deck: dict, index: int, view: str) -> str:
+    return render_views(deck, index, (view,))[view]
+
+
+def cache_views(deck_hash: str, deck: dict, index: int, views: tuple[str, ...] = VIEWS) -> dict[str, str]:
+    """Render and cache every view of a slide, for the other workers too if there is a shared cache"""
+    rendered: dict[str, str] = render_views(deck, index, views)
+    slide_cache().put_many({(deck_hash, index, view): html for view, html in rendered.items()})
+    shared: SharedCache | None = shared_cache()
+    if shared is not None:
+        shared.put_many(SHARED_NAMESPACE, {f'{deck_hash}/{index}/{view}': html.encode('utf-8')
+                                           for view, html in rendered.items()})
+    return rendered
+
+
+def cached_slide(deck_hash: str, deck: dict, index: int, view: str) -> str:
+    cache: SlideCache = slide_cache()
+    html: str | None = cache.get((deck_hash, index, view))
+    if html is not None:
+        return html
+    shared: SharedCache | None = shared_cache()
+    found: bytes | None = None if shared is None else shared.get(SHARED_NAMESPACE, f'{deck_hash}/{index}/{view}')
+    if found is not None:
+        html = found.decode('utf-8')
+        cache.put((deck_hash, index, view), html)
+        return html
+    # the other views of this slide are about to be wanted by the other screens
+    return cache_views(deck_hash, deck, index)[view]
@@ -1,8 +1,14 @@
 import xmltodict # type: ignore
 import os
-from dbms import Dbms
+import sys
+import zipfile
+from collections.abc import Iterator
+from prayer_of_hannah.dbms import Dbms
 from sqlmodel import Session, select
-from models import Author, Song_Book, Song, Song_Book_Item, Verse
+from prayer_of_hannah.models import Author, Song_Book, Song, Song_Book_Item, Verse
+from prayer_of_hannah.verse_order import SKIPPED_VERSE_TYPES, VERSE_TYPES, check_verse_order, parse_verse_code
+
+# python -m prayer_of_hannah.load_song_xml [directory or zip]
 
 #PATH_TO_XML = 'resources'
 PATH_TO_XML = 'xml'
@@ -23,13 +29,14 @@ def get_titles(xml_dict) -> list:
     return get_list_items(xml_dict['song']['properties']['titles']['title'])
 
 def get_verse_order(xml_dict) -> str:
-    return xml_dict['song']['properties']['verseOrder']
+    return xml_dict['song']['properties'].get('verseOrder') or ''
 
 def get_authors(xml_dict) -> list:
-    return get_list_items(xml_dict['song']['properties']['authors']['author'])
+    authors = xml_dict['song']['properties'].get('authors')
+    return get_list_items(authors['author']) if authors else []
 
 def get_song_books(xml_dict) -> list:
-    song_books = xml_dict['song']['properties']['songbooks']['songbook']
+    song_books = (xml_dict['song']['properties'].get('songbooks') or {}).get('songbook') or []
     result: list = []
 
     book: str = ''
@@ -43,8 +50,8 @@ def get_song_books(xml_dict) -> list:
         result = [sb]
     else:
         for item in song_books:
-            book = item.get('@name')
-            nbr = item.get('@entry')
+            book = str(item.get('@name'))
+            nbr = str(item.get('@entry'))
             sb = [book, nbr]
             if len(result) >= 1:
                 result.append(sb)
@@ -54,7 +61,7 @@ def get_song_books(xml_dict) -> list:
     return result
 
 def get_verses(xml_dict) -> list:
-    verses = xml_dict['song']['lyrics']['verse']
+    verses = (xml_dict['song'].get('lyrics') or {}).get('verse') or []
 
     result: list = []
     verse_code: str =''
@@ -65,7 +72,7 @@ def get_verses(xml_dict) -> list:
         #print('Dict verses:', end='')
         verse_code = str(verses.get('@name'))
         #print(f'{verse_code}')
-        verse_lines = str(verses.get('#text'))
+        verse_lines = verses.get('#text') or ''
         #print(f'{lines}')
         verse = [verse_code, verse_lines]
         result = [verse]
@@ -74,7 +81,7 @@ def get_verses(xml_dict) -> list:
             #print('list verses:', end='')
             verse_code = str(v.get('@name'))
             #print(f'{verse_code}')
-            verse_lines = str(v.get('#text'))
+            verse_lines = v.get('#text') or ''
             #print(f'{lines}')
             verse = [verse_code, verse_lines]
 
@@ -93,7 +100,7 @@ def save_authors(session: Session, authors: list) -> list:
             fn: str = ''
             for n in names[0:-1]:
                 if len(fn) >= 1:
-                    fn = ' ' + n
+                    fn = fn + ' ' + n
                 else:
                     fn = n
             fn = fn.strip()
@@ -105,7 +112,8 @@ def save_authors(session: Session, authors: list) -> list:
                 result.append(a)
                 #print(f'Saving author:{a}')
             else:
-                pass
+                # an author of an earlier song, this song is theirs too
+                result.append(author_check)
                 #print(f'NOT Saving author:{fn} {sn}')
         return result
 
@@ -164,83 +172,108 @@ def save_verses(session: Session, titles: list, song_books: list, verses: list)
                         vn: str = verse[0]
                         lyric: str = verse[1]
 
-                        vt: str = vn[0]
-                        if vt != "o":
-                            if vt not in "vcbe":
-                                print(f"Invalid Verse type for Song: {song}")
-
-                            nbr: int = int(vn[1])
-
-                            lines: list = lyric.split("\n")
-                            br_lyric: str = ''
-                            for li in lines:
-                                if len(br_lyric) >= 1:
-                                    br_lyric = br_lyric + "<br>" + li
-                                else:
-                                    br_lyric = li
-
-                            verse_check: Verse | None = session.exec(select(Verse).where(Verse.song_book_item == song_book_item_check)).first()
-
-                            if verse_check is None:
-                                v: Verse = Verse(song_book_item=song_book_item_check, type=vt, number=nbr, lyrics=br_lyric)
-                                session.add(v)
-
-
-def main() -> None:
-    db = Dbms()
-    db.create_database_structure()
+                        # eg v1, c (c1) or v1a, the first part of verse 1
+                        code = parse_verse_code(vn)
+                        if code is None or code[0] not in VERSE_TYPES:
+                            if code is None or code[0] not in SKIPPED_VERSE_TYPES:
+                                print(f"Invalid Verse name {vn} for Song: {song.title}")
+                            continue
+                        vt, nbr, part = code
+
+                        lines: list = lyric.split("\n")
+                        br_lyric: str = ''
+                        for li in lines:
+                            if len(br_lyric) >= 1:
+                                br_lyric = br_lyric + "<br>" + li
+                            else:
+                                br_lyric = li
+
+                        verse_check: Verse | None = session.exec(select(Verse)
+                                                                 .where(Verse.song_book_item == song_book_item_check)
+                                                                 .where(Verse.type == vt)
+                                                                 .where(Verse.number == nbr)
+                                                                 .where(Verse.part == part)).first()
+
+                        if verse_check is None:
+                            v: Verse = Verse(song_book_item=song_book_item_check, type=vt, number=nbr, part=part,
+                                             lyrics=br_lyric)
+                            session.add(v)
+
+                    for problem in check_verse_order(song_book_item_check.verse_order or '', song_book_item_check.verses):
+                        print(f"{song.title}: {problem}")
+
+
+def song_xml_files(path: str) -> Iterator[tuple[str, str]]:
+    """The name and text of each song, from a directory of xml files or a zip of them"""
+    if zipfile.is_zipfile(path):
+        with zipfile.ZipFile(path) as archive:
+            for name in sorted(archive.namelist()):
+                if name.endswith('.xml'):
+                    yield name, archive.read(name).decode('utf-8')
+        return
 
     # Scan the directory and get
     # an iterator of os.DirEntry objects
     # corresponding to entries in it
     # using os.scandir() method
-    obj = sorted(os.scandir(PATH_TO_XML), key=lambda entry: entry.name)
-
-    file_number: int = 0
-    # List all files and directories in the specified path
-    print("Files in '% s':" % PATH_TO_XML)
+    obj = sorted(os.scandir(path), key=lambda entry: entry.name)
     for file in obj:
         if file.is_file():
-            file_number += 1
-            #print(f'{file_number}', end='')
+            with open(path+'/'+file.name) as f:
+                yield file.name, f.read()
 
-            with open(PATH_TO_XML+'/'+file.name) as f:
-                xml_string = f.read()
 
-                xml_dict = xmltodict.parse(xml_string)
+def load_song(db: Dbms, xml_string: str) -> None:
+    xml_dict = xmltodict.parse(xml_string)
 
-                titles: list = get_titles(xml_dict)
-                #print(f'{titles}', end='')
+    titles: list = get_titles(xml_dict)
+    #print(f'{titles}', end='')
 
-                verse_order: str = get_verse_order(xml_dict)
-                #print(f'#{verse_order}', end='')
+    verse_order: str = get_verse_order(xml_dict)
+    #print(f'#{verse_order}', end='')
 
-                authors: list = get_authors(xml_dict)
-                #print(f'#{authors}', end='')
+    authors: list = get_authors(xml_dict)
+    #print(f'#{authors}', end='')
 
-                song_books: list = get_song_books(xml_dict)
-                #print(f'#{song_books}', end='')
-                #print('')
+    song_books: list = get_song_books(xml_dict)
+    #print(f'#{song_books}', end='')
+    #print('')
 
-                verses: list = get_verses(xml_dict)
-                #print(f'#{verses}')
+    verses: list = get_verses(xml_dict)
+    #print(f'#{verses}')
 
-                with Session(db.engine) as session:
-                    model_authors: list = save_authors(session, authors)
-                    save_song(session, titles, model_authors)
-                    save_song_books(session, song_books)
-                    session.commit()
+    with db.write_session() as session:
+        model_authors: list = save_authors(session, authors)
+        save_song(session, titles, model_authors)
+        save_song_books(session, song_books)
+        session.commit()
 
-                with Session(db.engine) as session:
-                    save_song_book_item(session, titles, song_books, verse_order)
-                    session.commit()
+    with db.write_session() as session:
+        save_song_book_item(session, titles, song_books, verse_order)
+        session.commit()
 
-                with Session(db.engine) as session:
-                    save_verses(session, titles, song_books, verses)
-                    session.commit()
+    with db.write_session() as session:
+        save_verses(session, titles, song_books, verses)
+        session.commit()
 
+
+def main(path: str = PATH_TO_XML) -> None:
+    db = Dbms()
+    db.create_database_structure()
+
+    file_number: int = 0
+    # List all files and directories in the specified path
+    print("Files in '% s':" % path)
+    for name, xml_string in song_xml_files(path):
+        file_number += 1
+        #print(f'{file_number}', end='')
+        load_song(db, xml_string)
+
+    db.maintenance.after_bulk_import()
+    print(f"Database status: {db.maintenance.status()}")
     print("end")
 
 
 if __name__ == "__main__":
-    main()
+    # a directory of xml files or a zip made by export_song_xml.py
+    main(*sys.argv[1:2])
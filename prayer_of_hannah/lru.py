@@ -0,0 +1,52 @@
+import threading
+from collections import OrderedDict
+from collections.abc import Callable, Hashable
+
+'''
+The least recently used cache behind the in memory caches of immutable things (deck
+bundles, deltas, media lookups). Bounded by its number of entries, and optionally by
+the total size of its values so a tenant's caches fit its share of memory (see
+tenants.py).
+'''
+
+
+class LruCache[K: Hashable, V]:
+    """
+    Thread safe. With max_bytes each value's size is measured once, by size (len unless
+    given), when it is put. A value bigger than max_bytes on its own is not kept.
+    """
+    def __init__(self, max_entries: int, max_bytes: int | None = None, size: Callable[[V], int] = len) -> None:
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._size = size
+        self._entries: OrderedDict[K, tuple[V, int]] = OrderedDict()
+        self.bytes: int = 0
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: K) -> V | None:
+        with self._lock:
+            entry: tuple[V, int] | None = self._entries.get(key)
+            if entry is None:
+                return None
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def put(self, key: K, value: V) -> None:
+        size: int = self._size(value) if self.max_bytes is not None else 0
+        with self._lock:
+            old: tuple[V, int] | None = self._entries.pop(key, None)
+            if old is not None:
+                self.bytes -= old[1]
+            self._entries[key] = (value, size)
+            self.bytes += size
+            while len(self._entries) > self.max_entries or (self.max_bytes is not None and self.bytes > self.max_bytes):
+                _, (_, dropped) = self._entries.popitem(last=False)
+                self.bytes -= dropped
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self.bytes = 0
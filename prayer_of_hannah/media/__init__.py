@@ -0,0 +1,6 @@
+from flask import Blueprint
+
+bp = Blueprint('media', __name__)
+
+
+from prayer_of_hannah.media import routes
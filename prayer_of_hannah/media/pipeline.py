@@ -0,0 +1,404 @@
+import contextvars
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+from concurrent.futures import Future
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
+from functools import partial
+from typing import TYPE_CHECKING
+from sqlmodel import Session, col, delete, func, select
+
+from prayer_of_hannah.dbms import Dbms
+from prayer_of_hannah.models import Media, MediaType, Media_Job, Media_Variant
+from prayer_of_hannah.media.store import media_dir, media_path, store_file
+from prayer_of_hannah.tenants import Tenant, tenant_cache
+
+if TYPE_CHECKING:
+    from concurrent.futures import ProcessPoolExecutor
+
+'''
+Makes the variants of uploaded images and videos: resized copies for projectors,
+tablets and slow links, and a thumbnail. The work runs in a process pool, submitting a
+job only queues it so a request handler never waits for it, and the job's progress can
+be polled. Each variant is stored by content hash like the original, and a file whose
+content has already been processed (eg the same background added to two songs) reuses
+the variants already made instead of being processed again.
+
+Images need Pillow (pip install prayer_of_hannah[media]) and videos need ffmpeg and
+ffprobe on the PATH, a job whose tool is missing fails with a message saying so.
+
+The pool is the worker's, shared by every tenant's pipeline (see tenants.py), so a host
+with many congregations starts one set of processes. Jobs are kept in the database
+(media_job) so their progress can be polled from any worker, not just the one that
+submitted them: a finished job can be polled for JOB_TTL seconds and at most MAX_JOBS are
+kept per database.
+'''
+
+# seconds a finished job is kept for its progress to be polled
+JOB_TTL = 3600
+# jobs kept per database, the oldest finished ones are dropped first
+MAX_JOBS = 1000
+
+
+@dataclass(frozen=True)
+class VariantSpec:
+    name: str
+    width: int
+    height: int
+    thumbnail: bool = False
+
+
+# largest first
+VARIANTS: tuple[VariantSpec, ...] = (
+    VariantSpec('projector', 1920, 1080),
+    VariantSpec('tablet', 1280, 800),
+    VariantSpec('low', 640, 360),
+    VariantSpec('thumbnail', 320, 180, thumbnail=True),
+)
+IMAGE_TYPES = {MediaType.BACKGROUND_IMAGE}
+VIDEO_TYPES = {MediaType.VIDEO, MediaType.VIDEO_WITH_LYRICS, MediaType.BACKGROUND_VIDEO}
+
+
+class ProcessingError(Exception):
+    pass
+
+
+def fit_within(width: int, height: int, max_width: int, max_height: int) -> tuple[int, int]:
+    """The size of width x height scaled down (never up) to fit, kept even for video encoders"""
+    scale: float = min(max_width / width, max_height / height, 1.0)
+    return max(int(width * scale) // 2 * 2, 2), max(int(height * scale) // 2 * 2, 2)
+
+
+def best_variant(variants: list[Media_Variant], width: int, height: int) -> Media_Variant | None:
+    """The smallest variant that covers a width x height screen, else the largest there is"""
+    screens: list[Media_Variant] = sorted((v for v in variants if v.variant != 'thumbnail'),
+                                          key=lambda v: v.width * v.height)
+    for variant in screens:
+        if variant.width >= width and variant.height >= height:
+            return variant
+    return screens[-1] if screens else None
+
+
+def _stored_variant(temp_path: str, spec: VariantSpec, size: tuple[int, int], mime_type: str, directory: str) -> dict:
+    try:
+        content_hash, length = store_file(temp_path, directory)
+    finally:
+        os.remove(temp_path)
+    return {'variant': spec.name, 'width': size[0], 'height': size[1], 'content_hash': content_hash,
+            'size': length, 'mime_type': mime_type}
+
+
+def make_image_variant(source: str, spec: VariantSpec, directory: str) -> dict | None:
+    try:
+        from PIL import Image
+    except ImportError:
+        raise ProcessingError("Pillow is needed to process images: pip install prayer_of_hannah[media]")
+    with Image.open(source) as image:
+        size: tuple[int, int] = fit_within(image.width, image.height, spec.width, spec.height)
+        if not spec.thumbnail and size[0] >= image.width - 1 and size[1] >= image.height - 1:
+            # no smaller than the original
+            return None
+        resized = image.convert('RGB').resize(size, Image.Resampling.LANCZOS)
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix='.variant-', suffix='.jpg')
+    os.close(fd)
+    resized.save(temp_path, 'JPEG', quality=85, optimize=True, progressive=True)
+    return _stored_variant(temp_path, spec, size, 'image/jpeg', directory)
+
+
+def video_size(source: str) -> tuple[int, int]:
+    output: str = subprocess.run(['ffprobe', '-v', 'error', '-select_streams', 'v:0', '-show_entries',
+                                  'stream=width,height', '-of', 'csv=p=0:s=x', source],
+                                 check=True, capture_output=True, text=True).stdout
+    width, height = output.strip().split('x')
+    return int(width), int(height)
+
+
+def make_video_variant(source: str, spec: VariantSpec, directory: str) -> dict | None:
+    if shutil.which('ffmpeg') is None or shutil.which('ffprobe') is None:
+        raise ProcessingError("ffmpeg and ffprobe are needed to process videos")
+    width, height = video_size(source)
+    size: tuple[int, int] = fit_within(width, height, spec.width, spec.height)
+    if not spec.thumbnail and size[0] >= width - 1 and size[1] >= height - 1:
+        return None
+    suffix, mime_type = ('.jpg', 'image/jpeg') if spec.thumbnail else ('.mp4', 'video/mp4')
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix='.variant-', suffix=suffix)
+    os.close(fd)
+    scale: list[str] = ['-vf', f'scale={size[0]}:{size[1]}']
+    if spec.thumbnail:
+        command: list[str] = ['-ss', '1', '-i', source, '-frames:v', '1', *scale]
+    else:
+        command = ['-i', source, *scale, '-c:v', 'libx264', '-preset', 'veryfast', '-crf', '26',
+                   '-c:a', 'aac', '-b:a', '96k', '-movflags', '+faststart']
+    try:
+        subprocess.run(['ffmpeg', '-v', 'error', '-y', *command, temp_path], check=True, capture_output=True)
+    except subprocess.CalledProcessError as e:
+        os.remove(temp_path)
+        raise ProcessingError(e.stderr.decode(errors='replace').strip() or str(e))
+    return _stored_variant(temp_path, spec, size, mime_type, directory)
+
+
+def make_variant(source: str, media_type: MediaType, spec: VariantSpec, directory: str) -> dict | None:
+    """Runs in a pool process. The variant's details, None if it would be no smaller than the original"""
+    if media_type in IMAGE_TYPES:
+        return make_image_variant(source, spec, directory)
+    return make_video_variant(source, spec, directory)
+
+
+@dataclass
+class Job:
+    id: int
+    media_id: int
+    total: int
+    done: int = 0
+    failed: int = 0
+    errors: list[str] = field(default_factory=list)
+    futures: list[Future] = field(default_factory=list, repr=False)
+    # when the last variant was made or failed
+    finished_at: datetime | None = None
+
+    @classmethod
+    def from_row(cls, row: Media_Job) -> 'Job':
+        return cls(row.id, row.media_id, row.total, row.done, row.failed, json.loads(row.errors), finished_at=row.finished)
+
+    @property
+    def finished(self) -> bool:
+        return self.done + self.failed >= self.total
+
+    @property
+    def status(self) -> str:
+        if not self.finished:
+            return 'running' if self.done + self.failed else 'queued'
+        return 'failed' if self.failed else 'done'
+
+    @property
+    def progress(self) -> float:
+        return (self.done + self.failed) / self.total if self.total else 1.0
+
+    def as_dict(self) -> dict:
+        return {'id': self.id, 'media_id': self.media_id, 'status': self.status, 'progress': round(self.progress, 3),
+                'done': self.done, 'failed': self.failed, 'total': self.total, 'errors': list(self.errors)}
+
+
+_executor: 'ProcessPoolExecutor | None' = None
+_executor_lock = threading.Lock()
+
+
+def worker_executor() -> 'ProcessPoolExecutor':
+    """The worker's process pool, started on first use"""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            # the pool (and multiprocessing) is only imported by a worker that processes media
+            from concurrent.futures import ProcessPoolExecutor
+            _executor = ProcessPoolExecutor()
+        return _executor
+
+
+def shutdown_worker_executor() -> None:
+    global _executor
+    with _executor_lock:
+        executor, _executor = _executor, None
+    if executor is not None:
+        executor.shutdown(wait=True, cancel_futures=True)
+
+
+class MediaPipeline:
+    """
+    Queues the variants of a Media for the worker's process pool (its own pool of
+    max_workers if given), and stores each as it is made
+    """
+    def __init__(self, db: Dbms | None = None, max_workers: int | None = None, directory: str | None = None,
+                 job_ttl: float = JOB_TTL, max_jobs: int = MAX_JOBS) -> None:
+        self._db = db
+        self.max_workers = max_workers
+        self.directory = directory
+        self.job_ttl = job_ttl
+        self.max_jobs = max_jobs
+        # this process's running jobs, by id
+        self.jobs: dict[int, Job] = {}
+        self._lock = threading.Lock()
+        self._executor: 'ProcessPoolExecutor | None' = None
+
+    @property
+    def db(self) -> Dbms:
+        # the app's database unless one was given
+        if self._db is None:
+            from prayer_of_hannah import get_db
+            return get_db()
+        return self._db
+
+    @property
+    def executor(self) -> 'ProcessPoolExecutor':
+        if self.max_workers is None:
+            return worker_executor()
+        with self._lock:
+            if self._executor is None:
+                from concurrent.futures import ProcessPoolExecutor
+                self._executor = ProcessPoolExecutor(max_workers=self.max_workers)
+            return self._executor
+
+    def submit(self, media_id: int) -> Job:
+        """Queue the variants media_id doesn't have yet, returns at once. Raises LookupError"""
+        directory: str = self.directory or media_dir()
+        with Session(self.db.engine) as session:
+            media: Media | None = session.get(Media, media_id)
+            if media is None:
+                raise LookupError(f"No media: {media_id}")
+            if media.type not in IMAGE_TYPES | VIDEO_TYPES:
+                raise LookupError(f"Media {media_id} is {media.type}, only images and videos have variants")
+            have: set[str] = {v.variant for v in media.variants}
+            reused: int = self._reuse_variants(session, media, have)
+            specs: list[VariantSpec] = [s for s in VARIANTS if s.name not in have]
+            source: str = media_path(media.content_hash, directory)
+            media_type: MediaType = media.type
+
+        with self.db.write_session() as session:
+            self._forget_jobs(session, room=1)
+            row: Media_Job = Media_Job(media_id=media_id, total=len(specs) + reused, done=reused,
+                                       finished=None if specs else datetime.now())
+            session.add(row)
+            session.flush()
+            job: Job = Job.from_row(row)
+            session.commit()
+        if job.finished:
+            return job
+        with self._lock:
+            self.jobs[job.id] = job
+        for spec in specs:
+            future: Future = self.executor.submit(make_variant, source, media_type, spec, directory)
+            job.futures.append(future)
+            # the callback runs on the pool's thread, with the submitter's tenant (see tenants.py)
+            future.add_done_callback(partial(contextvars.copy_context().run, self._finished, job, spec))
+        return job
+
+    def _reuse_variants(self, session: Session, media: Media, have: set[str]) -> int:
+        """Copy the variants made for other Media with the same content, returns how many"""
+        others = session.exec(select(Media_Variant).join(Media)
+                              .where(Media.content_hash == media.content_hash)
+                              .where(Media.id != media.id)).all()
+        copied: list[Media_Variant] = []
+        for other in others:
+            if other.variant not in have:
+                copied.append(Media_Variant(media_id=media.id, variant=other.variant, width=other.width,
+                                            height=other.height, content_hash=other.content_hash,
+                                            size=other.size, mime_type=other.mime_type))
+                have.add(other.variant)
+        if copied:
+            with self.db.write_session() as write:
+                write.add_all(copied)
+                write.commit()
+        return len(copied)
+
+    def _finished(self, job: Job, spec: VariantSpec, future: Future) -> None:
+        error: str | None = None
+        try:
+            made: dict | None = future.result()
+            if made is not None:
+                with self.db.write_session() as session:
+                    session.add(Media_Variant(media_id=job.media_id, **made))
+                    session.commit()
+        except Exception as e:
+            error = f"{spec.name}: {e}"
+        # one callback at a time, so the job's row is never written with an older count
+        with self._lock:
+            if error is None:
+                job.done += 1
+            else:
+                job.failed += 1
+                job.errors.append(error)
+            if job.finished:
+                job.finished_at = datetime.now()
+            try:
+                with self.db.write_session() as session:
+                    row: Media_Job | None = session.get(Media_Job, job.id)
+                    if row is not None:
+                        row.done, row.failed, row.errors, row.finished = \
+                            job.done, job.failed, json.dumps(job.errors), job.finished_at
+                        session.commit()
+            finally:
+                if job.finished:
+                    self.jobs.pop(job.id, None)
+        if job.finished and error is None:
+            from prayer_of_hannah.live_worship.slides import forget_backgrounds
+            forget_backgrounds()
+
+    def _forget_jobs(self, session: Session, room: int = 0) -> None:
+        """Drop the jobs finished more than job_ttl ago, then the oldest finished ones to keep room under max_jobs"""
+        expired: datetime = datetime.now() - timedelta(seconds=self.job_ttl)
+        session.exec(delete(Media_Job).where(col(Media_Job.finished) < expired))  # type: ignore[call-overload]
+        excess: int = session.exec(select(func.count()).select_from(Media_Job)).one() + room - self.max_jobs
+        if excess > 0:
+            oldest = (select(Media_Job.id).where(col(Media_Job.finished).is_not(None))
+                      .order_by(col(Media_Job.finished), col(Media_Job.id)).limit(excess))
+            session.exec(delete(Media_Job).where(col(Media_Job.id).in_(oldest)))  # type: ignore[call-overload]
+
+    def job(self, job_id: int) -> Job | None:
+        """The job, whichever worker submitted it, None if there isn't one or it was forgotten"""
+        with self._lock:
+            running: Job | None = self.jobs.get(job_id)
+        if running is not None:
+            return running
+        with Session(self.db.engine) as session:
+            row: Media_Job | None = session.get(Media_Job, job_id)
+            if row is None or (row.finished is not None
+                               and row.finished < datetime.now() - timedelta(seconds=self.job_ttl)):
+                return None
+            return Job.from_row(row)
+
+    @property
+    def busy(self) -> bool:
+        """A job still has variants to make"""
+        with self._lock:
+            return not all(job.finished for job in self.jobs.values())
+
+    def wait(self, job: Job, timeout: float | None = None) -> Job:
+        for future in job.futures:
+            try:
+                future.exception(timeout)
+            except Exception:
+                pass
+        # the done callbacks may still be storing the last variant and the job's progress
+        end: float = time.monotonic() + (timeout or 5.0)
+        while (not job.finished or job.id in self.jobs) and time.monotonic() < end:
+            time.sleep(0.01)
+        return job
+
+    def shutdown(self) -> None:
+        """Cancel the queued variants and wait for the ones being made, the worker's pool carries on"""
+        with self._lock:
+            jobs: list[Job] = list(self.jobs.values())
+            executor, self._executor = self._executor, None
+        for job in jobs:
+            for future in job.futures:
+                future.cancel()
+        for job in jobs:
+            self.wait(job)
+        if executor is not None:
+            executor.shutdown(wait=True, cancel_futures=True)
+        with self._lock:
+            self.jobs.clear()
+
+
+_pipeline: MediaPipeline | None = None
+_pipeline_lock = threading.Lock()
+
+
+def _tenant_pipeline(tenant: Tenant) -> MediaPipeline:
+    return MediaPipeline(db=tenant.db)
+
+
+def media_pipeline() -> MediaPipeline:
+    """The current tenant's pipeline (see tenants.py), or the worker's"""
+    found: MediaPipeline | None = tenant_cache('media_pipeline', _tenant_pipeline)
+    if found is not None:
+        return found
+    global _pipeline
+    with _pipeline_lock:
+        if _pipeline is None:
+            _pipeline = MediaPipeline()
+        return _pipeline
@@ -0,0 +1,114 @@
+from flask import abort, jsonify, request, send_file, url_for
+from sqlmodel import Session, select
+from prayer_of_hannah.media import bp
+from prayer_of_hannah.media import store
+from prayer_of_hannah.media.pipeline import IMAGE_TYPES, VIDEO_TYPES, media_pipeline
+from prayer_of_hannah.media.upload import Upload, UploadConflict, uploads
+from prayer_of_hannah.models import Media, MediaType
+from prayer_of_hannah.services.decks import IMMUTABLE
+from prayer_of_hannah import get_dbe
+
+@bp.get('/item/<int:song_book_item_id>')
+def item_media(song_book_item_id: int):
+    with Session(get_dbe()) as session:
+        media = session.exec(select(Media).where(Media.song_book_item_id == song_book_item_id)).all()
+        return jsonify([{'id': m.id, 'type': m.type, 'tune': m.tune, 'verse_count': m.verse_count,
+                         'size': m.size, 'mime_type': m.mime_type,
+                         'url': url_for('media.media_file', content_hash = m.content_hash),
+                         'variants': {v.variant: {'width': v.width, 'height': v.height, 'size': v.size,
+                                                  'url': url_for('media.media_file', content_hash = v.content_hash)}
+                                      for v in m.variants}} for m in media])
+
+@bp.post('/<int:media_id>/process')
+def process_media(media_id: int):
+    # only queues the job, poll its url for progress
+    try:
+        job = media_pipeline().submit(media_id)
+    except LookupError as e:
+        abort(404, description = str(e))
+    response = jsonify(job.as_dict())
+    response.status_code = 202
+    response.headers['Location'] = url_for('media.media_job', job_id = job.id)
+    return response
+
+@bp.get('/jobs/<int:job_id>')
+def media_job(job_id: int):
+    job = media_pipeline().job(job_id)
+    if job is None:
+        abort(404)
+    return jsonify(job.as_dict())
+
+@bp.get('/<content_hash>')
+def media_file(content_hash: str):
+    # under ASGI prayer_of_hannah.asgi serves this with media.serve.media_app
+    found = store.media_file(get_dbe(), content_hash)
+    if found is None:
+        abort(404)
+    # conditional handles Range and If-None-Match, USE_X_SENDFILE hands the file to the front end server
+    response = send_file(found.path, mimetype = found.mime_type, conditional = True, etag = found.content_hash)
+    response.headers['Cache-Control'] = IMMUTABLE
+    return response
+
+
+def upload_response(upload: Upload, status: int = 200):
+    body = upload.as_dict()
+    if upload.complete:
+        with Session(get_dbe()) as session:
+            media = session.get(Media, upload.media_id)
+            body['url'] = url_for('media.media_file', content_hash = media.content_hash)
+        if upload.job_id is None and upload.type in IMAGE_TYPES | VIDEO_TYPES:
+            # only queued, the upload doesn't wait for the variants
+            upload.job_id = media_pipeline().submit(upload.media_id).id
+        if upload.job_id is not None:
+            body['job'] = url_for('media.media_job', job_id = upload.job_id)
+    response = jsonify(body)
+    response.status_code = status
+    response.headers['Upload-Offset'] = str(upload.offset)
+    response.headers['Location'] = url_for('media.upload_status', upload_id = upload.id)
+    return response
+
+@bp.post('/uploads')
+def start_upload():
+    # json: song_book_item_id, type, size and optionally file_name, mime_type, tune, verse_count, content_hash
+    settings = request.get_json(silent = True) or {}
+    try:
+        upload = uploads().start(int(settings['song_book_item_id']), MediaType(settings['type']), int(settings['size']),
+                                 settings.get('file_name'), settings.get('mime_type'), settings.get('tune'),
+                                 settings.get('verse_count'), settings.get('content_hash'))
+    except (KeyError, ValueError, TypeError, store.MediaError) as e:
+        abort(400, description = str(e))
+    except LookupError as e:
+        abort(404, description = str(e))
+    return upload_response(upload, 201)
+
+@bp.get('/uploads/<upload_id>')
+def upload_status(upload_id: str):
+    try:
+        return upload_response(uploads().get(upload_id))
+    except LookupError:
+        abort(404)
+
+@bp.patch('/uploads/<upload_id>')
+def upload_chunk(upload_id: str):
+    # the body is the file from the Upload-Offset header on, read a chunk at a time
+    try:
+        offset = int(request.headers['Upload-Offset'])
+    except (KeyError, ValueError):
+        abort(400, description = "Upload-Offset header needed")
+    try:
+        upload = uploads().write(upload_id, offset, request.stream)
+    except LookupError:
+        abort(404)
+    except UploadConflict as e:
+        response = jsonify({'error': str(e), 'offset': e.offset})
+        response.status_code = 409
+        response.headers['Upload-Offset'] = str(e.offset)
+        return response
+    except store.MediaError as e:
+        abort(400, description = str(e))
+    return upload_response(upload)
+
+@bp.delete('/uploads/<upload_id>')
+def cancel_upload(upload_id: str):
+    uploads().cancel(upload_id)
+    return '', 204
@@ -0,0 +1,113 @@
+import asyncio
+import os
+
+from prayer_of_hannah import get_dbe
+from prayer_of_hannah.media.store import MediaFile, media_file
+
+'''
+Native ASGI media serving for /media/<content hash>, so many tablets can stream the same
+recording without tying up the Flask thread pool.
+
+Supports single byte range requests (206, and 416 for a range outside the file),
+If-None-Match and If-Range against the content hash ETag, and HEAD. When the server
+offers the http.response.zerocopysend extension the file is handed to it to send with
+sendfile, otherwise it is read in CHUNK_SIZE pieces off the event loop.
+'''
+
+# bytes sent at a time when the server can't sendfile
+CHUNK_SIZE = 256 * 1024
+IMMUTABLE = b'public, max-age=31536000, immutable'
+
+
+class RangeNotSatisfiable(Exception):
+    pass
+
+
+def parse_range(header: str | None, size: int) -> tuple[int, int] | None:
+    """
+    The (first, last) byte of a single Range header, None for the whole file (no header,
+    or one we don't handle eg several ranges). Raises RangeNotSatisfiable.
+    """
+    if not header or not header.startswith('bytes=') or ',' in header:
+        return None
+    first_text, _, last_text = header[6:].strip().partition('-')
+    try:
+        if not first_text:
+            # the last n bytes
+            suffix: int = int(last_text)
+            if suffix <= 0:
+                raise RangeNotSatisfiable(header)
+            return max(size - suffix, 0), size - 1
+        first: int = int(first_text)
+        last: int = min(int(last_text), size - 1) if last_text else size - 1
+    except ValueError:
+        return None
+    if first >= size or last < first:
+        raise RangeNotSatisfiable(header)
+    return first, last
+
+
+async def send_file_range(send, path: str, first: int, count: int, zerocopy: bool) -> None:
+    with open(path, 'rb') as file:
+        if zerocopy:
+            await send({'type': 'http.response.zerocopysend', 'file': file, 'offset': first, 'count': count,
+                        'more_body': False})
+            return
+        offset: int = first
+        end: int = first + count
+        while offset < end:
+            chunk: bytes = await asyncio.to_thread(os.pread, file.fileno(), min(CHUNK_SIZE, end - offset), offset)
+            if not chunk:
+                break
+            offset += len(chunk)
+            await send({'type': 'http.response.body', 'body': chunk, 'more_body': offset < end})
+    if offset < end:
+        # the file was shorter than expected, end the response
+        await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+
+
+async def media_app(scope, receive, send) -> None:
+    found: MediaFile | None = await asyncio.to_thread(media_file, get_dbe(), scope['path_params']['content_hash'])
+    if found is None:
+        await send({'type': 'http.response.start', 'status': 404, 'headers': [(b'content-type', b'text/plain')]})
+        await send({'type': 'http.response.body', 'body': b'Not Found'})
+        return
+
+    headers: dict[bytes, bytes] = dict(scope.get('headers', []))
+    etag: bytes = b'"' + found.content_hash.encode() + b'"'
+    response_headers: list[tuple[bytes, bytes]] = [
+        (b'etag', etag), (b'cache-control', IMMUTABLE), (b'accept-ranges', b'bytes')]
+
+    if etag in headers.get(b'if-none-match', b''):
+        await send({'type': 'http.response.start', 'status': 304, 'headers': response_headers})
+        await send({'type': 'http.response.body', 'body': b''})
+        return
+
+    range_header: str | None = headers.get(b'range', b'').decode() or None
+    if range_header and headers.get(b'if-range', etag) != etag:
+        # the client's copy is of another file, send it all
+        range_header = None
+    try:
+        byte_range: tuple[int, int] | None = parse_range(range_header, found.size)
+    except RangeNotSatisfiable:
+        await send({'type': 'http.response.start', 'status': 416,
+                    'headers': response_headers + [(b'content-range', f'bytes */{found.size}'.encode())]})
+        await send({'type': 'http.response.body', 'body': b''})
+        return
+
+    first, last = byte_range if byte_range is not None else (0, found.size - 1)
+    count: int = last - first + 1 if found.size else 0
+    response_headers += [(b'content-type', found.mime_type.encode()), (b'content-length', str(count).encode())]
+    if byte_range is not None:
+        response_headers.append((b'content-range', f'bytes {first}-{last}/{found.size}'.encode()))
+    await send({'type': 'http.response.start', 'status': 206 if byte_range is not None else 200,
+                'headers': response_headers})
+    if scope.get('method') == 'HEAD' or count == 0:
+        await send({'type': 'http.response.body', 'body': b''})
+        return
+    try:
+        await send_file_range(send, found.path, first, count,
+                              'http.response.zerocopysend' in scope.get('extensions', {}))
+    except OSError:
+        # the client went away, eg skipped to another part of the recording
+        pass
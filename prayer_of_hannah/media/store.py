@@ -0,0 +1,139 @@
+import hashlib
+import mimetypes
+import os
+import re
+import tempfile
+from dataclasses import dataclass
+from typing import BinaryIO
+from sqlalchemy.engine import Engine
+from sqlmodel import Session, select
+from config import Config
+
+from prayer_of_hannah.lru import LruCache
+from prayer_of_hannah.models import Media, MediaType, Media_Variant
+from prayer_of_hannah.tenants import tenant_cache
+
+'''
+The media store: every file is kept once, named by the sha256 of its content, in
+MEDIA_DIR/<first 2 hex digits>/<hash>. A file is hashed as it is copied in and moved
+into place when complete, so a half written file is never served and adding a file
+that is already stored only costs the copy.
+
+Stored files never change so they are served with content hash ETags and far future
+cache headers (see routes.py and serve.py).
+'''
+
+# bytes read and written at a time
+CHUNK_SIZE = 1024 * 1024
+CONTENT_HASH = re.compile(r'[0-9a-f]{64}')
+
+
+class MediaError(Exception):
+    pass
+
+
+def media_dir() -> str:
+    return Config.MEDIA_DIR
+
+
+def media_path(content_hash: str, directory: str | None = None) -> str:
+    if not CONTENT_HASH.fullmatch(content_hash):
+        raise MediaError(f"Invalid content hash: {content_hash}")
+    return os.path.join(directory or media_dir(), content_hash[:2], content_hash)
+
+
+def store_stream(stream: BinaryIO, directory: str | None = None) -> tuple[str, int]:
+    """Copy stream into the store, returns its content hash and size"""
+    directory = directory or media_dir()
+    os.makedirs(directory, exist_ok=True)
+    digest = hashlib.sha256()
+    size: int = 0
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix='.incoming-')
+    try:
+        with os.fdopen(fd, 'wb') as temp:
+            while chunk := stream.read(CHUNK_SIZE):
+                digest.update(chunk)
+                temp.write(chunk)
+                size += len(chunk)
+        content_hash: str = digest.hexdigest()
+        path: str = media_path(content_hash, directory)
+        if os.path.exists(path):
+            os.remove(temp_path)
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    return content_hash, size
+
+
+def store_file(file_path: str, directory: str | None = None) -> tuple[str, int]:
+    with open(file_path, 'rb') as stream:
+        return store_stream(stream, directory)
+
+
+def is_stored(content_hash: str, directory: str | None = None) -> bool:
+    return CONTENT_HASH.fullmatch(content_hash) is not None and os.path.isfile(media_path(content_hash, directory))
+
+
+def create_media(session: Session, song_book_item_id: int, media_type: MediaType, content_hash: str, size: int,
+                 file_name: str | None, mime_type: str | None = None, tune: str | None = None,
+                 verse_count: int | None = None) -> Media:
+    """The Media row for a file already in the store"""
+    media: Media = Media(song_book_item_id=song_book_item_id, type=media_type, tune=tune, verse_count=verse_count,
+                         content_hash=content_hash, size=size, file_name=file_name,
+                         mime_type=mime_type or mimetypes.guess_type(file_name or '')[0] or 'application/octet-stream')
+    session.add(media)
+    session.commit()
+    session.refresh(media)
+    return media
+
+
+def add_media(session: Session, song_book_item_id: int, media_type: MediaType, file_path: str,
+              tune: str | None = None, verse_count: int | None = None, mime_type: str | None = None) -> Media:
+    content_hash, size = store_file(file_path)
+    return create_media(session, song_book_item_id, media_type, content_hash, size, os.path.basename(file_path),
+                        mime_type, tune, verse_count)
+
+
+@dataclass(frozen=True)
+class MediaFile:
+    content_hash: str
+    path: str
+    size: int
+    mime_type: str
+
+
+# what is needed to serve a file, so serving never queries the database twice for it
+MEDIA_CACHE_SIZE = 1024
+_media_files: LruCache[str, MediaFile] = LruCache(MEDIA_CACHE_SIZE)
+
+
+def media_file_cache() -> LruCache[str, MediaFile]:
+    """The current tenant's media files (see tenants.py), or the worker's"""
+    cache: LruCache[str, MediaFile] | None = tenant_cache('media_files', lambda tenant: LruCache(MEDIA_CACHE_SIZE))
+    return _media_files if cache is None else cache
+
+
+def media_file(engine: Engine, content_hash: str) -> MediaFile | None:
+    """The stored file with this hash, None if there is no such media or its file is missing"""
+    if not CONTENT_HASH.fullmatch(content_hash):
+        return None
+    cache: LruCache[str, MediaFile] = media_file_cache()
+    found: MediaFile | None = cache.get(content_hash)
+    if found is not None:
+        return found
+
+    with Session(engine) as session:
+        # an uploaded file, or a variant made of one
+        media: Media | Media_Variant | None = (
+            session.exec(select(Media).where(Media.content_hash == content_hash)).first()
+            or session.exec(select(Media_Variant).where(Media_Variant.content_hash == content_hash)).first())
+    path: str = media_path(content_hash)
+    if media is None or not os.path.isfile(path):
+        return None
+    found = MediaFile(content_hash, path, os.path.getsize(path), media.mime_type)
+    cache.put(content_hash, found)
+    return found
@@ -0,0 +1,281 @@
+import fcntl
+import hashlib
+import json
+import os
+import threading
+import uuid
+from dataclasses import dataclass, field, fields
+from typing import BinaryIO
+from sqlmodel import Session, select
+
+from prayer_of_hannah.dbms import Dbms
+from prayer_of_hannah.models import Media, MediaType, Song_Book_Item
+from prayer_of_hannah.media.store import CHUNK_SIZE, CONTENT_HASH, MediaError, create_media, is_stored, media_dir, media_path
+from prayer_of_hannah.tenants import tenant_cache
+
+'''
+Resumable uploads. A client starts an upload with the file's size (and, if it knows it,
+its sha256) and then sends the file in any number of requests, each starting at the
+offset the server has. A broken transfer is resumed by asking for the offset and sending
+the rest, also after a restart.
+
+Every request's body is copied straight into the upload's one partial file through a
+single CHUNK_SIZE buffer, hashing it on the way, so memory use doesn't grow with the
+file and there is no separate hashing pass or step joining the parts: when the last
+byte arrives the file is renamed into the store. Under ASGI the body has already been
+spooled by asgiref (to a temporary file if it is large) before it is copied, so there
+is one more copy there.
+
+A file is only deduplicated against the store once its bytes have arrived and hash to
+the stored file's hash, as the store is shared by the tenants and knowing a hash
+mustn't be enough to attach someone else's file. If the client declared a hash this
+tenant's own media already has (before it starts or when it sends more) the upload
+finishes at once, anyone who can use the tenant can fetch that file anyway.
+
+Each request takes an exclusive lock on the partial file and reads the offset from its
+size, so requests to different worker processes can't write to an upload at once. The
+hash state is kept in memory. An upload continued in another process, or after a
+restart, hashes what it already has once.
+'''
+
+PARTIAL_PREFIX = '.upload-'
+
+
+class UploadConflict(MediaError):
+    """The request's offset is not the upload's, or another request is writing to it"""
+    def __init__(self, offset: int, message: str | None = None) -> None:
+        super().__init__(message or f"The upload is at offset {offset}")
+        self.offset = offset
+
+
+@dataclass
+class Upload:
+    id: str
+    song_book_item_id: int
+    type: MediaType
+    size: int
+    file_name: str | None = None
+    mime_type: str | None = None
+    tune: str | None = None
+    verse_count: int | None = None
+    # declared by the client, checked when the upload is complete
+    content_hash: str | None = None
+    offset: int = 0
+    # set when complete
+    media_id: int | None = None
+    # the job making its variants
+    job_id: int | None = None
+    digest: 'hashlib._Hash | None' = field(default=None, repr=False, compare=False)
+    lock: threading.Lock = field(default_factory=threading.Lock, repr=False, compare=False)
+
+    @property
+    def complete(self) -> bool:
+        return self.media_id is not None
+
+    def as_dict(self) -> dict:
+        return {'id': self.id, 'song_book_item_id': self.song_book_item_id, 'type': self.type, 'size': self.size,
+                'offset': self.offset, 'complete': self.complete, 'media_id': self.media_id}
+
+    def settings(self) -> dict:
+        """What is saved beside the partial file to resume the upload after a restart"""
+        return {f.name: getattr(self, f.name) for f in fields(self)
+                if f.name not in ('offset', 'media_id', 'job_id', 'digest', 'lock')}
+
+
+class Uploads:
+    """
+    The uploads in progress, their partial files are kept in the media directory
+    """
+    def __init__(self, db: Dbms | None = None, directory: str | None = None) -> None:
+        self._db = db
+        self.directory = directory
+        self._uploads: dict[str, Upload] = {}
+        self._lock = threading.Lock()
+
+    @property
+    def db(self) -> Dbms:
+        # the app's database unless one was given
+        if self._db is None:
+            from prayer_of_hannah import get_db
+            return get_db()
+        return self._db
+
+    def _path(self, upload_id: str, suffix: str = '') -> str:
+        return os.path.join(self.directory or media_dir(), PARTIAL_PREFIX + upload_id + suffix)
+
+    def _known(self, content_hash: str) -> bool:
+        """If this tenant's media has the file"""
+        with Session(self.db.engine) as session:
+            found: Media | None = session.exec(select(Media).where(Media.content_hash == content_hash)).first()
+        return found is not None and is_stored(content_hash, self.directory)
+
+    def start(self, song_book_item_id: int, media_type: MediaType, size: int, file_name: str | None = None,
+              mime_type: str | None = None, tune: str | None = None, verse_count: int | None = None,
+              content_hash: str | None = None) -> Upload:
+        """
+        A new upload, already complete if this tenant's media has content_hash. Raises
+        LookupError for an unknown Song_Book_Item, MediaError for a bad size or hash
+        """
+        if size < 0:
+            raise MediaError(f"Invalid size: {size}")
+        if content_hash is not None and not CONTENT_HASH.fullmatch(content_hash):
+            raise MediaError(f"Invalid content hash: {content_hash}")
+        with Session(self.db.engine) as session:
+            if session.get(Song_Book_Item, song_book_item_id) is None:
+                raise LookupError(f"No song book item: {song_book_item_id}")
+        upload: Upload = Upload(uuid.uuid4().hex, song_book_item_id, MediaType(media_type), size, file_name,
+                                mime_type, tune, verse_count, content_hash, digest=hashlib.sha256())
+        if content_hash is not None and self._known(content_hash):
+            self._finish(upload, content_hash)
+            return upload
+
+        os.makedirs(self.directory or media_dir(), exist_ok=True)
+        open(self._path(upload.id), 'wb').close()
+        with open(self._path(upload.id, '.json'), 'w') as settings:
+            json.dump(upload.settings(), settings)
+        with self._lock:
+            self._uploads[upload.id] = upload
+        return upload
+
+    def get(self, upload_id: str) -> Upload:
+        """
+        The upload, loaded from its files after a restart and brought up to date with what
+        other processes wrote. Raises LookupError, also if another process finished it
+        """
+        with self._lock:
+            upload: Upload | None = self._uploads.get(upload_id)
+            if upload is None:
+                if not all(c in '0123456789abcdef' for c in upload_id) or not os.path.isfile(self._path(upload_id, '.json')):
+                    raise LookupError(f"No upload: {upload_id}")
+                with open(self._path(upload_id, '.json')) as settings:
+                    upload = Upload(**json.load(settings))
+                upload.type = MediaType(upload.type)
+                self._uploads[upload_id] = upload
+        if not upload.complete:
+            try:
+                self._sync(upload, os.path.getsize(self._path(upload_id)))
+            except FileNotFoundError:
+                self._forget(upload_id)
+        return upload
+
+    @staticmethod
+    def _sync(upload: Upload, size: int) -> None:
+        """Take the offset from the partial file's size, which another process may have written to"""
+        if size != upload.offset:
+            upload.offset = size
+            # the hash is of what this process wrote
+            upload.digest = None
+
+    def _forget(self, upload_id: str) -> None:
+        """Raise LookupError for an upload finished or cancelled by another process"""
+        with self._lock:
+            self._uploads.pop(upload_id, None)
+        raise LookupError(f"No upload: {upload_id}")
+
+    def write(self, upload_id: str, offset: int, stream: BinaryIO) -> Upload:
+        """
+        Append stream to the upload at offset, completing it if it is all there. Raises
+        LookupError, UploadConflict, or MediaError if there is more than its size or the
+        complete file doesn't have the declared hash
+        """
+        upload: Upload = self.get(upload_id)
+        if not upload.lock.acquire(blocking=False):
+            raise UploadConflict(upload.offset, "Another request is writing to the upload")
+        try:
+            if upload.complete:
+                return upload
+            path: str = self._path(upload_id)
+            try:
+                partial = open(path, 'r+b')
+            except FileNotFoundError:
+                self._forget(upload_id)
+            with partial:
+                try:
+                    # held until the upload is finished, the lock of the request in another process
+                    fcntl.flock(partial, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    raise UploadConflict(upload.offset, "Another request is writing to the upload")
+                if not os.path.exists(path):
+                    # finished before the lock was taken
+                    self._forget(upload_id)
+                self._sync(upload, os.fstat(partial.fileno()).st_size)
+                if upload.content_hash is not None and self._known(upload.content_hash):
+                    # the tenant has the same file meanwhile, the rest isn't needed
+                    self._finish(upload, upload.content_hash)
+                    return upload
+                if offset != upload.offset:
+                    raise UploadConflict(upload.offset)
+                if upload.digest is None:
+                    upload.digest = self._rehash(path, upload.offset)
+
+                buffer: memoryview = memoryview(bytearray(CHUNK_SIZE))
+                partial.seek(upload.offset)
+                while (length := stream.readinto(buffer)):
+                    if upload.offset + length > upload.size:
+                        raise MediaError(f"More than the upload's {upload.size} bytes")
+                    partial.write(buffer[:length])
+                    upload.digest.update(buffer[:length])
+                    upload.offset += length
+                partial.flush()
+
+                if upload.offset == upload.size:
+                    content_hash: str = upload.digest.hexdigest()
+                    if upload.content_hash is not None and content_hash != upload.content_hash:
+                        self.cancel(upload_id)
+                        raise MediaError(f"The upload's content hash is {content_hash}, not {upload.content_hash}")
+                    # the bytes are here, so the stored copy (of any tenant) can be shared
+                    stored: str = media_path(content_hash, self.directory)
+                    if os.path.exists(stored):
+                        os.remove(path)
+                    else:
+                        os.makedirs(os.path.dirname(stored), exist_ok=True)
+                        os.replace(path, stored)
+                    self._finish(upload, content_hash)
+            return upload
+        finally:
+            upload.lock.release()
+
+    @staticmethod
+    def _rehash(path: str, length: int) -> 'hashlib._Hash':
+        digest = hashlib.sha256()
+        with open(path, 'rb') as partial:
+            while length > 0 and (chunk := partial.read(min(CHUNK_SIZE, length))):
+                digest.update(chunk)
+                length -= len(chunk)
+        return digest
+
+    def _finish(self, upload: Upload, content_hash: str) -> None:
+        # the stored file's size, not the one the client declared
+        size: int = os.path.getsize(media_path(content_hash, self.directory))
+        with self.db.write_session() as session:
+            media: Media = create_media(session, upload.song_book_item_id, upload.type, content_hash, size,
+                                        upload.file_name, upload.mime_type, upload.tune, upload.verse_count)
+        upload.media_id = media.id
+        upload.offset = upload.size
+        self._remove_files(upload.id)
+
+    def _remove_files(self, upload_id: str) -> None:
+        for suffix in ('', '.json'):
+            if os.path.exists(self._path(upload_id, suffix)):
+                os.remove(self._path(upload_id, suffix))
+
+    def cancel(self, upload_id: str) -> None:
+        with self._lock:
+            self._uploads.pop(upload_id, None)
+        self._remove_files(upload_id)
+
+
+_uploads: Uploads | None = None
+_uploads_lock = threading.Lock()
+
+
+def uploads() -> Uploads:
+    """The current tenant's uploads (see tenants.py), or the worker's"""
+    found: Uploads | None = tenant_cache('uploads', lambda tenant: Uploads(db=tenant.db))
+    if found is not None:
+        return found
+    global _uploads
+    with _uploads_lock:
+        if _uploads is None:
+            _uploads = Uploads()
+        return _uploads
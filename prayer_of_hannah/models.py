@@ -1,6 +1,7 @@
 from sqlmodel import SQLModel, Field, Relationship
 from sqlmodel._compat import SQLModelConfig
-from sqlalchemy import Column, String, Index
+from sqlalchemy import Column, String, Index, LargeBinary
+from datetime import datetime
 from pydantic import computed_field
 from enum import StrEnum
 
@@ -10,6 +11,14 @@ class VerseType(StrEnum):
     BRIDGE = 'b'
     ENDING = 'e'
 
+class MediaType(StrEnum):
+    BACKGROUND_IMAGE = 'BI'
+    VIDEO = 'V'
+    VIDEO_WITH_LYRICS = 'VL'
+    AUDIO = 'A'
+    AUDIO_WITH_SINGING = 'AS'
+    BACKGROUND_VIDEO = 'BV'
+
 class SQLModelValidation(SQLModel):
     """
     Helper class to allow for validation in SQLModel classes with table=True
@@ -58,7 +67,12 @@ A Song_Book_Item can have zero, one or many Verses. Each Verse has an enumerated
 A Song_Book_Item can have zero, one or many media files. These have an
 enumerated type to control what is displayed
 (BI=Background image, V=Video without lyrics, VL=Video with Lyrics, A=Audio only, AS=Audio with Singing, BV=Background video)
-They also have a tune name and a verse count
+They also have a tune name and a verse count. The files are stored once by content hash,
+the same recording added to two Song_Book_Items is one file.
+
+A Service is an ordered list of Service_Items, each one a Song_Book_Item with an optional
+verse_order for just this service. When a Service is finalised it is compiled into a
+Slide_Deck: an immutable, content hashed bundle of every slide in display order.
 
 '''
 
@@ -226,6 +240,12 @@ class Song_Book_Item(SQLModelValidation, table=True):
         the Song Nbr in this book
     verse_order : str
         the order verses are displayed (eg V1 C1 V2 B1 C1 V3 C1)
+    verse_order_ids : str
+        verse_order compiled to Verse ids (eg 3,4,5,6,4,7,4), maintained by verse_order.py
+    verses : list[Verse]
+        the lyrics
+    media : list[Media]
+        audio, video and images for this song
     """
     id: int | None = Field(default=None, primary_key=True)
     song_book_id: int = Field(foreign_key="song_book.id")
@@ -237,11 +257,17 @@ class Song_Book_Item(SQLModelValidation, table=True):
         min_length=0,
         max_length=50,
     )
+    verse_order_ids: str | None = Field(
+        default=None,
+        description="verse_order compiled to Verse ids eg 3,4,5,6,4,7,4",
+        sa_column=Column("verse_order_ids", String(200), nullable=True),
+    )
 
     song_book: "Song_Book" = Relationship(back_populates="songs")
     song: "Song" = Relationship(back_populates="song_book_items")
 
     verses: list["Verse"] = Relationship(back_populates="song_book_item")
+    media: list["Media"] = Relationship(back_populates="song_book_item")
 
     __table_args__ = (
         Index(
@@ -267,6 +293,8 @@ class Verse(SQLModelValidation, table=True):
         the verse type (see enum class VerseType)
     number : int
         the verse nbr
+    part : str
+        the part of a verse split across slides, eg the a of v1a, '' for a whole verse
     lyrics : str
         markdown lyrics for this verse
     song_book_item : int
@@ -275,6 +303,12 @@ class Verse(SQLModelValidation, table=True):
     id: int | None = Field(default=None, primary_key=True)
     type: VerseType = Field(description="the verse type", nullable=False)
     number: int = Field(description="the verse nbr", nullable=False, ge=1, le=10)
+    part: str | None = Field(
+        default='',
+        description="the part of the verse",
+        sa_column=Column("part", String(1), nullable=True, server_default=''),
+        max_length=1,
+    )
     lyrics: str = Field(
         description="markdown lyrics for this verse",
         sa_column=Column("lyrics", String(3000), nullable=True),
@@ -288,10 +322,314 @@ class Verse(SQLModelValidation, table=True):
 
     __table_args__ = (
         Index(
-            "compound_index_verse",
+            "compound_index_verse_part",
             "song_book_item_id",
             "type",
             "number",
+            "part",
             unique=True,
         ),
     )
+
+
+class Media(SQLModelValidation, table=True):
+    """
+    A class to represent an audio, video or image file for a Song_Book_Item.
+    The file itself is stored once by content hash (see media/store.py)
+
+
+    Attributes
+    ----------
+    id : int
+        Primary Key, autoincremented
+    song_book_item_id : int
+        foreign key to song_book_item
+    type : str
+        what is displayed or played (see enum class MediaType)
+    tune : str
+        tune name eg Sagina
+    verse_count : int
+        the number of verses recorded (audio and video)
+    content_hash : str
+        sha256 of the file, names it in the media store
+    size : int
+        file size in bytes
+    mime_type : str
+        eg audio/mpeg
+    file_name : str
+        the name of the file when it was added
+    created : datetime
+        when it was added
+    variants : list[Media_Variant]
+        resized copies and thumbnails
+    """
+    id: int | None = Field(default=None, primary_key=True)
+    song_book_item_id: int = Field(foreign_key="song_book_item.id")
+    type: MediaType = Field(description="what is displayed or played", nullable=False)
+    tune: str | None = Field(
+        default=None,
+        description="Tune name eg Sagina",
+        sa_column=Column("tune", String(50), nullable=True),
+        max_length=50,
+    )
+    verse_count: int | None = Field(default=None, description="verses recorded", nullable=True, ge=0, le=99)
+    content_hash: str = Field(sa_column=Column("content_hash", String(64), index=True, nullable=False))
+    size: int = Field(nullable=False, ge=0)
+    mime_type: str = Field(sa_column=Column("mime_type", String(100), nullable=False))
+    file_name: str | None = Field(default=None, sa_column=Column("file_name", String(200), nullable=True))
+    created: datetime = Field(default_factory=datetime.now, nullable=False)
+
+    song_book_item: "Song_Book_Item" = Relationship(back_populates="media")
+    variants: list["Media_Variant"] = Relationship(back_populates="media")
+
+
+class Media_Variant(SQLModel, table=True):
+    """
+    A class to represent a smaller copy of a Media file made for a kind of screen or a
+    slow link, or a thumbnail (see media/pipeline.py). Stored by content hash like Media
+
+
+    Attributes
+    ----------
+    id : int
+        Primary Key, autoincremented
+    media_id : int
+        foreign key to media, part of unique index
+    variant : str
+        the variant name eg projector, tablet, low, thumbnail, part of unique index
+    width : int
+        width in pixels
+    height : int
+        height in pixels
+    content_hash : str
+        sha256 of the file, names it in the media store
+    size : int
+        file size in bytes
+    mime_type : str
+        eg video/mp4
+    """
+    id: int | None = Field(default=None, primary_key=True)
+    media_id: int = Field(foreign_key="media.id")
+    variant: str = Field(sa_column=Column("variant", String(20), nullable=False))
+    width: int = Field(nullable=False, ge=1)
+    height: int = Field(nullable=False, ge=1)
+    content_hash: str = Field(sa_column=Column("content_hash", String(64), index=True, nullable=False))
+    size: int = Field(nullable=False, ge=0)
+    mime_type: str = Field(sa_column=Column("mime_type", String(100), nullable=False))
+
+    media: "Media" = Relationship(back_populates="variants")
+
+    __table_args__ = (
+        Index(
+            "compound_index_media_variant",
+            "media_id",
+            "variant",
+            unique=True,
+        ),
+    )
+
+
+class Media_Job(SQLModel, table=True):
+    """
+    A class to represent the making of a Media's variants (see media/pipeline.py). Kept in
+    the database so its progress can be polled from any worker process, and dropped a
+    while after it finished
+
+
+    Attributes
+    ----------
+    id : int
+        Primary Key, autoincremented. The job id polled for progress
+    media_id : int
+        the media whose variants are made
+    total : int
+        variants to make
+    done : int
+        variants made (or reused from the same content)
+    failed : int
+        variants that couldn't be made
+    errors : str
+        json list of why they failed
+    finished : datetime
+        when the last variant was made or failed, None while running
+    """
+    id: int | None = Field(default=None, primary_key=True)
+    media_id: int = Field(index=True, nullable=False)
+    total: int = Field(nullable=False, ge=0)
+    done: int = Field(default=0, nullable=False, ge=0)
+    failed: int = Field(default=0, nullable=False, ge=0)
+    errors: str = Field(default='[]', nullable=False)
+    finished: datetime | None = Field(default=None, nullable=True)
+
+
+class Service(SQLModelValidation, table=True):
+    """
+    A class to represent a worship service
+
+
+    Attributes
+    ----------
+    id : int
+        Primary Key, autoincremented
+    name : str
+        Name of the service eg Sunday Morning Worship
+    start : datetime
+        when the service starts
+    deck_hash : str
+        content hash of the Slide_Deck made when the service was last finalised
+    items : list[Service_Item]
+        the songs in the service, in position order
+    """
+    id: int | None = Field(default=None, primary_key=True)
+
+    name: str = Field(
+        description="Service name eg Sunday Morning Worship",
+        sa_column=Column("name", String(100), nullable=False),
+        min_length=1,
+        max_length=100,
+    )
+
+    start: datetime | None = Field(default=None, description="when the service starts", nullable=True)
+
+    deck_hash: str | None = Field(
+        default=None,
+        description="content hash of the finalised slide deck",
+        sa_column=Column("deck_hash", String(64), nullable=True),
+    )
+
+    items: list["Service_Item"] = Relationship(
+        back_populates="service",
+        sa_relationship_kwargs={"order_by": "Service_Item.position"},
+    )
+
+
+class Service_Item(SQLModelValidation, table=True):
+    """
+    A class to represent a song in a service
+
+
+    Attributes
+    ----------
+    id : int
+        Primary Key, autoincremented
+    service_id : int
+        foreign key to service, part of unique index
+    position : int
+        the order of the item in the service, part of unique index
+    song_book_item_id : int
+        foreign key to song_book_item
+    verse_order : str
+        the order verses are displayed in this service, overrides Song_Book_Item.verse_order
+    """
+    id: int | None = Field(default=None, primary_key=True)
+    service_id: int = Field(foreign_key="service.id")
+    position: int = Field(description="the order of the item in the service", nullable=False, ge=1)
+    song_book_item_id: int = Field(foreign_key="song_book_item.id")
+    verse_order: str | None = Field(
+        default=None,
+        description="verse order for this service eg v1 c1 v2 c1 (skipping v3)",
+        sa_column=Column("verse_order", String(50), nullable=True),
+        max_length=50,
+    )
+
+    service: "Service" = Relationship(back_populates="items")
+    song_book_item: "Song_Book_Item" = Relationship()
+
+    __table_args__ = (
+        Index(
+            "compound_index_service_item_position",
+            "service_id",
+            "position",
+            unique=True,
+        ),
+    )
+
+
+class Slide_Deck(SQLModel, table=True):
+    """
+    A class to represent a compiled service, every slide in display order.
+    The bundle never changes, it is identified (and cached by clients) by its content hash
+
+
+    Attributes
+    ----------
+    id : int
+        Primary Key, autoincremented
+    service_id : int
+        foreign key to service, part of unique index
+    version : int
+        1 for the first time the service is finalised, then 2 etc, part of unique index
+    content_hash : str
+        sha256 of the bundle
+    bundle : bytes
+        the deck as json
+    created : datetime
+        when the service was finalised
+    """
+    id: int | None = Field(default=None, primary_key=True)
+    service_id: int = Field(foreign_key="service.id")
+    version: int = Field(nullable=False, ge=1)
+    content_hash: str = Field(sa_column=Column("content_hash", String(64), index=True, nullable=False))
+    bundle: bytes = Field(sa_column=Column("bundle", LargeBinary, nullable=False))
+    created: datetime = Field(default_factory=datetime.now, nullable=False)
+
+    __table_args__ = (
+        Index(
+            "compound_index_slide_deck_version",
+            "service_id",
+            "version",
+            unique=True,
+        ),
+    )
+
+
+class Change_Log(SQLModel, table=True):
+    """
+    A class to represent one write to the database, filled in by triggers
+    (see Dbms.create_change_log_triggers) so every insert, update or delete
+    is recorded whichever connection or process made it.
+
+
+    Attributes
+    ----------
+    id : int
+        Primary Key, autoincremented. The highest id is the database write version
+    table_name : str
+        the table that was written to
+    row_key : str
+        json array of the primary key values of the row
+    deleted : bool
+        True if the row no longer exists under this key
+    """
+    id: int | None = Field(default=None, primary_key=True)
+    table_name: str = Field(sa_column=Column("table_name", String(50), nullable=False))
+    row_key: str = Field(sa_column=Column("row_key", String(100), nullable=False))
+    deleted: bool = Field(default=False, nullable=False)
+
+
+class Live_Event(SQLModel, table=True):
+    """
+    A class to represent an event sent to the screens following a live service, eg a slide
+    change (see live_worship/broadcast.py). Every worker process reads them from here, so
+    the operator and the screens of a service can be served by different workers. The
+    latest RING_SIZE of each service are kept and their writes are not in change_log.
+
+
+    Attributes
+    ----------
+    id : int
+        Primary Key, autoincremented. The event id the screens resume from
+    service_id : int
+        the service the event is for
+    name : str
+        the event type, eg slide or end
+    data : str
+        the event as json
+    published : datetime
+        when it was published, a service whose last event is old is over (see dbms.Maintenance)
+    """
+    id: int | None = Field(default=None, primary_key=True)
+    service_id: int = Field(index=True, nullable=False)
+    name: str = Field(sa_column=Column("name", String(20), nullable=False))
+    data: str = Field(nullable=False)
+    published: datetime | None = Field(default=None, nullable=True)
@@ -1,12 +1,10 @@
 from sqlalchemy import Sequence
-from dbms import Dbms
 from fasthtml import common as fh
-from models import Song_Book
+from prayer_of_hannah import get_dbe
+from prayer_of_hannah.models import Song_Book
 from sqlmodel import Session, select
 
-db = Dbms()
-db.create_database_structure()
-
+# uses the same Dbms as the Flask app (opened on first use), see prayer_of_hannah.asgi
 
 
 def song_book_row(sb: Song_Book) -> fh.Div:
@@ -14,7 +12,7 @@ def song_book_row(sb: Song_Book) -> fh.Div:
 
 
 def song_books():
-    with Session(db.engine) as session:
+    with Session(get_dbe()) as session:
         results: Sequence[Song_Book] = session.exec(select(Song_Book).order_by(Song_Book.name)).all()
         return fh.Table(map(song_book_row, results))
 
@@ -51,7 +49,8 @@ def get():
     return fh.Title(title), fh.Container(body)
 
 def main() -> None:
-    fh.serve()
+    # python -m prayer_of_hannah.prayer_of_hannah
+    fh.serve(appname='prayer_of_hannah.prayer_of_hannah')
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,47 @@
+import os
+from flask import Flask
+from jinja2 import FileSystemBytecodeCache
+
+'''
+Jinja keeps the compiled bytecode of every template in TEMPLATE_CACHE_DIR, shared by all
+the workers, so a template is compiled once per deploy instead of once per worker. Run
+the precompile command after deploying to compile them all before the first request:
+
+    python -m prayer_of_hannah.precompile
+
+A template's bytecode is found by its name and checksum, so a changed template is just
+compiled again. Jinja writes each file by renaming a temporary file, so workers can
+share the directory safely.
+'''
+
+
+def init_app(app: Flask) -> None:
+    """Use the bytecode cache, if TEMPLATE_CACHE_DIR is set"""
+    directory: str | None = app.config.get('TEMPLATE_CACHE_DIR')
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+        app.jinja_env.bytecode_cache = FileSystemBytecodeCache(directory)
+
+
+def precompile(app: Flask) -> list[str]:
+    """Compile every template of the app and its blueprints into the bytecode cache"""
+    names: list[str] = app.jinja_env.list_templates(extensions=('html',))
+    for name in names:
+        app.jinja_env.get_template(name)
+    return names
+
+
+def main() -> None:
+    import argparse
+    from prayer_of_hannah import create_app
+    parser = argparse.ArgumentParser(description="Compile every template into the Jinja bytecode cache")
+    parser.parse_args()
+    app: Flask = create_app()
+    if not app.config.get('TEMPLATE_CACHE_DIR'):
+        print("TEMPLATE_CACHE_DIR is not set")
+        return
+    print(f"{len(precompile(app))} templates compiled into {app.config['TEMPLATE_CACHE_DIR']}")
+
+
+if __name__ == "__main__":
+    main()
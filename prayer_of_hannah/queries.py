@@ -0,0 +1,86 @@
+from collections.abc import Iterator
+from typing import Sequence
+from sqlalchemy import or_
+from sqlalchemy.orm import selectinload
+from sqlmodel import Session, select
+from sqlmodel.sql.expression import SelectOfScalar
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from prayer_of_hannah.models import Author, Song, Song_Book_Item, Verse
+
+'''
+The queries used by the web pages, with an async variant for the async route handlers
+(the song book item page). The catalog and search pages have no async variant: they are
+streamed (stream_songs below) and Flask can't stream the response of an async view, so
+they read through a sync session.
+
+Everything a page uses is loaded eagerly (selectinload) so the results can be used
+after the session closes, and so async code never triggers a lazy load.
+
+Long listings are streamed instead: stream_songs yields the rows STREAM_CHUNK at a time
+(with their selectinloads done per chunk) while the page is being sent, so only one
+chunk is held in memory whatever the size of the catalog.
+'''
+
+SEARCH_LIMIT = 100
+# rows fetched at a time when a listing is streamed
+STREAM_CHUNK = 200
+
+
+def catalog_statement() -> SelectOfScalar[Song]:
+    return (select(Song)
+            .options(selectinload(Song.authors),  # type: ignore[arg-type]
+                     selectinload(Song.song_book_items).selectinload(Song_Book_Item.song_book))  # type: ignore[arg-type]
+            .order_by(Song.title))
+
+
+def export_statement() -> SelectOfScalar[Song]:
+    """The catalog with every item's verses"""
+    return catalog_statement().options(selectinload(Song.song_book_items)  # type: ignore[arg-type]
+                                       .selectinload(Song_Book_Item.verses))  # type: ignore[arg-type]
+
+
+def search_statement(text: str, limit: int = SEARCH_LIMIT) -> SelectOfScalar[Song]:
+    """Songs with text in the title, an author's name or the lyrics"""
+    like: str = f"%{text.strip()}%"
+    by_author = (select(Song.id)
+                 .join(Song.authors)  # type: ignore[arg-type]
+                 .where(or_(Author.surname.ilike(like), Author.first_names.ilike(like))))  # type: ignore[attr-defined]
+    by_lyrics = (select(Song_Book_Item.song_id)
+                 .join(Verse)
+                 .where(Verse.lyrics.ilike(like)))  # type: ignore[attr-defined]
+    return (catalog_statement()
+            .where(or_(Song.title.ilike(like),  # type: ignore[attr-defined]
+                       Song.id.in_(by_author),  # type: ignore[union-attr]
+                       Song.id.in_(by_lyrics)))  # type: ignore[union-attr]
+            .limit(limit))
+
+
+def song_book_item_statement(song_book_item_id: int) -> SelectOfScalar[Song_Book_Item]:
+    """A song book item with everything needed to display it in live worship"""
+    return (select(Song_Book_Item)
+            .where(Song_Book_Item.id == song_book_item_id)
+            .options(selectinload(Song_Book_Item.song),  # type: ignore[arg-type]
+                     selectinload(Song_Book_Item.song_book),  # type: ignore[arg-type]
+                     selectinload(Song_Book_Item.verses)))  # type: ignore[arg-type]
+
+
+def song_catalog(session: Session) -> Sequence[Song]:
+    return session.exec(catalog_statement()).all()
+
+
+def search_songs(session: Session, text: str) -> Sequence[Song]:
+    return session.exec(search_statement(text)).all()
+
+
+def stream_songs(session: Session, statement: SelectOfScalar[Song], chunk: int = STREAM_CHUNK) -> Iterator[Song]:
+    """The statement's songs, fetched chunk rows at a time, the session must stay open while they are used"""
+    yield from session.exec(statement.execution_options(yield_per=chunk))
+
+
+def song_book_item(session: Session, song_book_item_id: int) -> Song_Book_Item | None:
+    return session.exec(song_book_item_statement(song_book_item_id)).first()
+
+
+async def async_song_book_item(session: AsyncSession, song_book_item_id: int) -> Song_Book_Item | None:
+    return (await session.exec(song_book_item_statement(song_book_item_id))).first()
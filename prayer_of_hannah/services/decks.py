@@ -0,0 +1,171 @@
+import hashlib
+import json
+from functools import lru_cache
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import selectinload
+from sqlmodel import Session, select
+
+from prayer_of_hannah.lru import LruCache
+from prayer_of_hannah.models import MediaType, Service, Service_Item, Slide_Deck, Song_Book_Item, Verse
+from prayer_of_hannah.tenants import tenant_cache
+from prayer_of_hannah.verse_order import verse_name, verse_sequence
+
+'''
+Compiles a service into a slide deck bundle: one json document holding every slide's
+text and verse id in display order (from the compiled verse order, see verse_order.py),
+with a blank slide between songs. A verse too long for one screen of a view is split
+into several slides (see layout.py), numbered by their page.
+
+The bundle is identified by the sha256 of its bytes so it can be cached forever by
+clients and proxies. During the service clients download it once and live updates
+only need to carry a slide index.
+'''
+
+DECK_FORMAT = 4
+# Cache-Control for anything named by its content hash, so it never changes
+IMMUTABLE = 'public, max-age=31536000, immutable'
+LINE_BREAK = '<br>'
+# media shown behind an item's slides, the variant for each view is picked as it is rendered
+BACKGROUND_TYPES = (MediaType.BACKGROUND_IMAGE, MediaType.BACKGROUND_VIDEO)
+
+
+class DeckError(Exception):
+    pass
+
+
+def verse_lines(lyrics: str | None) -> list[str]:
+    return [line.strip() for line in (lyrics or '').split(LINE_BREAK) if line.strip()]
+
+
+def service_statement(service_id: int):
+    """The service with everything needed to build its deck"""
+    return (select(Service)
+            .where(Service.id == service_id)
+            .options(selectinload(Service.items)  # type: ignore[arg-type]
+                     .selectinload(Service_Item.song_book_item)  # type: ignore[arg-type]
+                     .options(selectinload(Song_Book_Item.verses),  # type: ignore[arg-type]
+                              selectinload(Song_Book_Item.media),  # type: ignore[arg-type]
+                              selectinload(Song_Book_Item.song),  # type: ignore[arg-type]
+                              selectinload(Song_Book_Item.song_book))))  # type: ignore[arg-type]
+
+
+def build_deck(service: Service) -> dict:
+    # live_worship imports this module
+    from prayer_of_hannah.live_worship.layout import Profile, split_slides
+    from prayer_of_hannah.live_worship.slides import view_profiles
+    profiles: list[Profile] = view_profiles()
+    items: list[dict] = []
+    slides: list[dict] = []
+    for item in service.items:
+        sbi: Song_Book_Item = item.song_book_item
+        verse_order: str | None = item.verse_order or sbi.verse_order
+        if slides:
+            slides.append({'item': len(items) - 1, 'id': None, 'verse': '', 'page': 0, 'lines': []})
+        background = next((m for m in sbi.media if m.type in BACKGROUND_TYPES), None)
+        items.append({'position': item.position, 'title': sbi.song.title,
+                      'book': sbi.song_book.code, 'nbr': sbi.nbr, 'verse_order': verse_order or '',
+                      'background': background.content_hash if background is not None else None,
+                      'background_video': background is not None and background.type == MediaType.BACKGROUND_VIDEO})
+        verses: dict[int | None, Verse] = {v.id: v for v in sbi.verses}
+        for verse_id in verse_sequence(sbi, item.verse_order):
+            verse: Verse | None = verses.get(verse_id)
+            if verse is None:
+                continue
+            for page, lines in enumerate(split_slides(tuple(verse_lines(verse.lyrics)), profiles)):
+                slides.append({'item': len(items) - 1, 'id': verse.id,
+                               'verse': verse_name(verse.type, verse.number, verse.part), 'page': page,
+                               'lines': list(lines)})
+    return {
+        'format': DECK_FORMAT,
+        'service': {'id': service.id, 'name': service.name,
+                    'start': service.start.isoformat() if service.start else None},
+        'items': items,
+        'slides': slides,
+    }
+
+
+def encode_deck(deck: dict) -> tuple[bytes, str]:
+    """Canonical json bytes and their content hash"""
+    bundle: bytes = json.dumps(deck, sort_keys=True, separators=(',', ':'), ensure_ascii=False).encode()
+    return bundle, hashlib.sha256(bundle).hexdigest()
+
+
+def finalise_service(session: Session, service_id: int) -> Slide_Deck:
+    """
+    Compile the service into a new Slide_Deck version. If nothing has changed since the
+    last version that deck is returned instead.
+    """
+    service: Service | None = session.exec(service_statement(service_id)).first()
+    if service is None:
+        raise DeckError(f"No service: {service_id}")
+    bundle, content_hash = encode_deck(build_deck(service))
+
+    latest: Slide_Deck | None = latest_deck(session, service_id)
+    if latest is not None and latest.content_hash == content_hash:
+        return latest
+
+    version: int = (latest.version + 1) if latest is not None else 1
+    deck: Slide_Deck = Slide_Deck(service_id=service_id, version=version, content_hash=content_hash, bundle=bundle)
+    service.deck_hash = content_hash
+    session.add(deck)
+    session.add(service)
+    try:
+        session.commit()
+    except IntegrityError:
+        # another worker finalised the service into this version first, compare with theirs
+        session.rollback()
+        return finalise_service(session, service_id)
+    session.refresh(deck)
+    return deck
+
+
+def latest_deck(session: Session, service_id: int) -> Slide_Deck | None:
+    return session.exec(select(Slide_Deck)
+                        .where(Slide_Deck.service_id == service_id)
+                        .order_by(Slide_Deck.version.desc())).first()  # type: ignore[attr-defined]
+
+
+def deck_version(session: Session, service_id: int, version: int) -> Slide_Deck | None:
+    return session.exec(select(Slide_Deck)
+                        .where(Slide_Deck.service_id == service_id)
+                        .where(Slide_Deck.version == version)).first()
+
+
+# bundles are immutable so can be kept in memory, keyed by content hash
+BUNDLE_CACHE_SIZE = 64
+_bundles: LruCache[str, bytes] = LruCache(BUNDLE_CACHE_SIZE)
+
+
+def bundle_cache() -> LruCache[str, bytes]:
+    """The current tenant's bundles (see tenants.py), or the worker's"""
+    cache: LruCache[str, bytes] | None = tenant_cache(
+        'bundles', lambda tenant: LruCache(BUNDLE_CACHE_SIZE, tenant.cache_budget('bundles')))
+    return _bundles if cache is None else cache
+
+
+def deck_bundle(engine: Engine, content_hash: str) -> bytes | None:
+    cache: LruCache[str, bytes] = bundle_cache()
+    bundle: bytes | None = cache.get(content_hash)
+    if bundle is not None:
+        return bundle
+
+    with Session(engine) as session:
+        deck: Slide_Deck | None = session.exec(select(Slide_Deck).where(Slide_Deck.content_hash == content_hash)).first()
+    if deck is None:
+        return None
+
+    cache.put(content_hash, deck.bundle)
+    return deck.bundle
+
+
+# a content hash names the same deck in every tenant's database, so parsed decks are shared
+@lru_cache(maxsize=BUNDLE_CACHE_SIZE)
+def _parse_bundle(content_hash: str, bundle: bytes) -> dict:
+    return json.loads(bundle)
+
+
+def deck_document(engine: Engine, content_hash: str) -> dict | None:
+    """The parsed bundle, shared by every caller so it must not be changed"""
+    bundle: bytes | None = deck_bundle(engine, content_hash)
+    return None if bundle is None else _parse_bundle(content_hash, bundle)
@@ -0,0 +1,144 @@
+import difflib
+import gzip
+import json
+from sqlalchemy.engine import Engine
+from sqlmodel import Session
+
+from prayer_of_hannah.lru import LruCache
+from prayer_of_hannah.models import Slide_Deck
+from prayer_of_hannah.services.decks import DeckError, deck_version, encode_deck
+from prayer_of_hannah.tenants import tenant_cache
+
+'''
+Deltas between two versions of a service's slide deck, so a client holding version N
+only downloads what changed on the way to version M.
+
+A delta is a small json document, gzipped:
+
+    {"format": 1, "from": <hash N>, "to": <hash M>,
+     "service": {...} (only if changed), "items": [...] (only if changed),
+     "slides": [["c", start, count, item_shift], ["s", [slide, ...]], ...]}
+
+"c" copies count slides of version N starting at start, adding item_shift to their
+item index (dropping or adding a hymn moves every later slide to another item without
+changing its text). "s" sends slides in full. The client (static/decks.js, used by the
+presenter page) rebuilds version M and checks the result against the "to" hash, falling
+back to downloading the whole bundle.
+
+Deltas are immutable (they are named by both hashes) so they are cached and computed
+once however many clients ask for them.
+'''
+
+DELTA_FORMAT = 1
+COPY = 'c'
+SLIDES = 's'
+
+
+def slide_key(slide: dict) -> str:
+    """A slide without its item index, slides with the same key can be copied"""
+    return json.dumps({k: v for k, v in slide.items() if k != 'item'}, sort_keys=True, separators=(',', ':'),
+                      ensure_ascii=False)
+
+
+def diff_decks(old: dict, new: dict) -> dict:
+    old_slides: list[dict] = old['slides']
+    new_slides: list[dict] = new['slides']
+    ops: list[list] = []
+
+    def send(slides: list[dict]) -> None:
+        if ops and ops[-1][0] == SLIDES:
+            ops[-1][1].extend(slides)
+        else:
+            ops.append([SLIDES, list(slides)])
+
+    matcher = difflib.SequenceMatcher(None, [slide_key(s) for s in old_slides],
+                                      [slide_key(s) for s in new_slides], autojunk=False)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag != 'equal':
+            if j2 > j1:
+                send(new_slides[j1:j2])
+            continue
+        # split the run wherever the item shift changes
+        start: int = 0
+        while start < i2 - i1:
+            shift: int = new_slides[j1 + start]['item'] - old_slides[i1 + start]['item']
+            end: int = start + 1
+            while end < i2 - i1 and new_slides[j1 + end]['item'] - old_slides[i1 + end]['item'] == shift:
+                end += 1
+            ops.append([COPY, i1 + start, end - start, shift])
+            start = end
+
+    delta: dict = {'format': DELTA_FORMAT, 'slides': ops}
+    if new['service'] != old['service']:
+        delta['service'] = new['service']
+    if new['items'] != old['items']:
+        delta['items'] = new['items']
+    return delta
+
+
+def apply_delta(old: dict, delta: dict) -> dict:
+    """The new deck, as a client rebuilds it"""
+    if delta.get('format') != DELTA_FORMAT:
+        raise DeckError(f"Unknown delta format: {delta.get('format')}")
+    slides: list[dict] = []
+    for op in delta['slides']:
+        if op[0] == COPY:
+            _, start, count, shift = op
+            slides.extend(dict(s, item=s['item'] + shift) for s in old['slides'][start:start + count])
+        elif op[0] == SLIDES:
+            slides.extend(op[1])
+        else:
+            raise DeckError(f"Unknown delta operation: {op[0]}")
+    return {
+        'format': old['format'],
+        'service': delta.get('service', old['service']),
+        'items': delta.get('items', old['items']),
+        'slides': slides,
+    }
+
+
+def encode_delta(old: Slide_Deck, new: Slide_Deck) -> bytes:
+    """The gzipped delta from old to new"""
+    delta: dict = diff_decks(json.loads(old.bundle), json.loads(new.bundle))
+    delta['from'] = old.content_hash
+    delta['to'] = new.content_hash
+    # mtime=0 so the same delta is always the same bytes
+    return gzip.compress(json.dumps(delta, separators=(',', ':'), ensure_ascii=False).encode(), mtime=0)
+
+
+def rebuild_deck(old_bundle: bytes, delta_gz: bytes) -> bytes:
+    """Apply a gzipped delta to a bundle, checking the result is the version it names"""
+    delta: dict = json.loads(gzip.decompress(delta_gz))
+    bundle, content_hash = encode_deck(apply_delta(json.loads(old_bundle), delta))
+    if content_hash != delta['to']:
+        raise DeckError(f"Delta did not rebuild {delta['to']}")
+    return bundle
+
+
+# deltas never change so are kept in memory, keyed by (from hash, to hash)
+DELTA_CACHE_SIZE = 256
+_deltas: LruCache[tuple[str, str], bytes] = LruCache(DELTA_CACHE_SIZE)
+
+
+def delta_cache() -> LruCache[tuple[str, str], bytes]:
+    """The current tenant's deltas (see tenants.py), or the worker's"""
+    cache: LruCache[tuple[str, str], bytes] | None = tenant_cache(
+        'deltas', lambda tenant: LruCache(DELTA_CACHE_SIZE, tenant.cache_budget('deltas')))
+    return _deltas if cache is None else cache
+
+
+def deck_delta(engine: Engine, service_id: int, from_version: int, to_version: int) -> tuple[Slide_Deck, bytes] | None:
+    """The target deck and the gzipped delta to it, None if either version does not exist"""
+    with Session(engine) as session:
+        old: Slide_Deck | None = deck_version(session, service_id, from_version)
+        new: Slide_Deck | None = deck_version(session, service_id, to_version)
+    if old is None or new is None:
+        return None
+
+    key: tuple[str, str] = (old.content_hash, new.content_hash)
+    cache: LruCache[tuple[str, str], bytes] = delta_cache()
+    delta: bytes | None = cache.get(key)
+    if delta is None:
+        delta = encode_delta(old, new)
+        cache.put(key, delta)
+    return new, delta
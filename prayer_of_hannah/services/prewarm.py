@@ -0,0 +1,172 @@
+import contextvars
+import threading
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from flask import Flask
+from sqlmodel import Session, select
+
+from prayer_of_hannah.dbms import Dbms
+from prayer_of_hannah.models import Service
+from prayer_of_hannah.live_worship.layout import precompute_layouts
+from prayer_of_hannah.live_worship.slides import VIEWS, SlideCache, render_views, slide_cache, view_profiles
+from prayer_of_hannah.services.decks import DeckError, deck_document
+
+'''
+Pre-warms a service before it starts so the first display of every song is as quick as
+the rest: the deck it was last finalised into is loaded (warming the bundle cache), its
+verses are laid out for every view's screen in a process pool and every slide is rendered
+for every view into the slide cache. The rendered slides are pinned until the service ends.
+Only the deck the service already has is warmed, pre-warming never finalises: a deck is
+only made when someone finalises the service.
+
+The Prewarmer thread does this for every finalised service starting within PREWARM_AHEAD,
+again if it is finalised into a new deck, and unpins services that started more than
+SERVICE_LENGTH ago in case no one ended them. With PREWARM_SERVICES set each worker runs
+one for its database, started by its first request or the ASGI lifespan (init_app), and
+with tenants each open tenant runs one for its own database and caches (see tenants.py).
+'''
+
+# how long before its start a service is pre-warmed
+PREWARM_AHEAD = timedelta(minutes=30)
+# after this long a service is treated as ended even if no one ended it
+SERVICE_LENGTH = timedelta(hours=3)
+# seconds between checks for upcoming services
+CHECK_INTERVAL = 60
+
+
+@dataclass
+class Prewarmed:
+    service_id: int
+    deck_hash: str
+    slides: int
+    rendered: int
+
+
+def prewarm_service(app: Flask, db: Dbms, service_id: int, views: tuple[str, ...] = VIEWS,
+                    cache: SlideCache | None = None) -> Prewarmed:
+    """
+    Render all the slides of the service's deck and pin them. Raises DeckError for an unknown
+    service or one that hasn't been finalised
+    """
+    cache = cache or slide_cache()
+    with Session(db.engine) as session:
+        service: Service | None = session.get(Service, service_id)
+        deck_hash: str | None = service.deck_hash if service is not None else None
+    deck: dict | None = deck_document(db.engine, deck_hash) if deck_hash else None
+    if deck_hash is None or deck is None:
+        raise DeckError(f"Service {service_id} has no deck")
+
+    # pinned first so rendering a large service can't evict its own slides
+    cache.pin(service_id, deck_hash, [(deck_hash, index, view) for index in range(len(deck['slides'])) for view in views])
+    precompute_layouts([(s['id'], tuple(s['lines'])) for s in deck['slides'] if s.get('id') is not None],
+                       view_profiles(views))
+    rendered: int = 0
+    with app.app_context():
+        for index in range(len(deck['slides'])):
+            missing: tuple[str, ...] = tuple(view for view in views if cache.get((deck_hash, index, view)) is None)
+            if missing:
+                # every missing view of the slide in one pass
+                cache.put_many({(deck_hash, index, view): html for view, html in render_views(deck, index, missing).items()})
+                rendered += len(missing)
+    return Prewarmed(service_id, deck_hash, len(deck['slides']), rendered)
+
+
+def end_service(service_id: int, cache: SlideCache | None = None) -> None:
+    """Let the service's slides be evicted again"""
+    (cache or slide_cache()).unpin(service_id)
+
+
+def upcoming_services(db: Dbms, now: datetime, ahead: timedelta = PREWARM_AHEAD) -> dict[int, str | None]:
+    """
+    The deck hash (None if not finalised) of each service starting within ahead of now, or
+    started but not yet SERVICE_LENGTH old
+    """
+    with Session(db.engine) as session:
+        return dict(session.exec(select(Service.id, Service.deck_hash)  # type: ignore[call-overload]
+                                 .where(Service.start <= now + ahead)  # type: ignore[operator]
+                                 .where(Service.start > now - SERVICE_LENGTH)).all())  # type: ignore[operator]
+
+
+class Prewarmer(threading.Thread):
+    """
+    Pre-warm upcoming services every CHECK_INTERVAL seconds until stopped
+    """
+    def __init__(self, app: Flask, db: Dbms, interval: float = CHECK_INTERVAL, cache: SlideCache | None = None) -> None:
+        super().__init__(name="Prewarmer", daemon=True)
+        # checks run with the tenant (if any) current when it was made, see tenants.py
+        self._context: contextvars.Context = contextvars.copy_context()
+        self.app = app
+        self.db = db
+        self.interval = interval
+        self.cache = cache or slide_cache()
+        # the deck each service was warmed with
+        self._warmed: dict[int, str] = {}
+        self._stop_event = threading.Event()
+
+    def check(self, now: datetime | None = None) -> list[Prewarmed]:
+        """Pre-warm the upcoming finalised services not yet warmed with their deck, unpin the ones that are over"""
+        upcoming: dict[int, str | None] = upcoming_services(self.db, now or datetime.now())
+        for service_id in set(self._warmed) - set(upcoming):
+            end_service(service_id, self.cache)
+            del self._warmed[service_id]
+        # a service ended early stays warmed (and unpinned) so it isn't pinned again
+        warmed: list[Prewarmed] = []
+        for service_id, deck_hash in upcoming.items():
+            if deck_hash is None or self._warmed.get(service_id) == deck_hash:
+                continue
+            try:
+                warmed.append(prewarm_service(self.app, self.db, service_id, cache=self.cache))
+            except DeckError:
+                # deleted since it was checked
+                continue
+            self._warmed[service_id] = warmed[-1].deck_hash
+        return warmed
+
+    def run(self) -> None:
+        while not self._stop_event.wait(self.interval):
+            try:
+                for warmed in self._context.run(self.check):
+                    print(f"Pre-warmed service {warmed.service_id}: {warmed.slides} slides, {warmed.rendered} rendered")
+            except Exception as e:
+                print(f"Pre-warming services failed: {e}")
+
+    def stop(self) -> None:
+        self._stop_event.set()
+
+
+_prewarmer_lock = threading.Lock()
+
+
+def start_prewarmer(app: Flask) -> Prewarmer:
+    """The Prewarmer of the worker's database, started on first use"""
+    with _prewarmer_lock:
+        prewarmer: Prewarmer | None = app.extensions.get('prewarmer')
+        if prewarmer is None:
+            from prayer_of_hannah import get_db
+            prewarmer = app.extensions['prewarmer'] = Prewarmer(app, get_db())
+            prewarmer.start()
+        return prewarmer
+
+
+def stop_prewarmer(app: Flask) -> None:
+    with _prewarmer_lock:
+        prewarmer: Prewarmer | None = app.extensions.pop('prewarmer', None)
+    if prewarmer is not None:
+        prewarmer.stop()
+
+
+def init_app(app: Flask) -> None:
+    """
+    Pre-warm the worker's upcoming services from its first request, if PREWARM_SERVICES is
+    set. With TENANT_ROUTING each tenant starts its own when it is opened
+    """
+    if not app.config.get('PREWARM_SERVICES'):
+        return
+    if app.config.get('TENANT_ROUTING'):
+        app.extensions['tenants'].prewarm_app = app
+        return
+
+    def prewarm_from_first_request() -> None:
+        if 'prewarmer' not in app.extensions:
+            start_prewarmer(app)
+    app.before_request(prewarm_from_first_request)
@@ -1,6 +1,87 @@
-from flask import render_template
+import gzip
+from flask import Response, abort, current_app, jsonify, render_template, request, url_for
+from sqlmodel import Session
 from prayer_of_hannah.services import bp
+from prayer_of_hannah.services import decks
+from prayer_of_hannah.services import delta
+from prayer_of_hannah.services import prewarm
+from prayer_of_hannah.live_worship.slides import slide_cache
+from prayer_of_hannah.services.decks import IMMUTABLE
+from prayer_of_hannah import get_db, get_dbe
 
 @bp.route('/')
 def index():
     return render_template('services/index.html')
+
+def deck_json(deck):
+    return jsonify(service_id = deck.service_id, version = deck.version, hash = deck.content_hash,
+                   url = url_for('services.deck_bundle', content_hash = deck.content_hash))
+
+@bp.post('/<int:service_id>/finalise')
+def finalise(service_id: int):
+    with get_db().write_session() as session:
+        try:
+            deck = decks.finalise_service(session, service_id)
+        except decks.DeckError:
+            abort(404)
+        response = deck_json(deck)
+    if slide_cache().service_deck(service_id) not in (None, deck.content_hash):
+        # changed after it was pre-warmed, warm the new deck
+        prewarm.prewarm_service(current_app._get_current_object(), get_db(), service_id)
+    return response
+
+@bp.post('/<int:service_id>/prewarm')
+def prewarm_service(service_id: int):
+    try:
+        warmed = prewarm.prewarm_service(current_app._get_current_object(), get_db(), service_id)
+    except decks.DeckError:
+        abort(404)
+    return jsonify(service_id = service_id, hash = warmed.deck_hash, slides = warmed.slides, rendered = warmed.rendered)
+
+@bp.get('/<int:service_id>/deck')
+def deck(service_id: int):
+    with Session(get_dbe()) as session:
+        deck = decks.latest_deck(session, service_id)
+        if deck is None:
+            abort(404)
+        response = deck_json(deck)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+@bp.get('/<int:service_id>/deck/delta')
+def deck_delta(service_id: int):
+    from_version = request.args.get('from', type = int)
+    to_version = request.args.get('to', type = int)
+    if from_version is None:
+        abort(400)
+    if to_version is None:
+        with Session(get_dbe()) as session:
+            latest = decks.latest_deck(session, service_id)
+        if latest is None:
+            abort(404)
+        to_version = latest.version
+    found = delta.deck_delta(get_dbe(), service_id, from_version, to_version)
+    if found is None:
+        # the client falls back to downloading the whole bundle
+        abort(404)
+    deck, body = found
+    headers = {'X-Deck-Version': str(deck.version), 'X-Deck-Hash': deck.content_hash, 'Vary': 'Accept-Encoding'}
+    if 'gzip' in request.headers.get('Accept-Encoding', ''):
+        headers['Content-Encoding'] = 'gzip'
+    else:
+        body = gzip.decompress(body)
+    if request.args.get('to') is not None:
+        headers['Cache-Control'] = IMMUTABLE
+    else:
+        headers['Cache-Control'] = 'no-cache'
+    return Response(body, mimetype = 'application/json', headers = headers)
+
+@bp.get('/decks/<content_hash>.json')
+def deck_bundle(content_hash: str):
+    etag: str = f'"{content_hash}"'
+    if etag in request.headers.get('If-None-Match', ''):
+        return Response(status = 304, headers = {'ETag': etag, 'Cache-Control': IMMUTABLE})
+    bundle = decks.deck_bundle(get_dbe(), content_hash)
+    if bundle is None:
+        abort(404)
+    return Response(bundle, mimetype = 'application/json', headers = {'ETag': etag, 'Cache-Control': IMMUTABLE})
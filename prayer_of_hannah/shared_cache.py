@@ -0,0 +1,247 @@
+import os
+import sqlite3
+import threading
+import time
+from collections.abc import Iterator
+from sqlalchemy import text
+from sqlalchemy.engine import Engine
+from config import Config
+
+from prayer_of_hannah.dbms import CHANGE_LOG_TABLE
+from prayer_of_hannah.tenants import Tenant, tenant_cache
+
+'''
+A cache shared by every worker process on the box: one SQLite file, SHARED_CACHE_FILE,
+so N workers keep one copy of each rendered slide or catalog page instead of N, and a
+worker that restarts finds them warm. There is no server to run, each process opens the
+file. It is in WAL mode so reads never wait for a write, with synchronous=OFF: a power
+cut can only lose entries, which costs rendering them again.
+
+An entry is (database, namespace, key) -> bytes, with the write version of the database
+(its highest change_log id) it was made from, or None for something named by its
+content (eg a deck hash) that never goes stale. The database is '' or the tenant's name
+(see tenants.py), each has its own versions. get(namespace, key, version) only returns
+an entry made from that version, so a page from before a write is never served once the
+worker has seen the write, whichever worker stored it. The first put of a newer version
+deletes the database's older versioned entries in the same transaction, and a put made
+from an older version than one seen is dropped.
+
+The file is kept under max_bytes: a put that takes it over deletes the least recently
+used entries (of any database) down to EVICT_TO of it. When an entry was last used is
+only written every TOUCH_SECONDS, so a hit is almost always a read. A value over
+MAX_ENTRY_SHARE of max_bytes is not stored.
+
+It is a cache: a get that finds the file locked is a miss and a put that finds it
+locked is dropped, neither waits more than TIMEOUT for another worker.
+'''
+
+# seconds a get or put waits for another worker's write
+TIMEOUT = 0.2
+# seconds between updates of an entry's last use
+TOUCH_SECONDS = 60.0
+# eviction frees space down to this fraction of max_bytes, so a full cache doesn't evict on every put
+EVICT_TO = 0.9
+MAX_ENTRY_SHARE = 0.125
+
+SCHEMA: list[str] = [
+    """CREATE TABLE IF NOT EXISTS entries (
+        id INTEGER PRIMARY KEY,
+        database TEXT NOT NULL,
+        namespace TEXT NOT NULL,
+        key TEXT NOT NULL,
+        version INTEGER,
+        value BLOB NOT NULL,
+        size INTEGER NOT NULL,
+        used REAL NOT NULL,
+        UNIQUE (database, namespace, key))""",
+    "CREATE INDEX IF NOT EXISTS entries_used ON entries (used)",
+    "CREATE INDEX IF NOT EXISTS entries_version ON entries (database, version) WHERE version IS NOT NULL",
+    # the newest write version of each database seen
+    "CREATE TABLE IF NOT EXISTS versions (database TEXT PRIMARY KEY, version INTEGER NOT NULL)",
+    # one row, the bytes stored
+    "CREATE TABLE IF NOT EXISTS size (id INTEGER PRIMARY KEY CHECK (id = 0), bytes INTEGER NOT NULL)",
+    "INSERT OR IGNORE INTO size VALUES (0, 0)",
+    """CREATE TRIGGER IF NOT EXISTS entries_insert AFTER INSERT ON entries
+        BEGIN UPDATE size SET bytes = bytes + new.size; END""",
+    """CREATE TRIGGER IF NOT EXISTS entries_update AFTER UPDATE OF size ON entries
+        BEGIN UPDATE size SET bytes = bytes + new.size - old.size; END""",
+    """CREATE TRIGGER IF NOT EXISTS entries_delete AFTER DELETE ON entries
+        BEGIN UPDATE size SET bytes = bytes - old.size; END""",
+]
+
+UPSERT = """
+    INSERT INTO entries (database, namespace, key, version, value, size, used) VALUES (?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT (database, namespace, key) DO UPDATE
+        SET version = excluded.version, value = excluded.value, size = excluded.size, used = excluded.used"""
+
+# deletes the least recently used entries until ? bytes have been freed
+EVICT = """
+    DELETE FROM entries WHERE id IN (
+        SELECT id FROM (SELECT id, size, sum(size) OVER (ORDER BY used, id) AS freed FROM entries)
+        WHERE freed - size < ?)"""
+
+
+def database_version(engine: Engine) -> int:
+    """The database write version, the highest change_log id"""
+    with engine.connect() as connection:
+        return connection.execute(text(f"SELECT max(id) FROM {CHANGE_LOG_TABLE}")).scalar() or 0
+
+
+# each thread's connection to each cache file, and the process it was opened in
+_connections = threading.local()
+
+
+def _connection(path: str) -> sqlite3.Connection:
+    opened: dict[str, tuple[int, sqlite3.Connection]] | None = getattr(_connections, 'files', None)
+    if opened is None:
+        opened = _connections.files = {}
+    found: tuple[int, sqlite3.Connection] | None = opened.get(path)
+    # a process started by fork opens its own
+    if found is not None and found[0] == os.getpid():
+        return found[1]
+    con: sqlite3.Connection = sqlite3.connect(path, timeout=TIMEOUT, isolation_level=None)
+    con.execute("PRAGMA journal_mode=WAL")
+    con.execute("PRAGMA synchronous=OFF")
+    with _transaction(con):
+        for sql in SCHEMA:
+            con.execute(sql)
+    opened[path] = (os.getpid(), con)
+    return con
+
+
+class _transaction:
+    """BEGIN IMMEDIATE, COMMIT or ROLLBACK"""
+    def __init__(self, con: sqlite3.Connection) -> None:
+        self.con = con
+
+    def __enter__(self) -> sqlite3.Connection:
+        self.con.execute("BEGIN IMMEDIATE")
+        return self.con
+
+    def __exit__(self, exc_type, exc, traceback) -> None:
+        self.con.execute("COMMIT" if exc_type is None else "ROLLBACK")
+
+
+class SharedCache:
+    """One database's entries in the cache file. Thread and process safe"""
+    def __init__(self, path: str, max_bytes: int = 256 * 1024 * 1024, database: str = '') -> None:
+        self.path = path
+        self.max_bytes = max_bytes
+        self.database = database
+        self.hits: int = 0
+        self.misses: int = 0
+        # gets and puts that found the file locked
+        self.busy: int = 0
+
+    def get(self, namespace: str, key: str, version: int | None = None) -> bytes | None:
+        """The value stored for key, if it was made from version (None for one that never goes stale)"""
+        try:
+            con: sqlite3.Connection = _connection(self.path)
+            row: tuple | None = con.execute("SELECT id, version, value, used FROM entries "
+                                            "WHERE database = ? AND namespace = ? AND key = ?",
+                                            (self.database, namespace, key)).fetchone()
+            if row is None or row[1] != version:
+                self.misses += 1
+                return None
+            now: float = time.time()
+            if now - row[3] > TOUCH_SECONDS:
+                con.execute("UPDATE entries SET used = ? WHERE id = ?", (now, row[0]))
+        except sqlite3.OperationalError:
+            self.busy += 1
+            self.misses += 1
+            return None
+        self.hits += 1
+        return row[2]
+
+    def put(self, namespace: str, key: str, value: bytes, version: int | None = None) -> bool:
+        return self.put_many(namespace, {key: value}, version)
+
+    def put_many(self, namespace: str, values: dict[str, bytes], version: int | None = None) -> bool:
+        """Store the values made from version in one transaction, False if they weren't"""
+        limit: float = self.max_bytes * MAX_ENTRY_SHARE
+        now: float = time.time()
+        rows: list[tuple] = [(self.database, namespace, key, version, value, len(value), now)
+                             for key, value in values.items() if len(value) <= limit]
+        if not rows:
+            return False
+        try:
+            with _transaction(_connection(self.path)) as con:
+                if version is not None and not self._new_version(con, version):
+                    # made before a write another worker has already seen
+                    return False
+                con.executemany(UPSERT, rows)
+                stored: int = con.execute("SELECT bytes FROM size").fetchone()[0]
+                if stored > self.max_bytes:
+                    con.execute(EVICT, (stored - int(self.max_bytes * EVICT_TO),))
+        except sqlite3.OperationalError:
+            self.busy += 1
+            return False
+        return True
+
+    def _new_version(self, con: sqlite3.Connection, version: int) -> bool:
+        """
+        In a write transaction: if version is newer than any seen, delete the entries made
+        before it. False if it is older than one seen
+        """
+        row: tuple | None = con.execute("SELECT version FROM versions WHERE database = ?", (self.database,)).fetchone()
+        seen: int = -1 if row is None else row[0]
+        if version > seen:
+            con.execute("INSERT OR REPLACE INTO versions VALUES (?, ?)", (self.database, version))
+            con.execute("DELETE FROM entries WHERE database = ? AND version < ?", (self.database, version))
+        return version >= seen
+
+    def invalidate(self, version: int) -> None:
+        """Delete the entries made before version"""
+        with _transaction(_connection(self.path)) as con:
+            self._new_version(con, version)
+
+    def status(self) -> dict:
+        con: sqlite3.Connection = _connection(self.path)
+        entries, stored = con.execute("SELECT count(*), total(size) FROM entries WHERE database = ?",
+                                      (self.database,)).fetchone()
+        version: tuple | None = con.execute("SELECT version FROM versions WHERE database = ?",
+                                            (self.database,)).fetchone()
+        return {'entries': entries, 'bytes': int(stored), 'file_bytes': con.execute("SELECT bytes FROM size").fetchone()[0],
+                'max_bytes': self.max_bytes, 'version': version[0] if version else None,
+                'hits': self.hits, 'misses': self.misses, 'busy': self.busy}
+
+
+def caching(chunks: Iterator[str] | Iterator[bytes], cache: SharedCache, namespace: str, key: str,
+            version: int | None) -> Iterator:
+    """Pass a streamed response's chunks on, storing the whole response once it has all been sent"""
+    limit: float = cache.max_bytes * MAX_ENTRY_SHARE
+    parts: list[bytes] | None = []
+    length: int = 0
+    for chunk in chunks:
+        yield chunk
+        if parts is not None:
+            part: bytes = chunk.encode('utf-8') if isinstance(chunk, str) else chunk
+            parts.append(part)
+            length += len(part)
+            if length > limit:
+                # too big to be stored, stop holding it
+                parts = None
+    if parts is not None:
+        cache.put(namespace, key, b''.join(parts), version)
+
+
+_shared_cache: SharedCache | None = None
+_shared_cache_lock = threading.Lock()
+
+
+def _tenant_shared_cache(tenant: Tenant) -> SharedCache:
+    return SharedCache(Config.SHARED_CACHE_FILE, Config.SHARED_CACHE_MB * 1024 * 1024, tenant.name)
+
+
+def shared_cache() -> SharedCache | None:
+    """The current tenant's (or the app's one database's) shared cache, None unless SHARED_CACHE_FILE is set"""
+    global _shared_cache
+    if not Config.SHARED_CACHE_FILE:
+        return None
+    found: SharedCache | None = tenant_cache('shared_cache', _tenant_shared_cache)
+    if found is not None:
+        return found
+    with _shared_cache_lock:
+        if _shared_cache is None:
+            _shared_cache = SharedCache(Config.SHARED_CACHE_FILE, Config.SHARED_CACHE_MB * 1024 * 1024)
+        return _shared_cache
@@ -0,0 +1,319 @@
+import json
+import os
+import sqlite3
+import struct
+import sys
+import time
+import zlib
+from array import array
+from datetime import datetime
+from sqlalchemy import Table
+from sqlalchemy.schema import CreateIndex, CreateTable
+from sqlmodel import SQLModel
+
+from prayer_of_hannah.dbms import CHANGE_LOG_TABLE, Dbms
+
+'''
+Snapshots: the whole database in one compact file, to clone a library onto a new node
+(or into an in memory database for a test) far faster than copying the sqlite file or
+importing the xml again:
+
+    python -m prayer_of_hannah.snapshot write library.snapshot
+    python -m prayer_of_hannah.snapshot load library.snapshot --db new.sqlite
+
+The file is MAGIC, the length of a json header, the header, then one zlib stream. The
+header has the FORMAT version, the database write version (the highest change_log id)
+and, for every table, its row count and its columns in order with how each is encoded.
+The stream is the string table followed by each table's columns, column by column:
+
+    int   every value's difference from the one before as int64, after a byte per row
+          (1 for NULL) if the column has NULLs. Ids and keys compress to almost nothing
+    str   int32 indexes into the string table, -1 for NULL. Every text in the database
+          is stored once, so lyrics shared by songs in two books cost one copy
+    blob  int64 lengths (-1 for NULL) then the bytes
+    json  anything else (floats, a column with mixed types) as a json list
+
+The string table is the utf-8 length of each string as uint32 then the strings.
+
+A snapshot is loaded into an empty database: the tables are created without their
+indexes and change_log triggers, filled with one executemany per table in a single
+transaction, and then the indexes, triggers and planner statistics are made, which
+takes a fraction of the time it takes to keep them up to date row by row. Columns the
+snapshot doesn't have are left NULL, so a newer version of the app loads an older
+snapshot.
+'''
+
+MAGIC = b'PoHsnap\n'
+FORMAT = 1
+# 9 is 2% smaller and takes almost three times as long
+COMPRESS_LEVEL = 6
+HEADER_LENGTH = struct.Struct('<I')
+# the snapshot's array types, 8 and 4 bytes on every platform python runs on
+INT64 = 'q'
+INT32 = 'i'
+UINT32 = 'I'
+
+
+class SnapshotError(Exception):
+    pass
+
+
+def _to_bytes(values: array) -> bytes:
+    """The array's bytes, little endian"""
+    if sys.byteorder == 'big':
+        values = array(values.typecode, values)
+        values.byteswap()
+    return values.tobytes()
+
+
+def _from_bytes(typecode: str, data: bytes) -> array:
+    values: array = array(typecode)
+    values.frombytes(data)
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return values
+
+
+def _quoted(names: list[str]) -> str:
+    return ", ".join(f'"{name}"' for name in names)
+
+
+class _Strings:
+    """The string table, each distinct string once"""
+    def __init__(self) -> None:
+        self.index: dict[str, int] = {}
+
+    def add(self, value: str) -> int:
+        found: int | None = self.index.get(value)
+        if found is None:
+            found = self.index[value] = len(self.index)
+        return found
+
+    def encode(self) -> bytes:
+        encoded: list[bytes] = [s.encode('utf-8') for s in self.index]
+        return _to_bytes(array(UINT32, map(len, encoded))) + b''.join(encoded)
+
+
+def _decode_strings(data: memoryview, count: int) -> tuple[list[str], int]:
+    """The strings and the length of the table"""
+    lengths: array = _from_bytes(UINT32, bytes(data[:count * 4]))
+    strings: list[str] = []
+    offset: int = count * 4
+    for length in lengths:
+        strings.append(str(data[offset:offset + length], 'utf-8'))
+        offset += length
+    return strings, offset
+
+
+def encode_column(values: list, strings: _Strings) -> tuple[str, bool, bytes]:
+    """The column's encoding, whether it has NULLs, and its bytes"""
+    types: set[type] = {type(v) for v in values if v is not None}
+    nulls: bool = len(values) > 0 and None in values
+    if types <= {int}:
+        deltas: array = array(INT64)
+        last: int = 0
+        for value in values:
+            if value is None:
+                deltas.append(0)
+            else:
+                deltas.append(value - last)
+                last = value
+        mask: bytes = bytes(v is None for v in values) if nulls else b''
+        return 'int', nulls, mask + _to_bytes(deltas)
+    if types == {str}:
+        return 'str', nulls, _to_bytes(array(INT32, (-1 if v is None else strings.add(v) for v in values)))
+    if types == {bytes}:
+        lengths: array = array(INT64, (-1 if v is None else len(v) for v in values))
+        return 'blob', nulls, _to_bytes(lengths) + b''.join(v for v in values if v is not None)
+    if bytes in types:
+        raise SnapshotError(f"A column has blobs and other types: {types}")
+    return 'json', nulls, json.dumps(values).encode('utf-8')
+
+
+def decode_column(encoding: str, nulls: bool, data: bytes, rows: int, strings: list[str]) -> list:
+    if encoding == 'int':
+        mask: bytes = data[:rows] if nulls else b''
+        deltas: array = _from_bytes(INT64, data[len(mask):])
+        values: list = []
+        last: int = 0
+        for delta in deltas:
+            last += delta
+            values.append(last)
+        for i in (i for i, null in enumerate(mask) if null):
+            values[i] = None
+        return values
+    if encoding == 'str':
+        return [None if i < 0 else strings[i] for i in _from_bytes(INT32, data)]
+    if encoding == 'blob':
+        lengths: array = _from_bytes(INT64, data[:rows * 8])
+        blobs: list = []
+        offset: int = rows * 8
+        for length in lengths:
+            if length < 0:
+                blobs.append(None)
+            else:
+                blobs.append(data[offset:offset + length])
+                offset += length
+        return blobs
+    if encoding == 'json':
+        return json.loads(data)
+    raise SnapshotError(f"Unknown column encoding: {encoding}")
+
+
+def snapshot_tables() -> list[Table]:
+    """Every table, parents before children"""
+    return list(SQLModel.metadata.sorted_tables)
+
+
+def write_snapshot(db: Dbms, path: str) -> dict:
+    """Write the database to a snapshot file, returns the header"""
+    strings: _Strings = _Strings()
+    tables: list[dict] = []
+    columns: list[bytes] = []
+    raw = db.write_engine.raw_connection()
+    try:
+        con: sqlite3.Connection = raw.driver_connection  # type: ignore[assignment]
+        # one read transaction, so the tables and the version agree
+        con.execute("BEGIN")
+        try:
+            version: int = con.execute(f'SELECT max(id) FROM "{CHANGE_LOG_TABLE}"').fetchone()[0] or 0
+            for table in snapshot_tables():
+                names: list[str] = [c.name for c in table.columns]
+                order: str = _quoted([c.name for c in table.primary_key.columns])
+                rows: list[tuple] = con.execute(f'SELECT {_quoted(names)} FROM "{table.name}" '
+                                                f'ORDER BY {order}').fetchall()
+                described: list[dict] = []
+                for name, values in zip(names, zip(*rows) if rows else [() for _ in names]):
+                    encoding, nulls, data = encode_column(list(values), strings)
+                    described.append({'name': name, 'encoding': encoding, 'nulls': nulls, 'length': len(data)})
+                    columns.append(data)
+                tables.append({'name': table.name, 'rows': len(rows), 'columns': described})
+        finally:
+            con.rollback()
+    finally:
+        raw.close()
+
+    string_table: bytes = strings.encode()
+    header: dict = {'format': FORMAT, 'created': datetime.now().isoformat(timespec='seconds'), 'version': version,
+                    'strings': len(strings.index), 'strings_length': len(string_table), 'tables': tables}
+    encoded_header: bytes = json.dumps(header).encode('utf-8')
+    compressor = zlib.compressobj(COMPRESS_LEVEL)
+    partial: str = path + '.partial'
+    with open(partial, 'wb') as output:
+        output.write(MAGIC + HEADER_LENGTH.pack(len(encoded_header)) + encoded_header)
+        for data in (string_table, *columns):
+            output.write(compressor.compress(data))
+        output.write(compressor.flush())
+    os.replace(partial, path)
+    return header
+
+
+def read_snapshot(path: str) -> tuple[dict, bytes]:
+    """The header and the uncompressed body. Raises SnapshotError"""
+    with open(path, 'rb') as source:
+        if source.read(len(MAGIC)) != MAGIC:
+            raise SnapshotError(f"Not a snapshot: {path}")
+        (length,) = HEADER_LENGTH.unpack(source.read(HEADER_LENGTH.size))
+        header: dict = json.loads(source.read(length))
+        if header.get('format') != FORMAT:
+            raise SnapshotError(f"Snapshot format {header.get('format')} is not {FORMAT}: {path}")
+        try:
+            body: bytes = zlib.decompress(source.read())
+        except zlib.error as e:
+            raise SnapshotError(f"Snapshot is damaged: {path}: {e}") from e
+    expected: int = header['strings_length'] + sum(c['length'] for t in header['tables'] for c in t['columns'])
+    if len(body) != expected:
+        raise SnapshotError(f"Snapshot is damaged: {path}: {len(body)} bytes, not {expected}")
+    return header, body
+
+
+def load_snapshot(db: Dbms, path: str) -> dict:
+    """
+    Load a snapshot into db, which must have no tables yet (a new file or in memory
+    database). Returns the header. Raises SnapshotError
+    """
+    started: float = time.perf_counter()
+    header, body = read_snapshot(path)
+    view: memoryview = memoryview(body)
+    strings, offset = _decode_strings(view, header['strings'])
+    known: dict[str, Table] = {t.name: t for t in snapshot_tables()}
+    dialect = db.write_engine.dialect
+
+    raw = db.write_engine.raw_connection()
+    try:
+        con: sqlite3.Connection = raw.driver_connection  # type: ignore[assignment]
+        if con.execute("SELECT count(*) FROM sqlite_master WHERE type = 'table'").fetchone()[0]:
+            raise SnapshotError("A snapshot can only be loaded into an empty database")
+        if not db.in_memory:
+            # as create_database_structure, these only take effect before the first table is made
+            con.execute("PRAGMA auto_vacuum=INCREMENTAL")
+            con.execute("PRAGMA journal_mode=WAL")
+        con.execute("PRAGMA foreign_keys=OFF")
+        try:
+            con.execute("BEGIN")
+            for table in known.values():
+                con.execute(str(CreateTable(table).compile(dialect=dialect)))
+            for described in header['tables']:
+                columns: list[dict] = described['columns']
+                values: list[list] = []
+                for column in columns:
+                    data: bytes = bytes(view[offset:offset + column['length']])
+                    offset += column['length']
+                    values.append(decode_column(column['encoding'], column['nulls'], data, described['rows'], strings))
+                table = known.get(described['name'])
+                if table is None:
+                    print(f"Snapshot table not in this version, skipped: {described['name']}")
+                    continue
+                names: list[str] = [c['name'] for c in columns if c['name'] in table.columns]
+                if len(names) < len(columns):
+                    raise SnapshotError(f"Snapshot columns not in this version of {table.name}: "
+                                        f"{[c['name'] for c in columns if c['name'] not in table.columns]}")
+                con.executemany(f'INSERT INTO "{table.name}" ({_quoted(names)}) VALUES ({", ".join("?" * len(names))})',
+                                zip(*values))
+            # built once from the sorted rows rather than updated for each insert
+            for table in known.values():
+                for index in table.indexes:
+                    con.execute(str(CreateIndex(index).compile(dialect=dialect)))
+            con.commit()
+        except BaseException:
+            con.rollback()
+            raise
+        finally:
+            con.execute("PRAGMA foreign_keys=ON")
+    finally:
+        raw.close()
+
+    db.create_change_log_triggers()
+    db.maintenance.after_bulk_import()
+    if db.serve_from_memory:
+        db.load_into_memory()
+    print(f"Loaded snapshot {path} (version {header['version']}, "
+          f"{sum(t['rows'] for t in header['tables'])} rows) in {time.perf_counter() - started:.2f}s")
+    return header
+
+
+def main() -> None:
+    import argparse
+    parser = argparse.ArgumentParser(description="Write or load a snapshot of the Prayer of Hannah database")
+    parser.add_argument('--db', default=Dbms.SQLALCHEMY_DATABASE_FILE, help="database file")
+    commands = parser.add_subparsers(dest='command', required=True)
+    write = commands.add_parser('write', help="write the database to a snapshot")
+    write.add_argument('snapshot_file')
+    load = commands.add_parser('load', help="load a snapshot into a new database file")
+    load.add_argument('snapshot_file')
+    args = parser.parse_args()
+
+    db = Dbms(False, 'sqlite:///' + args.db, args.db)
+    try:
+        if args.command == 'write':
+            header: dict = write_snapshot(db, args.snapshot_file)
+            print(f"Wrote {args.snapshot_file}: version {header['version']}, "
+                  f"{os.path.getsize(args.snapshot_file) / 1024:.0f} KB")
+        else:
+            load_snapshot(db, args.snapshot_file)
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
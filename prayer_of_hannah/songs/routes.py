@@ -1,18 +1,75 @@
-from flask import render_template
-from sqlmodel import Session, select
-from prayer_of_hannah.songs import bp
+from collections.abc import Iterator
+from flask import Response, render_template, request, stream_template
+from sqlmodel import Session
+from sqlmodel.sql.expression import SelectOfScalar
 from prayer_of_hannah.models import Song
+from prayer_of_hannah.songs import bp
 from prayer_of_hannah import get_dbe
+from prayer_of_hannah import queries
+from prayer_of_hannah.export_song_xml import zip_chunks
+from prayer_of_hannah.media.pipeline import worker_executor
+from prayer_of_hannah.shared_cache import caching, database_version, shared_cache
+
+# catalog pages in the cache shared by the workers
+SHARED_NAMESPACE = 'songs'
+
+# jinja yields every piece of template output on its own, they are sent this many characters at a time
+STREAM_BUFFER = 16 * 1024
+
+def buffered(chunks: Iterator[str], size: int = STREAM_BUFFER) -> Iterator[str]:
+    parts: list[str] = []
+    length: int = 0
+    for chunk in chunks:
+        parts.append(chunk)
+        length += len(chunk)
+        if length >= size:
+            yield ''.join(parts)
+            parts, length = [], 0
+    if parts:
+        yield ''.join(parts)
+
+def streamed_songs(template: str, statement: SelectOfScalar[Song], shared_key: str | None = None) -> Response:
+    # the page is sent as the rows are read, the session closes when the last row has been rendered
+    shared = shared_cache() if shared_key else None
+    if shared is not None:
+        # whole catalog pages are shared by the workers until the next write (see shared_cache.py)
+        version = database_version(get_dbe())
+        page = shared.get(SHARED_NAMESPACE, shared_key, version)
+        if page is not None:
+            return Response(page, mimetype = 'text/html')
+    def songs() -> Iterator[Song]:
+        with Session(get_dbe()) as session:
+            yield from queries.stream_songs(session, statement)
+    chunks = buffered(stream_template(template, songs = songs()))
+    if shared is not None:
+        chunks = caching(chunks, shared, SHARED_NAMESPACE, shared_key, version)
+    return Response(chunks, mimetype = 'text/html')
 
 @bp.get('/')
 def index():
     return render_template('songs/index.html')
 
+# streamed, so these views are sync: flask can't stream the response of an async view
 @bp.get('/htmx/songs')
 def songs():
-    with Session(get_dbe()) as session:
-        songs = session.exec(select(Song).order_by(Song.title))
-        return render_template('songs/songs.html', songs = songs)
+    return streamed_songs('songs/songs.html', queries.catalog_statement(), 'songs')
+
+@bp.get('/htmx/search')
+def search():
+    text: str = request.args.get('q', '').strip()
+    if not text:
+        return songs()
+    return streamed_songs('songs/songs.html', queries.search_statement(text))
+
+@bp.get('/export')
+def export():
+    return streamed_songs('songs/export.html', queries.export_statement(), 'export')
+
+@bp.get('/export.zip')
+def export_zip():
+    # OpenLyrics files rendered in the worker's media process pool (not a pool per request), zipped as they are sent
+    return Response(zip_chunks(get_dbe(), executor=worker_executor()), mimetype = 'application/zip',
+                    headers = {'Content-Disposition': 'attachment; filename=songs.zip'})
 
 @bp.get('/htmx/song/<id>')
 def song(int: id):
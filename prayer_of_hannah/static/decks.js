@@ -0,0 +1,94 @@
+// A service's slide deck bundle (see services/decks.py) kept in localStorage and brought up
+// to date with the delta from the version held (see services/delta.py)
+class DeckStore {
+    constructor(deckUrl, deltaUrl) {
+        this.deckUrl = deckUrl;
+        this.deltaUrl = deltaUrl;
+        this.key = "deck:" + deckUrl;
+        this.version = null;
+        this.hash = null;
+        this.deck = null;
+    }
+
+    // the service's latest deck, from the delta to the one held if it rebuilds it, else in full
+    async load() {
+        const response = await fetch(this.deckUrl, {cache: "no-cache"});
+        if (!response.ok) throw new Error("No deck: " + response.status);
+        const latest = await response.json();
+        const held = this.deck !== null ? {version: this.version, hash: this.hash, deck: this.deck} : this.stored();
+        let deck = held !== null && held.hash === latest.hash ? held.deck : null;
+        if (deck === null && held !== null) deck = await this.rebuild(held, latest);
+        if (deck === null) {
+            // named by its hash, so the browser caches it
+            const bundle = await fetch(latest.url);
+            if (!bundle.ok) throw new Error("No deck bundle: " + bundle.status);
+            deck = await bundle.json();
+        }
+        this.version = latest.version;
+        this.hash = latest.hash;
+        this.deck = deck;
+        try {
+            localStorage.setItem(this.key, JSON.stringify({version: latest.version, hash: latest.hash, deck: deck}));
+        } catch (e) {
+            // storage full or disabled, the bundle is downloaded again next time
+        }
+        return deck;
+    }
+
+    stored() {
+        try {
+            return JSON.parse(localStorage.getItem(this.key));
+        } catch (e) {
+            return null;
+        }
+    }
+
+    // the latest deck from the delta to it, null if it can't be checked against the latest hash
+    async rebuild(held, latest) {
+        if (!(window.crypto && crypto.subtle)) return null;
+        try {
+            const response = await fetch(this.deltaUrl + "?from=" + held.version + "&to=" + latest.version);
+            if (!response.ok) return null;
+            const deck = applyDelta(held.deck, await response.json());
+            return await sha256(canonicalJson(deck)) === latest.hash ? deck : null;
+        } catch (e) {
+            return null;
+        }
+    }
+}
+
+// copy ("c") the unchanged runs of slides from the old deck and add the ones sent ("s")
+function applyDelta(old, delta) {
+    if (delta.format !== 1) throw new Error("Unknown delta format: " + delta.format);
+    const slides = [];
+    for (const op of delta.slides) {
+        if (op[0] === "c") {
+            const [, start, count, shift] = op;
+            for (const slide of old.slides.slice(start, start + count)) slides.push({...slide, item: slide.item + shift});
+        } else if (op[0] === "s") {
+            slides.push(...op[1]);
+        } else {
+            throw new Error("Unknown delta operation: " + op[0]);
+        }
+    }
+    return {
+        format: old.format,
+        service: "service" in delta ? delta.service : old.service,
+        items: "items" in delta ? delta.items : old.items,
+        slides: slides,
+    };
+}
+
+// the bytes the server hashes: json with sorted keys and no spaces (decks.encode_deck)
+function canonicalJson(value) {
+    if (Array.isArray(value)) return "[" + value.map(canonicalJson).join(",") + "]";
+    if (value !== null && typeof value === "object") {
+        return "{" + Object.keys(value).sort().map(k => JSON.stringify(k) + ":" + canonicalJson(value[k])).join(",") + "}";
+    }
+    return JSON.stringify(value);
+}
+
+async function sha256(text) {
+    const digest = await crypto.subtle.digest("SHA-256", new TextEncoder().encode(text));
+    return Array.from(new Uint8Array(digest), b => b.toString(16).padStart(2, "0")).join("");
+}
@@ -0,0 +1,56 @@
+// Slide buffer shared by the presenter and display pages, see live_worship/presenter.py
+class SlideBuffer {
+    constructor(windowUrl, view, k) {
+        this.windowUrl = windowUrl;  // with HASH in place of the deck hash
+        this.view = view;
+        this.k = k;
+        this.hash = null;
+        this.count = 0;
+        this.slides = new Map();
+        this.loading = new Map();
+    }
+
+    // forget everything if the deck has changed
+    useDeck(hash) {
+        if (hash !== this.hash) {
+            this.hash = hash;
+            this.slides.clear();
+            this.loading.clear();
+        }
+    }
+
+    get(index) {
+        return this.slides.get(index);
+    }
+
+    // fetch the window around index, unless it is already buffered or on its way
+    fill(index) {
+        const hash = this.hash;
+        let missing = false;
+        for (let i = Math.max(index - this.k, 0); i <= index + this.k && (this.count === 0 || i < this.count); i++) {
+            if (!this.slides.has(i)) { missing = true; break; }
+        }
+        if (!missing) return Promise.resolve();
+        if (this.loading.has(index)) return this.loading.get(index);
+        const url = this.windowUrl.replace("HASH", hash) + "?index=" + index + "&k=" + this.k + "&view=" + this.view;
+        const request = fetch(url).then(r => r.json()).then(data => {
+            if (data.hash !== this.hash) return;
+            this.count = data.count;
+            for (const [i, html] of Object.entries(data.slides)) this.slides.set(Number(i), html);
+        }).finally(() => this.loading.delete(index));
+        this.loading.set(index, request);
+        return request;
+    }
+
+    // show a slide now if buffered (else as soon as it arrives) and top the buffer up
+    async show(target, index) {
+        let html = this.get(index);
+        if (html === undefined) {
+            await this.fill(index);
+            html = this.get(index);
+        } else {
+            this.fill(index);
+        }
+        if (html !== undefined) target.innerHTML = html;
+    }
+}
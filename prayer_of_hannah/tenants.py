@@ -0,0 +1,373 @@
+import contextvars
+import os
+import re
+import threading
+from collections import OrderedDict
+from collections.abc import Callable, Iterator
+from contextlib import contextmanager
+from typing import TYPE_CHECKING
+from config import Config
+
+from prayer_of_hannah.dbms import Dbms
+
+if TYPE_CHECKING:
+    from flask import Flask
+    from prayer_of_hannah.services.prewarm import Prewarmer
+
+'''
+Hosting many congregations from one app. Each tenant has its own database file,
+TENANT_DIR/<name>.sqlite, and each request is routed to one by TENANT_ROUTING:
+
+    subdomain   stf.example.org/songs/ is tenant stf (with TENANT_DOMAIN=example.org)
+    path        example.org/t/stf/songs/ is tenant stf (with TENANT_PATH_PREFIX=/t), the
+                prefix becomes part of the script root so url_for keeps links in the tenant
+
+A worker keeps at most TENANT_ENGINES tenants open. Opening one past that closes the
+least recently used idle tenant: its maintenance thread is stopped, its connection
+pools are disposed (running PRAGMA optimize) and its caches dropped, so a host with
+hundreds of small congregations only holds the pools of the ones in use. A tenant with
+a request in flight (a streamed response or an event stream counts until it ends) or
+media being processed is not idle, the worker goes over TENANT_ENGINES until it is.
+
+Everything a worker keeps about a database (rendered slides and layouts, deck bundles
+and deltas, media lookups and backgrounds, live event channels,
+media jobs and uploads) is kept per tenant: the module that owns it asks tenant_cache
+for the current tenant's copy, made on first use, and closing the tenant shuts down the
+ones that need it (eg its media jobs, the media process pool itself is the worker's). The slide, layout, bundle and delta
+caches share TENANT_CACHE_MB between them (CACHE_SHARES), so one congregation can't
+push another's slides out or see its data. get_db() and get_dbe() are the current
+tenant's database.
+
+Each open tenant also runs its own maintenance thread and, with PREWARM_SERVICES, its
+own prewarmer (see services/prewarm.py) rendering its upcoming services into its slide
+cache. Outside a tenant (TENANT_ROUTING is not set, command line tools) all of them are
+the worker's one database and caches as before. Add a tenant with
+
+    python -m prayer_of_hannah.tenants create stf [--snapshot library.snapshot]
+'''
+
+# a DNS label, so the same names work as subdomains and in paths
+TENANT_NAME = re.compile(r'[a-z0-9](?:[a-z0-9-]{0,61}[a-z0-9])?')
+TENANT_FILE_SUFFIX = '.sqlite'
+ROUTINGS = ('subdomain', 'path')
+# the share of TENANT_CACHE_MB each memory capped cache of a tenant gets, by tenant_cache name
+CACHE_SHARES: dict[str, float] = {'slides': 0.5, 'layouts': 0.15, 'bundles': 0.2, 'deltas': 0.15}
+NOT_FOUND = b'No such congregation'
+
+
+class UnknownTenant(LookupError):
+    pass
+
+
+class Tenant:
+    """A congregation's database and everything cached about it, open in this worker"""
+    def __init__(self, name: str, database_file: str, cache_bytes: int, serve_from_memory: bool = False) -> None:
+        self.name = name
+        self.cache_bytes = cache_bytes
+        self.db: Dbms = Dbms(False, 'sqlite:///' + database_file, database_file, serve_from_memory=serve_from_memory)
+        # requests in flight
+        self.active: int = 0
+        self.prewarmer: 'Prewarmer | None' = None
+        self._caches: dict[str, object] = {}
+        self._lock = threading.Lock()
+
+    def cache_budget(self, name: str) -> int:
+        """The bytes the tenant's cache called name may hold"""
+        return int(self.cache_bytes * CACHE_SHARES.get(name, 0))
+
+    def cache[T](self, name: str, factory: Callable[['Tenant'], T]) -> T:
+        with self._lock:
+            found: object | None = self._caches.get(name)
+            if found is None:
+                found = self._caches[name] = factory(self)
+            return found  # type: ignore[return-value]
+
+    @property
+    def idle(self) -> bool:
+        """No request in flight and nothing it keeps busy (ie media being processed)"""
+        with self._lock:
+            caches: list[object] = list(self._caches.values())
+        return self.active == 0 and not any(getattr(cache, 'busy', False) for cache in caches)
+
+    @contextmanager
+    def current(self) -> Iterator['Tenant']:
+        """Make this the current tenant for the block"""
+        token: contextvars.Token = _current.set(self)
+        try:
+            yield self
+        finally:
+            _current.reset(token)
+
+    def run[T](self, action: Callable[..., T], *args) -> T:
+        """action(*args) with this as the current tenant"""
+        with self.current():
+            return action(*args)
+
+    def start_prewarmer(self, app: 'Flask') -> None:
+        """Pre-warm the tenant's upcoming services into its slide cache"""
+        from prayer_of_hannah.services.prewarm import Prewarmer
+        self.prewarmer = self.run(Prewarmer, app, self.db)
+        self.prewarmer.start()
+
+    def close(self) -> None:
+        if self.prewarmer is not None:
+            self.prewarmer.stop()
+        with self._lock:
+            caches: list[object] = list(self._caches.values())
+            self._caches.clear()
+        for cache in caches:
+            shutdown: Callable[[], None] | None = getattr(cache, 'shutdown', None)
+            if shutdown is not None:
+                shutdown()
+        self.db.close()
+
+
+_current: contextvars.ContextVar[Tenant | None] = contextvars.ContextVar('tenant', default=None)
+
+
+def current_tenant() -> Tenant | None:
+    return _current.get()
+
+
+def tenant_cache[T](name: str, factory: Callable[[Tenant], T]) -> T | None:
+    """The current tenant's cache called name, made by factory(tenant) on first use. None outside a tenant"""
+    tenant: Tenant | None = _current.get()
+    return None if tenant is None else tenant.cache(name, factory)
+
+
+class Tenants:
+    """
+    The tenants of TENANT_DIR, and the ones open in this worker in least recently used
+    order, at most max_open of them while they are idle
+    """
+    def __init__(self, directory: str, max_open: int = 32, cache_bytes: int = 16 * 1024 * 1024,
+                 serve_from_memory: bool = False, routing: str = 'subdomain', domain: str = '',
+                 path_prefix: str = '/t') -> None:
+        if routing not in ROUTINGS:
+            raise ValueError(f"TENANT_ROUTING is {routing!r}, not one of {ROUTINGS}")
+        self.directory = directory
+        self.max_open = max_open
+        self.cache_bytes = cache_bytes
+        self.serve_from_memory = serve_from_memory
+        self.routing = routing
+        self.domain = domain.lower().strip('.')
+        self.path_prefix = path_prefix.rstrip('/')
+        # the app each opened tenant's upcoming services are pre-warmed with, None not to
+        self.prewarm_app: 'Flask | None' = None
+        self._open: OrderedDict[str, Tenant] = OrderedDict()
+        # tenants whose structure this worker has brought up to date
+        self._checked: set[str] = set()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._open)
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._open
+
+    def database_file(self, name: str) -> str:
+        if not TENANT_NAME.fullmatch(name):
+            raise UnknownTenant(f"Not a tenant name: {name!r}")
+        return os.path.join(self.directory, name + TENANT_FILE_SUFFIX)
+
+    def names(self) -> list[str]:
+        if not os.path.isdir(self.directory):
+            return []
+        return sorted(f[:-len(TENANT_FILE_SUFFIX)] for f in os.listdir(self.directory)
+                      if f.endswith(TENANT_FILE_SUFFIX) and TENANT_NAME.fullmatch(f[:-len(TENANT_FILE_SUFFIX)]))
+
+    def create(self, name: str, snapshot: str | None = None) -> None:
+        """A new tenant with an empty database, or a copy of a snapshot (see snapshot.py)"""
+        database_file: str = self.database_file(name)
+        if os.path.exists(database_file):
+            raise ValueError(f"Tenant {name} already exists: {database_file}")
+        os.makedirs(self.directory, exist_ok=True)
+        db = Dbms(False, 'sqlite:///' + database_file, database_file)
+        try:
+            if snapshot is None:
+                db.create_database_structure()
+            else:
+                from prayer_of_hannah.snapshot import load_snapshot
+                load_snapshot(db, snapshot)
+        finally:
+            db.close()
+
+    def acquire(self, name: str) -> Tenant:
+        """The tenant, opened if it isn't, in use until release(). Raises UnknownTenant"""
+        with self._lock:
+            tenant: Tenant | None = self._open.get(name)
+            if tenant is not None:
+                self._open.move_to_end(name)
+                tenant.active += 1
+                return tenant
+
+        # opened outside the lock so other tenants' requests don't wait for it
+        database_file: str = self.database_file(name)
+        if not os.path.isfile(database_file):
+            raise UnknownTenant(f"No tenant: {name}")
+        opened: Tenant = Tenant(name, database_file, self.cache_bytes, self.serve_from_memory)
+        try:
+            if name not in self._checked:
+                opened.db.create_database_structure()
+        except BaseException:
+            opened.close()
+            raise
+        opened.db.maintenance.start()
+        if self.prewarm_app is not None:
+            opened.start_prewarmer(self.prewarm_app)
+
+        with self._lock:
+            tenant = self._open.get(name)
+            if tenant is None:
+                tenant = self._open[name] = opened
+                self._checked.add(name)
+            else:
+                # another request opened it first
+                self._open.move_to_end(name)
+            tenant.active += 1
+            closing: list[Tenant] = self._evict()
+        if tenant is not opened:
+            closing.append(opened)
+        for old in closing:
+            old.close()
+        return tenant
+
+    def release(self, tenant: Tenant) -> None:
+        with self._lock:
+            tenant.active -= 1
+            closing: list[Tenant] = self._evict()
+        for old in closing:
+            old.close()
+
+    def _evict(self) -> list[Tenant]:
+        """Take the least recently used idle tenants over max_open out, the caller closes them"""
+        excess: int = len(self._open) - self.max_open
+        if excess <= 0:
+            return []
+        evicted: list[Tenant] = [t for t in self._open.values() if t.idle][:excess]
+        for tenant in evicted:
+            del self._open[tenant.name]
+        return evicted
+
+    @contextmanager
+    def activate(self, name: str) -> Iterator[Tenant]:
+        """Make the tenant current for the block. Raises UnknownTenant"""
+        tenant: Tenant = self.acquire(name)
+        try:
+            with tenant.current():
+                yield tenant
+        finally:
+            self.release(tenant)
+
+    def route(self, host: str, path: str) -> tuple[str | None, str, str]:
+        """The tenant a request is for (None if it names none), the path prefix naming it and the rest of the path"""
+        if self.routing == 'subdomain':
+            hostname: str = host.lower().split(':')[0]
+            if self.domain:
+                suffix: str = '.' + self.domain
+                return (hostname[:-len(suffix)] if hostname.endswith(suffix) else None), '', path
+            return (hostname.partition('.')[0] if '.' in hostname else None), '', path
+        prefix: str = self.path_prefix + '/'
+        if not path.startswith(prefix):
+            return None, '', path
+        name, _, rest = path[len(prefix):].partition('/')
+        return name or None, prefix + name, '/' + rest
+
+    def close(self) -> None:
+        with self._lock:
+            closing: list[Tenant] = list(self._open.values())
+            self._open.clear()
+        for tenant in closing:
+            tenant.close()
+
+
+class _TenantResponse:
+    """A WSGI response iterated (streamed responses rendering as they go) with its tenant current"""
+    def __init__(self, response, tenant: Tenant, tenants: Tenants) -> None:
+        self.response = response
+        self.tenant = tenant
+        self.tenants = tenants
+        self._iterator = iter(response)
+        self._released: bool = False
+
+    def __iter__(self) -> '_TenantResponse':
+        return self
+
+    def __next__(self) -> bytes:
+        return self.tenant.run(next, self._iterator)
+
+    def close(self) -> None:
+        try:
+            close: Callable[[], None] | None = getattr(self.response, 'close', None)
+            if close is not None:
+                self.tenant.run(close)
+        finally:
+            if not self._released:
+                self._released = True
+                self.tenants.release(self.tenant)
+
+
+class TenantMiddleware:
+    """WSGI middleware running each request with its tenant current, 404 for a request with none"""
+    def __init__(self, app, tenants: Tenants) -> None:
+        self.app = app
+        self.tenants = tenants
+
+    def __call__(self, environ: dict, start_response):
+        name, prefix, path = self.tenants.route(environ.get('HTTP_HOST', ''), environ.get('PATH_INFO', ''))
+        try:
+            if name is None:
+                raise UnknownTenant("The request names no tenant")
+            tenant: Tenant = self.tenants.acquire(name)
+        except UnknownTenant:
+            start_response('404 Not Found', [('Content-Type', 'text/plain'), ('Content-Length', str(len(NOT_FOUND)))])
+            return [NOT_FOUND]
+        if prefix:
+            environ['SCRIPT_NAME'] = environ.get('SCRIPT_NAME', '') + prefix
+            environ['PATH_INFO'] = path
+        try:
+            response = tenant.run(self.app, environ, start_response)
+        except BaseException:
+            self.tenants.release(tenant)
+            raise
+        return _TenantResponse(response, tenant, self.tenants)
+
+
+def tenants_from_config(config) -> Tenants:
+    return Tenants(config['TENANT_DIR'], max_open=config['TENANT_ENGINES'],
+                   cache_bytes=config['TENANT_CACHE_MB'] * 1024 * 1024,
+                   serve_from_memory=config['SERVE_FROM_MEMORY'], routing=config['TENANT_ROUTING'],
+                   domain=config['TENANT_DOMAIN'], path_prefix=config['TENANT_PATH_PREFIX'])
+
+
+def init_app(app: 'Flask') -> None:
+    """Route requests to their tenants, if TENANT_ROUTING is set"""
+    if not app.config.get('TENANT_ROUTING'):
+        return
+    tenants: Tenants = tenants_from_config(app.config)
+    app.extensions['tenants'] = tenants
+    app.wsgi_app = TenantMiddleware(app.wsgi_app, tenants)  # type: ignore[method-assign]
+
+
+def main() -> None:
+    import argparse
+    parser = argparse.ArgumentParser(description="Add or list the congregations hosted from TENANT_DIR")
+    parser.add_argument('--dir', default=Config.TENANT_DIR, help="the tenants' directory")
+    commands = parser.add_subparsers(dest='command', required=True)
+    create = commands.add_parser('create', help="add a tenant")
+    create.add_argument('name')
+    create.add_argument('--snapshot', help="start from a copy of this snapshot")
+    commands.add_parser('list', help="list the tenants")
+    args = parser.parse_args()
+
+    tenants = Tenants(args.dir)
+    if args.command == 'create':
+        tenants.create(args.name, args.snapshot)
+        print(f"Created tenant {args.name}: {tenants.database_file(args.name)}")
+    else:
+        for name in tenants.names():
+            print(name)
+
+
+if __name__ == "__main__":
+    main()
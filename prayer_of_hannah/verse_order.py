@@ -0,0 +1,155 @@
+import re
+from functools import lru_cache
+from typing import Iterable
+from sqlalchemy import select, update
+from sqlalchemy.event import listen
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlmodel import Session
+
+from prayer_of_hannah.models import Song_Book_Item, Verse, VerseType
+
+'''
+Compiles Song_Book_Item.verse_order (eg "v1 b1 c1 v2 c1 v3 b1 c1") into the sequence of
+Verse ids it displays.
+
+Codes are OpenLyrics verse names: a type, a number that defaults to 1 and an optional
+part, eg "c" is c1 and "v1a v1b" are the two parts of verse 1. A code without a part
+shows every part of its verse. Compiling never fails, codes that aren't valid or have
+no verse are left out, so a bad verse order can't stop a service being shown. Only an
+order a user has just typed is checked with parse_verse_order.
+
+The compiled form is stored in Song_Book_Item.verse_order_ids (eg "3,5,4,6,4,7,5,4") by a
+flush hook whenever the verse_order or the item's verses change, so slides never parse
+the text. Per service overrides (Service_Item.verse_order) are compiled on demand and
+memoised, so the same override costs nothing the second time.
+'''
+
+# o (other) verses are not imported, eg the title and book reference
+SKIPPED_VERSE_TYPES = 'o'
+VERSE_CODE = re.compile(r'([a-z])(\d{1,2})?([a-z]?)')
+VERSE_TYPES = {t.value for t in VerseType}
+COMPILED_SEPARATOR = ','
+
+VerseCode = tuple[str, int, str]
+
+
+class VerseOrderError(ValueError):
+    pass
+
+
+def parse_verse_code(code: str) -> VerseCode | None:
+    """The (type, number, part) of a verse name, None if it isn't one"""
+    match = VERSE_CODE.fullmatch(code.lower())
+    if match is None:
+        return None
+    return match.group(1), int(match.group(2) or 1), match.group(3)
+
+
+def parse_verse_order(verse_order: str, strict: bool = True) -> tuple[VerseCode, ...]:
+    """
+    The (type, number, part) of each code. Raises VerseOrderError for a code that can't be a
+    verse, unless not strict when it is left out
+    """
+    codes: list[VerseCode] = []
+    for code in verse_order.split():
+        parsed: VerseCode | None = parse_verse_code(code)
+        if parsed is not None and parsed[0] in SKIPPED_VERSE_TYPES:
+            continue
+        if parsed is None or parsed[0] not in VERSE_TYPES:
+            if strict:
+                raise VerseOrderError(f"Invalid verse code '{code}' in verse order '{verse_order}'")
+            continue
+        codes.append(parsed)
+    return tuple(codes)
+
+
+def verse_name(verse_type: str, number: int, part: str | None = None) -> str:
+    return f"{verse_type}{number}{part or ''}"
+
+
+def verse_index(verses: Iterable) -> tuple[tuple[str, int, str, int], ...]:
+    """(type, number, part, id) of each verse, hashable so it can be part of a memo key"""
+    return tuple(sorted((str(v.type), v.number, v.part or '', v.id) for v in verses))
+
+
+def _verse_ids(index: tuple[tuple[str, int, str, int], ...]) -> dict[VerseCode, list[int]]:
+    """The ids each code shows: its verse, or for a code without a part all the verse's parts"""
+    ids: dict[VerseCode, list[int]] = {(verse_type, number, part): [verse_id]
+                                       for verse_type, number, part, verse_id in index}
+    parts: dict[VerseCode, list[int]] = {}
+    for verse_type, number, part, verse_id in index:
+        if part:
+            parts.setdefault((verse_type, number, ''), []).append(verse_id)
+    return parts | ids
+
+
+@lru_cache(maxsize=4096)
+def compile_verse_order(verse_order: str, index: tuple[tuple[str, int, str, int], ...]) -> tuple[int, ...]:
+    """
+    The verse ids to display, in order. Invalid codes and codes without a matching verse are
+    left out. An empty verse order displays every verse once, in the order they were added.
+    """
+    if not verse_order.strip():
+        return tuple(sorted(verse_id for *_, verse_id in index))
+    ids: dict[VerseCode, list[int]] = _verse_ids(index)
+    return tuple(verse_id for code in parse_verse_order(verse_order, strict=False) for verse_id in ids.get(code, ()))
+
+
+def check_verse_order(verse_order: str, verses: Iterable) -> list[str]:
+    """Problems with the verse order, empty if it is valid for these verses"""
+    try:
+        codes = parse_verse_order(verse_order)
+    except VerseOrderError as e:
+        return [str(e)]
+    known: dict[VerseCode, list[int]] = _verse_ids(verse_index(verses))
+    return [f"No verse {verse_name(*code)} for verse order '{verse_order}'"
+            for code in dict.fromkeys(codes) if code not in known]
+
+
+def encode_ids(ids: tuple[int, ...]) -> str:
+    return COMPILED_SEPARATOR.join(str(i) for i in ids)
+
+
+@lru_cache(maxsize=4096)
+def decode_ids(compiled: str) -> tuple[int, ...]:
+    return tuple(int(i) for i in compiled.split(COMPILED_SEPARATOR) if i)
+
+
+def verse_sequence(item: Song_Book_Item, override: str | None = None) -> tuple[int, ...]:
+    """The verse ids item displays, with a per service override of its verse order"""
+    if override and override.strip():
+        return compile_verse_order(override, verse_index(item.verses))
+    if item.verse_order_ids is not None:
+        return decode_ids(item.verse_order_ids)
+    return compile_verse_order(item.verse_order or '', verse_index(item.verses))
+
+
+def compile_changed_verse_orders(session: Session, flush_context) -> None:
+    """after_flush: recompile the items whose verse order or verses were written"""
+    item_ids: set[int] = set()
+    for obj in session.new | session.dirty | session.deleted:
+        if isinstance(obj, Song_Book_Item) and obj not in session.deleted and obj.id is not None:
+            item_ids.add(obj.id)
+        elif isinstance(obj, Verse) and obj.song_book_item_id is not None:
+            item_ids.add(obj.song_book_item_id)
+    if not item_ids:
+        return
+
+    conn = session.connection()
+    for item_id in item_ids:
+        row = conn.execute(select(Song_Book_Item.verse_order, Song_Book_Item.verse_order_ids)  # type: ignore[call-overload]
+                           .where(Song_Book_Item.id == item_id)).first()
+        if row is None:
+            continue
+        verses = conn.execute(select(Verse.type, Verse.number, Verse.part, Verse.id)  # type: ignore[call-overload]
+                              .where(Verse.song_book_item_id == item_id)).all()
+        compiled: str = encode_ids(compile_verse_order(row.verse_order or '', verse_index(verses)))
+        if compiled != row.verse_order_ids:
+            conn.execute(update(Song_Book_Item).where(Song_Book_Item.id == item_id)  # type: ignore[arg-type]
+                         .values(verse_order_ids=compiled))
+            item = session.identity_map.get(Session.identity_key(Song_Book_Item, (item_id,)))
+            if item is not None:
+                set_committed_value(item, 'verse_order_ids', compiled)
+
+
+listen(Session, "after_flush", compile_changed_verse_orders)
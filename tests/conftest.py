@@ -0,0 +1,10 @@
+# The scripts in prayer_of_hannah import their siblings as top level modules (dbms, models)
+# while the web app imports them from the package. Make both names the same module so the
+# SQLModel tables are only defined once when a test run uses both.
+import sys
+
+import prayer_of_hannah.dbms
+import prayer_of_hannah.models
+
+sys.modules.setdefault('dbms', prayer_of_hannah.dbms)
+sys.modules.setdefault('models', prayer_of_hannah.models)
@@ -0,0 +1,126 @@
+from dbms import Dbms
+import dbms
+
+from models import VerseType, Author, Song_Book, Song, Song_Book_Item, Verse
+import prayer_of_hannah
+from prayer_of_hannah import create_app
+from prayer_of_hannah.api import catalog
+from sqlmodel import Session, select
+import json
+import tracemalloc
+import pytest
+import pathlib as pl
+
+
+@pytest.fixture
+def db(tmp_path: pl.Path, monkeypatch: pytest.MonkeyPatch) -> Dbms:
+    file: str = str(tmp_path / "api_test.sqlite")
+    dbase = Dbms(False, 'sqlite:///' + file, file)
+    dbase.create_database_structure()
+    with dbase.write_session() as session:
+        book: Song_Book = Song_Book(code="StF", name="Singing the Faith")
+        wesley: Author = Author(surname="Wesley", first_names="Charles")
+        for n, title in enumerate(["And Can It Be", "O For A Thousand Tongues"], start=1):
+            item: Song_Book_Item = Song_Book_Item(song_book=book, song=Song(title=title, authors=[wesley]), nbr=n,
+                                                  verse_order="v1 v2")
+            session.add_all([Verse(type=VerseType.VERSE, number=v, lyrics=f"{title} verse {v}", song_book_item=item)
+                             for v in (1, 2)])
+        session.commit()
+    monkeypatch.setattr(prayer_of_hannah, "__DB", dbase)
+    monkeypatch.setattr(prayer_of_hannah, "__DBE", dbase.engine)
+    return dbase
+
+
+def test_whole_catalog(db: Dbms) -> None:
+    client = create_app().test_client()
+    response = client.get('/api/catalog')
+    assert response.is_streamed and response.mimetype == 'application/json'
+    dump: dict = response.json
+    with Session(db.engine) as session:
+        assert dump['version'] == catalog.version(session.connection()) > 0
+    assert dump['since'] is None
+    assert list(dump)[2:] == list(catalog.RESOURCES)
+    assert [a['surname'] for a in dump['authors']['rows']] == ["Wesley"]
+    assert [s['title'] for s in dump['songs']['rows']] == ["And Can It Be", "O For A Thousand Tongues"]
+    assert len(dump['author_songs']['rows']) == 2
+    assert dump['verses']['rows'][0] == {'id': 1, 'type': 'v', 'number': 1, 'part': '',
+                                         'lyrics': "And Can It Be verse 1", 'song_book_item_id': 1}
+    assert all(not dump[name]['deleted'] for name in catalog.RESOURCES)
+
+
+def test_ndjson(db: Dbms) -> None:
+    client = create_app().test_client()
+    for response in (client.get('/api/verses?format=ndjson'),
+                     client.get('/api/verses', headers={'Accept': 'application/x-ndjson'})):
+        assert response.mimetype == 'application/x-ndjson'
+        lines: list[dict] = [json.loads(line) for line in response.data.splitlines()]
+        assert set(lines[0]) == {'version', 'since'}
+        assert [line['row']['lyrics'] for line in lines[1:]][-1] == "O For A Thousand Tongues verse 2"
+        assert {line['resource'] for line in lines[1:]} == {'verses'}
+
+
+def test_since(db: Dbms) -> None:
+    client = create_app().test_client()
+    since: int = client.get('/api/authors').json['version']
+    assert client.get(f'/api/catalog?since={since}').json['version'] == since
+    assert all(not rows for name, rows in client.get(f'/api/catalog?since={since}').json.items()
+               if name in catalog.RESOURCES for rows in rows.values()), "Nothing changed"
+
+    with db.write_session() as session:
+        song: Song = session.get(Song, 2)
+        song.title = "O for a Thousand Tongues to Sing"
+        session.delete(session.get(Verse, 4))
+        session.add(Author(surname="Watts", first_names="Isaac"))
+        session.commit()
+
+    changes: dict = client.get(f'/api/catalog?since={since}').json
+    assert changes['version'] > since and changes['since'] == since
+    assert [s['title'] for s in changes['songs']['rows']] == ["O for a Thousand Tongues to Sing"]
+    assert [a['surname'] for a in changes['authors']['rows']] == ["Watts"]
+    assert changes['verses'] == {'rows': [], 'deleted': [[4]]}
+    # the item's compiled verse order changed with its verses
+    assert [i['id'] for i in changes['song_book_items']['rows']] == [2]
+
+    lines: list[dict] = [json.loads(line) for line in client.get(f'/api/verses?since={since}&format=ndjson').data.splitlines()]
+    assert lines[1:] == [{'resource': 'verses', 'deleted': [4]}]
+
+
+def test_since_pruned(db: Dbms, monkeypatch: pytest.MonkeyPatch) -> None:
+    client = create_app().test_client()
+    since: int = client.get('/api/authors').json['version']
+    with db.write_session() as session:
+        session.add_all([Author(surname="Watts", first_names="Isaac"), Author(surname="Newton", first_names="John")])
+        session.commit()
+    monkeypatch.setattr(dbms, "CHANGE_LOG_KEEP", 1)
+    assert db.maintenance.run_idle_tasks(force=True)
+
+    changes: dict = client.get(f'/api/catalog?since={since}').json
+    assert changes['since'] is None, "The change_log no longer says what changed"
+    assert len(changes['authors']['rows']) == 3
+    assert client.get(f"/api/catalog?since={changes['version'] - 1}").json['since'] == changes['version'] - 1
+
+
+def test_bad_requests(db: Dbms) -> None:
+    client = create_app().test_client()
+    assert client.get('/api/hymns').status_code == 404
+    assert client.get('/api/songs?since=yesterday').status_code == 400
+    assert client.get('/api/songs?since=-1').status_code == 400
+
+
+def test_memory_is_flat(db: Dbms) -> None:
+    with db.write_session() as session:
+        book: Song_Book = session.exec(select(Song_Book)).first()
+        for n in range(500):
+            item: Song_Book_Item = Song_Book_Item(song_book=book, song=Song(title=f"Hymn {n}", authors=[]),
+                                                  nbr=n + 10, verse_order="")
+            session.add_all([Verse(type=VerseType.VERSE, number=v, lyrics="Amazing love! " * 30, song_book_item=item)
+                             for v in range(1, 11)])
+        session.commit()
+    tracemalloc.start()
+    try:
+        sent: int = sum(len(chunk) for chunk in catalog.buffered(catalog.stream_ndjson(db.engine, ['verses'])))
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    assert sent > 2_000_000
+    assert peak < sent / 2, f"{peak} bytes used to send {sent}"
@@ -0,0 +1,109 @@
+from dbms import Dbms
+
+from models import Song_Book
+import prayer_of_hannah
+from prayer_of_hannah.asgi import AsgiApp
+from prayer_of_hannah import create_app
+import asyncio
+import threading
+import pytest
+import pathlib as pl
+
+
+@pytest.fixture
+def db(tmp_path: pl.Path, monkeypatch: pytest.MonkeyPatch) -> Dbms:
+    file: str = str(tmp_path / "asgi_test.sqlite")
+    dbase = Dbms(False, 'sqlite:///' + file, file)
+    dbase.create_database_structure()
+    with dbase.write_session() as session:
+        session.add(Song_Book(code="StF", name="Singing the Faith"))
+        session.commit()
+    monkeypatch.setattr(prayer_of_hannah, "__DB", dbase)
+    monkeypatch.setattr(prayer_of_hannah, "__DBE", dbase.engine)
+    return dbase
+
+
+def call(app, path: str) -> tuple[int, bytes, list]:
+    """Make one http request to an ASGI app, returns status, body and the body chunks"""
+    scope: dict = {'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'method': 'GET',
+                   'scheme': 'http', 'path': path, 'root_path': '', 'query_string': b'', 'headers': [],
+                   'server': ('testserver', 80)}
+    sent: list[dict] = []
+
+    async def receive() -> dict:
+        return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+    async def send(message: dict) -> None:
+        sent.append(message)
+
+    asyncio.run(app(scope, receive, send))
+    chunks: list = [m.get('body', b'') for m in sent if m['type'] == 'http.response.body']
+    return sent[0]['status'], b''.join(chunks), chunks
+
+
+def test_blueprints_served(db: Dbms) -> None:
+    app = AsgiApp(create_app())
+    status, body, _ = call(app, '/')
+    assert status == 200
+    assert b'Singing the Faith' in body, "Home page should list the song books"
+
+    status, _, _ = call(app, '/songs/htmx/songs')
+    assert status == 200, "Async views should work under ASGI"
+
+
+def test_mounted_app(db: Dbms) -> None:
+    async def prototype(scope, receive, send) -> None:
+        await send({'type': 'http.response.start', 'status': 200, 'headers': []})
+        for part in (b'root=' + scope['root_path'].encode(), b' path=' + scope['path'].encode()):
+            await send({'type': 'http.response.body', 'body': part, 'more_body': True})
+        await send({'type': 'http.response.body', 'body': b''})
+
+    app = AsgiApp(create_app())
+    app.mount('/prototype/', prototype)
+    status, body, chunks = call(app, '/prototype/song_books')
+    assert status == 200
+    assert body == b'root=/prototype path=/prototype/song_books'
+    assert len(chunks) == 3, "Response should be streamed in chunks"
+
+    status, _, _ = call(app, '/prototypes')
+    assert status == 404, "Only paths under the prefix go to the mounted app"
+
+
+def test_lifespan_closes_database(db: Dbms) -> None:
+    app = AsgiApp(create_app())
+    messages: list[dict] = [{'type': 'lifespan.startup'}, {'type': 'lifespan.shutdown'}]
+    sent: list[dict] = []
+
+    async def receive() -> dict:
+        return messages.pop(0)
+
+    async def send(message: dict) -> None:
+        sent.append(message)
+
+    db.maintenance.start()
+    asyncio.run(app({'type': 'lifespan'}, receive, send))
+    assert [m['type'] for m in sent] == ['lifespan.startup.complete', 'lifespan.shutdown.complete']
+    assert db.maintenance._thread is None, "Shutdown should close the database"
+
+
+def test_views_run_in_parallel(db: Dbms) -> None:
+    flask_app = create_app()
+    both = threading.Barrier(2, timeout=5)
+
+    @flask_app.route('/wait')
+    def wait() -> str:
+        # only returns once the other request is running too
+        both.wait()
+        return threading.current_thread().name
+
+    app = AsgiApp(flask_app)
+
+    async def both_requests() -> list:
+        return await asyncio.gather(asyncio.to_thread(call, app, '/wait'), asyncio.to_thread(call, app, '/wait'))
+
+    try:
+        results: list = asyncio.run(both_requests())
+    finally:
+        app.wsgi.shutdown()
+    assert [status for status, _, _ in results] == [200, 200]
+    assert len({body for _, body, _ in results}) == 2 and all(body.startswith(b'wsgi') for _, body, _ in results)
@@ -0,0 +1,86 @@
+from flask import Flask, url_for
+from prayer_of_hannah import assets
+import gzip
+import json
+import pytest
+import pathlib as pl
+
+CSS: str = """/* a comment */
+@charset "utf-8";
+:root { --gap: 1rem; }
+.button, .unused-button { color: red; }
+.unused { color: blue; }
+.columns .column:not(.is-narrow) { flex: 1; }
+@media screen and (max-width: 768px) { .unused { display: none; } .button { display: block; } }
+@media print { .unused-too { display: none; } }
+@keyframes spin { from { transform: rotate(0); } to { transform: rotate(359deg); } }
+a[href^="http"]::after { content: "}"; }
+"""
+
+
+@pytest.fixture
+def package(tmp_path: pl.Path) -> pl.Path:
+    (tmp_path / "static").mkdir()
+    (tmp_path / "static" / "site.css").write_text(CSS)
+    (tmp_path / "static" / "site.js").write_text("document.body.classList.add('is-loading');")
+    (tmp_path / "templates").mkdir()
+    (tmp_path / "templates" / "base.html").write_text(
+        """<link rel="stylesheet" href="{{ url_for('static', filename='site.css') }}">
+        <script src="{{ url_for('static', filename = 'site.js') }}"></script>
+        <div class="columns"><div class="column {{ 'button' if wide }}"></div></div>""")
+    return tmp_path
+
+
+def test_purge_css() -> None:
+    purged: str = assets.purge_css(CSS, {'button', 'columns', 'column'})
+    assert '.unused' not in purged
+    assert '.button{color: red;}' in purged, "Unused selectors are dropped from a selector list"
+    assert '@media screen and (max-width: 768px){.button{display: block;}}' in purged
+    assert '@media print' not in purged, "An empty @media block is dropped"
+    for kept in ('@charset "utf-8";', ':root{--gap: 1rem;}', '.columns .column:not(.is-narrow)', '@keyframes spin',
+                 'a[href^="http"]::after{content: "}";}'):
+        assert kept in purged
+
+
+def test_build_assets(package: pl.Path) -> None:
+    manifest: dict[str, str] = assets.build_assets(str(package / "static"), str(package / "templates"))
+    assert set(manifest) == {'site.css', 'site.js'}
+    assert manifest['site.js'].startswith('dist/site.') and manifest['site.js'].endswith('.js')
+    assert json.loads((package / "static" / "dist" / "manifest.json").read_text()) == manifest
+
+    built: pl.Path = package / "static" / manifest['site.css']
+    css: str = built.read_text()
+    assert '.button' in css and '.unused' not in css
+    assert gzip.decompress((package / "static" / (manifest['site.css'] + '.gz')).read_bytes()).decode() == css
+    assert assets.build_assets(str(package / "static"), str(package / "templates")) == manifest, \
+        "The same content has the same name"
+
+
+def test_serve_built_assets(package: pl.Path) -> None:
+    app: Flask = Flask(__name__, static_folder=str(package / "static"))
+    assets.init_app(app)
+    with app.test_request_context():
+        assert url_for('static', filename='site.css') == '/static/site.css', "Nothing has been built"
+
+    manifest: dict[str, str] = assets.build_assets(str(package / "static"), str(package / "templates"))
+    app = Flask(__name__, static_folder=str(package / "static"))
+    assets.init_app(app)
+    with app.test_request_context():
+        url: str = url_for('static', filename='site.css')
+        assert url == '/static/' + manifest['site.css']
+        assert url_for('static', filename='other.css') == '/static/other.css'
+
+    client = app.test_client()
+    response = client.get(url, headers={'Accept-Encoding': 'br;q=1.0, gzip;q=0.8'})
+    # brotli copies are only built if brotli is installed
+    assert response.headers['Content-Encoding'] == \
+        ('br' if (package / "static" / (manifest['site.css'] + '.br')).exists() else 'gzip')
+    assert response.headers['Content-Type'].startswith('text/css')
+    assert response.headers['Cache-Control'] == assets.IMMUTABLE
+    assert response.headers['Vary'] == 'Accept-Encoding'
+    identity = client.get(url)
+    assert 'Content-Encoding' not in identity.headers
+    gzipped = client.get(url, headers={'Accept-Encoding': 'gzip'})
+    assert gzip.decompress(gzipped.data) == identity.data
+    assert client.get('/static/site.css').status_code == 200, "The sources are still served"
+    assert client.get('/static/dist/missing.css').status_code == 404
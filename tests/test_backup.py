@@ -0,0 +1,89 @@
+from dbms import Dbms
+
+from models import Song
+from prayer_of_hannah.backup import BackupError, backup_database, verify_backup, restore_database, take_backup, list_backups
+from prayer_of_hannah.api.catalog import stream_ndjson
+from prayer_of_hannah.shared_cache import SharedCache, database_version
+from sqlmodel import Session, select
+import pytest
+import pathlib as pl
+
+
+@pytest.fixture
+def db(tmp_path: pl.Path) -> Dbms:
+    file: str = str(tmp_path / "backup_test.sqlite")
+    dbase = Dbms(False, 'sqlite:///' + file, file)
+    dbase.create_database_structure()
+    with dbase.write_session() as session:
+        for n in range(200):
+            session.add(Song(title=f"Song number {n}", authors=[]))
+        session.commit()
+    return dbase
+
+
+def song_count(db: Dbms) -> int:
+    with Session(db.engine) as session:
+        return len(session.exec(select(Song)).all())
+
+
+def test_backup_while_reading(db: Dbms, tmp_path: pl.Path) -> None:
+    backup_file: str = str(tmp_path / "copy.sqlite")
+    with Session(db.engine) as session:
+        # a reader holding a result set open must not stop the backup
+        songs = session.exec(select(Song))
+        backup_database(db.database_file, backup_file, pages=1, pause=0)
+        assert len(songs.all()) == 200
+
+    verify_backup(backup_file)
+    copy = Dbms(False, 'sqlite:///' + backup_file, backup_file)
+    assert song_count(copy) == 200, "Backup should hold every song"
+
+
+def test_verify_rejects_bad_backup(tmp_path: pl.Path) -> None:
+    bad: pl.Path = tmp_path / "bad.sqlite"
+    bad.write_bytes(b"this is not a database" * 100)
+    with pytest.raises(BackupError):
+        verify_backup(str(bad))
+    with pytest.raises(BackupError):
+        verify_backup(str(tmp_path / "missing.sqlite"))
+
+
+def test_retention_and_restore(db: Dbms, tmp_path: pl.Path) -> None:
+    backup_dir: str = str(tmp_path / "backups")
+    files: list[str] = [take_backup(db.database_file, backup_dir, keep=2) for _ in range(3)]
+    assert list_backups(backup_dir, db.database_file) == files[1:], "Only the newest 2 backups should be kept"
+
+    with db.write_session() as session:
+        for song in session.exec(select(Song)).all():
+            session.delete(song)
+        session.commit()
+    assert song_count(db) == 0
+
+    restore_database(files[-1], db.database_file)
+    assert song_count(db) == 200, "Restore should bring back the songs for an open engine"
+
+
+def test_restore_moves_version_forward(db: Dbms, tmp_path: pl.Path) -> None:
+    backup_file: str = take_backup(db.database_file, str(tmp_path / "backups"))
+    db.close()
+    served = Dbms(False, 'sqlite:///' + db.database_file, db.database_file, serve_from_memory=True)
+    with served.write_session() as session:
+        for song in session.exec(select(Song)).all():
+            session.delete(song)
+        session.commit()
+    assert song_count(served) == 0
+    seen: int = database_version(served.write_engine)
+    cache = SharedCache(str(tmp_path / "shared.cache"))
+    assert cache.put('songs', 'list', b'<no songs>', seen)
+
+    restore_database(backup_file, served.database_file, db=served)
+    assert song_count(served) == 200, "The memory copy should have been reloaded"
+    restored: int = database_version(served.write_engine)
+    assert restored > seen, "The write version should only go up"
+    assert cache.get('songs', 'list', restored) is None
+    assert cache.put('songs', 'list', b'<200 songs>', restored) and cache.get('songs', 'list', restored)
+
+    # a consumer of the catalog from before the restore gets all of it again
+    lines: list[bytes] = list(stream_ndjson(served.engine, ['songs'], since=seen))
+    assert b'"since":null' in lines[0] and len(lines) == 201
+    served.close()
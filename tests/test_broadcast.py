@@ -0,0 +1,135 @@
+from prayer_of_hannah.live_worship import broadcast
+from prayer_of_hannah.live_worship.broadcast import Broadcaster, Channel, sse_app
+import asyncio
+import threading
+import json
+import pytest
+
+
+def test_ring_buffer_resume() -> None:
+    channel: Channel = Channel(1, size=4)
+    for index in range(6):
+        channel.publish('slide', {'index': index})
+
+    assert [e.id for e in channel.since(4)] == [5, 6], "Reconnecting client should get what it missed"
+    assert channel.since(6) == [], "Up to date client gets nothing"
+    assert [e.id for e in channel.since(2)] == [3, 4, 5, 6], "Only the ring buffer is kept"
+    assert json.loads(channel.since(5)[0].data) == {'index': 5}
+    assert channel.since(5)[0].sse == b'id: 6\nevent: slide\ndata: {"index":5}\n\n'
+
+
+def test_unknown_or_lost_position_resets() -> None:
+    channel: Channel = Channel(1, size=4)
+    assert channel.since(9) == [], "Nothing to start again from yet"
+    assert channel.wait(9, timeout=0.01) == []
+    for index in range(6):
+        channel.publish('slide', {'index': index})
+
+    # an id from before a restart, or from another worker's channel
+    assert [e.id for e in channel.since(40)] == [6]
+    assert [e.id for e in channel.wait(40, timeout=5)] == [6], "Sent at once, not when the channel passes 40"
+    # events lost from the ring buffer
+    assert [e.id for e in channel.since(1)] == [6] and [e.id for e in channel.since(0)] == [6]
+
+    async def wait() -> list[int]:
+        return [e.id for e in await channel.wait_async(40, timeout=5)]
+    assert asyncio.run(wait()) == [6]
+
+
+def test_sync_wait_wakes_on_publish() -> None:
+    channel: Channel = Channel(1)
+    timer = threading.Timer(0.05, channel.publish, args=('slide', {'index': 1}))
+    timer.start()
+    events = channel.wait(0, timeout=5)
+    assert [e.id for e in events] == [1]
+    assert channel.wait(1, timeout=0.01) == [], "Timeout with nothing new returns no events"
+
+
+def test_thousand_async_subscribers() -> None:
+    clients: int = 1000
+
+    async def run() -> list[list[int]]:
+        channel: Channel = Broadcaster().channel(7)
+        subscribers = [asyncio.create_task(channel.wait_async(0, timeout=10)) for _ in range(clients)]
+        while channel.subscribers < clients:
+            await asyncio.sleep(0)
+        # published from another thread, like the operator's request
+        await asyncio.to_thread(channel.publish, 'slide', {'index': 3})
+        results = await asyncio.gather(*subscribers)
+        assert channel.subscribers == 0
+        return [[e.id for e in events] for events in results]
+
+    assert asyncio.run(run()) == [[1]] * clients, "Every subscriber should get the slide once"
+
+
+def test_sse_app_streams_until_disconnect(monkeypatch: pytest.MonkeyPatch) -> None:
+    # this worker's channels only, without the live_event table
+    monkeypatch.setattr(broadcast, "broadcaster", Broadcaster())
+
+    async def run() -> list[dict]:
+        channel: Channel = broadcast.broadcaster.channel(42)
+        channel.publish('slide', {'index': 1})
+        sent: list[dict] = []
+        disconnect: asyncio.Event = asyncio.Event()
+
+        async def receive() -> dict:
+            await disconnect.wait()
+            return {'type': 'http.disconnect'}
+
+        async def send(message: dict) -> None:
+            sent.append(message)
+            if len(sent) == 2:
+                channel.publish('slide', {'index': 2})
+            if len(sent) == 3:
+                disconnect.set()
+
+        scope: dict = {'type': 'http', 'method': 'GET', 'path': '/live/42/events', 'query_string': b'',
+                       'headers': [(b'last-event-id', b'0')], 'path_params': {'service_id': '42'}}
+        await asyncio.wait_for(sse_app(scope, receive, send), 5)
+        return sent
+
+    sent: list[dict] = asyncio.run(run())
+    assert sent[0]['status'] == 200
+    assert (b'content-type', b'text/event-stream') in sent[0]['headers']
+    assert sent[1]['body'].startswith(b'id: 1\n'), sent[1]
+    assert sent[2]['body'].startswith(b'id: 2\n'), sent[2]
+
+
+def test_sse_app_reads_the_store_off_the_loop(monkeypatch: pytest.MonkeyPatch) -> None:
+    class Store:
+        def __init__(self) -> None:
+            self.threads: list[threading.Thread] = []
+
+        def last_id(self) -> int:
+            self.threads.append(threading.current_thread())
+            return 0
+
+        def recent(self, service_id: int, limit: int) -> list:
+            self.threads.append(threading.current_thread())
+            return []
+
+        def after(self, last_id: int) -> list:
+            return []
+
+    store = Store()
+    monkeypatch.setattr(broadcast, "broadcaster", Broadcaster(store=store, poll_interval=60))
+
+    async def run() -> None:
+        async def receive() -> dict:
+            return {'type': 'http.disconnect'}
+
+        async def send(message: dict) -> None:
+            pass
+
+        scope: dict = {'type': 'http', 'method': 'GET', 'path': '/live/42/events', 'query_string': b'',
+                       'headers': [], 'path_params': {'service_id': '42'}}
+        await asyncio.wait_for(sse_app(scope, receive, send), 5)
+        # the channel is open now, the next subscriber doesn't query
+        await asyncio.wait_for(sse_app(scope, receive, send), 5)
+
+    try:
+        asyncio.run(run())
+    finally:
+        broadcast.broadcaster.shutdown()
+    assert len(store.threads) == 2, "Only the first subscriber reads the store"
+    assert threading.current_thread() not in store.threads, "Not on the event loop's thread"
@@ -0,0 +1,140 @@
+from dbms import Dbms, Maintenance
+import dbms
+
+from models import Author, Song, Change_Log
+from sqlmodel import Session, select
+import threading
+import time
+import pytest
+import pathlib as pl
+
+
+@pytest.fixture
+def db_file(tmp_path: pl.Path) -> str:
+    file: str = str(tmp_path / "memory_test.sqlite")
+    dbase = Dbms(False, 'sqlite:///' + file, file)
+    dbase.create_database_structure()
+    with dbase.write_session() as session:
+        session.add(Song(title="And Can It Be", authors=[Author(surname="Wesley", first_names="Charles")]))
+        session.commit()
+    dbase.engine.dispose()
+    return file
+
+
+@pytest.fixture
+def db(db_file: str) -> Dbms:
+    dbase = Dbms(False, 'sqlite:///' + db_file, db_file, serve_from_memory=True)
+    dbase.create_database_structure()
+    return dbase
+
+
+def test_reads_come_from_memory(db: Dbms) -> None:
+    assert db.engine is not db.write_engine, "Reads should not use the file engine"
+    assert db.engine.url.query.get("vfs") == "memdb", f"Read engine should be in memory: {db.engine.url}"
+
+    with Session(db.engine) as session:
+        song: Song | None = session.exec(select(Song)).first()
+        assert song is not None, "Song from the file should have been loaded into memory"
+        assert song.title == "And Can It Be", f"Song title is {song.title}"
+        assert [a.surname for a in song.authors] == ["Wesley"], f"Song authors are {song.authors}"
+
+
+def test_writes_refresh_memory(db: Dbms) -> None:
+    with db.write_session() as session:
+        session.add(Song(title="Be Thou My Vision", authors=[]))
+        session.commit()
+
+    with Session(db.engine) as session:
+        titles = session.exec(select(Song.title).order_by(Song.title)).all()
+        assert titles == ["And Can It Be", "Be Thou My Vision"], f"Memory copy not refreshed: {titles}"
+
+    with db.write_session() as session:
+        song: Song | None = session.exec(select(Song).where(Song.title == "And Can It Be")).first()
+        assert song is not None
+        song.title = "And Can It Be That I Should Gain"
+        session.commit()
+
+    with db.write_session() as session:
+        song = session.exec(select(Song).where(Song.title == "Be Thou My Vision")).first()
+        session.delete(song)
+        session.commit()
+
+    with Session(db.engine) as session:
+        titles = session.exec(select(Song.title)).all()
+        assert titles == ["And Can It Be That I Should Gain"], f"Memory copy not refreshed: {titles}"
+        changes = session.exec(select(Change_Log)).all()
+        assert changes[-1].id == db.memory_version, f"Memory version {db.memory_version} is not the last change"
+        assert changes[-1].deleted, "Last change should be the delete"
+
+
+def test_refresh_picks_up_other_writers(db: Dbms, db_file: str) -> None:
+    other = Dbms(False, 'sqlite:///' + db_file, db_file)
+    with other.write_session() as session:
+        session.add(Author(surname="Watts", first_names="Isaac"))
+        session.commit()
+
+    assert db.refresh_memory() == 1, "One changed row should be copied"
+    with Session(db.engine) as session:
+        surnames = session.exec(select(Author.surname).order_by(Author.surname)).all()
+        assert surnames == ["Watts", "Wesley"], f"Memory copy not refreshed: {surnames}"
+
+    assert db.refresh_memory() == 0, "Nothing left to copy"
+
+
+def test_reads_see_other_processes_writes(db: Dbms, db_file: str) -> None:
+    # eg another worker or the command line tools, writing to the file
+    other = Dbms(False, 'sqlite:///' + db_file, db_file, serve_from_memory=True)
+    with other.write_session() as session:
+        session.add(Song(title="O For A Thousand Tongues", authors=[]))
+        session.commit()
+
+    with Session(db.engine) as session:
+        titles = session.exec(select(Song.title).order_by(Song.title)).all()
+        assert titles == ["And Can It Be", "O For A Thousand Tongues"], "Checked before the read"
+    assert db.memory_version == db.file_version()
+
+
+def test_readers_wait_for_a_refresh(db: Dbms) -> None:
+    # a refresh half done: the row deleted, not yet inserted again
+    keeper = db._memory_keeper
+    keeper.execute("BEGIN IMMEDIATE")
+    keeper.execute("DELETE FROM song")
+    read: list = []
+
+    def reader() -> None:
+        with db.engine.connect() as conn:
+            read.extend(conn.exec_driver_sql("SELECT title FROM song").scalars().all())
+    thread = threading.Thread(target=reader)
+    thread.start()
+    time.sleep(0.1)
+    assert not read, "The reader waits"
+    keeper.execute("INSERT INTO song (id, title) VALUES (1, 'And Can It Be')")
+    keeper.execute("COMMIT")
+    thread.join()
+    assert read == ["And Can It Be"], "Never half a refresh"
+
+
+def test_change_log_pruned(db: Dbms, db_file: str, monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(dbms, "CHANGE_LOG_KEEP", 2)
+    monkeypatch.setattr(Maintenance, "IDLE_SECONDS", 0)
+    behind = Dbms(False, 'sqlite:///' + db_file, db_file, serve_from_memory=True)
+    for title in ("Be Thou My Vision", "Love Divine", "Amazing Grace"):
+        with db.write_session() as session:
+            session.add(Song(title=title, authors=[]))
+            session.commit()
+    version: int = db.file_version()
+    assert db.maintenance.run_idle_tasks()
+    with Session(db.write_engine) as session:
+        assert session.exec(select(Change_Log.id)).all() == [version - 1, version]
+    with db.write_session() as session:
+        session.add(Song(title="Thine Be The Glory", authors=[]))
+        session.commit()
+    with Session(db.engine) as session:
+        assert session.exec(select(Change_Log.id)).all() == [version - 1, version, version + 1], \
+            "The memory copy is pruned when it is next refreshed"
+
+    # a copy behind the pruned entries loads the file again
+    assert behind.memory_version < version - 2
+    assert behind.refresh_memory() == -1
+    with Session(behind.engine) as session:
+        assert len(session.exec(select(Song)).all()) == 5
@@ -0,0 +1,112 @@
+from dbms import Dbms
+
+from models import VerseType, Author, Song_Book, Song, Song_Book_Item, Verse, Service, Service_Item, Slide_Deck
+from prayer_of_hannah import create_app
+from prayer_of_hannah.live_worship.slides import render_views
+from prayer_of_hannah.services import decks
+from sqlmodel import Session, select
+import json
+import pytest
+
+
+@pytest.fixture
+def db() -> Dbms:
+    dbase = Dbms(True)
+    dbase.create_database_structure()
+    with dbase.write_session() as session:
+        book: Song_Book = Song_Book(code="StF", name="Singing the Faith")
+        song1: Song = Song(title="And Can It Be", authors=[Author(surname="Wesley", first_names="Charles")])
+        song2: Song = Song(title="Be Thou My Vision", authors=[])
+        item1: Song_Book_Item = Song_Book_Item(song_book=book, song=song1, nbr=345, verse_order="v1 c1 v2 c1")
+        item2: Song_Book_Item = Song_Book_Item(song_book=book, song=song2, nbr=545, verse_order="")
+        session.add_all([
+            Verse(type=VerseType.VERSE, number=1, lyrics="And can it be<br>that I should gain", song_book_item=item1),
+            Verse(type=VerseType.CHORUS, number=1, lyrics="Amazing love!<br>How can it be", song_book_item=item1),
+            Verse(type=VerseType.VERSE, number=2, lyrics="Long my imprisoned spirit lay", song_book_item=item1),
+            Verse(type=VerseType.VERSE, number=1, lyrics="Be thou my vision", song_book_item=item2),
+            Verse(type=VerseType.VERSE, number=2, lyrics="Be thou my wisdom", song_book_item=item2),
+        ])
+        service: Service = Service(name="Sunday Morning")
+        session.add_all([service,
+                         Service_Item(service=service, position=1, song_book_item=item1),
+                         Service_Item(service=service, position=2, song_book_item=item2)])
+        session.commit()
+    return dbase
+
+
+def test_deck_slides_follow_verse_order(db: Dbms) -> None:
+    with db.write_session() as session:
+        deck: Slide_Deck = decks.finalise_service(session, 1)
+        bundle: dict = json.loads(deck.bundle)
+
+    assert deck.version == 1
+    assert [s['verse'] for s in bundle['slides']] == ['v1', 'c1', 'v2', 'c1', '', 'v1', 'v2'], \
+        "Slides should be expanded from verse_order with a blank slide between songs"
+    assert bundle['slides'][1]['lines'] == ["Amazing love!", "How can it be"]
+    assert [i['title'] for i in bundle['items']] == ["And Can It Be", "Be Thou My Vision"]
+
+
+def test_long_verse_is_stepped_through(db: Dbms) -> None:
+    lines: list[str] = [f"Line {n:02} of a verse that goes on and on" for n in range(40)]
+    with db.write_session() as session:
+        verse: Verse = session.exec(select(Verse).where(Verse.lyrics == "Long my imprisoned spirit lay")).one()
+        verse.lyrics = "<br>".join(lines)
+        session.commit()
+        bundle: dict = json.loads(decks.finalise_service(session, 1).bundle)
+
+    pages: list[int] = [index for index, slide in enumerate(bundle['slides']) if slide['verse'] == 'v2' and slide['item'] == 0]
+    assert len(pages) > 1, "A verse too long for the screen is split into slides"
+    assert [bundle['slides'][index]['page'] for index in pages] == list(range(len(pages)))
+    assert [line for index in pages for line in bundle['slides'][index]['lines']] == lines
+    with create_app().app_context():
+        for index in pages:
+            shown: dict[str, str] = render_views(bundle, index, ('projector', 'large_print', 'high_contrast'))
+            for view, html in shown.items():
+                assert all(line in html for line in bundle['slides'][index]['lines'])
+                assert sum(line in html for line in lines) == len(bundle['slides'][index]['lines']), \
+                    f"{view} shows only its own page"
+
+
+def test_refinalise_only_versions_changes(db: Dbms) -> None:
+    with db.write_session() as session:
+        first: Slide_Deck = decks.finalise_service(session, 1)
+        again: Slide_Deck = decks.finalise_service(session, 1)
+        assert again.id == first.id, "Nothing changed so no new version"
+
+        item: Service_Item | None = session.get(Service_Item, 1)
+        assert item is not None
+        item.verse_order = "v1 c1"
+        session.add(item)
+        session.commit()
+        second: Slide_Deck = decks.finalise_service(session, 1)
+
+        assert second.version == 2
+        assert second.content_hash != first.content_hash
+        service: Service | None = session.get(Service, 1)
+        assert service is not None and service.deck_hash == second.content_hash
+        assert decks.deck_version(session, 1, 1) is not None, "Old versions are kept"
+
+    assert decks.deck_bundle(db.engine, second.content_hash) == second.bundle
+    assert decks.deck_bundle(db.engine, "0" * 64) is None
+
+
+def test_unknown_service(db: Dbms) -> None:
+    with Session(db.engine) as session:
+        with pytest.raises(decks.DeckError):
+            decks.finalise_service(session, 99)
+
+
+def test_finalise_race(db: Dbms, monkeypatch: pytest.MonkeyPatch) -> None:
+    latest_deck = decks.latest_deck
+
+    def raced(session: Session, service_id: int) -> Slide_Deck | None:
+        # another worker finalises between this one reading the latest version and adding its own
+        monkeypatch.setattr(decks, "latest_deck", latest_deck)
+        with db.write_session() as other:
+            decks.finalise_service(other, service_id)
+        return None
+
+    monkeypatch.setattr(decks, "latest_deck", raced)
+    with db.write_session() as session:
+        deck: Slide_Deck = decks.finalise_service(session, 1)
+        assert deck.version == 1 and len(session.exec(select(Slide_Deck)).all()) == 1
@@ -0,0 +1,104 @@
+from dbms import Dbms
+
+from models import VerseType, Song_Book, Song, Song_Book_Item, Verse, Service, Service_Item, Slide_Deck
+import prayer_of_hannah
+from prayer_of_hannah import create_app
+from prayer_of_hannah.services import decks, delta
+import gzip
+import json
+import pytest
+import pathlib as pl
+
+
+@pytest.fixture
+def db(tmp_path: pl.Path, monkeypatch: pytest.MonkeyPatch) -> Dbms:
+    file: str = str(tmp_path / "delta_test.sqlite")
+    dbase = Dbms(False, 'sqlite:///' + file, file)
+    dbase.create_database_structure()
+    with dbase.write_session() as session:
+        book: Song_Book = Song_Book(code="StF", name="Singing the Faith")
+        service: Service = Service(name="Sunday Morning")
+        session.add(service)
+        for n in range(1, 5):
+            item: Song_Book_Item = Song_Book_Item(song_book=book, song=Song(title=f"Hymn {n}", authors=[]),
+                                                  nbr=n, verse_order="")
+            session.add_all([Verse(type=VerseType.VERSE, number=v, lyrics=f"Hymn {n} verse {v}<br>line two",
+                                   song_book_item=item) for v in range(1, 5)])
+            if n < 4:
+                session.add(Service_Item(service=service, position=n, song_book_item=item))
+        session.commit()
+    monkeypatch.setattr(prayer_of_hannah, "__DB", dbase)
+    monkeypatch.setattr(prayer_of_hannah, "__DBE", dbase.engine)
+    return dbase
+
+
+def edit_and_finalise(db: Dbms, position: int, **changes) -> Slide_Deck:
+    with db.write_session() as session:
+        item: Service_Item | None = session.get(Service_Item, position)
+        assert item is not None
+        if changes.get('drop'):
+            session.delete(item)
+        for name, value in changes.items():
+            if name != 'drop':
+                setattr(item, name, value)
+        session.commit()
+        return decks.finalise_service(session, 1)
+
+
+def rebuilt(old: Slide_Deck, new: Slide_Deck) -> bytes:
+    return delta.rebuild_deck(old.bundle, delta.encode_delta(old, new))
+
+
+def test_delta_rebuilds_new_version(db: Dbms) -> None:
+    with db.write_session() as session:
+        v1: Slide_Deck = decks.finalise_service(session, 1)
+    v2: Slide_Deck = edit_and_finalise(db, 2, verse_order="v1 v2 v4")
+    v3: Slide_Deck = edit_and_finalise(db, 3, song_book_item_id=4)
+    v4: Slide_Deck = edit_and_finalise(db, 1, drop=True)
+
+    for old, new in [(v1, v2), (v2, v3), (v3, v4), (v1, v4), (v4, v1)]:
+        assert rebuilt(old, new) == new.bundle
+
+    ops: list = json.loads(gzip.decompress(delta.encode_delta(v3, v4)))['slides']
+    assert all(op[0] == delta.COPY for op in ops), "Dropping the first hymn only shifts the later slides"
+    assert {op[3] for op in ops} == {-1}
+    assert len(delta.encode_delta(v1, v2)) < len(v2.bundle) / 4
+
+
+def test_delta_checks_result(db: Dbms) -> None:
+    with db.write_session() as session:
+        v1: Slide_Deck = decks.finalise_service(session, 1)
+    v2: Slide_Deck = edit_and_finalise(db, 2, verse_order="v1")
+    with pytest.raises(decks.DeckError):
+        delta.rebuild_deck(v2.bundle, delta.encode_delta(v1, v2))
+
+
+def test_delta_route(db: Dbms) -> None:
+    with db.write_session() as session:
+        v1: Slide_Deck = decks.finalise_service(session, 1)
+    v2: Slide_Deck = edit_and_finalise(db, 2, verse_order="v2 v1")
+    client = create_app().test_client()
+
+    response = client.get('/services/1/deck/delta?from=1', headers={'Accept-Encoding': 'gzip'})
+    assert response.status_code == 200
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert response.headers['X-Deck-Version'] == '2'
+    assert response.headers['Cache-Control'] == 'no-cache', "The latest version can change"
+    assert delta.rebuild_deck(v1.bundle, response.data) == v2.bundle
+
+    response = client.get('/services/1/deck/delta?from=1&to=2')
+    assert 'Content-Encoding' not in response.headers
+    assert response.json['to'] == v2.content_hash
+    assert 'immutable' in response.headers['Cache-Control']
+
+    assert client.get('/services/1/deck/delta?from=9').status_code == 404
+    assert client.get('/services/1/deck/delta').status_code == 400
+
+
+def test_presenter_applies_deltas(db: Dbms) -> None:
+    client = create_app().test_client()
+    page: str = client.get('/live/1/present').get_data(as_text=True)
+    assert 'decks.js' in page
+    assert '"/services/1/deck"' in page and '"/services/1/deck/delta"' in page
+    script: str = client.get('/static/decks.js').get_data(as_text=True)
+    assert 'function applyDelta' in script, "The client rebuilds a deck from the version it holds"
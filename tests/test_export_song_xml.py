@@ -0,0 +1,128 @@
+from dbms import Dbms
+
+from models import VerseType, Author, Song_Book, Song, Song_Book_Item, Verse
+import prayer_of_hannah
+from prayer_of_hannah import create_app
+from prayer_of_hannah import export_song_xml
+from prayer_of_hannah.media import pipeline
+from prayer_of_hannah.load_song_xml import load_song, song_xml_files
+from sqlalchemy.orm import selectinload
+from sqlmodel import Session, select
+import io
+import zipfile
+import zlib
+import pytest
+import pathlib as pl
+
+
+def new_db(path: pl.Path) -> Dbms:
+    dbase = Dbms(False, 'sqlite:///' + str(path), str(path))
+    dbase.create_database_structure()
+    return dbase
+
+
+@pytest.fixture
+def db(tmp_path: pl.Path, monkeypatch: pytest.MonkeyPatch) -> Dbms:
+    dbase = new_db(tmp_path / "export_test.sqlite")
+    with dbase.write_session() as session:
+        stf: Song_Book = Song_Book(code="StF", name="Singing the Faith")
+        hp: Song_Book = Song_Book(code="H+P", name="Hymns and Psalms")
+        wesley: Author = Author(surname="Wesley", first_names="Charles")
+        byrne: Author = Author(surname="Byrne", first_names="Mary Elizabeth")
+        love: Song = Song(title="Love divine, all loves excelling", authors=[wesley])
+        vision: Song = Song(title="Be thou my vision", authors=[byrne, wesley])
+        items: list[Song_Book_Item] = [
+            Song_Book_Item(song_book=stf, song=love, nbr=503, verse_order="v1 c1 v2 c1"),
+            Song_Book_Item(song_book=hp, song=love, nbr=267, verse_order=""),
+            Song_Book_Item(song_book=stf, song=vision, nbr=545, verse_order="o1 v1 v10"),
+        ]
+        session.add_all([
+            Verse(type=VerseType.VERSE, number=1, lyrics="Love divine, all loves excelling,<br>joy of heaven", song_book_item=items[0]),
+            Verse(type=VerseType.CHORUS, number=1, lyrics="Changed from glory into glory & <praise>", song_book_item=items[0]),
+            Verse(type=VerseType.VERSE, number=2, lyrics="Breathe, O breathe", song_book_item=items[0]),
+            Verse(type=VerseType.VERSE, number=2, lyrics="Second verse first", song_book_item=items[1]),
+            Verse(type=VerseType.VERSE, number=1, lyrics="First verse second", song_book_item=items[1]),
+            Verse(type=VerseType.VERSE, number=1, lyrics="Be thou my vision", song_book_item=items[2]),
+            Verse(type=VerseType.VERSE, number=10, lyrics="High King of heaven", song_book_item=items[2]),
+            Song(title="A song in no book", authors=[byrne]),
+        ])
+        session.commit()
+    monkeypatch.setattr(prayer_of_hannah, "__DB", dbase)
+    monkeypatch.setattr(prayer_of_hannah, "__DBE", dbase.engine)
+    return dbase
+
+
+def library(db: Dbms) -> dict[str, dict]:
+    """Everything the export carries, by song title"""
+    with Session(db.engine) as session:
+        songs = session.exec(select(Song).options(
+            selectinload(Song.authors),  # type: ignore[arg-type]
+            selectinload(Song.song_book_items).selectinload(Song_Book_Item.song_book),  # type: ignore[arg-type]
+            selectinload(Song.song_book_items).selectinload(Song_Book_Item.verses))).all()  # type: ignore[arg-type]
+        return {song.title: {
+            'authors': sorted((a.surname, a.first_names) for a in song.authors),
+            'items': sorted((i.song_book.code, i.nbr, i.verse_order or '',
+                             [(str(v.type), v.number, v.lyrics) for v in sorted(i.verses, key=lambda v: v.id)])
+                            for i in song.song_book_items)}
+            for song in songs}
+
+
+@pytest.mark.parametrize('workers', [0, 2])
+def test_round_trip(db: Dbms, tmp_path: pl.Path, workers: int) -> None:
+    path: pl.Path = tmp_path / "songs.zip"
+    # small batches so the pool gets several
+    with open(path, 'wb') as output:
+        for chunk in export_song_xml.zip_chunks(db.engine, workers, batch=1):
+            output.write(chunk)
+    with zipfile.ZipFile(path) as archive:
+        assert archive.testzip() is None
+        names: list[str] = sorted(archive.namelist())
+        assert names[:3] == ['H+P-267-Love-divine-all-loves-excelling.xml',
+                             'StF-503-Love-divine-all-loves-excelling.xml',
+                             'StF-545-Be-thou-my-vision.xml']
+        assert names[3].startswith('song-') and names[3].endswith('-A-song-in-no-book.xml')
+
+    imported: Dbms = new_db(tmp_path / "imported.sqlite")
+    for _, xml in song_xml_files(str(path)):
+        load_song(imported, xml)
+    assert library(imported) == library(db)
+
+
+def test_openlyrics_xml(db: Dbms) -> None:
+    songs: dict[str, dict] = {song['file_name']: song for song in next(export_song_xml.song_batches(db.engine))}
+    xml: str = export_song_xml.render_song(songs['StF-503-Love-divine-all-loves-excelling.xml']).decode('utf-8')
+    assert '<song xmlns="http://openlyrics.info/namespace/2009/song" version="0.9">' in xml
+    assert '<songbook name="StF" entry="503"/>' in xml
+    assert '<verseOrder>v1 c1 v2 c1</verseOrder>' in xml
+    assert 'Love divine, all loves excelling,\njoy of heaven' in xml
+    assert 'glory &amp; &lt;praise&gt;' in xml
+
+
+def test_zip_stream() -> None:
+    archive = export_song_xml.ZipStream((2026, 10, 19, 12, 30, 0))
+    xml: bytes = b"<song/>"
+    entry = export_song_xml.ZipEntry('', export_song_xml.deflate(xml), zlib.crc32(xml), len(xml))
+    # more files than a zip without zip64 records holds
+    data: bytes = b''.join(archive.entry(entry._replace(name=f'Dié Liedjie-{n}.xml')) for n in range(0x10000))
+    data += archive.close()
+    with zipfile.ZipFile(io.BytesIO(data)) as read:
+        infos: list[zipfile.ZipInfo] = read.infolist()
+        assert len(infos) == 0x10000
+        assert infos[-1].filename == 'Dié Liedjie-65535.xml' and infos[-1].date_time == (2026, 10, 19, 12, 30, 0)
+        assert read.read(infos[0]) == read.read(infos[-1]) == xml
+
+
+def test_export_route_streams(db: Dbms, monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(pipeline, "_executor", None)
+    client = create_app().test_client()
+    try:
+        response = client.get('/songs/export.zip')
+        assert response.status_code == 200 and response.is_streamed
+        assert response.mimetype == 'application/zip'
+        with zipfile.ZipFile(io.BytesIO(response.data)) as archive:
+            assert len(archive.namelist()) == 4
+        pool = pipeline._executor
+        assert pool is not None, "Rendered in the worker's pool"
+        assert client.get('/songs/export.zip').data and pipeline._executor is pool, "Not a pool per request"
+    finally:
+        pipeline.shutdown_worker_executor()
@@ -0,0 +1,107 @@
+from dbms import Dbms
+
+from models import VerseType, Song_Book, Song, Song_Book_Item, Verse
+import prayer_of_hannah
+from prayer_of_hannah import create_app
+from prayer_of_hannah.live_worship import layout
+from prayer_of_hannah.live_worship.layout import PROFILES, Layout, LayoutCache, Profile
+import pytest
+import pathlib as pl
+
+LONG_LINE: str = "And can it be that I should gain an interest in the Saviour's blood"
+
+
+@pytest.fixture
+def cache(monkeypatch: pytest.MonkeyPatch) -> LayoutCache:
+    layout_cache: LayoutCache = LayoutCache()
+    monkeypatch.setattr(layout, "_layout_cache", layout_cache)
+    return layout_cache
+
+
+@pytest.fixture
+def db(tmp_path: pl.Path, monkeypatch: pytest.MonkeyPatch) -> Dbms:
+    file: str = str(tmp_path / "layout_test.sqlite")
+    dbase = Dbms(False, 'sqlite:///' + file, file)
+    dbase.create_database_structure()
+    with dbase.write_session() as session:
+        item: Song_Book_Item = Song_Book_Item(song_book=Song_Book(code="StF", name="Singing the Faith"),
+                                              song=Song(title="And Can It Be", authors=[]), nbr=345, verse_order="")
+        session.add(Verse(type=VerseType.VERSE, number=1, lyrics="And can it be<br>that I should gain",
+                          song_book_item=item))
+        session.commit()
+    monkeypatch.setattr(prayer_of_hannah, "__DB", dbase)
+    monkeypatch.setattr(prayer_of_hannah, "__DBE", dbase.engine)
+    return dbase
+
+
+def test_short_verse_fits_at_largest_font() -> None:
+    fitted: Layout = layout.layout_lines(("And can it be", "that I should gain"), PROFILES['projector'])
+    assert fitted.font_size == PROFILES['projector'].max_font
+    assert fitted.pages == (("And can it be", "that I should gain"),)
+
+
+def test_long_verse_is_split_across_slides() -> None:
+    profile: Profile = PROFILES['tablet']
+    lines: tuple[str, ...] = tuple(f"{n} {LONG_LINE}" for n in range(40))
+    fitted: Layout = layout.layout_lines(lines, profile)
+    wrapped, rows = layout.fit(lines, profile, profile.min_font)
+
+    assert fitted.font_size == profile.min_font
+    assert len(fitted.pages) > 1
+    assert all(len(page) <= rows for page in fitted.pages)
+    assert [part for page in fitted.pages for part in page] == [part for parts in wrapped for part in parts]
+    assert all(page[0][0].isdigit() for page in fitted.pages), "Slides break between lyric lines"
+
+
+def test_font_shrinks_before_splitting() -> None:
+    profile: Profile = PROFILES['projector']
+    fitted: Layout = layout.layout_lines(tuple(LONG_LINE for _ in range(6)), profile)
+    assert profile.min_font <= fitted.font_size < profile.max_font
+    assert len(fitted.pages) == 1
+
+
+def test_split_slides_fit_every_profile() -> None:
+    profiles: list[Profile] = [PROFILES['projector'], PROFILES['tablet']]
+    lines: tuple[str, ...] = tuple(f"{n} {LONG_LINE}" for n in range(40))
+    slides: tuple[tuple[str, ...], ...] = layout.split_slides(lines, profiles)
+
+    assert len(slides) > 1
+    assert all(len(layout.layout_lines(slide, profile).pages) == 1 for slide in slides for profile in profiles)
+    assert [line for slide in slides for line in slide] == list(lines), "Slides break between lyric lines"
+    assert layout.split_slides(lines[:2], profiles) == (lines[:2],)
+    assert layout.split_slides((), profiles) == ((),)
+
+    too_long: str = " ".join([LONG_LINE] * 60)
+    parts: tuple[tuple[str, ...], ...] = layout.split_slides((too_long,), profiles)
+    assert len(parts) > 1 and " ".join(line for slide in parts for line in slide) == too_long
+
+
+def test_layouts_memoised_until_lyrics_change(db: Dbms, cache: LayoutCache) -> None:
+    client = create_app().test_client()
+    response = client.get('/live/layout/1?profile=tablet')
+    assert response.json['pages'] == [["And can it be", "that I should gain"]]
+    assert len(cache) == 1
+    client.get('/live/layout/1?profile=tablet')
+    assert len(cache) == 1, "Second request comes from the memo"
+
+    with db.write_session() as session:
+        verse: Verse | None = session.get(Verse, 1)
+        assert verse is not None
+        verse.lyrics = "Amazing love!"
+        session.add(verse)
+        session.commit()
+    assert len(cache) == 0, "Changing the lyrics drops the verse's layouts"
+    assert client.get('/live/layout/1?profile=tablet').json['pages'] == [["Amazing love!"]]
+    assert client.get('/live/layout/1?profile=nope').status_code == 404
+    assert client.get('/live/layout/9').status_code == 404
+
+
+def test_precompute_in_worker_pool(cache: LayoutCache) -> None:
+    verses: list[tuple[int, tuple[str, ...]]] = [(n, (f"{n} {LONG_LINE}",) * (n % 30 + 1)) for n in range(1, 41)]
+    profiles: list[Profile] = [PROFILES['projector'], PROFILES['phone']]
+    assert layout.precompute_layouts(verses, profiles, max_workers=2, pool_threshold=1) == 80
+    assert len(cache) == 80
+    for verse_id, lines in verses:
+        for profile in profiles:
+            assert layout.verse_layout(verse_id, lines, profile) == layout.layout_lines(lines, profile)
+    assert layout.precompute_layouts(verses, profiles) == 0, "Already laid out"
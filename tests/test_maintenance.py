@@ -0,0 +1,120 @@
+from dbms import Dbms, Maintenance
+
+from models import Song, Live_Event
+from prayer_of_hannah.live_worship.broadcast import Broadcaster, EventStore
+from datetime import datetime, timedelta
+import asyncio
+import pytest
+import pathlib as pl
+
+
+@pytest.fixture
+def db(tmp_path: pl.Path) -> Dbms:
+    file: str = str(tmp_path / "maintenance_test.sqlite")
+    dbase = Dbms(False, 'sqlite:///' + file, file)
+    dbase.create_database_structure()
+    return dbase
+
+
+def add_and_delete_songs(db: Dbms, count: int) -> None:
+    with db.write_session() as session:
+        songs: list[Song] = [Song(title=f"Song number {n} " + "x" * 80, authors=[]) for n in range(count)]
+        session.add_all(songs)
+        session.commit()
+        for song in songs:
+            session.delete(song)
+        session.commit()
+
+
+def test_new_database_is_wal_with_incremental_vacuum(db: Dbms) -> None:
+    status: dict = db.maintenance.status()
+    assert status['incremental_vacuum'], f"auto_vacuum should be incremental: {status}"
+    with db.engine.connect() as conn:
+        assert conn.exec_driver_sql("PRAGMA journal_mode").scalar() == "wal"
+
+
+def test_idle_tasks_shrink_file(db: Dbms) -> None:
+    add_and_delete_songs(db, 2000)
+    before: dict = db.maintenance.status()
+    assert before['freelist_count'] > 0, f"Deletes should leave free pages: {before}"
+    assert before['checkpoint_lag'] > 0, f"Writes should be in the WAL: {before}"
+
+    assert not db.maintenance.run_idle_tasks(), "Just written to so should not be idle"
+    assert db.maintenance.run_idle_tasks(force=True)
+
+    after: dict = db.maintenance.status()
+    assert after['freelist_count'] < before['freelist_count'], f"Free pages not vacuumed: {before} {after}"
+    assert after['checkpoint_lag'] == 0, f"WAL should be truncated: {after}"
+    assert set(after['last_run']) == {'vacuum', 'checkpoint'}
+
+
+def publish(db: Dbms, service_id: int, name: str, published: datetime) -> None:
+    """A live event, as any worker's broadcaster writes it"""
+    with db.write_session() as session:
+        session.add(Live_Event(service_id=service_id, name=name, data='{}', published=published))
+        session.commit()
+
+
+def test_nothing_runs_during_live_service(db: Dbms, monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(Maintenance, "IDLE_SECONDS", 0)
+    publish(db, 1, 'slide', datetime.now())
+    assert db.maintenance.in_live_service
+    assert not db.maintenance.run_idle_tasks(force=True), "Must not run during a live service"
+    publish(db, 1, 'end', datetime.now())
+    assert not db.maintenance.in_live_service
+    # no one ended it
+    publish(db, 2, 'slide', datetime.now() - timedelta(seconds=Maintenance.LIVE_SECONDS + 60))
+    assert not db.maintenance.in_live_service
+    assert db.maintenance.run_idle_tasks(), "Idle and no live service so should run"
+
+
+def test_live_service_seen_by_every_worker(db: Dbms) -> None:
+    # the operator's worker publishes, another worker's Dbms on the same file checks
+    broadcaster = Broadcaster(store=EventStore(db))
+    other = Dbms(False, db.SQLALCHEMY_DATABASE_URI, db.database_file)
+    broadcaster.publish(1, 'slide', {'index': 0})
+    assert other.maintenance.in_live_service
+    broadcaster.publish(1, 'end', {})
+    assert not other.maintenance.in_live_service
+
+
+def test_idle_tasks_run_once_at_a_time(db: Dbms) -> None:
+    db.maintenance._idle_lock.acquire()
+    try:
+        assert not db.maintenance.run_idle_tasks(force=True), "Already running in another thread"
+    finally:
+        db.maintenance._idle_lock.release()
+    assert db.maintenance.run_idle_tasks(force=True)
+
+
+def test_analyze_after_bulk_import(db: Dbms) -> None:
+    with db.write_session() as session:
+        session.add_all([Song(title=f"Imported song {n}", authors=[]) for n in range(50)])
+        session.commit()
+    db.maintenance.after_bulk_import()
+    with db.engine.connect() as conn:
+        stats = conn.exec_driver_sql("SELECT tbl FROM sqlite_stat1").scalars().all()
+    assert "song" in stats, f"ANALYZE should have written statistics: {stats}"
+    db.close()
+
+
+def test_reads_are_activity(tmp_path: pl.Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    file: str = str(tmp_path / "maintenance_reads.sqlite")
+    Dbms(False, 'sqlite:///' + file, file).create_database_structure()
+    served = Dbms(False, 'sqlite:///' + file, file, serve_from_memory=True)
+    monkeypatch.setattr(Maintenance, "IDLE_SECONDS", 60)
+
+    async def read_async() -> None:
+        async with served.async_engine.connect() as conn:
+            await conn.exec_driver_sql("SELECT count(*) FROM song")
+
+    def read() -> None:
+        with served.engine.connect() as conn:
+            conn.exec_driver_sql("SELECT count(*) FROM song").scalar()
+
+    for reader in (read, lambda: asyncio.run(read_async())):
+        served.maintenance.last_activity -= 120
+        assert served.maintenance.is_idle()
+        reader()
+        assert not served.maintenance.is_idle(), "A read from memory should count as activity"
+    served.close()
@@ -0,0 +1,141 @@
+from dbms import Dbms
+
+from models import MediaType, Song_Book, Song, Song_Book_Item, Media
+import prayer_of_hannah
+from prayer_of_hannah import create_app
+from prayer_of_hannah.asgi import create_asgi_app
+from prayer_of_hannah.media import store
+from prayer_of_hannah.media.serve import RangeNotSatisfiable, parse_range
+from config import Config
+import asyncio
+import os
+import pytest
+import pathlib as pl
+
+AUDIO: bytes = bytes(range(256)) * 4000
+
+
+@pytest.fixture
+def db(tmp_path: pl.Path, monkeypatch: pytest.MonkeyPatch) -> Dbms:
+    file: str = str(tmp_path / "media_test.sqlite")
+    dbase = Dbms(False, 'sqlite:///' + file, file)
+    dbase.create_database_structure()
+    with dbase.write_session() as session:
+        session.add(Song_Book_Item(song_book=Song_Book(code="StF", name="Singing the Faith"),
+                                   song=Song(title="And Can It Be", authors=[]), nbr=345, verse_order=""))
+        session.commit()
+    monkeypatch.setattr(prayer_of_hannah, "__DB", dbase)
+    monkeypatch.setattr(prayer_of_hannah, "__DBE", dbase.engine)
+    monkeypatch.setattr(Config, "MEDIA_DIR", str(tmp_path / "media"))
+    return dbase
+
+
+@pytest.fixture
+def media(db: Dbms, tmp_path: pl.Path) -> Media:
+    recording: pl.Path = tmp_path / "sagina.mp3"
+    recording.write_bytes(AUDIO)
+    with db.write_session() as session:
+        return store.add_media(session, 1, MediaType.AUDIO_WITH_SINGING, str(recording), tune="Sagina", verse_count=5)
+
+
+def call(app, path: str, headers: list[tuple[bytes, bytes]], method: str = 'GET') -> tuple[int, dict, bytes]:
+    scope: dict = {'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'method': method,
+                   'scheme': 'http', 'path': path, 'root_path': '', 'query_string': b'', 'headers': headers,
+                   'server': ('testserver', 80)}
+    sent: list[dict] = []
+
+    async def receive() -> dict:
+        return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+    async def send(message: dict) -> None:
+        sent.append(message)
+
+    asyncio.run(app(scope, receive, send))
+    return (sent[0]['status'], dict(sent[0]['headers']),
+            b''.join(m.get('body', b'') for m in sent if m['type'] == 'http.response.body'))
+
+
+def test_parse_range() -> None:
+    assert parse_range(None, 100) is None
+    assert parse_range("bytes=0-9", 100) == (0, 9)
+    assert parse_range("bytes=90-", 100) == (90, 99)
+    assert parse_range("bytes=90-500", 100) == (90, 99)
+    assert parse_range("bytes=-10", 100) == (90, 99)
+    assert parse_range("bytes=0-1,5-6", 100) is None, "Several ranges get the whole file"
+    for unsatisfiable in ("bytes=100-", "bytes=9-5", "bytes=-0"):
+        with pytest.raises(RangeNotSatisfiable):
+            parse_range(unsatisfiable, 100)
+
+
+def test_store_deduplicates(db: Dbms, media: Media, tmp_path: pl.Path) -> None:
+    assert media.size == len(AUDIO)
+    assert media.mime_type == "audio/mpeg"
+    path: str = store.media_path(media.content_hash)
+    assert pl.Path(path).read_bytes() == AUDIO
+
+    copy: pl.Path = tmp_path / "copy.mp3"
+    copy.write_bytes(AUDIO)
+    assert store.store_file(str(copy)) == (media.content_hash, len(AUDIO))
+    stored: list[str] = [f for _, _, files in os.walk(store.media_dir()) for f in files]
+    assert stored == [media.content_hash], "The same content is stored once, no temporary files left"
+
+
+def test_flask_route(media: Media) -> None:
+    client = create_app().test_client()
+    url: str = f'/media/{media.content_hash}'
+    response = client.get(url, headers={'Range': 'bytes=1000-1999'})
+    assert response.status_code == 206
+    assert response.data == AUDIO[1000:2000]
+    assert response.headers['ETag'] == f'"{media.content_hash}"'
+    assert 'immutable' in response.headers['Cache-Control']
+    assert client.get(url, headers={'If-None-Match': f'"{media.content_hash}"'}).status_code == 304
+    assert client.get('/media/item/1').json[0]['url'] == url
+    assert client.get('/media/' + '0' * 64).status_code == 404
+
+
+def test_asgi_ranges(media: Media) -> None:
+    app = create_asgi_app()
+    path: str = f'/media/{media.content_hash}'
+    etag: bytes = f'"{media.content_hash}"'.encode()
+
+    status, headers, body = call(app, path, [])
+    assert status == 200 and body == AUDIO
+    assert headers[b'content-length'] == str(len(AUDIO)).encode()
+    assert headers[b'etag'] == etag
+
+    status, headers, body = call(app, path, [(b'range', b'bytes=-600000')])
+    assert status == 206
+    assert body == AUDIO[-600000:], "Sent in several chunks"
+    assert headers[b'content-range'] == f'bytes {len(AUDIO) - 600000}-{len(AUDIO) - 1}/{len(AUDIO)}'.encode()
+
+    status, headers, _ = call(app, path, [(b'range', f'bytes={len(AUDIO)}-'.encode())])
+    assert status == 416
+    assert headers[b'content-range'] == f'bytes */{len(AUDIO)}'.encode()
+
+    assert call(app, path, [(b'if-none-match', etag)])[0] == 304
+    assert call(app, path, [(b'range', b'bytes=0-9'), (b'if-range', b'"other"')])[2] == AUDIO, "Changed since"
+    assert call(app, path, [], method='HEAD')[2] == b''
+    assert call(app, '/media/' + 'f' * 64, [])[0] == 404
+
+
+def test_asgi_zerocopy(media: Media) -> None:
+    sent: list[dict] = []
+
+    async def run() -> None:
+        async def receive() -> dict:
+            return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+        async def send(message: dict) -> None:
+            if message['type'] == 'http.response.zerocopysend':
+                message = dict(message, body=os.pread(message['file'].fileno(), message['count'], message['offset']))
+            sent.append(message)
+
+        scope: dict = {'type': 'http', 'method': 'GET', 'path': f'/media/{media.content_hash}',
+                       'headers': [(b'range', b'bytes=10-19')], 'extensions': {'http.response.zerocopysend': {}},
+                       'path_params': {'content_hash': media.content_hash}}
+        from prayer_of_hannah.media.serve import media_app
+        await media_app(scope, receive, send)
+
+    asyncio.run(run())
+    assert sent[1]['type'] == 'http.response.zerocopysend', "The file is handed to the server"
+    assert sent[1]['body'] == AUDIO[10:20]
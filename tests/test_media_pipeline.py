@@ -0,0 +1,199 @@
+from dbms import Dbms
+
+from models import MediaType, Song_Book, Song, Song_Book_Item, Media, Media_Job, Media_Variant
+import prayer_of_hannah
+from prayer_of_hannah import create_app
+from prayer_of_hannah.live_worship import slides
+from prayer_of_hannah.live_worship.slides import MEDIA_URL, forget_backgrounds, item_background
+from prayer_of_hannah.media import store
+from prayer_of_hannah.media import pipeline as media_pipeline
+from prayer_of_hannah.media.pipeline import VARIANTS, Job, MediaPipeline, best_variant, fit_within
+from config import Config
+from sqlmodel import Session, select
+import io
+from datetime import datetime, timedelta
+import shutil
+import pytest
+import pathlib as pl
+
+PICTURE: bytes = b'not really a picture ' * 100
+
+
+@pytest.fixture
+def db(tmp_path: pl.Path, monkeypatch: pytest.MonkeyPatch) -> Dbms:
+    file: str = str(tmp_path / "pipeline_test.sqlite")
+    dbase = Dbms(False, 'sqlite:///' + file, file)
+    dbase.create_database_structure()
+    with dbase.write_session() as session:
+        book: Song_Book = Song_Book(code="StF", name="Singing the Faith")
+        session.add(Song_Book_Item(song_book=book, song=Song(title="And Can It Be", authors=[]), nbr=345, verse_order=""))
+        session.add(Song_Book_Item(song_book=book, song=Song(title="O For A Thousand Tongues", authors=[]), nbr=364,
+                                   verse_order=""))
+        session.commit()
+    monkeypatch.setattr(prayer_of_hannah, "__DB", dbase)
+    monkeypatch.setattr(prayer_of_hannah, "__DBE", dbase.engine)
+    monkeypatch.setattr(Config, "MEDIA_DIR", str(tmp_path / "media"))
+    forget_backgrounds()
+    return dbase
+
+
+@pytest.fixture
+def pipeline(db: Dbms):
+    pipeline = MediaPipeline(db, max_workers=1)
+    yield pipeline
+    pipeline.shutdown()
+
+
+def add(db: Dbms, tmp_path: pl.Path, song_book_item_id: int, media_type: MediaType, name: str, content: bytes) -> Media:
+    path: pl.Path = tmp_path / name
+    path.write_bytes(content)
+    with db.write_session() as session:
+        return store.add_media(session, song_book_item_id, media_type, str(path))
+
+
+def test_fit_within() -> None:
+    assert fit_within(3840, 2160, 1920, 1080) == (1920, 1080)
+    assert fit_within(1000, 1000, 1920, 1080) == (1000, 1000), "Never scaled up"
+    assert fit_within(4000, 3000, 1920, 1080) == (1440, 1080), "The aspect ratio is kept"
+    assert fit_within(1001, 333, 640, 360) == (640, 212), "Sizes are even"
+
+
+def test_best_variant() -> None:
+    variants: list[Media_Variant] = [Media_Variant(variant=s.name, width=s.width, height=s.height) for s in VARIANTS]
+    assert best_variant(variants, 1920, 1080).variant == 'projector'
+    assert best_variant(variants, 1280, 800).variant == 'tablet'
+    assert best_variant(variants, 640, 360).variant == 'low'
+    assert best_variant(variants, 412, 915).variant == 'projector', "The smallest that covers the screen"
+    assert best_variant(variants, 3840, 2160).variant == 'projector', "Else the largest"
+    assert best_variant(variants[-1:], 320, 180) is None, "Thumbnails are not backgrounds"
+
+
+def test_only_images_and_videos(db: Dbms, pipeline: MediaPipeline, tmp_path: pl.Path) -> None:
+    audio: Media = add(db, tmp_path, 1, MediaType.AUDIO, "sagina.mp3", b'audio')
+    with pytest.raises(LookupError):
+        pipeline.submit(audio.id)
+    with pytest.raises(LookupError):
+        pipeline.submit(999)
+
+
+@pytest.mark.skipif(shutil.which('ffmpeg') is not None, reason="ffmpeg is installed")
+def test_missing_tool_fails_the_job(db: Dbms, pipeline: MediaPipeline, tmp_path: pl.Path) -> None:
+    video: Media = add(db, tmp_path, 1, MediaType.BACKGROUND_VIDEO, "clouds.mp4", b'video')
+    job = pipeline.wait(pipeline.submit(video.id), timeout=30)
+    assert job.status == 'failed'
+    assert job.progress == 1.0
+    assert len(job.errors) == len(VARIANTS) and "ffmpeg" in job.errors[0]
+
+
+def test_variants_reused_for_the_same_content(db: Dbms, pipeline: MediaPipeline, tmp_path: pl.Path) -> None:
+    first: Media = add(db, tmp_path, 1, MediaType.BACKGROUND_IMAGE, "cross.jpg", PICTURE)
+    with db.write_session() as session:
+        for spec in VARIANTS:
+            content_hash, size = store.store_stream(io.BytesIO(spec.name.encode()))
+            session.add(Media_Variant(media_id=first.id, variant=spec.name, width=spec.width, height=spec.height,
+                                      content_hash=content_hash, size=size, mime_type='image/jpeg'))
+        session.commit()
+
+    second: Media = add(db, tmp_path, 2, MediaType.BACKGROUND_IMAGE, "cross-copy.jpg", PICTURE)
+    assert second.content_hash == first.content_hash
+    job = pipeline.wait(pipeline.submit(second.id), timeout=30)
+    assert job.as_dict() == {'id': job.id, 'media_id': second.id, 'status': 'done', 'progress': 1.0,
+                             'done': len(VARIANTS), 'failed': 0, 'total': len(VARIANTS), 'errors': []}
+    assert not job.futures, "Nothing was processed again"
+    with Session(db.engine) as session:
+        copied = session.exec(select(Media_Variant).where(Media_Variant.media_id == second.id)).all()
+        assert {v.variant for v in copied} == {s.name for s in VARIANTS}
+
+    # slides show the variant that fits the view's screen
+    projector = next(v for v in copied if v.variant == 'projector')
+    item: dict = {'background': second.content_hash, 'background_video': False}
+    assert item_background(item, 'projector') == {'url': MEDIA_URL + projector.content_hash, 'video': False}
+    assert item_background({'background': None}, 'projector') is None
+
+    # and the variants are served like any other media
+    client = create_app().test_client()
+    response = client.get(f"/media/{projector.content_hash}")
+    assert response.status_code == 200 and response.data == b'projector'
+
+
+def test_finished_jobs_forgotten(db: Dbms) -> None:
+    pipeline = MediaPipeline(db, job_ttl=60, max_jobs=3)
+    now: datetime = datetime.now()
+    with db.write_session() as session:
+        session.add_all([Media_Job(media_id=1, total=1, done=1, finished=now - timedelta(seconds=120)),
+                         Media_Job(media_id=1, total=1),
+                         Media_Job(media_id=1, total=1, failed=1, finished=now - timedelta(seconds=30)),
+                         Media_Job(media_id=1, total=1, done=1, finished=now)])
+        session.commit()
+    assert pipeline.job(1) is None, "Finished longer ago than the ttl"
+    assert pipeline.job(2).status == 'queued' and pipeline.job(3).status == 'failed'
+    # room for a new job
+    with db.write_session() as session:
+        pipeline._forget_jobs(session, room=1)
+        session.commit()
+    with Session(db.engine) as session:
+        assert session.exec(select(Media_Job.id)).all() == [2, 4], \
+            "The oldest finished job makes room, running ones are kept"
+
+
+def test_jobs_polled_from_another_worker(db: Dbms, pipeline: MediaPipeline, tmp_path: pl.Path) -> None:
+    media: Media = add(db, tmp_path, 1, MediaType.BACKGROUND_IMAGE, "cross.jpg", PICTURE)
+    # another worker process, with its own connection to the database
+    other: Dbms = Dbms(False, db.SQLALCHEMY_DATABASE_URI, db.database_file)
+    try:
+        first = pipeline.submit(media.id)
+        second = pipeline.submit(media.id)
+        assert first.id != second.id, "Every worker numbers jobs from the database"
+        pipeline.wait(first, timeout=30)
+        pipeline.wait(second, timeout=30)
+        polled = MediaPipeline(other).job(first.id)
+        assert polled is not None and polled.as_dict() == first.as_dict()
+        assert not pipeline.jobs and not pipeline.busy, "Only running jobs are kept in memory"
+    finally:
+        other.close()
+
+
+def test_backgrounds_follow_other_workers(db: Dbms, tmp_path: pl.Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    media: Media = add(db, tmp_path, 1, MediaType.BACKGROUND_IMAGE, "cross.jpg", PICTURE)
+    item: dict = {'background': media.content_hash, 'background_video': False}
+    assert item_background(item, 'projector') == {'url': MEDIA_URL + media.content_hash, 'video': False}
+
+    # another worker makes the variant, this one's cache isn't told
+    monkeypatch.setattr(slides, "BACKGROUND_CHECK_SECONDS", 0.0)
+    with db.write_session() as session:
+        session.add(Media_Variant(media_id=media.id, variant='projector', width=1920, height=1080,
+                                  content_hash='f' * 64, size=1, mime_type='image/jpeg'))
+        session.commit()
+    assert item_background(item, 'projector') == {'url': MEDIA_URL + 'f' * 64, 'video': False}
+
+
+def test_pool_shared_by_pipelines(db: Dbms, monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(media_pipeline, "_executor", None)
+    first, second = MediaPipeline(db), MediaPipeline(db)
+    try:
+        assert first.executor is second.executor
+        first.jobs = {1: Job(1, 1, 1)}
+        first.shutdown()
+        assert not first.jobs and media_pipeline._executor is second.executor, "The worker's pool carries on"
+    finally:
+        media_pipeline.shutdown_worker_executor()
+    assert media_pipeline._executor is None
+
+
+def test_process_route(db: Dbms, tmp_path: pl.Path) -> None:
+    audio: Media = add(db, tmp_path, 1, MediaType.AUDIO, "sagina.mp3", b'audio')
+    client = create_app().test_client()
+    assert client.post(f"/media/{audio.id}/process").status_code == 404
+    assert client.get("/media/jobs/999").status_code == 404
+
+
+def test_image_variants(db: Dbms, pipeline: MediaPipeline, tmp_path: pl.Path) -> None:
+    Image = pytest.importorskip("PIL.Image")
+    path: pl.Path = tmp_path / "sunrise.png"
+    Image.new('RGB', (2400, 1600), (200, 120, 40)).save(path)
+    media: Media = add(db, tmp_path, 1, MediaType.BACKGROUND_IMAGE, "sunrise.png", path.read_bytes())
+    job = pipeline.wait(pipeline.submit(media.id), timeout=60)
+    assert job.status == 'done', job.errors
+    with Session(db.engine) as session:
+        sizes = {v.variant: (v.width, v.height) for v in session.get(Media, media.id).variants}
+    assert sizes == {'projector': (1620, 1080), 'tablet': (1200, 800), 'low': (540, 360), 'thumbnail': (270, 180)}
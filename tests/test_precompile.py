@@ -0,0 +1,28 @@
+from config import Config
+from prayer_of_hannah import create_app, precompile
+import pathlib as pl
+
+
+def test_precompile(tmp_path: pl.Path) -> None:
+    class CacheConfig(Config):
+        TEMPLATE_CACHE_DIR = str(tmp_path / "template_cache")
+
+    names: list[str] = precompile.precompile(create_app(CacheConfig))
+    assert {'base.html', '_navigation.html', 'songs/songs.html', 'live_worship/slides/projector.html'} <= set(names)
+    assert len(list((tmp_path / "template_cache").iterdir())) == len(names)
+
+    # a new worker loads the bytecode instead of compiling
+    app = create_app(CacheConfig)
+
+    def compile(*args, **kwargs):
+        raise AssertionError("compiled again")
+    app.jinja_env.compile = compile  # type: ignore[method-assign]
+    with app.test_request_context():
+        assert app.jinja_env.get_template('base.html').render(active_page='songs')
+
+
+def test_no_cache(tmp_path: pl.Path) -> None:
+    class NoCacheConfig(Config):
+        TEMPLATE_CACHE_DIR = ''
+
+    assert create_app(NoCacheConfig).jinja_env.bytecode_cache is None
@@ -0,0 +1,102 @@
+from dbms import Dbms
+
+from models import VerseType, Song_Book, Song, Song_Book_Item, Verse, Service, Service_Item
+import prayer_of_hannah
+from prayer_of_hannah import create_app
+from prayer_of_hannah.live_worship import presenter, slides
+from prayer_of_hannah.live_worship import broadcast
+from prayer_of_hannah.live_worship.broadcast import Broadcaster, EventStore, broadcaster
+from prayer_of_hannah.live_worship.slides import SlideCache
+import json
+import threading
+import time
+import pytest
+import pathlib as pl
+
+
+@pytest.fixture
+def db(tmp_path: pl.Path, monkeypatch: pytest.MonkeyPatch) -> Dbms:
+    file: str = str(tmp_path / "presenter_test.sqlite")
+    dbase = Dbms(False, 'sqlite:///' + file, file)
+    dbase.create_database_structure()
+    with dbase.write_session() as session:
+        item: Song_Book_Item = Song_Book_Item(song_book=Song_Book(code="StF", name="Singing the Faith"),
+                                              song=Song(title="Be Thou My Vision", authors=[]), nbr=545, verse_order="")
+        session.add_all([Verse(type=VerseType.VERSE, number=n, lyrics=f"Verse {n}", song_book_item=item)
+                         for n in range(1, 11)])
+        service: Service = Service(name="Sunday Morning")
+        session.add_all([service, Service_Item(service=service, position=1, song_book_item=item)])
+        session.commit()
+    monkeypatch.setattr(prayer_of_hannah, "__DB", dbase)
+    monkeypatch.setattr(prayer_of_hannah, "__DBE", dbase.engine)
+    monkeypatch.setattr(slides, "_slide_cache", SlideCache())
+    yield dbase
+    broadcaster.close(1)
+
+
+def test_window_buffers_k_either_side(db: Dbms) -> None:
+    client = create_app().test_client()
+    deck_hash: str = client.post('/services/1/finalise').json['hash']
+
+    window: dict = client.get(f'/live/decks/{deck_hash}/window?index=5&k=2&view=large_print').json
+    assert window['count'] == 10
+    assert sorted(int(i) for i in window['slides']) == [3, 4, 5, 6, 7]
+    assert "Verse 6" in window['slides']['5']
+
+    response = client.get(f'/live/decks/{deck_hash}/window?index=0')
+    assert sorted(int(i) for i in response.json['slides']) == [0, 1, 2, 3], "Clipped at the start of the deck"
+    assert 'immutable' in response.headers['Cache-Control']
+    assert client.get('/live/decks/nope/window').status_code == 404
+
+
+def test_slide_confirms_and_broadcasts_position(db: Dbms) -> None:
+    client = create_app().test_client()
+    assert client.post('/live/1/slide', json={'index': 1}).status_code == 404, "Not finalised"
+    deck_hash: str = client.post('/services/1/finalise').json['hash']
+    assert client.get('/live/1/position').json == {'index': None, 'hash': deck_hash, 'count': 10, 'id': 0}
+
+    confirmed: dict = client.post('/live/1/slide', json={'index': 4, 'hash': deck_hash}).json
+    assert confirmed['index'] == 4 and confirmed['hash'] == deck_hash
+    event = broadcaster.channel(1).since(confirmed['id'] - 1)[0]
+    assert json.loads(event.data) == {'index': 4, 'hash': deck_hash, 'count': 10}, "Displays get the position and deck"
+    assert client.get('/live/1/position').json['index'] == 4
+
+    assert client.post('/live/1/slide', json={'index': 99}).json['index'] == 9, "Clamped to the deck"
+    response = client.post('/live/1/slide', json={'index': 2, 'hash': "old"})
+    assert response.status_code == 409
+    assert response.json['hash'] == deck_hash, "A client with an old deck is told the new one"
+
+    client.post('/live/1/end')
+    assert presenter.position(1) is None
+
+
+def test_workers_share_positions_and_events(db: Dbms, monkeypatch: pytest.MonkeyPatch) -> None:
+    # two worker processes, each with its own broadcaster on the same database
+    operator, display = Broadcaster(store=EventStore(db)), Broadcaster(store=EventStore(db))
+    try:
+        channel = display.channel(1)
+        assert display.poll() == 0, "Nothing read while no one is watching"
+        client = create_app().test_client()
+        deck_hash: str = client.post('/services/1/finalise').json['hash']
+        monkeypatch.setattr(broadcast, "broadcaster", operator)
+        confirmed: dict = client.post('/live/1/slide', json={'index': 3, 'hash': deck_hash}).json
+
+        # the other worker's display is waiting on its channel
+        waiting = threading.Thread(target=channel.wait, args=(0, 5))
+        waiting.start()
+        while channel.subscribers == 0:
+            time.sleep(0.001)
+        assert display.poll() == 1
+        waiting.join()
+        assert [e.id for e in channel.since(0)] == [confirmed['id']], "A display resuming from before the gap starts again"
+        assert json.loads(channel.since(0)[0].data)['index'] == 3
+
+        monkeypatch.setattr(broadcast, "broadcaster", display)
+        assert client.get('/live/1/position').json == confirmed, "Any worker knows where the service is"
+        assert client.post('/live/1/slide', json={'index': 4, 'hash': deck_hash}).json['id'] == confirmed['id'] + 1
+        client.post('/live/1/end')
+        monkeypatch.setattr(broadcast, "broadcaster", operator)
+        assert presenter.position(1) is None, "Ended for every worker"
+    finally:
+        operator.shutdown()
+        display.shutdown()
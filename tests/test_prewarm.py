@@ -0,0 +1,182 @@
+from dbms import Dbms
+
+from models import VerseType, Song_Book, Song, Song_Book_Item, Verse, Service, Service_Item, Slide_Deck
+import prayer_of_hannah
+from prayer_of_hannah import create_app
+from prayer_of_hannah.live_worship import slides
+from prayer_of_hannah.live_worship.slides import SlideCache
+from prayer_of_hannah.services import prewarm
+from prayer_of_hannah.services.decks import DeckError, finalise_service
+from sqlmodel import Session, select
+from datetime import datetime, timedelta
+import pytest
+import pathlib as pl
+
+
+@pytest.fixture
+def cache(monkeypatch: pytest.MonkeyPatch) -> SlideCache:
+    slide_cache: SlideCache = SlideCache(max_entries=8)
+    monkeypatch.setattr(slides, "_slide_cache", slide_cache)
+    return slide_cache
+
+
+@pytest.fixture
+def db(tmp_path: pl.Path, monkeypatch: pytest.MonkeyPatch) -> Dbms:
+    file: str = str(tmp_path / "prewarm_test.sqlite")
+    dbase = Dbms(False, 'sqlite:///' + file, file)
+    dbase.create_database_structure()
+    with dbase.write_session() as session:
+        book: Song_Book = Song_Book(code="StF", name="Singing the Faith")
+        item: Song_Book_Item = Song_Book_Item(song_book=book, song=Song(title="And Can It Be", authors=[]),
+                                              nbr=345, verse_order="v1 c1 v2 c1")
+        session.add_all([
+            Verse(type=VerseType.VERSE, number=1, lyrics="And can it be<br>that I should gain", song_book_item=item),
+            Verse(type=VerseType.CHORUS, number=1, lyrics="Amazing love!<br>How can it be", song_book_item=item),
+            Verse(type=VerseType.VERSE, number=2, lyrics="Long my imprisoned spirit lay", song_book_item=item),
+        ])
+        soon: Service = Service(name="Sunday Morning", start=datetime(2024, 6, 2, 10, 30))
+        later: Service = Service(name="Sunday Evening", start=datetime(2024, 6, 2, 18, 30))
+        session.add_all([soon, later, Service_Item(service=soon, position=1, song_book_item=item),
+                         Service_Item(service=later, position=1, song_book_item=item)])
+        session.commit()
+    monkeypatch.setattr(prayer_of_hannah, "__DB", dbase)
+    monkeypatch.setattr(prayer_of_hannah, "__DBE", dbase.engine)
+    return dbase
+
+
+def test_pinned_slides_are_not_evicted() -> None:
+    cache: SlideCache = SlideCache(max_entries=2)
+    cache.put(("a", 0, "projector"), "a0")
+    cache.put(("a", 1, "projector"), "a1")
+    cache.pin(1, "a", [("a", 0, "projector"), ("a", 1, "projector")])
+    for index in range(5):
+        cache.put(("b", index, "projector"), f"b{index}")
+
+    assert cache.get(("a", 0, "projector")) == "a0", "Pinned entries survive"
+    assert cache.get(("b", 0, "projector")) is None, "Unpinned entries are evicted first"
+    assert cache.get(("b", 4, "projector")) == "b4"
+    assert cache.service_deck(1) == "a"
+
+    cache.unpin(1)
+    assert len(cache) == 2, "Unpinning lets the cache shrink back to its limit"
+    assert cache.service_deck(1) is None
+
+
+def finalise(db: Dbms, service_id: int) -> str:
+    with db.write_session() as session:
+        return finalise_service(session, service_id).content_hash
+
+
+def test_prewarm_renders_and_pins(db: Dbms, cache: SlideCache) -> None:
+    finalise(db, 1)
+    warmed = prewarm.prewarm_service(create_app(), db, 1)
+    assert warmed.slides == 4
+    views: int = len(slides.VIEWS)
+    assert warmed.rendered == 4 * views, "Every slide in every view"
+    assert cache.misses == 4 * views and len(cache) == 4 * views
+    assert cache.service_deck(1) == warmed.deck_hash
+    assert all(cache.is_pinned((warmed.deck_hash, i, "projector")) for i in range(4))
+
+    again = prewarm.prewarm_service(create_app(), db, 1)
+    assert again.rendered == 0, "Already rendered slides are reused"
+
+    client = create_app().test_client()
+    hits: int = cache.hits
+    response = client.get('/live/1/slides/1')
+    assert response.status_code == 200
+    assert b"Amazing love!" in response.data
+    assert cache.hits == hits + 1, "A pre-warmed slide is served from the cache"
+    assert client.get('/live/1/slides/4').status_code == 404
+    assert client.get('/live/1/slides/1?view=nope').status_code == 404
+
+    client.post('/live/1/end')
+    assert cache.pinned_services() == []
+
+
+def test_prewarmer_follows_start_times(db: Dbms, cache: SlideCache) -> None:
+    prewarmer = prewarm.Prewarmer(create_app(), db, cache=cache)
+    finalise(db, 1)
+    finalise(db, 2)
+    assert prewarmer.check(datetime(2024, 6, 2, 9, 0)) == [], "Nothing starts within the next half hour"
+
+    warmed = prewarmer.check(datetime(2024, 6, 2, 10, 15))
+    assert [w.service_id for w in warmed] == [1]
+    assert prewarmer.check(datetime(2024, 6, 2, 10, 45)) == [], "Already pre-warmed"
+    assert cache.pinned_services() == [1]
+
+    warmed = prewarmer.check(datetime(2024, 6, 2, 18, 0) + timedelta(minutes=5))
+    assert [w.service_id for w in warmed] == [2]
+    assert cache.pinned_services() == [2], "The morning service is over so is unpinned"
+
+
+def test_prewarmer_never_finalises(db: Dbms, cache: SlideCache) -> None:
+    prewarmer = prewarm.Prewarmer(create_app(), db, cache=cache)
+    assert prewarmer.check(datetime(2024, 6, 2, 10, 15)) == [], "Not finalised so nothing to warm"
+    with pytest.raises(DeckError):
+        prewarm.prewarm_service(create_app(), db, 1)
+    with Session(db.engine) as session:
+        assert session.exec(select(Slide_Deck)).all() == [], "No deck nobody asked for"
+
+    first: str = finalise(db, 1)
+    assert [w.deck_hash for w in prewarmer.check(datetime(2024, 6, 2, 10, 15))] == [first]
+    with db.write_session() as session:
+        verse: Verse | None = session.get(Verse, 3)
+        assert verse is not None
+        verse.lyrics = "Long my imprisoned spirit lay fast bound"
+        session.commit()
+    assert prewarmer.check(datetime(2024, 6, 2, 10, 20)) == [], "Changes aren't shown until finalised"
+    second: str = finalise(db, 1)
+    assert [w.deck_hash for w in prewarmer.check(datetime(2024, 6, 2, 10, 25))] == [second]
+    assert cache.service_deck(1) == second
+
+
+def test_slide_of_finalised_service_without_prewarm(db: Dbms, cache: SlideCache) -> None:
+    client = create_app().test_client()
+    assert client.get('/live/2/slides/0').status_code == 404, "Not finalised yet"
+    assert client.post('/services/2/finalise').status_code == 200
+    response = client.get('/live/2/slides/0')
+    assert b"And can it be" in response.data
+    assert cache.pinned_services() == []
+
+
+def test_all_views_rendered_in_one_pass(db: Dbms, cache: SlideCache) -> None:
+    client = create_app().test_client()
+    client.post('/services/1/finalise')
+    response = client.get('/live/1/slides/0?view=confidence')
+    assert b"And can it be" in response.data
+    assert b"Amazing love!" in response.data, "The confidence monitor previews the next slide"
+    assert len(cache) == len(slides.VIEWS), "The other views were rendered in the same pass"
+
+    for view in slides.VIEWS:
+        assert client.get(f'/live/1/slides/0?view={view}').status_code == 200
+    assert cache.misses == 1, "Every other screen picks its view from the cache"
+    assert b"End of service" in client.get('/live/1/slides/3?view=confidence').data
+
+
+def test_slide_text_escaped(db: Dbms, cache: SlideCache) -> None:
+    with db.write_session() as session:
+        verse: Verse | None = session.get(Verse, 3)
+        assert verse is not None
+        verse.lyrics = "Long my <imprisoned> spirit lay<br><script>alert(1)</script>"
+        session.commit()
+    client = create_app().test_client()
+    client.post('/services/1/finalise')
+    for view in slides.VIEWS:
+        page: str = client.get(f'/live/1/slides/1?view={view}').get_data(as_text=True)
+        assert "<script>" not in page and "<imprisoned>" not in page, view
+    assert "&lt;script&gt;" in client.get('/live/1/slides/2?view=projector').get_data(as_text=True)
+
+
+def test_prewarmer_started_by_first_request(db: Dbms, cache: SlideCache) -> None:
+    app = create_app()
+    assert 'prewarmer' not in app.extensions
+    client = app.test_client()
+    client.get('/')
+    prewarmer: prewarm.Prewarmer = app.extensions['prewarmer']
+    try:
+        assert prewarmer.is_alive() and prewarmer.db is db and prewarmer.cache is cache
+        client.get('/')
+        assert app.extensions['prewarmer'] is prewarmer, "One per worker"
+    finally:
+        prewarm.stop_prewarmer(app)
+    assert 'prewarmer' not in app.extensions
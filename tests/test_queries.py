@@ -0,0 +1,75 @@
+from dbms import Dbms
+
+from models import VerseType, Author, Song_Book, Song, Song_Book_Item, Verse
+import prayer_of_hannah
+from prayer_of_hannah import create_app, queries
+from sqlmodel import Session
+import asyncio
+import pytest
+import pathlib as pl
+
+
+@pytest.fixture
+def db(tmp_path: pl.Path) -> Dbms:
+    file: str = str(tmp_path / "queries_test.sqlite")
+    dbase = Dbms(False, 'sqlite:///' + file, file)
+    dbase.create_database_structure()
+    with dbase.write_session() as session:
+        song_book: Song_Book = Song_Book(code="StF", name="Singing the Faith")
+        wesley: Song = Song(title="And Can It Be", authors=[Author(surname="Wesley", first_names="Charles")])
+        watts: Song = Song(title="When I Survey", authors=[Author(surname="Watts", first_names="Isaac")])
+        item: Song_Book_Item = Song_Book_Item(song_book=song_book, song=wesley, nbr=345, verse_order="v1 c1")
+        session.add_all([song_book, wesley, watts, item,
+                         Verse(type=VerseType.CHORUS, number=1, lyrics="Amazing love!", song_book_item=item),
+                         Verse(type=VerseType.VERSE, number=1, lyrics="And can it be that I should gain", song_book_item=item)])
+        session.commit()
+    return dbase
+
+
+def test_catalog(db: Dbms) -> None:
+    with Session(db.engine) as session:
+        songs = queries.song_catalog(session)
+    titles: list[str] = [s.title for s in songs]
+    assert titles == ["And Can It Be", "When I Survey"], f"Catalog is {titles}"
+    # eager loaded so usable after the session has closed
+    assert songs[0].authors[0].surname == "Wesley"
+    assert songs[0].song_book_items[0].song_book.code == "StF"
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("survey", ["When I Survey"]),
+    ("WESLEY", ["And Can It Be"]),
+    ("amazing love", ["And Can It Be"]),
+    ("no such song", []),
+])
+def test_search(db: Dbms, text: str, expected: list[str]) -> None:
+    with Session(db.engine) as session:
+        assert [s.title for s in queries.search_songs(session, text)] == expected
+
+
+def test_async_song_book_item(db: Dbms) -> None:
+    async def item() -> Song_Book_Item | None:
+        async with db.async_session() as session:
+            return await queries.async_song_book_item(session, 1)
+
+    result: Song_Book_Item | None = asyncio.run(item())
+    assert result is not None
+    assert result.song.title == "And Can It Be"
+    assert sorted(v.lyrics for v in result.verses) == ["Amazing love!", "And can it be that I should gain"]
+
+
+def test_item_lyrics_escaped(db: Dbms, monkeypatch: pytest.MonkeyPatch) -> None:
+    with db.write_session() as session:
+        session.add(Verse(type=VerseType.VERSE, number=2, lyrics="<script>alert(1)</script><br>1 < 2",
+                          song_book_item_id=1))
+        session.commit()
+    monkeypatch.setattr(prayer_of_hannah, "__DB", db)
+    monkeypatch.setattr(prayer_of_hannah, "__DBE", db.engine)
+    page: str = create_app().test_client().get('/live/htmx/item/1').get_data(as_text=True)
+    assert "<script>" not in page
+    assert "&lt;script&gt;alert(1)&lt;/script&gt;<br>1 &lt; 2" in page, "Escaped, with the line breaks kept"
+
+
+def test_in_memory_has_no_async_engine() -> None:
+    with pytest.raises(ValueError):
+        Dbms(True).async_engine
@@ -0,0 +1,108 @@
+from dbms import Dbms
+
+from models import Song
+import prayer_of_hannah
+from config import Config
+from prayer_of_hannah import create_app
+from prayer_of_hannah.live_worship import slides
+from prayer_of_hannah.live_worship.slides import SlideCache, cached_slide
+from prayer_of_hannah.shared_cache import SharedCache, database_version, shared_cache
+import multiprocessing
+import pytest
+import pathlib as pl
+
+
+@pytest.fixture
+def cache(tmp_path: pl.Path) -> SharedCache:
+    return SharedCache(str(tmp_path / "shared.cache"), max_bytes=10_000)
+
+
+def test_versioned(cache: SharedCache) -> None:
+    assert cache.put('songs', 'list', b'<v1>', 1)
+    cache.put('slides', 'deck/0/projector', b'<slide>')
+    assert cache.get('songs', 'list', 1) == b'<v1>'
+    # a worker that has seen a write doesn't get the old page
+    assert cache.get('songs', 'list', 2) is None
+
+    assert cache.put('songs', 'other', b'<v2>', 2)
+    # one that hasn't still can't store its page from before the write
+    assert not cache.put('songs', 'list', b'<v1 again>', 1)
+    assert cache.get('songs', 'list', 1) is None
+    assert cache.status()['entries'] == 2 and cache.status()['version'] == 2
+    # things named by their content never go stale
+    assert cache.get('slides', 'deck/0/projector') == b'<slide>'
+
+    # each tenant's database has its own versions
+    tenant = SharedCache(cache.path, cache.max_bytes, 'stf')
+    assert tenant.put('songs', 'list', b'<stf v1>', 1) and tenant.get('songs', 'list', 1) == b'<stf v1>'
+    assert cache.get('songs', 'list', 1) is None and cache.get('songs', 'other', 2) == b'<v2>'
+    cache.invalidate(3)
+    assert cache.get('songs', 'other', 2) is None and tenant.get('songs', 'list', 1) == b'<stf v1>'
+
+
+def test_size_limit(cache: SharedCache) -> None:
+    for n in range(30):
+        cache.put('slides', f'{n}', bytes(1000))
+    status: dict = cache.status()
+    assert status['file_bytes'] == status['bytes'] <= cache.max_bytes
+    # the least recently used went first
+    assert cache.get('slides', '0') is None and cache.get('slides', '29') is not None
+    # a value over its share of the cache is not stored
+    assert not cache.put('slides', 'huge', bytes(2000)) and cache.get('slides', 'huge') is None
+
+
+def _store(path: str) -> None:
+    SharedCache(path).put('slides', 'from another worker', b'<rendered once>')
+
+
+def test_shared_between_processes(cache: SharedCache) -> None:
+    cache.get('slides', 'from another worker')
+    process = multiprocessing.get_context('fork').Process(target=_store, args=(cache.path,))
+    process.start()
+    process.join()
+    assert process.exitcode == 0
+    assert cache.get('slides', 'from another worker') == b'<rendered once>'
+
+
+@pytest.fixture
+def shared(tmp_path: pl.Path, monkeypatch: pytest.MonkeyPatch) -> SharedCache:
+    monkeypatch.setattr(Config, "SHARED_CACHE_FILE", str(tmp_path / "shared.cache"))
+    monkeypatch.setattr(prayer_of_hannah.shared_cache, "_shared_cache", None)
+    found: SharedCache | None = shared_cache()
+    assert found is not None
+    return found
+
+
+def test_slides_rendered_once(shared: SharedCache, monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(slides, "_slide_cache", SlideCache())
+    shared.put(slides.SHARED_NAMESPACE, 'abc/0/projector', '<p>Alleluia ✝</p>'.encode('utf-8'))
+
+    def render(*args, **kwargs):
+        raise AssertionError("Another worker has rendered this slide")
+    monkeypatch.setattr(slides, "render_views", render)
+    assert cached_slide('abc', {}, 0, 'projector') == '<p>Alleluia ✝</p>'
+    assert slides.slide_cache().get(('abc', 0, 'projector')) == '<p>Alleluia ✝</p>'
+
+
+def test_catalog_pages(shared: SharedCache, tmp_path: pl.Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    file: str = str(tmp_path / "shared_test.sqlite")
+    db = Dbms(False, 'sqlite:///' + file, file)
+    db.create_database_structure()
+    with db.write_session() as session:
+        session.add(Song(title="Amazing grace", authors=[]))
+        session.commit()
+    monkeypatch.setattr(prayer_of_hannah, "__DB", db)
+    monkeypatch.setattr(prayer_of_hannah, "__DBE", db.engine)
+    client = create_app().test_client()
+
+    first = client.get('/songs/htmx/songs')
+    assert 'Amazing grace' in first.get_data(as_text=True)
+    assert shared.get('songs', 'songs', database_version(db.engine)) == first.get_data()
+    hits: int = shared.hits
+    assert client.get('/songs/htmx/songs').get_data() == first.get_data() and shared.hits == hits + 1
+
+    with db.write_session() as session:
+        session.add(Song(title="Be thou my vision", authors=[]))
+        session.commit()
+    assert 'Be thou my vision' in client.get('/songs/htmx/songs').get_data(as_text=True)
+    db.close()
@@ -0,0 +1,111 @@
+from dbms import Dbms
+
+from models import VerseType, Author, Song_Book, Song, Song_Book_Item, Verse, Media, MediaType, Service, Slide_Deck
+from prayer_of_hannah.snapshot import MAGIC, SnapshotError, _Strings, decode_column, encode_column, load_snapshot, read_snapshot, write_snapshot
+from sqlmodel import Session, select
+import struct
+import pytest
+import pathlib as pl
+
+
+def new_db(path: pl.Path) -> Dbms:
+    return Dbms(False, 'sqlite:///' + str(path), str(path))
+
+
+@pytest.fixture
+def db(tmp_path: pl.Path) -> Dbms:
+    dbase = new_db(tmp_path / "snapshot_test.sqlite")
+    dbase.create_database_structure()
+    with dbase.write_session() as session:
+        stf: Song_Book = Song_Book(code="StF", name="Singing the Faith", url="https://example.org/stf")
+        hp: Song_Book = Song_Book(code="H+P", name="Hymns and Psalms")
+        wesley: Author = Author(surname="Wesley", first_names="Charles")
+        for n in range(50):
+            song: Song = Song(title=f"Hymn {n:03} – ünïcode", authors=[wesley])
+            for book, nbr, order in ((stf, n + 1, "v1 c1 v2"), (hp, n + 100, "")):
+                item: Song_Book_Item = Song_Book_Item(song_book=book, song=song, nbr=nbr, verse_order=order)
+                # the same lyrics in both books
+                session.add_all([Verse(type=VerseType.VERSE, number=1, lyrics=f"First verse of {n}<br>line two", song_book_item=item),
+                                 Verse(type=VerseType.CHORUS, number=1, lyrics="Alleluia!", song_book_item=item)])
+            if n == 0:
+                session.add(Media(song_book_item=item, type=MediaType.AUDIO, content_hash="ab" * 32, size=123,
+                                  mime_type="audio/mpeg", file_name="hymn.mp3"))
+        service: Service = Service(name="Sunday Morning")
+        session.add(service)
+        session.flush()
+        session.add(Slide_Deck(service_id=service.id, version=1, content_hash="cd" * 32, bundle=b'\x00{"slides": []}\xff'))
+        session.commit()
+    # a deleted row leaves its change_log entry
+    with dbase.write_session() as session:
+        session.delete(session.exec(select(Verse)).first())
+        session.commit()
+    return dbase
+
+
+def dump(db: Dbms) -> dict[str, list[tuple]]:
+    """Every row of every table, and the schema"""
+    raw = db.write_engine.raw_connection()
+    try:
+        con = raw.driver_connection
+        names: list[str] = [n for (n,) in con.execute("SELECT name FROM sqlite_master WHERE type = 'table' ORDER BY name")]
+        found: dict[str, list[tuple]] = {name: con.execute(f'SELECT * FROM "{name}" ORDER BY rowid').fetchall()
+                                         for name in names if not name.startswith('sqlite_')}
+        found['schema'] = con.execute("SELECT type, name, tbl_name FROM sqlite_master "
+                                      "WHERE name NOT LIKE 'sqlite_%' ORDER BY name").fetchall()
+        return found
+    finally:
+        raw.close()
+
+
+def test_round_trip(db: Dbms, tmp_path: pl.Path) -> None:
+    path: str = str(tmp_path / "library.snapshot")
+    header: dict = write_snapshot(db, path)
+    assert header['version'] == max(r[0] for r in dump(db)['change_log'])
+
+    for copy in (new_db(tmp_path / "copy.sqlite"), Dbms(True)):
+        assert load_snapshot(copy, path)['version'] == header['version']
+        assert dump(copy) == dump(db)
+        # the triggers are back, writes carry on from the snapshot's version
+        with copy.write_session() as session:
+            session.add(Song(title="A new song", authors=[]))
+            session.commit()
+        assert max(r[0] for r in dump(copy)['change_log']) == header['version'] + 1
+        with Session(copy.engine) as session:
+            assert session.exec(select(Song).where(Song.title == "Hymn 007 – ünïcode")).one().song_book_items[0].verses
+
+
+def test_strings_are_stored_once() -> None:
+    strings: _Strings = _Strings()
+    lyrics: list = ["Alleluia!", None, "Amen", "Alleluia!"]
+    encoding, nulls, data = encode_column(lyrics, strings)
+    assert (encoding, nulls, len(strings.index)) == ('str', True, 2)
+    assert decode_column(encoding, nulls, data, len(lyrics), list(strings.index)) == lyrics
+
+
+@pytest.mark.parametrize('values', [[3, 4, 5, 1000, -7], [None, 1, None, 2**40], [], [b'\x00', None, b''], [1.5, None, 'x', 2]])
+def test_columns(values: list) -> None:
+    strings: _Strings = _Strings()
+    encoding, nulls, data = encode_column(values, strings)
+    assert decode_column(encoding, nulls, data, len(values), list(strings.index)) == values
+
+
+def test_load_refuses(db: Dbms, tmp_path: pl.Path) -> None:
+    path: str = str(tmp_path / "library.snapshot")
+    write_snapshot(db, path)
+    with pytest.raises(SnapshotError, match="empty database"):
+        load_snapshot(db, path)
+
+    with open(path, 'rb') as snapshot:
+        data: bytes = snapshot.read()
+    (tmp_path / "not.snapshot").write_bytes(b'SQLite format 3\x00' + data)
+    with pytest.raises(SnapshotError, match="Not a snapshot"):
+        read_snapshot(str(tmp_path / "not.snapshot"))
+    (tmp_path / "short.snapshot").write_bytes(data[:-50])
+    with pytest.raises(SnapshotError, match="damaged"):
+        read_snapshot(str(tmp_path / "short.snapshot"))
+    length: int = struct.unpack('<I', data[len(MAGIC):len(MAGIC) + 4])[0]
+    newer: bytes = data[:len(MAGIC) + 4] + data[len(MAGIC) + 4:len(MAGIC) + 4 + length].replace(b'"format": 1', b'"format": 9') \
+        + data[len(MAGIC) + 4 + length:]
+    (tmp_path / "newer.snapshot").write_bytes(newer)
+    with pytest.raises(SnapshotError, match="format 9"):
+        read_snapshot(str(tmp_path / "newer.snapshot"))
@@ -0,0 +1,76 @@
+from dbms import Dbms
+
+from models import VerseType, Author, Song_Book, Song, Song_Book_Item, Verse
+import prayer_of_hannah
+from prayer_of_hannah import create_app, queries
+from prayer_of_hannah.songs.routes import buffered
+from sqlmodel import Session
+import pytest
+import pathlib as pl
+
+SONGS = 250
+
+
+@pytest.fixture
+def db(tmp_path: pl.Path, monkeypatch: pytest.MonkeyPatch) -> Dbms:
+    file: str = str(tmp_path / "songs_test.sqlite")
+    dbase = Dbms(False, 'sqlite:///' + file, file)
+    dbase.create_database_structure()
+    with dbase.write_session() as session:
+        book: Song_Book = Song_Book(code="StF", name="Singing the Faith")
+        wesley: Author = Author(surname="Wesley", first_names="Charles")
+        for n in range(SONGS):
+            item: Song_Book_Item = Song_Book_Item(
+                song_book=book, nbr=n + 1, verse_order="v1",
+                song=Song(title=f"Hymn {n:03}", authors=[wesley]))
+            session.add(Verse(type=VerseType.VERSE, number=1, lyrics=f"Lyrics of hymn {n:03}<br>line two",
+                              song_book_item=item))
+        session.commit()
+    monkeypatch.setattr(prayer_of_hannah, "__DB", dbase)
+    monkeypatch.setattr(prayer_of_hannah, "__DBE", dbase.engine)
+    return dbase
+
+
+def test_stream_songs_holds_one_chunk(db: Dbms) -> None:
+    with Session(db.engine) as session:
+        songs = queries.stream_songs(session, queries.catalog_statement(), chunk=20)
+        first: Song = next(songs)
+        assert first.title == "Hymn 000" and first.song_book_items[0].song_book.code == "StF"
+        loaded: int = sum(isinstance(o, Song) for o in session.identity_map.values())
+        assert loaded <= 20, f"{loaded} songs loaded to read the first"
+        assert [s.title for s in songs][-1] == f"Hymn {SONGS - 1:03}"
+
+
+def test_buffered() -> None:
+    assert list(buffered(iter(['ab', 'c', 'de', 'f']), size=3)) == ['abc', 'def']
+    assert list(buffered(iter(['ab', 'c', 'd']), size=3)) == ['abc', 'd']
+    assert list(buffered(iter([]))) == []
+
+
+def test_streamed_pages(db: Dbms) -> None:
+    client = create_app().test_client()
+    response = client.get('/songs/htmx/songs')
+    assert response.status_code == 200 and response.is_streamed
+    page: str = response.get_data(as_text=True)
+    assert page.count('<tr>') >= SONGS
+    assert page.index("Hymn 000") < page.index("Hymn 249"), "In title order"
+    assert "StF:250" in page and "Wesley, Charles" in page
+
+    page = client.get('/songs/htmx/search?q=hymn 01').get_data(as_text=True)
+    assert "Hymn 010" in page and "Hymn 019" in page and "Hymn 020" not in page
+
+    response = client.get('/songs/export')
+    assert response.is_streamed
+    page = response.get_data(as_text=True)
+    assert page.strip().endswith('</html>')
+    assert "Lyrics of hymn 000<br>line two" in page and "Lyrics of hymn 249" in page
+
+
+def test_export_escapes_lyrics(db: Dbms) -> None:
+    with db.write_session() as session:
+        verse: Verse | None = session.get(Verse, 1)
+        assert verse is not None
+        verse.lyrics = "<img src=x onerror=alert(1)><br>1 < 2"
+        session.commit()
+    page: str = create_app().test_client().get('/songs/export').get_data(as_text=True)
+    assert "<img" not in page and "&lt;img src=x onerror=alert(1)&gt;<br>1 &lt; 2" in page
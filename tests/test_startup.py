@@ -0,0 +1,61 @@
+import os
+import subprocess
+import sys
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# import time budgets in ms, measured with -X importtime. They are about twice what the
+# imports take on a slow machine so only a real regression (a heavy import at the top of
+# a module everything imports) fails
+ENTRY_POINTS: dict[str, tuple[str, int]] = {
+    'importer': ("import prayer_of_hannah.load_song_xml", 1000),
+    'backup': ("import prayer_of_hannah.backup", 1000),
+    'web worker': ("from prayer_of_hannah import create_app; create_app()", 1300),
+}
+# never needed by the command line tools
+WEB_MODULES = ('flask', 'werkzeug', 'jinja2', 'sqlalchemy.ext.asyncio', 'aiosqlite')
+# only imported when a process pool is started
+POOL_MODULES = ('multiprocessing', 'concurrent.futures.process')
+
+
+def import_times(code: str) -> list[tuple[str, int, int]]:
+    """(module, nesting depth, cumulative microseconds) of each import code makes in a new interpreter"""
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], cwd=ROOT, check=True,
+                            capture_output=True, text=True)
+    times: list[tuple[str, int, int]] = []
+    for line in result.stderr.splitlines():
+        fields: list[str] = line.removeprefix('import time:').split('|')
+        if len(fields) == 3 and fields[1].strip().isdigit():
+            name: str = fields[2].rstrip()
+            times.append((name.strip(), (len(name) - len(name.lstrip()) - 1) // 2, int(fields[1])))
+    return times
+
+
+def imported(code: str) -> set[str]:
+    return {name for name, _, _ in import_times(code)}
+
+
+def total_ms(code: str) -> float:
+    """The time taken by code's imports, the best of three runs"""
+    return min(sum(us for _, depth, us in import_times(code) if depth == 0) for _ in range(3)) / 1000
+
+
+@pytest.mark.parametrize('entry_point', ['importer', 'backup'])
+def test_command_line_tools_skip_the_web_stack(entry_point: str) -> None:
+    modules: set[str] = imported(ENTRY_POINTS[entry_point][0])
+    assert 'prayer_of_hannah.dbms' in modules
+    assert [m for m in WEB_MODULES if m in modules] == []
+
+
+def test_web_worker_skips_process_pools() -> None:
+    modules: set[str] = imported(ENTRY_POINTS['web worker'][0])
+    assert 'flask' in modules
+    assert [m for m in POOL_MODULES if m in modules] == []
+
+
+@pytest.mark.parametrize('entry_point', list(ENTRY_POINTS))
+def test_cold_start_budget(entry_point: str) -> None:
+    code, budget = ENTRY_POINTS[entry_point]
+    took: float = total_ms(code)
+    assert took < budget, f"{entry_point} imports take {took:.0f} ms, over the {budget} ms budget"
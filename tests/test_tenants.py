@@ -0,0 +1,161 @@
+from dbms import Dbms
+
+from models import Song, Song_Book
+import prayer_of_hannah
+from config import Config
+from prayer_of_hannah import create_app, get_db, get_dbe
+from prayer_of_hannah.asgi import AsgiApp
+from prayer_of_hannah.live_worship.slides import SlideCache, slide_cache
+from prayer_of_hannah.lru import LruCache
+from prayer_of_hannah.media.pipeline import Job, MediaPipeline, media_pipeline
+from prayer_of_hannah.services.decks import bundle_cache
+from prayer_of_hannah.tenants import Tenants, UnknownTenant, current_tenant
+from test_asgi import call
+import pytest
+import pathlib as pl
+
+
+def add_tenant(tenants: Tenants, name: str, book: str) -> None:
+    tenants.create(name)
+    file: str = tenants.database_file(name)
+    db = Dbms(False, 'sqlite:///' + file, file)
+    with db.write_session() as session:
+        session.add(Song_Book(code=book, name=f"{book} hymnal"))
+        session.add(Song(title=f"The {name} song", authors=[]))
+        session.commit()
+    db.close()
+
+
+@pytest.fixture
+def tenants(tmp_path: pl.Path) -> Tenants:
+    found = Tenants(str(tmp_path / "tenants"), max_open=2, routing='path')
+    for name, book in (('stf', 'StF'), ('hp', 'H+P'), ('mp', 'MP')):
+        add_tenant(found, name, book)
+    yield found
+    found.close()
+
+
+def tenant_app(tmp_path: pl.Path, routing: str):
+    settings = type('TenantConfig', (Config,), {'TENANT_ROUTING': routing, 'TENANT_DIR': str(tmp_path / "tenants"),
+                                               'TENANT_DOMAIN': 'example.org', 'TEMPLATE_CACHE_DIR': ''})
+    return create_app(settings)
+
+
+def test_path_routing(tenants: Tenants, tmp_path: pl.Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    # the app's one database is never opened
+    monkeypatch.setattr(prayer_of_hannah, "__DB", None)
+    app = tenant_app(tmp_path, 'path')
+    client = app.test_client()
+    with client.get('/t/stf/') as response:
+        assert response.status_code == 200
+        assert 'StF hymnal' in response.get_data(as_text=True) and 'H+P' not in response.get_data(as_text=True)
+    with client.get('/t/hp/songs/') as response:
+        # links stay in the tenant
+        assert 'href="/t/hp/songs/export"' in response.get_data(as_text=True)
+    # streamed, the rows are read as the response is sent
+    with client.get('/t/hp/songs/htmx/songs') as response:
+        assert response.is_streamed and 'The hp song' in response.get_data(as_text=True)
+    for path in ('/', '/songs/', '/t/nowhere/', '/t/Not_A_Name/'):
+        with client.get(path) as response:
+            assert response.status_code == 404, path
+    assert getattr(prayer_of_hannah, "__DB") is None
+    opened: Tenants = app.extensions['tenants']
+    assert 'stf' in opened and 'hp' in opened and current_tenant() is None
+    for name in ('stf', 'hp'):
+        tenant = opened.acquire(name)
+        assert tenant.active == 1, "Every response released its tenant"
+        opened.release(tenant)
+    opened.close()
+
+
+def test_subdomain_routing(tenants: Tenants, tmp_path: pl.Path) -> None:
+    app = tenant_app(tmp_path, 'subdomain')
+    client = app.test_client()
+    with client.get('/', headers={'Host': 'mp.example.org'}) as response:
+        assert 'MP hymnal' in response.get_data(as_text=True)
+    with client.get('/', headers={'Host': 'example.org'}) as response:
+        assert response.status_code == 404
+
+    # the native ASGI routes find the tenant too
+    asgi = AsgiApp(app)
+    status, body, _ = call(asgi, '/media/' + 'ab' * 32)
+    assert (status, body) == (404, b'No such congregation')
+    app.extensions['tenants'].close()
+
+
+def test_least_recently_used_idle_tenant_closed(tenants: Tenants) -> None:
+    with tenants.activate('stf') as stf:
+        assert get_db() is stf.db and get_dbe() is stf.db.engine
+        with tenants.activate('hp'):
+            pass
+        with tenants.activate('mp'):
+            # stf is busy, so the idle hp is closed
+            assert len(tenants) == 2 and 'hp' not in tenants
+            with tenants.activate('hp'):
+                # none are idle, so the worker goes over max_open until one is
+                assert len(tenants) == 3
+            assert len(tenants) == 2
+    with tenants.activate('hp'):
+        assert len(tenants) == 2 and 'stf' not in tenants and 'mp' in tenants
+    # closed: maintenance stopped and no pooled connections left
+    assert stf.db.maintenance._thread is None
+    assert stf.db.engine.pool.checkedin() == 0
+    with pytest.raises(UnknownTenant):
+        tenants.acquire('nowhere')
+    with pytest.raises(UnknownTenant):
+        tenants.acquire('../stf')
+
+
+def test_caches_per_tenant(tenants: Tenants) -> None:
+    worker: SlideCache = slide_cache()
+    with tenants.activate('stf') as stf:
+        stf_slides: SlideCache = slide_cache()
+        stf_slides.put(('deck', 0, 'projector'), '<p>stf</p>')
+        assert media_pipeline().db is stf.db
+    with tenants.activate('hp'):
+        assert slide_cache() is not stf_slides and slide_cache() is not worker
+        assert slide_cache().get(('deck', 0, 'projector')) is None
+    assert len(worker) == 0 or worker.get(('deck', 0, 'projector')) is None
+
+    # each cache gets its share of the tenant's memory
+    with tenants.activate('mp') as mp:
+        assert slide_cache().max_bytes == mp.cache_budget('slides') > 0
+        assert bundle_cache().max_bytes == mp.cache_budget('bundles') > 0
+
+
+def test_close_shuts_down_media_jobs(tenants: Tenants) -> None:
+    with tenants.activate('stf') as stf:
+        pipeline: MediaPipeline = media_pipeline()
+        pipeline.jobs = {1: Job(1, 1, 1, done=1)}
+    stf.close()
+    assert not pipeline.jobs
+    assert media_pipeline() is not pipeline, "Outside the tenant"
+
+
+def test_each_tenant_prewarmed(tenants: Tenants) -> None:
+    tenants.prewarm_app = create_app()
+    with tenants.activate('stf') as stf:
+        prewarmer = stf.prewarmer
+        assert prewarmer is not None and prewarmer.is_alive()
+        assert prewarmer.db is stf.db and prewarmer.cache is slide_cache(), "The tenant's database and slides"
+    assert prewarmer._context.run(current_tenant) is stf, "Its checks run in the tenant"
+    stf.close()
+    prewarmer.join(timeout=5)
+    assert not prewarmer.is_alive()
+
+
+def test_memory_capped_caches() -> None:
+    slides: SlideCache = SlideCache(max_bytes=100)
+    slides.pin(1, 'deck', [('deck', 0, 'projector')])
+    slides.put_many({('deck', i, 'projector'): 'x' * 30 for i in range(5)})
+    # the pinned slide stays, the oldest others go until the rest fit
+    assert slides.is_pinned(('deck', 0, 'projector')) and slides.get(('deck', 0, 'projector'))
+    assert len(slides) == 3 and slides.bytes == 90
+    assert slides.get(('deck', 1, 'projector')) is None and slides.get(('deck', 4, 'projector'))
+
+    cache: LruCache[str, bytes] = LruCache(10, max_bytes=10)
+    for key in 'abc':
+        cache.put(key, b'1234')
+    assert (len(cache), cache.bytes, cache.get('a')) == (2, 8, None)
+    cache.put('big', b'x' * 11)
+    assert cache.get('big') is None and cache.bytes <= 10
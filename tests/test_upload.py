@@ -0,0 +1,190 @@
+from dbms import Dbms
+
+from models import MediaType, Song_Book, Song, Song_Book_Item, Media
+import prayer_of_hannah
+from prayer_of_hannah import create_app
+from prayer_of_hannah.media import store
+from prayer_of_hannah.media.upload import Uploads, UploadConflict
+from config import Config
+from sqlmodel import Session
+import fcntl
+import hashlib
+import io
+import os
+import tracemalloc
+import pytest
+import pathlib as pl
+
+RECORDING: bytes = bytes(range(256)) * 1000
+
+
+class Zeros(io.RawIOBase):
+    """A request body of length zero bytes that is never in memory"""
+    def __init__(self, length: int) -> None:
+        self.left = length
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        length: int = min(len(buffer), self.left)
+        buffer[:length] = bytes(length)
+        self.left -= length
+        return length
+
+
+@pytest.fixture
+def db(tmp_path: pl.Path, monkeypatch: pytest.MonkeyPatch) -> Dbms:
+    file: str = str(tmp_path / "upload_test.sqlite")
+    dbase = Dbms(False, 'sqlite:///' + file, file)
+    dbase.create_database_structure()
+    with dbase.write_session() as session:
+        session.add(Song_Book_Item(song_book=Song_Book(code="StF", name="Singing the Faith"),
+                                   song=Song(title="And Can It Be", authors=[]), nbr=345, verse_order=""))
+        session.commit()
+    monkeypatch.setattr(prayer_of_hannah, "__DB", dbase)
+    monkeypatch.setattr(prayer_of_hannah, "__DBE", dbase.engine)
+    monkeypatch.setattr(Config, "MEDIA_DIR", str(tmp_path / "media"))
+    return dbase
+
+
+def left_over(directory: str) -> list[str]:
+    return [f for _, _, files in os.walk(directory) for f in files if f.startswith('.')]
+
+
+def test_chunked_upload(db: Dbms) -> None:
+    client = create_app().test_client()
+    response = client.post("/media/uploads", json={'song_book_item_id': 1, 'type': 'AS', 'size': len(RECORDING),
+                                                   'file_name': "sagina.mp3", 'tune': "Sagina"})
+    assert response.status_code == 201
+    upload_id: str = response.json['id']
+    url: str = response.headers['Location']
+
+    response = client.patch(url, data=RECORDING[:100000], headers={'Upload-Offset': '0'})
+    assert response.json['offset'] == 100000 and not response.json['complete']
+    # a repeated chunk whose response was lost
+    response = client.patch(url, data=RECORDING[:100000], headers={'Upload-Offset': '0'})
+    assert response.status_code == 409 and response.json['offset'] == 100000
+    assert client.get(url).headers['Upload-Offset'] == '100000'
+    assert client.patch(url, data=b'').status_code == 400, "The offset is needed"
+
+    response = client.patch(url, data=RECORDING[100000:], headers={'Upload-Offset': '100000'})
+    assert response.status_code == 200 and response.json['complete']
+    assert 'job' not in response.json, "Audio has no variants"
+    content_hash: str = hashlib.sha256(RECORDING).hexdigest()
+    assert response.json['url'] == f"/media/{content_hash}"
+    assert client.get(response.json['url']).data == RECORDING
+    with Session(db.engine) as session:
+        media: Media = session.get(Media, response.json['media_id'])
+        assert (media.content_hash, media.size, media.tune, media.mime_type) == \
+            (content_hash, len(RECORDING), "Sagina", "audio/mpeg")
+    assert left_over(store.media_dir()) == [], f"The partial file of {upload_id} became the stored file"
+
+
+def test_bad_uploads(db: Dbms) -> None:
+    client = create_app().test_client()
+    assert client.post("/media/uploads", json={'song_book_item_id': 9, 'type': 'A', 'size': 1}).status_code == 404
+    assert client.post("/media/uploads", json={'song_book_item_id': 1, 'type': 'X', 'size': 1}).status_code == 400
+    assert client.post("/media/uploads", json={'song_book_item_id': 1, 'type': 'A'}).status_code == 400
+    assert client.patch("/media/uploads/abc", data=b'x', headers={'Upload-Offset': '0'}).status_code == 404
+
+    url: str = client.post("/media/uploads", json={'song_book_item_id': 1, 'type': 'A', 'size': 10}).headers['Location']
+    assert client.patch(url, data=bytes(11), headers={'Upload-Offset': '0'}).status_code == 400, "More than its size"
+
+    url = client.post("/media/uploads", json={'song_book_item_id': 1, 'type': 'A', 'size': 10,
+                                              'content_hash': '0' * 64}).headers['Location']
+    assert client.patch(url, data=bytes(10), headers={'Upload-Offset': '0'}).status_code == 400, "Not the declared hash"
+    assert client.get(url).status_code == 404, "The upload is dropped"
+    assert client.delete(client.post("/media/uploads", json={'song_book_item_id': 1, 'type': 'A', 'size': 10})
+                         .headers['Location']).status_code == 204
+    assert len(left_over(store.media_dir())) == 2, "Only the oversized upload is still open"
+
+
+def test_resume_after_restart(db: Dbms) -> None:
+    upload = Uploads(db).start(1, MediaType.AUDIO, len(RECORDING), "sagina.mp3")
+    Uploads(db).write(upload.id, 0, io.BytesIO(RECORDING[:3000]))
+
+    restarted: Uploads = Uploads(db)
+    assert restarted.get(upload.id).offset == 3000
+    with pytest.raises(UploadConflict):
+        restarted.write(upload.id, 0, io.BytesIO(RECORDING))
+    done = restarted.write(upload.id, 3000, io.BytesIO(RECORDING[3000:]))
+    assert done.complete
+    with Session(db.engine) as session:
+        assert session.get(Media, done.media_id).content_hash == hashlib.sha256(RECORDING).hexdigest()
+
+
+def test_deduplicated_before_the_transfer_ends(db: Dbms) -> None:
+    uploads: Uploads = Uploads(db)
+    content_hash: str = hashlib.sha256(RECORDING).hexdigest()
+    first = uploads.start(1, MediaType.AUDIO, len(RECORDING), content_hash=content_hash)
+    second = uploads.start(1, MediaType.AUDIO_WITH_SINGING, len(RECORDING), content_hash=content_hash)
+    uploads.write(second.id, 0, io.BytesIO(RECORDING[:1000]))
+    assert uploads.write(first.id, 0, io.BytesIO(RECORDING)).complete
+
+    # the rest of the second isn't needed
+    assert uploads.write(second.id, 1000, io.BytesIO(RECORDING[1000:2000])).complete
+    assert uploads.start(1, MediaType.AUDIO, len(RECORDING), content_hash=content_hash).complete, \
+        "An upload of stored content is complete before it starts"
+    stored: list[str] = [f for _, _, files in os.walk(store.media_dir()) for f in files]
+    assert stored == [content_hash]
+
+
+def test_memory_is_bounded(db: Dbms) -> None:
+    size: int = 64 * store.CHUNK_SIZE
+    uploads: Uploads = Uploads(db)
+    upload = uploads.start(1, MediaType.VIDEO, size)
+    tracemalloc.start()
+    try:
+        upload = uploads.write(upload.id, 0, Zeros(size // 2))
+        upload = uploads.write(upload.id, size // 2, Zeros(size // 2))
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    assert upload.complete
+    assert peak < 4 * store.CHUNK_SIZE, f"{peak} bytes used for a {size} byte upload"
+    assert os.path.getsize(store.media_path(hashlib.sha256(bytes(size)).hexdigest())) == size
+
+
+def test_another_tenants_file_needs_its_bytes(db: Dbms) -> None:
+    # stored for another tenant, this one has no media with the hash
+    content_hash, size = store.store_stream(io.BytesIO(RECORDING))
+    uploads: Uploads = Uploads(db)
+    upload = uploads.start(1, MediaType.AUDIO, 10, content_hash=content_hash)
+    assert not upload.complete, "Knowing the hash isn't enough"
+    with pytest.raises(store.MediaError):
+        uploads.write(upload.id, 0, io.BytesIO(bytes(10)))
+
+    upload = uploads.start(1, MediaType.AUDIO, size, content_hash=content_hash)
+    done = uploads.write(upload.id, 0, io.BytesIO(RECORDING))
+    assert done.complete
+    # now the tenant has it, another upload of it needn't send it
+    known = uploads.start(1, MediaType.AUDIO, 10, content_hash=content_hash)
+    assert known.complete
+    with Session(db.engine) as session:
+        assert session.get(Media, known.media_id).size == len(RECORDING), "The stored file's size, not the declared one"
+    assert left_over(store.media_dir()) == []
+
+
+def test_worker_processes_share_an_upload(db: Dbms) -> None:
+    first, second = Uploads(db), Uploads(db)
+    upload = first.start(1, MediaType.AUDIO, len(RECORDING))
+    first.write(upload.id, 0, io.BytesIO(RECORDING[:1000]))
+    # the next chunk goes to the other worker, which takes the offset from the file
+    assert second.get(upload.id).offset == 1000
+    second.write(upload.id, 1000, io.BytesIO(RECORDING[1000:5000]))
+    assert first.get(upload.id).offset == 5000
+    with pytest.raises(UploadConflict):
+        first.write(upload.id, 1000, io.BytesIO(RECORDING[1000:]))
+
+    # a request in one process holds the partial file's lock
+    with open(os.path.join(store.media_dir(), '.upload-' + upload.id), 'rb') as partial:
+        fcntl.flock(partial, fcntl.LOCK_EX)
+        with pytest.raises(UploadConflict):
+            second.write(upload.id, 5000, io.BytesIO(RECORDING[5000:]))
+    done = first.write(upload.id, 5000, io.BytesIO(RECORDING[5000:]))
+    assert done.complete
+    with Session(db.engine) as session:
+        assert session.get(Media, done.media_id).content_hash == hashlib.sha256(RECORDING).hexdigest()
+    with pytest.raises(LookupError):
+        second.get(upload.id)
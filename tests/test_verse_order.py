@@ -0,0 +1,148 @@
+from dbms import Dbms
+
+from models import VerseType, Song_Book, Song, Song_Book_Item, Verse, Service, Service_Item
+from prayer_of_hannah.load_song_xml import load_song
+from prayer_of_hannah.services.decks import build_deck, service_statement
+from prayer_of_hannah.verse_order import (VerseOrderError, parse_verse_order, compile_verse_order, check_verse_order,
+                                          verse_index, verse_sequence)
+from sqlmodel import Session, select
+import pytest
+import pathlib as pl
+
+
+@pytest.fixture
+def db() -> Dbms:
+    dbase = Dbms(True)
+    dbase.create_database_structure()
+    return dbase
+
+
+def add_item(db: Dbms, verse_order: str, codes: list[tuple[VerseType, int]]) -> int:
+    with db.write_session() as session:
+        item: Song_Book_Item = Song_Book_Item(song_book=Song_Book(code="StF", name="Singing the Faith"),
+                                              song=Song(title="And Can It Be", authors=[]), nbr=345, verse_order=verse_order)
+        session.add_all([Verse(type=t, number=n, lyrics=f"{t}{n}", song_book_item=item) for t, n in codes])
+        session.commit()
+        assert item.id is not None
+        return item.id
+
+
+def test_parse() -> None:
+    assert parse_verse_order("V1 c1  b1 v10") == (('v', 1, ''), ('c', 1, ''), ('b', 1, ''), ('v', 10, ''))
+    assert parse_verse_order("o1 v1") == (('v', 1, ''),), "Other (o) verses are not imported so are skipped"
+    assert parse_verse_order("v1a v1b c") == (('v', 1, 'a'), ('v', 1, 'b'), ('c', 1, '')), "OpenLyrics parts"
+    assert parse_verse_order("") == ()
+    for bad in ("x1", "v1c1", "1v", "v1ab"):
+        with pytest.raises(VerseOrderError):
+            parse_verse_order(bad)
+    assert parse_verse_order("v1 x1 v1c1 c", strict=False) == (('v', 1, ''), ('c', 1, ''))
+
+
+def test_compile_and_check() -> None:
+    class V:
+        def __init__(self, type: str, number: int, id: int, part: str = '') -> None:
+            self.type, self.number, self.id, self.part = type, number, id, part
+
+    verses: list[V] = [V('v', 1, 10), V('c', 1, 11), V('v', 2, 12)]
+    index = verse_index(verses)
+    assert compile_verse_order("v1 c1 v2 c1", index) == (10, 11, 12, 11)
+    assert compile_verse_order("", index) == (10, 11, 12), "No verse order shows every verse once"
+    assert compile_verse_order("v1 v3 c1", index) == (10, 11), "Missing verses are left out"
+    assert check_verse_order("v1 c1 v2", verses) == []
+    assert check_verse_order("v1 v3 v3", verses) == ["No verse v3 for verse order 'v1 v3 v3'"]
+    assert len(check_verse_order("v1 z1", verses)) == 1
+    # a bad code doesn't stop the rest being shown
+    assert compile_verse_order("v1 z1 v1c1 c1", index) == (10, 11)
+
+    parts: list[V] = [V('v', 1, 20, 'a'), V('v', 1, 21, 'b'), V('c', 1, 22)]
+    assert compile_verse_order("v1b c v1a", verse_index(parts)) == (21, 22, 20)
+    assert compile_verse_order("v1 c", verse_index(parts)) == (20, 21, 22), "v1 shows both its parts"
+    assert check_verse_order("v1a v1b v1 c1", parts) == [] and len(check_verse_order("v1c", parts)) == 1
+
+
+def test_compiled_form_kept_in_step(db: Dbms) -> None:
+    item_id: int = add_item(db, "v1 c1 v2 c1", [(VerseType.VERSE, 1), (VerseType.CHORUS, 1)])
+    with db.write_session() as session:
+        item: Song_Book_Item | None = session.get(Song_Book_Item, item_id)
+        assert item is not None
+        assert item.verse_order_ids == "1,2,2", "v2 has not been added yet"
+
+        session.add(Verse(type=VerseType.VERSE, number=2, lyrics="v2", song_book_item=item))
+        session.commit()
+        assert item.verse_order_ids == "1,2,3,2", "Adding a verse should recompile"
+
+        item.verse_order = "v2 c1"
+        session.commit()
+        assert item.verse_order_ids == "3,2", "Changing the verse order should recompile"
+
+    with Session(db.engine) as session:
+        stored: str | None = session.exec(select(Song_Book_Item.verse_order_ids)).first()
+        assert stored == "3,2"
+
+
+def test_override_is_memoised(db: Dbms) -> None:
+    item_id: int = add_item(db, "v1 c1 v2 c1", [(VerseType.VERSE, 1), (VerseType.CHORUS, 1), (VerseType.VERSE, 2)])
+    with Session(db.engine) as session:
+        item: Song_Book_Item | None = session.get(Song_Book_Item, item_id)
+        assert item is not None
+        assert verse_sequence(item) == (1, 2, 3, 2)
+        assert verse_sequence(item, "v1 c1") == (1, 2), "Service override skips verse 2"
+        hits: int = compile_verse_order.cache_info().hits
+        assert verse_sequence(item, "v1 c1") == (1, 2)
+        assert compile_verse_order.cache_info().hits == hits + 1, "Same override should come from the memo"
+
+
+def test_imported_verse_parts(tmp_path: pl.Path) -> None:
+    file: str = str(tmp_path / "parts_test.sqlite")
+    dbase = Dbms(False, 'sqlite:///' + file, file)
+    dbase.create_database_structure()
+    load_song(dbase, """<?xml version='1.0' encoding='UTF-8'?>
+<song xmlns="http://openlyrics.info/namespace/2009/song" version="0.9">
+<properties><titles><title>In Christ Alone</title></titles><verseOrder>v1a v1b c</verseOrder>
+<songbooks><songbook name="StF" entry="351"/></songbooks></properties>
+<lyrics>
+<verse name="v1a">In Christ alone my hope is found
+He is my light, my strength, my song</verse>
+<verse name="v1b">This Cornerstone, this solid ground
+Firm through the fiercest drought and storm</verse>
+<verse name="c">Here in the love of Christ I stand</verse>
+</lyrics></song>""")
+    with dbase.write_session() as session:
+        item: Song_Book_Item | None = session.exec(select(Song_Book_Item)).first()
+        assert item is not None
+        session.add(Service_Item(service=Service(name="Sunday"), position=1, song_book_item=item, verse_order="v1 q9"))
+        session.add(Service(name="Evening", items=[Service_Item(position=1, song_book_item=item)]))
+        session.commit()
+        deck: dict = build_deck(session.exec(service_statement(2)).one())
+    assert [s['verse'] for s in deck['slides']] == ['v1a', 'v1b', 'c1']
+    assert deck['slides'][1]['lines'] == ["This Cornerstone, this solid ground", "Firm through the fiercest drought and storm"]
+
+    with dbase.write_session() as session:
+        deck = build_deck(session.exec(service_statement(1)).one())
+    assert [s['verse'] for s in deck['slides']] == ['v1a', 'v1b'], "A bad override code is left out"
+    dbase.close()
+
+
+def test_existing_database_gets_parts(tmp_path: pl.Path) -> None:
+    file: str = str(tmp_path / "old_schema.sqlite")
+    dbase = Dbms(False, 'sqlite:///' + file, file)
+    dbase.create_database_structure()
+    add_item(dbase, "v1", [(VerseType.VERSE, 1)])
+    # as a database made before verses had parts
+    with dbase.write_engine.begin() as conn:
+        conn.exec_driver_sql('DROP INDEX compound_index_verse_part')
+        conn.exec_driver_sql('ALTER TABLE verse DROP COLUMN part')
+        conn.exec_driver_sql('CREATE UNIQUE INDEX compound_index_verse ON verse (song_book_item_id, type, number)')
+    dbase.close()
+
+    dbase = Dbms(False, 'sqlite:///' + file, file)
+    dbase.create_database_structure()
+    with dbase.write_session() as session:
+        verse: Verse | None = session.get(Verse, 1)
+        assert verse is not None and verse.part == ''
+        session.add(Verse(type=VerseType.VERSE, number=1, part='b', lyrics="v1b", song_book_item_id=1))
+        session.commit()
+    with Session(dbase.engine) as session:
+        item: Song_Book_Item | None = session.get(Song_Book_Item, 1)
+        assert item is not None and verse_sequence(item, "v1b v1") == (2, 1)
+    dbase.close()